@@ -0,0 +1,243 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Pool allocator backend for the interpreted CPython.
+
+Interpreting obmalloc.c means that every small allocation runs the pool and
+arena bookkeeping line by line. This backend replaces the allocator entry
+points (PyMem_Raw*, PyMem_*, PyObject_*) by Python-native code:
+
+* We mmap large arenas and carve them into pools of PoolSize bytes.
+  Every pool serves one size class (multiples of Alignment, up to
+  SmallRequestThreshold), like obmalloc does.
+* Allocation takes a block from the free list of its size class, or
+  bumps the pointer in the current pool of that class.
+* Free finds the size class of a block via its pool (pools are aligned)
+  and puts the block on the free list. Memory is never returned to the OS.
+* Larger requests, and all blocks which are not in our arenas (e.g. from
+  before the backend was installed), go to the libc malloc.
+
+cpython.py selects the backend with --allocator, where "c" interprets obmalloc.c as-is.
+"""
+
+from __future__ import print_function
+
+import bisect
+import ctypes
+import mmap
+
+import native_bindings
+from overrides import get_address, get_int
+
+Alignment = 16
+SmallRequestThreshold = 512
+NumSizeClasses = SmallRequestThreshold // Alignment
+PoolSize = 16 * 1024
+ArenaSize = 4 * 1024 * 1024
+assert ArenaSize % PoolSize == 0 and PoolSize % mmap.PAGESIZE == 0
+
+
+class PoolAllocator:
+
+    def __init__(self):
+        self._arenas = []  # type: list[mmap.mmap]  # sorted by address. this also keeps them alive
+        self._arena_starts = []  # type: list[int]  # same order
+        self._arena_ends = []  # type: list[int]  # same order
+        self._next_pool = 0  # address of the next unused pool in the current arena
+        self._arena_end = 0
+        self._pool_classes = {}  # type: dict[int,int]  # pool address -> size class index
+        self._free_lists = [[] for _ in range(NumSizeClasses)]  # type: list[list[int]]
+        self._bump = [0] * NumSizeClasses  # next free address in the current pool of the class
+        self._bump_end = [0] * NumSizeClasses
+        self.num_allocs = 0
+        self.num_frees = 0
+        self.num_large_allocs = 0
+        p, size = ctypes.c_void_p, ctypes.c_size_t
+        self._libc_malloc = native_bindings.bind_symbol("malloc", p, (size,))
+        self._libc_calloc = native_bindings.bind_symbol("calloc", p, (size, size))
+        self._libc_realloc = native_bindings.bind_symbol("realloc", p, (p, size))
+        self._libc_free = native_bindings.bind_symbol("free", None, (p,))
+
+    def _map_region(self, size):
+        """
+        :param int size: multiple of the page size
+        :return: start address of the new mapping, which counts as one of our arenas
+        :rtype: int
+        """
+        arena = mmap.mmap(-1, size)
+        start = ctypes.addressof(ctypes.c_char.from_buffer(arena))
+        index = bisect.bisect(self._arena_starts, start)
+        self._arenas.insert(index, arena)
+        self._arena_starts.insert(index, start)
+        self._arena_ends.insert(index, start + size)
+        return start
+
+    def _unmap_region(self, start):
+        """
+        :param int start: from _map_region(). the memory is gone afterwards
+        """
+        index = bisect.bisect(self._arena_starts, start) - 1
+        assert index >= 0 and self._arena_starts[index] == start
+        self._arenas[index].close()
+        del self._arenas[index], self._arena_starts[index], self._arena_ends[index]
+
+    def _new_arena(self):
+        # mmap gives us page alignment. Allocate one more pool to align the pools.
+        start = self._map_region(ArenaSize + PoolSize)
+        self._next_pool = (start + PoolSize - 1) & ~(PoolSize - 1)
+        self._arena_end = self._next_pool + ArenaSize
+
+    def _new_pool(self, class_index):
+        if self._next_pool + PoolSize > self._arena_end:
+            self._new_arena()
+        pool = self._next_pool
+        self._next_pool += PoolSize
+        self._pool_classes[pool] = class_index
+        self._bump[class_index] = pool
+        self._bump_end[class_index] = pool + PoolSize
+
+    def is_own(self, addr):
+        """
+        :param int addr:
+        :return: whether the address is in one of our arenas
+        :rtype: bool
+        """
+        index = bisect.bisect(self._arena_starts, addr) - 1
+        return index >= 0 and addr < self._arena_ends[index]
+
+    def get_block_size(self, addr):
+        """
+        :param int addr: from malloc()
+        :return: usable size of the block, or None if it is not one of our blocks
+        :rtype: int|None
+        """
+        class_index = self._pool_classes.get(addr & ~(PoolSize - 1))
+        if class_index is None:
+            return None
+        return (class_index + 1) * Alignment
+
+    def malloc(self, size):
+        """
+        :param int size:
+        :return: address, 0 if we are out of memory
+        :rtype: int
+        """
+        self.num_allocs += 1
+        if size > SmallRequestThreshold:
+            self.num_large_allocs += 1
+            return self._libc_malloc(size) or 0
+        class_index = (size - 1) // Alignment if size else 0
+        free_list = self._free_lists[class_index]
+        if free_list:
+            return free_list.pop()
+        addr = self._bump[class_index]
+        block_size = (class_index + 1) * Alignment
+        if addr + block_size > self._bump_end[class_index]:
+            self._new_pool(class_index)
+            addr = self._bump[class_index]
+        self._bump[class_index] = addr + block_size
+        return addr
+
+    def calloc(self, nelem, elsize):
+        """
+        :param int nelem:
+        :param int elsize:
+        :rtype: int
+        """
+        size = nelem * elsize
+        if size > SmallRequestThreshold:
+            self.num_allocs += 1
+            self.num_large_allocs += 1
+            return self._libc_calloc(nelem, elsize) or 0
+        addr = self.malloc(size)
+        if addr:
+            ctypes.memset(addr, 0, size)
+        return addr
+
+    def realloc(self, addr, size):
+        """
+        :param int addr: 0 or from malloc()
+        :param int size:
+        :rtype: int
+        """
+        if not addr:
+            return self.malloc(size)
+        old_size = self.get_block_size(addr)
+        if old_size is None:
+            if self.is_own(addr):
+                raise ValueError("realloc of invalid address 0x%x" % addr)
+            return self._libc_realloc(addr, size or 1) or 0
+        if size <= old_size and (size > old_size - Alignment or size <= Alignment):
+            return addr  # same size class
+        new_addr = self.malloc(size)
+        if new_addr:
+            ctypes.memmove(new_addr, addr, min(size, old_size))
+            self.free(addr)
+        return new_addr
+
+    def free(self, addr):
+        """
+        :param int addr: 0 or from malloc()
+        """
+        if not addr:
+            return
+        self.num_frees += 1
+        class_index = self._pool_classes.get(addr & ~(PoolSize - 1))
+        if class_index is None:
+            if self.is_own(addr):
+                raise ValueError("free of invalid address 0x%x" % addr)
+            self._libc_free(addr)
+            return
+        self._free_lists[class_index].append(addr)
+
+
+# entry point -> PoolAllocator method
+EntryPoints = {}
+for _family in ["PyMem_Raw", "PyMem_", "PyObject_"]:
+    for _op in ["Malloc", "Calloc", "Realloc", "Free"]:
+        EntryPoints[_family + _op] = _op.lower()
+del _family, _op
+
+
+def install(interpreter, state, pool_allocator=None):
+    """
+    :param cparser.interpreter.Interpreter interpreter: after interpreter.register(state)
+    :param cparser.State state:
+    :param PoolAllocator|None pool_allocator:
+    :return: the allocator
+    :rtype: PoolAllocator
+    """
+    if pool_allocator is None:
+        pool_allocator = PoolAllocator()
+    for name, op in sorted(EntryPoints.items()):
+        if name not in state.funcs:
+            continue
+        interpreter._func_cache[name] = _make_entry_point(interpreter, state, name, getattr(pool_allocator, op))
+    return pool_allocator
+
+
+def _make_entry_point(interpreter, state, name, method):
+    res_type = state.funcs[name].type
+    ptr_ctype = interpreter.getCType(res_type) if name.endswith("alloc") else None
+
+    def make_ptr(addr):
+        return ctypes.cast(ctypes.c_void_p(addr), ptr_ctype)
+
+    if name.endswith("Malloc"):
+        def entry_point(size):
+            return make_ptr(method(get_int(size)))
+    elif name.endswith("Calloc"):
+        def entry_point(nelem, elsize):
+            return make_ptr(method(get_int(nelem), get_int(elsize)))
+    elif name.endswith("Realloc"):
+        def entry_point(ptr, size):
+            return make_ptr(method(get_address(ptr), get_int(size)))
+    else:
+        def entry_point(ptr):
+            method(get_address(ptr))
+
+    entry_point.__name__ = name
+    entry_point.C_argTypes = None
+    entry_point.C_resType = res_type
+    return entry_point
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Interpreted bytecode throughput of ceval.c, with and without the switch dispatch lowering
+and the unboxed locals.
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+
+import benchlib
+
+# The function with the opcode switch.
+CevalFunc = "_PyEval_EvalFrameDefault"
+
+# Mostly simple opcodes: loads, stores, arithmetic, compares, jumps.
+BenchCode = """
+i = 0
+x = 0
+while i < %i:
+    x = (x + i * 3) %% 1000
+    i += 1
+"""
+
+
+def _run_variant(args, lower, unbox):
+    """
+    In a forked process, as each variant needs its own interpreter and translations.
+
+    :param argparse.Namespace args:
+    :param bool lower: whether to install switch_dispatch
+    :param bool unbox: whether to install unboxing
+    :return: best time in seconds, number of lowered chains and of unboxed locals per translated function
+    :rtype: (float,dict[str,int],dict[str,int])
+    """
+    import switch_dispatch
+    import unboxing
+    state = benchlib.load_cpython_state()
+    interpreter = benchlib.make_interpreter(state)
+    # Like cpython.py: the switch lowering runs after the unboxing.
+    unboxing_pass = unboxing.install(interpreter) if unbox else None
+    lowering = switch_dispatch.install(interpreter) if lower else None
+    interpreter.runFunc("Py_InitializeEx", 0)
+    code = BenchCode % args.iterations
+    interpreter.runFunc("PyRun_SimpleString", code)  # translates the functions
+    duration, _ = benchlib.timed(lambda: interpreter.runFunc("PyRun_SimpleString", code), repeat=args.repeat)
+    return (
+        duration, lowering.num_lowered_by_func if lowering else {},
+        unboxing_pass.num_unboxed_by_func if unboxing_pass else {})
+
+
+def run(args):
+    """
+    :param argparse.Namespace args:
+    :rtype: benchlib.Results
+    """
+    results = benchlib.Results("ceval")
+    ctx = multiprocessing.get_context("fork")
+    for variant, lower, unbox in [("plain", False, False), ("switch", True, False), ("unboxed", True, True)]:
+        with ctx.Pool(1) as pool:
+            duration, num_lowered_by_func, num_unboxed_by_func = pool.apply(_run_variant, (args, lower, unbox))
+        if lower:
+            for func_name, num_lowered in sorted(num_lowered_by_func.items()):
+                print("Lowered %i switches in %s." % (num_lowered, func_name))
+            num_lowered = sum(num for (func_name, num) in num_lowered_by_func.items() if CevalFunc in func_name)
+            # Otherwise we would only measure the noise.
+            assert num_lowered > 0, "the switch of %s was not lowered" % CevalFunc
+            results.add("ceval.loop.%s.lowered_chains" % variant, num_lowered, "chains", direction=None)
+        if unbox:
+            print("Unboxed %i locals in %i functions." % (
+                sum(num_unboxed_by_func.values()), len(num_unboxed_by_func)))
+            num_unboxed = sum(num for (func_name, num) in num_unboxed_by_func.items() if CevalFunc in func_name)
+            results.add("ceval.loop.%s.unboxed_locals" % variant, num_unboxed, "locals", direction=None)
+        results.add("ceval.loop.%s.time" % variant, duration, "s")
+        results.add("ceval.loop.%s.per_iteration" % variant, duration / args.iterations * 1e6, "us")
+    return results
+
+
+def main():
+    argparser = benchlib.make_argparser(__doc__.strip())
+    argparser.add_argument('--iterations', type=int, default=1000, help="Loop iterations of the Python code.")
+    args = argparser.parse_args()
+    results = run(args)
+    results.print_table()
+    if args.json:
+        results.write_json(args.json)
+
+
+if __name__ == "__main__":
+    main()
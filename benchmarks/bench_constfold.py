@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Hot loops of obmalloc.c and dictobject.c, with and without constant folding at translation time.
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import time
+
+import benchlib
+
+
+def _bench_calls(number, repeat, calls):
+    """
+    :param list[()->None] calls: run in this order per round
+    :return: best time per round in microseconds
+    :rtype: float
+    """
+    def run_calls():
+        for call in calls:
+            call()
+
+    run_calls()  # translates the functions
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for _ in range(number):
+            run_calls()
+        duration = (time.perf_counter() - start_time) / number
+        if best is None or duration < best:
+            best = duration
+    return best * 1e6
+
+
+def _run_variant(args, fold):
+    """
+    In a forked process, as each variant needs its own interpreter, translations and Py_InitializeEx().
+
+    :param argparse.Namespace args:
+    :param bool fold:
+    :return: name -> value
+    :rtype: dict[str,float]
+    """
+    import constfold
+    state = benchlib.load_cpython_state()
+    interpreter = benchlib.make_interpreter(state)
+    if not fold:
+        return _run_calls(args, interpreter)
+    folder = constfold.ConstFolder(interpreter)
+    with folder.installed():
+        res = _run_calls(args, interpreter)
+    res["num_folded"] = folder.num_folded
+    return res
+
+
+def _run_calls(args, interpreter):
+    """
+    :param argparse.Namespace args:
+    :param cparser.interpreter.Interpreter interpreter:
+    :return: name -> value
+    :rtype: dict[str,float]
+    """
+    res = {}
+    call = interpreter.runFunc
+    # obmalloc.c: the size class computation and the pool handling of PyObject_Malloc/Free.
+    res["obmalloc"] = _bench_calls(args.number, args.repeat, [
+        lambda size=size: call("PyObject_Free", call("PyObject_Malloc", size)) for size in (8, 24, 100, 500)])
+    call("Py_InitializeEx", 0)
+    # dictobject.c: lookup and insertion, incl. the probing and resizing.
+    d = call("PyDict_New")
+    keys = [call("PyUnicode_InternFromString", "key%i" % i) for i in range(8)]
+    res["dict_setitem"] = _bench_calls(args.number, args.repeat, [
+        lambda key=key: call("PyDict_SetItem", d, key, key) for key in keys])
+    res["dict_getitem"] = _bench_calls(args.number, args.repeat, [
+        lambda key=key: call("PyDict_GetItem", d, key) for key in keys])
+    return res
+
+
+def run(args):
+    """
+    :param argparse.Namespace args:
+    :rtype: benchlib.Results
+    """
+    results = benchlib.Results("constfold")
+    ctx = multiprocessing.get_context("fork")
+    for variant, fold in [("plain", False), ("folded", True)]:
+        with ctx.Pool(1) as pool:
+            res = pool.apply(_run_variant, (args, fold))
+        num_folded = res.pop("num_folded", None)
+        if num_folded is not None:
+            print("Folded %i constant expressions." % num_folded)
+        for name, value in sorted(res.items()):
+            results.add("constfold.%s.%s" % (name, variant), value, "us/round")
+    return results
+
+
+def main():
+    argparser = benchlib.make_argparser(__doc__.strip())
+    argparser.add_argument('--number', type=int, default=100, help="Rounds per repetition.")
+    args = argparser.parse_args()
+    results = run(args)
+    results.print_table()
+    if args.json:
+        results.write_json(args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Memory footprint of the parsed CPython state as loaded from the parse cache, without and with compact.compact_state.
+
+One process parses CPython and writes the state to two parse caches in a
+temporary directory, as it is ("plain") and compacted ("compacted"). Then
+a new process per variant loads its cache, like every later cpython.py run
+does. So the peak RSS of those processes is comparable. We also report the
+time of the compaction, which is paid once before the cache is saved.
+"""
+
+from __future__ import print_function
+
+import gc
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import benchlib
+
+Variants = ["plain", "compacted"]
+
+
+def _prepare_caches(cache_dirs):
+    """
+    In a new process. Parses CPython and writes one parse cache per variant.
+
+    :param dict[str,str] cache_dirs: variant -> parse cache dir
+    :return: name -> value, for the compaction
+    :rtype: dict[str,float]
+    """
+    import compact
+    import parse_cache
+    import prelude
+    from cpython import CPythonState
+    state = CPythonState()
+    table = prelude.load_into(state)
+    state.parse_cpython()
+    parse_cache.CacheDir = cache_dirs["plain"]
+    assert parse_cache.save_state(state, table)
+    start_time = time.perf_counter()
+    compactor = compact.compact_state(state)
+    compact_time = time.perf_counter() - start_time
+    parse_cache.CacheDir = cache_dirs["compacted"]
+    assert parse_cache.save_state(state, table)
+    return {
+        "compact_time": compact_time, "num_interned": compactor.num_interned, "num_shared": compactor.num_shared}
+
+
+def _load_cache(cache_dir):
+    """
+    In a new process, so that the peak RSS is only the one of the loading.
+
+    :param str cache_dir: parse cache dir
+    :return: name -> (value, unit)
+    :rtype: dict[str,(float,str)]
+    """
+    import parse_cache
+    from cpython import CPythonState
+    parse_cache.CacheDir = cache_dir
+    state = CPythonState()
+    start_time = time.perf_counter()
+    assert parse_cache.load_state(state)
+    res = {"load_time": (time.perf_counter() - start_time, "s")}
+    gc.collect()
+    res["blocks"] = (sys.getallocatedblocks(), "blocks")
+    res["peak_rss"] = (benchlib.get_peak_rss_mb(), "MB")
+    current_rss = benchlib.get_current_rss_mb()
+    if current_rss is not None:
+        res["rss"] = (current_rss, "MB")
+    cache_fn = parse_cache.get_cache_filename(CPythonState)
+    res["cache_size"] = (os.path.getsize(cache_fn) / 1024.0 / 1024.0, "MB")
+    return res
+
+
+def run(args):
+    """
+    :param argparse.Namespace args:
+    :rtype: benchlib.Results
+    """
+    results = benchlib.Results("memory")
+    ctx = multiprocessing.get_context("spawn")  # fresh processes, not forks of this one
+    tmp_dir = tempfile.mkdtemp(prefix="pycpython-bench-memory-")
+    try:
+        cache_dirs = {variant: os.path.join(tmp_dir, variant) for variant in Variants}
+        with ctx.Pool(1) as pool:
+            res = pool.apply(_prepare_caches, (cache_dirs,))
+        print("Interned %i strings, shared %i tuples and type instances." % (res["num_interned"], res["num_shared"]))
+        results.add("memory.compact.time", res["compact_time"], "s")
+        for variant in Variants:
+            with ctx.Pool(1) as pool:
+                res = pool.apply(_load_cache, (cache_dirs[variant],))
+            for name, (value, unit) in sorted(res.items()):
+                results.add("memory.%s.%s" % (variant, name), value, unit)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    argparser = benchlib.make_argparser(__doc__.strip().splitlines()[0])
+    args = argparser.parse_args()
+    results = run(args)
+    results.print_table()
+    if args.json:
+        results.write_json(args.json)
+
+
+if __name__ == "__main__":
+    main()
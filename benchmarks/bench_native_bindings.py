@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Interpreted C API calls which call libc functions, with the wrapped libc functions vs. native_bindings.
+
+"wrapped" uses the libc wrappers of cparser as they are, "bound" calls
+native_bindings.install() before the registration, like cpython.py does.
+Both run the same interpreted C code through Interpreter.runFunc, e.g.
+PyBytes_FromString, which calls strlen and memcpy.
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import time
+
+import benchlib
+
+
+def _bench_calls(number, repeat, call):
+    """
+    :param ()->None call:
+    :return: best time per call in microseconds
+    :rtype: float
+    """
+    call()  # translates the functions
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for _ in range(number):
+            call()
+        duration = (time.perf_counter() - start_time) / number
+        if best is None or duration < best:
+            best = duration
+    return best * 1e6
+
+
+def _run_variant(args, bound):
+    """
+    In a forked process, as native_bindings.install() modifies the state.
+
+    :param argparse.Namespace args:
+    :param bool bound:
+    :return: name -> value
+    :rtype: dict[str,float]
+    """
+    state = benchlib.load_cpython_state()
+    interpreter = benchlib.make_interpreter(state, use_native_bindings=bound)
+    call = interpreter.runFunc
+    call("Py_InitializeEx", 0)
+    s = "x" * 63
+    res = {}
+    # strlen and memcpy.
+    res["PyBytes_FromString"] = _bench_calls(
+        args.number, args.repeat, lambda: call("Py_DecRef", call("PyBytes_FromString", s)))
+    # strlen, memcmp.
+    a, b = call("PyBytes_FromString", s), call("PyBytes_FromString", s)
+    res["bytes_compare"] = _bench_calls(args.number, args.repeat, lambda: call("PyObject_RichCompareBool", a, b, 2))
+    return res
+
+
+def run(args):
+    """
+    :param argparse.Namespace args:
+    :rtype: benchlib.Results
+    """
+    results = benchlib.Results("native_bindings")
+    ctx = multiprocessing.get_context("fork")
+    for variant, bound in [("wrapped", False), ("bound", True)]:
+        with ctx.Pool(1) as pool:
+            res = pool.apply(_run_variant, (args, bound))
+        for name, value in sorted(res.items()):
+            results.add("native_bindings.%s.%s" % (name, variant), value, "us/call")
+    return results
+
+
+def main():
+    argparser = benchlib.make_argparser(__doc__.strip().splitlines()[0])
+    argparser.add_argument('--number', type=int, default=100, help="calls per measurement")
+    args = argparser.parse_args()
+    results = run(args)
+    results.print_table()
+    if args.json:
+        results.write_json(args.json)
+
+
+if __name__ == "__main__":
+    main()
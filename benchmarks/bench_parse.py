@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Wall time of parsing CPython, per parse unit, without the parse cache.
+
+All units are parsed in the same process, so the peak RSS after a unit is the
+peak of the process so far (cumulative), not the peak of that unit.
+"""
+
+from __future__ import print_function
+
+import time
+
+import benchlib
+
+
+def run(args):
+    """
+    :param argparse.Namespace args:
+    :rtype: benchlib.Results
+    """
+    from cpython import CPythonState
+    results = benchlib.Results("parse")
+    state = CPythonState()
+    total_start_time = time.perf_counter()
+    for unit in state.parse_units:
+        start_time = time.perf_counter()
+        state.parse_unit(unit)
+        results.add("parse.%s.time" % unit.filename, time.perf_counter() - start_time, "s")
+        results.add("parse.%s.cumulative_peak_rss" % unit.filename, benchlib.get_peak_rss_mb(), "MB")
+    results.add("parse.total.time", time.perf_counter() - total_start_time, "s")
+    results.add("parse.total.peak_rss", benchlib.get_peak_rss_mb(), "MB")
+    results.add("parse.total.errors", len(state._errors), "errors", direction=None)
+    return results
+
+
+def main():
+    argparser = benchlib.make_argparser(__doc__.strip())
+    args = argparser.parse_args()
+    results = run(args)
+    results.print_table()
+    if args.json:
+        results.write_json(args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Micro-benchmarks of single interpreted C API calls through Interpreter.runFunc.
+"""
+
+from __future__ import print_function
+
+import time
+
+import benchlib
+
+
+def _bench_call(interpreter, number, repeat, funcname, *args, decref=False):
+    """
+    :param bool decref: the function returns a new reference, which we release
+      with Py_DecRef after each call. The time includes the Py_DecRef call
+    :return: best time per call in microseconds, over the rounds
+    :rtype: float
+    """
+    res = interpreter.runFunc(funcname, *args)  # translates the function
+    if decref:
+        interpreter.runFunc("Py_DecRef", res)
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for _ in range(number):
+            res = interpreter.runFunc(funcname, *args)
+            if decref:
+                interpreter.runFunc("Py_DecRef", res)
+        duration = (time.perf_counter() - start_time) / number
+        if best is None or duration < best:
+            best = duration
+    return best * 1e6
+
+
+def run(args):
+    """
+    :param argparse.Namespace args:
+    :rtype: benchlib.Results
+    """
+    results = benchlib.Results("runfunc")
+    state = benchlib.load_cpython_state()
+    interpreter = benchlib.make_interpreter(state)
+    number, repeat = args.number, args.repeat
+
+    results.add(
+        "runfunc.PyMem_RawMalloc", _bench_call(interpreter, number, repeat, "PyMem_RawMalloc", 16), "us/call")
+    if not args.no_init:
+        # The other calls need the runtime, the types and the interned strings.
+        start_time = time.perf_counter()
+        interpreter.runFunc("Py_InitializeEx", 0)
+        results.add("runfunc.Py_InitializeEx.time", time.perf_counter() - start_time, "s")
+        results.add(
+            "runfunc.PyTuple_New+Py_DecRef",
+            _bench_call(interpreter, number, repeat, "PyTuple_New", 3, decref=True), "us/call")
+        results.add(
+            "runfunc.PyUnicode_InternFromString+Py_DecRef",
+            _bench_call(interpreter, number, repeat, "PyUnicode_InternFromString", "benchmark_key", decref=True),
+            "us/call")
+        d = interpreter.runFunc("PyDict_New")
+        key = interpreter.runFunc("PyUnicode_InternFromString", "benchmark_key")
+        results.add(
+            "runfunc.PyDict_SetItem",
+            _bench_call(interpreter, number, repeat, "PyDict_SetItem", d, key, key), "us/call")
+    return results
+
+
+def main():
+    argparser = benchlib.make_argparser(__doc__.strip())
+    argparser.add_argument('--number', type=int, default=100, help="Calls per round.")
+    argparser.add_argument('--no-init', action='store_true', help="Only the calls which don't need Py_Initialize.")
+    args = argparser.parse_args()
+    results = run(args)
+    results.print_table()
+    if args.json:
+        results.write_json(args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Time until Py_Main returns, for cpython.py -V and cpython.py -c pass, incl. the (cached) parse.
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+
+import benchlib
+
+Commands = [
+    ("version", ["-V"]),
+    ("pass", ["-c", "pass"]),
+]
+
+
+def run(args):
+    """
+    :param argparse.Namespace args:
+    :rtype: benchlib.Results
+    """
+    results = benchlib.Results("startup")
+    cpython_py = os.path.join(benchlib.RootDir, "cpython.py")
+    # The first run fills the parse cache, which we don't want to measure.
+    subprocess.call([sys.executable, cpython_py, "-V"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for name, cmd_args in Commands:
+        exit_codes = []
+
+        def run_cmd():
+            exit_codes.append(subprocess.call(
+                [sys.executable, cpython_py] + cmd_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        duration, _ = benchlib.timed(run_cmd, repeat=args.repeat)
+        failed = [exit_code for exit_code in exit_codes if exit_code != 0]
+        if failed:
+            # A failing run can be fast, so its time would hide a regression.
+            print("cpython.py %s exited with %i, no result for %s" % (" ".join(cmd_args), failed[0], name))
+            continue
+        results.add("startup.%s.time" % name, duration, "s")
+    return results
+
+
+def main():
+    argparser = benchlib.make_argparser(__doc__.strip())
+    args = argparser.parse_args()
+    results = run(args)
+    results.print_table()
+    if args.json:
+        results.write_json(args.json)
+
+
+if __name__ == "__main__":
+    main()
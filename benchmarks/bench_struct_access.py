@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Struct field access: ctypes pointer.contents vs. struct_layout, on Py_INCREF/Py_TYPE patterns,
+as micro-benchmark and in the interpreted C API. Also reads with a known struct type and address,
+like in the overrides: ctypes from_address() vs. struct_layout.
+"""
+
+from __future__ import print_function
+
+import ctypes
+import multiprocessing
+
+import benchlib
+import struct_layout
+
+
+class _WrappedSsize(ctypes.c_ssize_t):
+    # Like the types of ctypes_wrapped, which ctypes does not convert to Python ints.
+    pass
+
+
+class _WrappedUlong(ctypes.c_ulong):
+    pass
+
+
+class TypeObject(ctypes.Structure):
+    _fields_ = [("ob_refcnt", _WrappedSsize), ("ob_type", ctypes.c_void_p), ("tp_flags", _WrappedUlong)]
+
+
+class Object(ctypes.Structure):
+    _fields_ = [("ob_refcnt", _WrappedSsize), ("ob_type", ctypes.POINTER(TypeObject))]
+
+
+class _Helpers:
+    # Like helpers.postInc of cparser.interpreter, for the micro-benchmark.
+
+    @staticmethod
+    def postInc(a):
+        old = type(a)(a.value)
+        a.value += 1
+        return old
+
+
+# Lots of new references to existing objects.
+BenchCode = """
+l = [None, 1, "a"]
+for _ in range(%i):
+    t = (l, l[0], l[1], l[2])
+"""
+
+
+def _run_micro(args, results):
+    """
+    :param argparse.Namespace args:
+    :param benchlib.Results results:
+    """
+    tp = TypeObject(_WrappedSsize(1), None, _WrappedUlong(1 << 18))
+    ob = Object(_WrappedSsize(1), ctypes.pointer(tp))
+    p = ctypes.pointer(ob)
+    number = args.number
+    helpers = _Helpers
+    access = struct_layout.StructFieldAccess(helpers)
+
+    def incref_contents():
+        for _ in range(number):
+            helpers.postInc(p.contents.ob_refcnt)
+
+    def incref_layout():
+        for _ in range(number):
+            access.inc(p, "ob_refcnt", 1)
+
+    def type_flags_contents():
+        for _ in range(number):
+            p.contents.ob_type.contents.tp_flags.value & (1 << 18)
+
+    get_type = struct_layout.make_field_getter(Object, "ob_type")
+    get_flags = struct_layout.make_field_getter(TypeObject, "tp_flags")
+
+    def type_flags_layout():
+        # Every access needs the address of the pointer, like in translated code.
+        for _ in range(number):
+            get_flags(get_type(struct_layout.get_pointer_address(p))) & (1 << 18)
+
+    # Python code which knows the struct type and the address, like the overrides.
+    ob_addr = ctypes.addressof(ob)
+    ob_type_offset = Object.ob_type.offset
+
+    def known_type_from_address():
+        for _ in range(number):
+            ctypes.c_void_p.from_address(ob_addr + ob_type_offset).value
+
+    def known_type_layout():
+        for _ in range(number):
+            get_type(ob_addr)
+
+    for name, func in [
+            ("incref.contents", incref_contents), ("incref.layout", incref_layout),
+            ("type_flags.contents", type_flags_contents), ("type_flags.layout", type_flags_layout),
+            ("known_type.from_address", known_type_from_address), ("known_type.layout", known_type_layout)]:
+        duration, _ = benchlib.timed(func, repeat=args.repeat)
+        results.add("struct_access.%s" % name, duration / number * 1e9, "ns/op")
+
+
+def _run_interpreted_variant(args, use_layout):
+    """
+    In a forked process, as each variant needs its own interpreter and translations.
+
+    :param argparse.Namespace args:
+    :param bool use_layout: whether to install struct_layout
+    :return: best times in seconds of the Py_IncRef/Py_DecRef calls and of the Python code,
+      number of rewritten accesses per translated function
+    :rtype: (float,float,dict[str,int])
+    """
+    state = benchlib.load_cpython_state()
+    interpreter = benchlib.make_interpreter(state)
+    access_pass = struct_layout.install(interpreter) if use_layout else None
+    interpreter.runFunc("Py_InitializeEx", 0)
+    ob = interpreter.runFunc("PyLong_FromLong", 12345)
+
+    def incref_decref():
+        for _ in range(args.calls):
+            interpreter.runFunc("Py_IncRef", ob)
+            interpreter.runFunc("Py_DecRef", ob)
+
+    code = BenchCode % args.iterations
+    incref_decref()  # translates the functions
+    interpreter.runFunc("PyRun_SimpleString", code)
+    incref_duration, _ = benchlib.timed(incref_decref, repeat=args.repeat)
+    code_duration, _ = benchlib.timed(lambda: interpreter.runFunc("PyRun_SimpleString", code), repeat=args.repeat)
+    return incref_duration, code_duration, access_pass.num_rewritten_by_func if access_pass else {}
+
+
+def _run_interpreted(args, results):
+    """
+    :param argparse.Namespace args:
+    :param benchlib.Results results:
+    """
+    ctx = multiprocessing.get_context("fork")
+    for variant, use_layout in [("contents", False), ("layout", True)]:
+        with ctx.Pool(1) as pool:
+            incref_duration, code_duration, num_rewritten_by_func = pool.apply(
+                _run_interpreted_variant, (args, use_layout))
+        if use_layout:
+            print("Rewrote %i field increments in %i functions." % (
+                sum(num_rewritten_by_func.values()), len(num_rewritten_by_func)))
+            # Otherwise we would only measure the noise.
+            assert num_rewritten_by_func, "no field increments were rewritten"
+            results.add(
+                "struct_access.interpreted.%s.rewritten" % variant, sum(num_rewritten_by_func.values()), "accesses",
+                direction=None)
+        results.add(
+            "struct_access.interpreted.%s.incref_decref" % variant, incref_duration / args.calls * 1e6, "us/call")
+        results.add("struct_access.interpreted.%s.code" % variant, code_duration, "s")
+
+
+def run(args):
+    """
+    :param argparse.Namespace args:
+    :rtype: benchlib.Results
+    """
+    results = benchlib.Results("struct_access")
+    _run_micro(args, results)
+    if not args.micro_only:
+        _run_interpreted(args, results)
+    return results
+
+
+def main():
+    argparser = benchlib.make_argparser(__doc__.strip())
+    argparser.add_argument('--number', type=int, default=100000, help="Operations per repetition.")
+    argparser.add_argument('--calls', type=int, default=1000, help="Interpreted Py_IncRef/Py_DecRef calls.")
+    argparser.add_argument('--iterations', type=int, default=1000, help="Loop iterations of the Python code.")
+    argparser.add_argument('--micro-only', action='store_true', help="Only the micro-benchmark, without CPython.")
+    args = argparser.parse_args()
+    results = run(args)
+    results.print_table()
+    if args.json:
+        results.write_json(args.json)
+
+
+if __name__ == "__main__":
+    main()
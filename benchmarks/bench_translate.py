@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Translation time per C function (Interpreter._translateFuncToPyAst), without the translate cache.
+"""
+
+from __future__ import print_function
+
+import time
+
+import benchlib
+
+DefaultFuncs = [
+    "Py_Main", "PyDict_SetItem", "PyTuple_New", "PyUnicode_InternFromString", "PyMem_RawMalloc",
+    "PyObject_Malloc", "_PyEval_EvalFrameDefault", "PyUnicode_FromString", "PyLong_FromLong"]
+
+
+def run(args):
+    """
+    :param argparse.Namespace args:
+    :rtype: benchlib.Results
+    """
+    import cparser
+    results = benchlib.Results("translate")
+    state = benchlib.load_cpython_state()
+    interpreter = benchlib.make_interpreter(state)
+    if args.all:
+        funcs = sorted(name for (name, f) in state.funcs.items() if isinstance(f, cparser.CFunc) and f.body)
+    else:
+        funcs = args.func or DefaultFuncs
+    total_time = 0.0
+    for name in funcs:
+        func = state.funcs.get(name)
+        if func is None:
+            print("%s not parsed, skipped" % name)
+            continue
+        start_time = time.perf_counter()
+        interpreter._translateFuncToPyAst(func)
+        duration = time.perf_counter() - start_time
+        total_time += duration
+        if not args.all:
+            results.add("translate.%s.time" % name, duration, "s")
+    results.add("translate.total.time", total_time, "s")
+    results.add("translate.total.funcs", len(funcs), "funcs", direction=None)
+    return results
+
+
+def main():
+    argparser = benchlib.make_argparser(__doc__.strip())
+    argparser.add_argument('--func', action='append', help="Function to translate. Default: a fixed set.")
+    argparser.add_argument('--all', action='store_true', help="Translate all functions, only report the total.")
+    args = argparser.parse_args()
+    results = run(args)
+    results.print_table()
+    if args.json:
+        results.write_json(args.json)
+
+
+if __name__ == "__main__":
+    main()
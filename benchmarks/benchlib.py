@@ -0,0 +1,210 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Common code for the benchmarks: timing, peak RSS, JSON results and the comparison of two runs.
+
+Result files look like::
+
+    {"format": 1, "benchmark": "parse", "env": {...},
+     "results": {"parse.total": {"value": 12.3, "unit": "s", "direction": "lower"}, ...}}
+
+The direction tells whether lower or higher values are better. Counters
+(e.g. the number of translated functions) have direction None and are not
+compared. Results without a direction (older files) count as lower is better.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+MyDir = os.path.dirname(os.path.abspath(__file__))
+RootDir = os.path.dirname(MyDir)
+if RootDir not in sys.path:
+    sys.path.insert(0, RootDir)
+
+ResultsFormatVersion = 1
+
+Directions = ("lower", "higher", None)
+
+
+def get_peak_rss_mb():
+    """
+    :return: peak resident set size of this process so far, in MB
+    :rtype: float
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024.0 / 1024.0  # bytes
+    return peak / 1024.0  # KB
+
+
+def get_current_rss_mb():
+    """
+    :return: current resident set size of this process in MB, or None if we cannot tell (no /proc)
+    :rtype: float|None
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize() / 1024.0 / 1024.0
+
+
+def get_env():
+    """
+    :return: what we know about the machine and the code, to judge whether two runs are comparable
+    :rtype: dict[str]
+    """
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=RootDir, stderr=subprocess.DEVNULL).decode("utf8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+class Results:
+
+    def __init__(self, benchmark):
+        """
+        :param str benchmark: e.g. "parse"
+        """
+        self.benchmark = benchmark
+        self.results = {}  # type: dict[str,dict[str]]
+
+    def add(self, name, value, unit, direction="lower"):
+        """
+        :param str name: e.g. "parse.Objects/dictobject.c.time"
+        :param float value:
+        :param str unit: e.g. "s", "MB", "us/call"
+        :param str|None direction: "lower" or "higher" is better, or None for counters
+        """
+        assert direction in Directions
+        self.results[name] = {"value": value, "unit": unit, "direction": direction}
+
+    def print_table(self):
+        for name, result in sorted(self.results.items()):
+            print("%-60s %14.4f %s" % (name, result["value"], result["unit"]))
+
+    def as_json(self):
+        return {
+            "format": ResultsFormatVersion, "benchmark": self.benchmark, "env": get_env(), "results": self.results}
+
+    def write_json(self, filename):
+        """
+        :param str filename:
+        """
+        with open(filename, "w") as f:
+            json.dump(self.as_json(), f, indent=1, sort_keys=True)
+            f.write("\n")
+
+
+def load_results(filename):
+    """
+    :param str filename: written by Results.write_json() or run_all.py
+    :return: name -> {"value": ..., "unit": ...}
+    :rtype: dict[str,dict[str]]
+    """
+    with open(filename) as f:
+        data = json.load(f)
+    assert data["format"] == ResultsFormatVersion, "%s: unknown format %r" % (filename, data["format"])
+    return data["results"]
+
+
+def compare(old, new, threshold):
+    """
+    :param dict[str,dict[str]] old: from load_results()
+    :param dict[str,dict[str]] new: from load_results()
+    :param float threshold: relative, e.g. 0.1 for 10%
+    :return: list of (name, old value, new value, relative change) where new is worse than old by more than threshold.
+      Counters are skipped
+    :rtype: list[(str,float,float,float)]
+    """
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        direction = new[name].get("direction", "lower")
+        if direction is None:
+            continue
+        old_value, new_value = old[name]["value"], new[name]["value"]
+        if old_value <= 0:
+            continue
+        change = (new_value - old_value) / old_value
+        if (change if direction == "lower" else -change) > threshold:
+            regressions.append((name, old_value, new_value, change))
+    return regressions
+
+
+def make_argparser(description):
+    """
+    :param str description:
+    :rtype: argparse.ArgumentParser
+    """
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument('--json', metavar="FILE", help="Write the results to this file.")
+    argparser.add_argument('--repeat', type=int, default=3, help="Repetitions, we take the best.")
+    return argparser
+
+
+def timed(func, repeat=1):
+    """
+    :param ()->object func:
+    :param int repeat:
+    :return: best wall time in seconds, and the result of the last call
+    :rtype: (float,object)
+    """
+    best = None
+    res = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        res = func()
+        duration = time.perf_counter() - start_time
+        if best is None or duration < best:
+            best = duration
+    return best, res
+
+
+def load_cpython_state(use_cache=True):
+    """
+    :param bool use_cache: see parse_cache
+    :return: parsed state
+    :rtype: cpython.CPythonState
+    """
+    import parse_cache
+    from cpython import CPythonState
+    state = CPythonState()
+    parse_cache.parse_cpython(state, use_cache=use_cache)
+    return state
+
+
+def make_interpreter(state, use_native_bindings=True):
+    """
+    Like cpython.main() sets it up.
+
+    :param cpython.CPythonState state:
+    :param bool use_native_bindings: whether to call native_bindings.install()
+    :rtype: cparser.interpreter.Interpreter
+    """
+    import cparser.interpreter
+    import native_bindings
+    import overrides
+    if use_native_bindings:
+        native_bindings.install(state)
+    interpreter = cparser.interpreter.Interpreter()
+    interpreter.register(state)
+    overrides.install(interpreter, state, argv=[os.path.join(RootDir, "cpython.py")])
+    return interpreter
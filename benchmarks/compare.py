@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Compares two benchmark result files. Exits with 1 if a result got worse by more than the threshold.
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+import benchlib
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip())
+    argparser.add_argument('old', help="JSON results of the baseline run")
+    argparser.add_argument('new', help="JSON results of the new run")
+    argparser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help="Allowed relative regression, e.g. 0.1 for 10%% (default: %(default)s).")
+    args = argparser.parse_args()
+    old = benchlib.load_results(args.old)
+    new = benchlib.load_results(args.new)
+    print("%-60s %14s %14s %8s" % ("result", "old", "new", "change"))
+    for name in sorted(set(old) & set(new)):
+        old_value, new_value = old[name]["value"], new[name]["value"]
+        change = (new_value - old_value) / old_value if old_value else 0.0
+        print("%-60s %14.4f %14.4f %+7.1f%%" % (name, old_value, new_value, change * 100.0))
+    for name in sorted(set(old) ^ set(new)):
+        print("%-60s only in %s" % (name, "old" if name in old else "new"))
+    regressions = benchlib.compare(old, new, args.threshold)
+    if regressions:
+        print("%i regressions over %.0f%%:" % (len(regressions), args.threshold * 100.0))
+        for name, old_value, new_value, change in regressions:
+            print("  %s: %.4f -> %.4f (%+.1f%%)" % (name, old_value, new_value, change * 100.0))
+        sys.exit(1)
+    print("No regressions over %.0f%%." % (args.threshold * 100.0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Runs the benchmarks and writes all results to one JSON file, for compare.py.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+
+import benchlib
+import bench_ceval
+import bench_constfold
+import bench_memory
+import bench_native_bindings
+import bench_parse
+import bench_runfunc
+import bench_startup
+import bench_struct_access
+import bench_translate
+
+# name -> (module, extra default args)
+Benchmarks = {
+    "parse": (bench_parse, {}),
+    "constfold": (bench_constfold, {"number": 100}),
+    "ceval": (bench_ceval, {"iterations": 1000}),
+    "translate": (bench_translate, {"func": None, "all": False}),
+    "startup": (bench_startup, {}),
+    "struct_access": (
+        bench_struct_access, {"number": 100000, "calls": 1000, "iterations": 1000, "micro_only": False}),
+    "runfunc": (bench_runfunc, {"number": 100, "no_init": False}),
+    "native_bindings": (bench_native_bindings, {"number": 100}),
+    "memory": (bench_memory, {}),
+}
+
+
+def main():
+    argparser = benchlib.make_argparser(__doc__.strip())
+    argparser.add_argument(
+        '--only', action='append', choices=sorted(Benchmarks),
+        help="Only run these benchmarks. Default: all.")
+    args = argparser.parse_args()
+    combined = benchlib.Results("all")
+    for name in sorted(args.only or Benchmarks):
+        module, defaults = Benchmarks[name]
+        bench_args = argparse_namespace(args, defaults)
+        print("Benchmark %s..." % name)
+        results = module.run(bench_args)
+        results.print_table()
+        combined.results.update(results.results)
+    if args.json:
+        combined.write_json(args.json)
+    else:
+        print(json.dumps(combined.as_json(), indent=1, sort_keys=True))
+
+
+def argparse_namespace(args, defaults):
+    """
+    :param argparse.Namespace args: our args
+    :param dict[str] defaults: args of the benchmark which we don't have
+    :rtype: argparse.Namespace
+    """
+    bench_args = argparse.Namespace(**defaults)
+    bench_args.repeat = args.repeat
+    bench_args.json = None
+    return bench_args
+
+
+if __name__ == "__main__":
+    main()
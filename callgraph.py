@@ -0,0 +1,155 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Reference graph over the parsed global functions and variables, for dead-code elimination.
+
+cparser resolves identifiers while it parses, so a function body or a
+variable initializer holds the referenced declaration objects themselves:
+called functions, functions whose address is taken (type slots, method
+tables), used global variables. We walk the object graph of every
+declaration and record which other global functions and variables it reaches.
+We do not walk into the "parent" links, which go up to the enclosing scope.
+
+Declarations are identified by name, because a call can refer to the
+prototype while we emit the definition.
+"""
+
+from __future__ import print_function
+
+SkipAttribs = {"parent"}
+
+
+def _get_decl_types():
+    """
+    :return: the types of the global declarations in the graph
+    :rtype: tuple[type]
+    """
+    import cparser
+    return cparser.CFunc, cparser.CVarDecl
+
+
+def _get_stop_types():
+    """
+    :return: the types which we don't walk into. Types don't refer to functions or variables
+    :rtype: tuple[type]
+    """
+    import cparser
+    return cparser.CStruct, cparser.CUnion, cparser.CTypedef, cparser.CEnum
+
+
+def _is_walked_type(t, modules):
+    """
+    :param type t:
+    :param tuple[str] modules: e.g. ("cparser",)
+    :return: whether t is from one of these modules (or submodules)
+    :rtype: bool
+    """
+    module = t.__module__ or ""
+    return any(module == m or module.startswith(m + ".") for m in modules)
+
+
+def get_global_decls(state, decl_types=None):
+    """
+    :param cparser.State state:
+    :param tuple[type]|None decl_types: by default cparser.CFunc and cparser.CVarDecl
+    :return: id(decl) -> name, for all global functions and variables, incl. prototypes
+    :rtype: dict[int,str]
+    """
+    if decl_types is None:
+        decl_types = _get_decl_types()
+    decls = {}
+    for obj in list(state.contentlist) + list(state.funcs.values()) + list(state.vars.values()):
+        if isinstance(obj, decl_types) and obj.name:
+            decls[id(obj)] = obj.name
+    return decls
+
+
+def get_references(decl, decls, stop_types=None, modules=("cparser",)):
+    """
+    :param object decl: global function or variable
+    :param dict[int,str] decls: from get_global_decls()
+    :param tuple[type]|None stop_types: types which we don't walk into. by default the cparser types
+    :param tuple[str] modules: we walk into the objects of classes from these modules (and submodules)
+    :return: names of the global functions and variables which decl refers to
+    :rtype: set[str]
+    """
+    if stop_types is None:
+        stop_types = _get_stop_types()
+    refs = set()
+    visited = {id(decl)}
+    stack = [decl]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            children = list(obj.values())
+        elif isinstance(obj, (list, tuple, set)):
+            children = list(obj)
+        elif _is_walked_type(type(obj), modules) and hasattr(obj, "__dict__"):
+            children = [value for (key, value) in vars(obj).items() if key not in SkipAttribs]
+        else:
+            continue
+        for child in children:
+            if id(child) in visited:
+                continue
+            visited.add(id(child))
+            if id(child) in decls:
+                if decls[id(child)] != getattr(decl, "name", None):
+                    refs.add(decls[id(child)])
+                continue
+            if isinstance(child, stop_types):
+                continue
+            stack.append(child)
+    return refs
+
+
+def build_graph(state, decl_types=None, stop_types=None, modules=("cparser",)):
+    """
+    :param cparser.State state:
+    :param tuple[type]|None decl_types: see get_global_decls()
+    :param tuple[type]|None stop_types: see get_references()
+    :param tuple[str] modules: see get_references()
+    :return: name -> names it refers to, for all global functions and variables
+    :rtype: dict[str,set[str]]
+    """
+    decls = get_global_decls(state, decl_types=decl_types)
+    graph = {}
+    seen = set()
+    for obj in list(state.contentlist) + list(state.funcs.values()) + list(state.vars.values()):
+        if id(obj) not in decls or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        graph.setdefault(obj.name, set()).update(
+            get_references(obj, decls, stop_types=stop_types, modules=modules))
+    return graph
+
+
+def rename_graph(graph, rename):
+    """
+    :param dict[str,set[str]] graph: from build_graph()
+    :param (str)->str rename: e.g. compile_output.fixed_name
+    :return: the same graph, with all names renamed
+    :rtype: dict[str,set[str]]
+    """
+    res = {}
+    for name, refs in graph.items():
+        res.setdefault(rename(name), set()).update(rename(ref) for ref in refs)
+    return res
+
+
+def find_reachable(graph, roots):
+    """
+    :param dict[str,set[str]] graph: from build_graph()
+    :param list[str] roots: e.g. ["Py_Main"]
+    :return: names of all functions and variables reachable from the roots, incl. the roots
+    :rtype: set[str]
+    """
+    reachable = set()
+    stack = list(roots)
+    while stack:
+        name = stack.pop()
+        if name in reachable:
+            continue
+        reachable.add(name)
+        stack.extend(graph.get(name, ()))
+    return reachable
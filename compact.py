@@ -0,0 +1,137 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Compaction of the parsed state, to reduce its memory footprint.
+
+After parsing CPython, the state holds many objects which are equal but not
+identical: names and other strings which are copied from the tokens, and
+type instances like CBuiltinType(("unsigned", "int")) which are created
+again for every declaration. We walk the parsed objects and
+
+* intern all strings (sys.intern), also the dict keys,
+* share equal tuples of atoms,
+* share equal instances of the value types (see SharedTypes), i.e. objects
+  which consist only of atoms (str, int, bool, None or tuples of those).
+
+This does not change the semantics of the state. The parse cache pickles
+shared objects only once, so its files get smaller as well.
+"""
+
+from __future__ import print_function
+
+import sys
+
+# Pure value types of cparser. Their instances can be shared when they are equal.
+SharedTypes = ("CBuiltinType", "CStdIntType")
+
+_AtomTypes = (str, int, float, bool, type(None))
+
+
+def _is_atom(v):
+    if type(v) in _AtomTypes:
+        return True
+    if type(v) is tuple:
+        return all(type(x) in _AtomTypes for x in v)
+    return False
+
+
+class Compactor:
+
+    def __init__(self, shared_types=(), modules=("cparser",)):
+        """
+        :param tuple[type] shared_types: instances of these are shared when they are equal
+        :param tuple[str] modules: we descend into objects of classes from these modules (and submodules)
+        """
+        self.shared_types = tuple(shared_types)
+        self.modules = tuple(modules)
+        self.num_interned = 0  # strings which we replaced by the interned one
+        self.num_shared = 0  # tuples and instances which we replaced by an equal one
+        self._tuples = {}  # type: dict[tuple,tuple]
+        self._shared = {}  # type: dict[(type,tuple),object]
+        self._seen = set()  # type: set[int]
+        self._queue = []  # objects and containers which we still need to walk
+
+    def _is_walked_type(self, t):
+        module = t.__module__ or ""
+        return any(module == m or module.startswith(m + ".") for m in self.modules)
+
+    def _intern(self, s):
+        res = sys.intern(s)
+        if res is not s:
+            self.num_interned += 1
+        return res
+
+    def _share_key(self, obj):
+        attribs = getattr(obj, "__dict__", None)
+        if attribs is None or not all(_is_atom(v) for v in attribs.values()):
+            return None
+        return type(obj), tuple(sorted(attribs.items()))
+
+    def _replace(self, v):
+        """
+        :return: the replacement for the value v, and queues v for the walk if it is a container
+        """
+        t = type(v)
+        if t is str:
+            return self._intern(v)
+        if t is tuple and _is_atom(v):
+            v = tuple([self._intern(x) if type(x) is str else x for x in v])
+            res = self._tuples.setdefault(v, v)
+            if res is not v:
+                self.num_shared += 1
+            return res
+        if self.shared_types and isinstance(v, self.shared_types):
+            key = self._share_key(v)
+            if key is not None:
+                res = self._shared.setdefault(key, v)
+                if res is not v:
+                    self.num_shared += 1
+                    return res
+        if id(v) not in self._seen and (isinstance(v, (list, dict)) or self._is_walked_type(t)):
+            self._seen.add(id(v))
+            self._queue.append(v)
+        return v
+
+    def _walk(self, obj):
+        if isinstance(obj, list):
+            for i, x in enumerate(obj):
+                new = self._replace(x)
+                if new is not x:
+                    obj[i] = new
+        elif isinstance(obj, dict):
+            items = [(self._intern(k) if type(k) is str else k, self._replace(v)) for (k, v) in obj.items()]
+            obj.clear()
+            obj.update(items)  # keeps the order
+        attribs = getattr(obj, "__dict__", None)
+        if attribs is not None:
+            for k, x in list(attribs.items()):
+                new = self._replace(x)
+                if new is not x:
+                    attribs[k] = new
+
+    def compact(self, *roots):
+        """
+        :param roots: objects or containers. all reachable cparser objects are compacted in-place
+        """
+        for root in roots:
+            self._replace(root)
+        while self._queue:
+            self._walk(self._queue.pop())
+
+
+def compact_state(state):
+    """
+    :param cparser.State state: after parsing
+    :return: the compactor, for its statistics
+    :rtype: Compactor
+    """
+    import cparser
+    compactor = Compactor(
+        shared_types=tuple(getattr(cparser, name) for name in SharedTypes if hasattr(cparser, name)))
+    compactor.compact(*[
+        getattr(state, name) for name in
+        ["contentlist", "macros", "funcs", "typedefs", "structs", "unions", "enums", "enumconsts", "vars",
+         "lazy_bodies"]
+        if getattr(state, name, None) is not None])
+    return compactor
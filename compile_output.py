@@ -0,0 +1,159 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+The parts of compile_to_py which don't need cparser: the renaming of the C names,
+the module layout of the sharded output, and the code tables of the bytecode output.
+
+load_code_table() and make_function() are copied into the compiled output.
+"""
+
+from __future__ import print_function
+
+import ast
+import importlib.util
+import inspect
+import marshal
+import os
+import re
+import types
+
+
+def fixed_name(name):
+    """
+    Python mangles names which start with "__" in class bodies, e.g. in "class g",
+    thus we rename them.
+
+    :param str name: C name of a global declaration
+    :return: its name in the compiled output
+    :rtype: str
+    """
+    if name.startswith("__"):
+        return "_M_%s" % name[2:]
+    return name
+
+
+def get_shard_module_name(content):
+    """
+    :param cparser.CFunc|cparser.CVarDecl content:
+    :return: name of the module in the sharded output, derived from the source file of the declaration
+    :rtype: str
+    """
+    def_pos = getattr(content, "defPos", None)
+    if not def_pos:
+        return "_f_unknown"
+    source_fn = os.path.basename(str(def_pos).split(":")[0])
+    return "_f_%s" % re.sub(r"\W", "_", source_fn)
+
+
+def write_shard_header(f, module_name, bytecode=False):
+    """
+    :param file f: new module of the package
+    :param str module_name: e.g. "_local_types" or from get_shard_module_name()
+    :param bool bytecode: whether the functions of the module are in its code table
+    """
+    f.write("# PyCPython - interpret CPython in Python\n")
+    f.write("# Statically compiled CPython, module %s.\n\n" % module_name)
+    f.write("from ._types import *\n")
+    f.write("from . import g\n")
+    if bytecode and module_name.startswith("_f_"):
+        f.write("\n")
+        f.write("_code = load_code_table(__file__)\n")
+    f.write("\n\n")
+
+
+def write_shard_initializers(f, initializers):
+    """
+    The initializers of the global variables of a module come after all its functions,
+    so that they can refer to them directly, e.g. the slots of a static type object.
+    References to other modules go via g and import those only then.
+
+    :param file f: module of the package, with everything else written
+    :param list[str] initializers: statements, e.g. "helpers.assign(PyDict_Type, ...)\n"
+    """
+    f.write("\n")
+    f.write("# The initializers of the global variables, after all functions of this module.\n")
+    for initializer in initializers:
+        f.write(initializer)
+
+
+def write_package_init(f, global_modules):
+    """
+    :param file f: __init__.py of the package
+    :param dict[str,str] global_modules: global name -> module name. everything else is in _types
+    """
+    f.write("# PyCPython - interpret CPython in Python\n")
+    f.write("# Statically compiled CPython, sharded by source file.\n\n")
+    f.write("import importlib\n")
+    f.write("from ._types import *\n")
+    f.write("\n")
+    f.write("# global name -> module. Everything else is in _types.\n")
+    f.write("_global_modules = {\n")
+    for name, module_name in sorted(global_modules.items()):
+        if module_name != "_types":
+            f.write("    %r: %r,\n" % (name, module_name))
+    f.write("}\n")
+    f.write("\n\n")
+    f.write("class _Globals(object):\n")
+    f.write("    # Imports the module of a global on first access.\n")
+    f.write("    def __getattr__(self, name):\n")
+    f.write("        module = importlib.import_module(\".\" + _global_modules.get(name, \"_types\"), __name__)\n")
+    f.write("        value = getattr(module, name)\n")
+    f.write("        setattr(self, name, value)\n")
+    f.write("        return value\n")
+    f.write("\n\n")
+    f.write("g = _Globals()\n")
+    f.write("\n")
+    f.write("# The values which the function modules share. Needs g, like all our modules.\n")
+    f.write("from . import _local_types\n")
+
+
+def compile_func_ast(py_ast, filename):
+    """
+    :param ast.FunctionDef py_ast: translated C function
+    :param str filename: for the code object, e.g. the C source file
+    :return: the code object of the function, or None if it cannot be created without its def statement
+    :rtype: types.CodeType|None
+    """
+    if py_ast.decorator_list or py_ast.args.defaults or getattr(py_ast.args, "kw_defaults", None):
+        return None
+    module_ast = ast.Module(body=[py_ast], type_ignores=[])
+    ast.fix_missing_locations(module_ast)
+    module_code = compile(module_ast, filename, "exec")
+    for const in module_code.co_consts:
+        if isinstance(const, types.CodeType) and const.co_name == py_ast.name:
+            if const.co_freevars:
+                return None
+            return const
+    return None
+
+
+def write_code_table(module_filename, code_table):
+    """
+    :param str module_filename: the code table goes next to it, to <module>.pyfuncs
+    :param dict[str,types.CodeType] code_table: func name -> code
+    """
+    with open(os.path.splitext(module_filename)[0] + ".pyfuncs", "wb") as f:
+        f.write(importlib.util.MAGIC_NUMBER)
+        marshal.dump(code_table, f)
+
+
+def load_code_table(module_filename):
+    fn = os.path.splitext(module_filename)[0] + '.pyfuncs'
+    with open(fn, 'rb') as f:
+        if f.read(len(importlib.util.MAGIC_NUMBER)) != importlib.util.MAGIC_NUMBER:
+            raise ImportError('%s was compiled for another Python version' % fn)
+        return marshal.load(f)
+
+
+def make_function(code_table, name, func_globals):
+    return types.FunctionType(code_table[name], func_globals, name)
+
+
+def get_code_table_loader_source():
+    """
+    :return: source of load_code_table() and make_function(), for the compiled output.
+      It needs the modules importlib.util, marshal, os and types
+    :rtype: str
+    """
+    return "\n".join(inspect.getsource(func) for func in [load_code_table, make_function]) + "\n"
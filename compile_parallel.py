@@ -0,0 +1,131 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Parallel function translation for compile_to_py.
+
+Once the structs, unions and values are written, the translation of every
+function is independent of the others, except for the wrapped values which
+a translation registers: CodeGen writes those to the output right when they
+are registered, and their names depend on the order.
+
+We fork workers from the CodeGen right before write_globals() and let them
+translate and render chunks of functions (CodeGen._render_func). The parent
+writes the results in contentlist order. A worker result is dropped, and the
+parent translates the function again in order, if
+
+* the translation raised an exception (so that the "Compile exception"
+  placeholder and the report are exactly as in a serial run),
+* the translation registered new wrapped values,
+* the result refers to wrapped values which another function in the same
+  worker has registered.
+
+Thus the output is the same as with a serial run.
+"""
+
+from __future__ import print_function
+
+import marshal
+import multiprocessing
+import time
+
+from translate_cache import get_code_names
+
+# Set in the parent right before we fork the workers.
+_job_code_gen = None  # type: compile_to_py.CodeGen|None
+_job_funcs = None  # type: list[cparser.CFunc]|None
+_job_values_at_fork = None  # type: set[str]|None  # names of the wrapped values
+_in_worker = False
+
+
+def in_worker():
+    """
+    :return: whether we are in a worker process, where we must not write anything
+    :rtype: bool
+    """
+    return _in_worker
+
+
+def _refers_to_values(rendered, value_names):
+    """
+    :param dict[str] rendered: from CodeGen._render_func()
+    :param set[str] value_names:
+    :rtype: bool
+    """
+    if not value_names:
+        return False
+    if any(("values.%s" % name) in rendered["text"] for name in value_names):
+        return True
+    if rendered["code"] is not None:
+        return bool(value_names & get_code_names(rendered["code"][1]))
+    return False
+
+
+def _render_funcs_job(indices):
+    """
+    Runs in a forked worker.
+
+    :param list[int] indices: into _job_funcs
+    :return: (index, rendered) for all functions which we could translate without side effects.
+      code objects are marshalled
+    :rtype: list[(int,dict[str])]
+    """
+    global _in_worker
+    _in_worker = True
+    code_gen = _job_code_gen
+    wrapped_values = code_gen.interpreter.wrappedValues
+    results = []
+    for i in indices:
+        values_before = set(wrapped_values.list)
+        try:
+            rendered = code_gen._render_func(_job_funcs[i])
+        except Exception:
+            continue
+        if wrapped_values.list != values_before:
+            continue
+        if _refers_to_values(rendered, set(wrapped_values.list) - _job_values_at_fork):
+            continue
+        if rendered["code"] is not None:
+            name, code = rendered["code"]
+            rendered["code"] = (name, marshal.dumps(code))
+        results.append((i, rendered))
+    return results
+
+
+def render_funcs(code_gen, jobs):
+    """
+    :param compile_to_py.CodeGen code_gen: right before write_globals() writes the functions
+    :param int jobs: number of worker processes
+    :return: id(func) -> rendered, for CodeGen._prerendered
+    :rtype: dict[int,dict[str]]
+    """
+    global _job_code_gen, _job_funcs, _job_values_at_fork
+    funcs = code_gen.get_funcs_to_translate()
+    print("Translate %i functions in %i jobs..." % (len(funcs), jobs))
+    start_time = time.time()
+    chunk_size = max(1, len(funcs) // (jobs * 16))
+    chunks = [list(range(i, min(i + chunk_size, len(funcs)))) for i in range(0, len(funcs), chunk_size)]
+    # The workers must not write to the output, but their copies of the file buffers would be flushed otherwise.
+    code_gen.f.flush()
+    for shard_f in code_gen._shard_files.values():
+        shard_f.flush()
+    results = {}
+    _job_code_gen, _job_funcs = code_gen, funcs
+    _job_values_at_fork = set(code_gen.interpreter.wrappedValues.list)
+    try:
+        pool = multiprocessing.get_context("fork").Pool(processes=jobs)
+        try:
+            for chunk_results in pool.imap_unordered(_render_funcs_job, chunks):
+                for i, rendered in chunk_results:
+                    if rendered["code"] is not None:
+                        name, code_data = rendered["code"]
+                        rendered["code"] = (name, marshal.loads(code_data))
+                    results[id(funcs[i])] = rendered
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _job_code_gen = _job_funcs = _job_values_at_fork = None
+    print("(%i/%i functions translated in workers, %.1fs, the others follow in order)" % (
+        len(results), len(funcs), time.time() - start_time))
+    return results
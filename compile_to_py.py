@@ -11,10 +11,17 @@ import argparse
 from cpython import CPythonState, MyDir
 import cparser
 import cparser.interpreter
+import parse_cache
+import callgraph
+import compile_parallel
+from compile_output import fixed_name, get_shard_module_name, write_shard_header, write_shard_initializers
+from compile_output import write_package_init
+from compile_output import compile_func_ast, write_code_table, get_code_table_loader_source
 from cparser.py_demo_unparse import Unparser
 import time
 import ast
 import ctypes
+import io
 
 
 # See State.CBuiltinTypes.
@@ -83,19 +90,57 @@ def set_name_for_typedeffed_struct(obj, state):
 
 def fix_name(obj):
     assert obj.name
-    if obj.name.startswith("__"):
-        obj.name = "_M_%s" % obj.name[2:]
+    obj.name = fixed_name(obj.name)
 
 
 class CodeGen:
 
-    def __init__(self, f, state, interpreter):
+    def __init__(self, f, state, interpreter, shard_dir=None, bytecode=False, emit_source=False, jobs=1,
+                 dce_roots=None):
+        """
+        :param file f: output file. in sharded mode, this is the _types module of the package
+        :param cparser.State state:
+        :param cparser.interpreter.Interpreter interpreter:
+        :param str|None shard_dir: if given, write a package to this directory.
+          Structs, unions, values and typedefs go to f (the _types module), functions and global
+          variables to one module per source file. The package imports those modules lazily, on
+          first attribute access of g. The initializers of the variables come at the end of their
+          module, see write_shard_initializers.
+        :param bool bytecode: if True, compile the functions directly and write their code objects
+          to a marshal file next to the module (<module>.pyfuncs), instead of the unparsed source.
+          The marshal format depends on the Python version, thus the file starts with
+          importlib.util.MAGIC_NUMBER, and the module only loads with the same Python version.
+        :param bool emit_source: with bytecode, also write the unparsed functions to <module>.pyfuncs.py,
+          for debugging only
+        :param int jobs: if > 1, translate the functions in that many worker processes, see compile_parallel
+        :param list[str]|None dce_roots: if given, only write the global functions and variables
+          which are reachable from these, see callgraph. types are always written
+        """
         self.f = f
         self.state = state
         self.interpreter = interpreter
+        self.shard_dir = shard_dir
+        self._shard_files = {}  # type: dict[str,file]  # module name -> file
+        self._global_modules = {}  # type: dict[str,str]  # global name -> module name, in sharded mode
+        self._shard_initializers = {}  # type: dict[str,list[str]]  # module name -> variable initializers
+        self._cur_module = None  # type: str|None  # module of the global which we currently write
+        self.bytecode = bytecode
+        self.emit_source = emit_source
+        self._code_tables = {}  # type: dict[str,dict[str,types.CodeType]]  # module filename -> func name -> code
+        self._source_files = {}  # type: dict[str,file]  # module filename -> debug source file
+        self.jobs = jobs
+        self._prerendered = {}  # type: dict[int,dict[str]]  # id(func) -> _render_func() result
+        self.dce_roots = dce_roots
+        self._reachable = None  # type: set[str]|None
+        self.dropped = []  # type: list[cparser.CFunc|cparser.CVarDecl]  # by dead-code elimination
         self.structs = {}
         self.unions = {}
         self.delayed_structs = []
+        # State of the struct construction, keyed by id(content), instead of attributes on the parsed objects.
+        self._written_structs = set()  # type: set[int]
+        self._constructing_structs = set()  # type: set[int]
+        self._delayed_parent_types = {}  # type: dict[int,list]  # parent types of delayed structs under construction
+        self._delayed_headers = set()  # type: set[int]
         self._py_in_structs = False
         self._py_in_unions = False
         self._py_in_delayed = False
@@ -115,7 +160,15 @@ class CodeGen:
         f.write("import cparser.interpreter\n")
         f.write("import cparser.cparser_utils\n")
         f.write("import ctypes\n")
+        if self.bytecode:
+            f.write("import importlib.util\n")
+            f.write("import marshal\n")
+            f.write("import os\n")
+            f.write("import types\n")
         f.write("\n")
+        if self.bytecode:
+            f.write(get_code_table_loader_source())
+            f.write("\n")
         f.write("better_exchook.install()\n")
         f.write("cparser.cparser_utils.setup_Structure_debug_helper()\n")
         f.write("intp = cparser.interpreter.Interpreter()\n")
@@ -191,9 +244,9 @@ class CodeGen:
         assert content.name
         if content.body is None:
             raise self.NoBody()
-        if getattr(content, "_comppy_constructing", None):
+        if id(content) in self._constructing_structs:
             raise self.RecursiveConstruction()
-        content._comppy_constructing = True
+        self._constructing_structs.add(id(content))
         base_type = {cparser.CStruct: "struct", cparser.CUnion: "union"}[type(content)]
         ctype_base = {"struct": "ctypes.Structure", "union": "ctypes.Union"}[base_type]
         struct_dict = {"struct": self.structs, "union": self.unions}[base_type]
@@ -212,7 +265,7 @@ class CodeGen:
                 else:
                     fields.append("(%r, %s)" % (str(c.name), t))
         finally:
-            content._comppy_constructing = False
+            self._constructing_structs.discard(id(content))
         f = self.f
         f.write("class _class_%s_%s(%s):\n" % (base_type, content.name, ctype_base))
         f.write("    _fields_ = [\n")
@@ -220,7 +273,7 @@ class CodeGen:
         f.write("%ss.%s = _class_%s_%s\n" % (base_type, content.name, base_type, content.name))
         f.write("del _class_%s_%s\n" % (base_type, content.name))
         f.write("\n")
-        content._comppy_written = True
+        self._written_structs.add(id(content))
         assert content.name not in struct_dict
         struct_dict[content.name] = content
 
@@ -237,7 +290,7 @@ class CodeGen:
         assert content.body is not None
         base_type = {cparser.CStruct: "struct", cparser.CUnion: "union"}[type(content)]
         struct_dict = {"struct": self.structs, "union": self.unions}[base_type]
-        if getattr(content, "_comppy_written", None):
+        if id(content) in self._written_structs:
             assert struct_dict[content.name] is content
             return
         try:
@@ -246,7 +299,6 @@ class CodeGen:
             if content not in self.delayed_structs:
                 assert content.name not in struct_dict
                 self.delayed_structs.append(content)
-                content._delayed_write = True
 
     def _check_local_struct_type(self, t):
         if not t.name:
@@ -274,10 +326,10 @@ class CodeGen:
         struct_dict = getattr(self, "%ss" % base_type)
         assert content.name not in struct_dict
         ctype_base = {"struct": "ctypes.Structure", "union": "ctypes.Union"}[base_type]
-        if not getattr(content, "_wrote_header", False):
+        if id(content) not in self._delayed_headers:
             f.write("%sclass _class_%s_%s(%s): pass\n" % (indent, base_type, content.name, ctype_base))
             f.write("%s%ss.%s = _class_%s_%s\n" % (indent, base_type, content.name, base_type, content.name))
-            content._wrote_header = True
+            self._delayed_headers.add(id(content))
         if content.body is None:
             return
 
@@ -292,20 +344,21 @@ class CodeGen:
                 if not isinstance(parent_type, cparser.CTypedef):
                     break
 
-        if getattr(content, "_comppy_constructing", None):
+        parent_types = self._delayed_parent_types.get(id(content))
+        if parent_types:
             if parent_type is not None:
                 # If the parent referred to us as a pointer, it's fine,
                 # we can use our incomplete type and don't need to construct it now.
                 if cparser.isPointerType(parent_type, alsoFuncPtr=True, alsoArray=False):
                     return
             # Otherwise, we must construct it now.
-            content._comppy_constructing.append(parent_type)
-            if len(content._comppy_constructing) > 2:
+            parent_types.append(parent_type)
+            if len(parent_types) > 2:
                 # We got called more than once. This is an infinite loop.
                 raise self.RecursiveConstruction(
-                    "The parent types when we were called: %s" % (content._comppy_constructing,))
+                    "The parent types when we were called: %s" % (parent_types,))
         else:
-            content._comppy_constructing = [parent_type]
+            parent_types = self._delayed_parent_types[id(content)] = [parent_type]
         fields = []
         try:
             for c in content.body.contentlist:
@@ -320,7 +373,7 @@ class CodeGen:
                 else:
                     fields.append("(%r, %s)" % (str(c.name), t))
         finally:
-            content._comppy_constructing.pop()
+            parent_types.pop()
 
         # finalize the type
         if content.name not in struct_dict:
@@ -352,7 +405,8 @@ class CodeGen:
 
     def _get_py_type(self, t):
         if isinstance(t, cparser.CTypedef):
-            if self._py_in_globals:
+            # In the sharded output, the typedef names are only in scope in the _types module.
+            if self._py_in_globals and self._cur_module in (None, "_types"):
                 assert t.name, "typedef target typedef must have name"
                 return t.name
             return self.get_py_type(t.type)
@@ -400,6 +454,11 @@ class CodeGen:
                     and isinstance(value.value, ast.Name)
                     and value.value.id == "g"):  # found one
                 assert value.attr in self._py_globals
+                if self.shard_dir:
+                    # Names from other modules are resolved (lazily) via g.
+                    if self._global_modules.get(value.attr) != self._cur_module:
+                        return value
+                    return ast.Name(id=value.attr, ctx=ast.Load())
                 if isinstance(self._py_globals[value.attr], cparser.CFunc):
                     # overwrite this with "something.__func__" to resolve the staticmethod
                     return ast.Attribute(
@@ -420,10 +479,85 @@ class CodeGen:
                 elif isinstance(value, tuple):
                     setattr(node, fieldname, tuple(map(maybe_replace, value)))
 
+    def _get_shard_file(self, module_name):
+        """
+        :param str module_name: e.g. "_local_types" or from get_shard_module_name()
+        :return: the file of this module in the package. opens it on first use
+        :rtype: file
+        """
+        if module_name == "_types":
+            return self.f
+        if module_name not in self._shard_files:
+            f = open("%s/%s.py" % (self.shard_dir, module_name), "w")
+            write_shard_header(f, module_name, bytecode=self.bytecode)
+            self._shard_files[module_name] = f
+        return self._shard_files[module_name]
+
+    def _select_global_module(self, content):
+        """
+        :param object content: declaration from the contentlist
+        :return: the file to write this global to, and the indent
+        :rtype: (file,str)
+        """
+        if not self.shard_dir:
+            return self.f, "    "
+        if isinstance(content, (cparser.CFunc, cparser.CVarDecl)):
+            self._cur_module = get_shard_module_name(content)
+        else:  # typedefs, enums
+            self._cur_module = "_types"
+        self._global_modules[content.name] = self._cur_module
+        return self._get_shard_file(self._cur_module), ""
+
+    def get_funcs_to_translate(self):
+        """
+        :return: the functions which write_globals() will probably translate, in order.
+          Like write_globals(), but without the duplicate handling
+        :rtype: list[cparser.CFunc]
+        """
+        funcs = []
+        seen = set()
+        for content in self.state.contentlist:
+            try:
+                if cparser.isExternDecl(content):
+                    content = self.state.getResolvedDecl(content)
+                    if not cparser.isExternDecl(content):
+                        continue  # we will get it later
+            except Exception:
+                continue  # write_globals() will report it
+            if not isinstance(content, cparser.CFunc) or not content.name or id(content) in seen:
+                continue
+            fix_name(content)
+            if self._is_dropped(content):
+                continue
+            seen.add(id(content))
+            funcs.append(content)
+        return funcs
+
+    def _is_dropped(self, content):
+        """
+        :param object content: global declaration, with fixed name
+        :return: whether dead-code elimination drops it
+        :rtype: bool
+        """
+        if self._reachable is None:
+            return False
+        if not isinstance(content, (cparser.CFunc, cparser.CVarDecl)):
+            return False
+        return content.name not in self._reachable
+
     def write_globals(self):
         self._py_in_globals = True
-        f = self.f
-        f.write("class g:\n")
+        if self.dce_roots is not None:
+            print("Dead-code elimination, roots %s..." % ", ".join(self.dce_roots))
+            # Some declarations have their fixed names already, see fix_names(). _is_dropped() compares fixed names.
+            graph = callgraph.rename_graph(callgraph.build_graph(self.state), fixed_name)
+            self._reachable = callgraph.find_reachable(graph, [fixed_name(name) for name in self.dce_roots])
+        if not self.shard_dir:
+            if self.bytecode:
+                self.f.write("_code = load_code_table(__file__)\n\n")
+            self.f.write("class g:\n")
+        if self.jobs > 1:
+            self._prerendered = compile_parallel.render_funcs(self, self.jobs)
         last_log_time = time.time()
         count = count_incomplete = 0
         for i, content in enumerate(self.state.contentlist):
@@ -455,50 +589,143 @@ class CodeGen:
                     self._py_globals[content.name] = content
                 else:
                     continue
+                if self._is_dropped(content):
+                    self.dropped.append(content)
+                    continue
+                f, indent = self._select_global_module(content)
                 if isinstance(content, cparser.CFunc):
-                    funcEnv = self.interpreter._translateFuncToPyAst(content, noBodyMode="code-with-exception")
-                    pyAst = funcEnv.astNode
-                    assert isinstance(pyAst, ast.FunctionDef)
-                    pyAst.decorator_list.append(ast.Name(id="staticmethod", ctx=ast.Load()))
-                    Unparser(pyAst, indent=1, file=f)
-                    f.write("\n")
+                    rendered = self._prerendered.pop(id(content), None)
+                    if rendered is None:
+                        rendered = self._render_func(content)
+                    self._write_rendered_func(f, rendered)
                 elif isinstance(content, (cparser.CStruct, cparser.CUnion)):
                     pass  # Handled in the other loops.
                 elif isinstance(content, cparser.CTypedef):
-                    f.write("    %s = %s\n" % (content.name, self.get_py_type(content.type)))
+                    f.write("%s%s = %s\n" % (indent, content.name, self.get_py_type(content.type)))
                 elif isinstance(content, cparser.CVarDecl):
                     # See cparser.interpreter.GlobalScope.getVar() for reference.
                     decl_type, bodyAst, bodyType = \
                         self.interpreter.globalScope._getDeclTypeBodyAstAndType(content)
                     pyEmptyAst = self.interpreter.globalScope._getEmptyValueAst(decl_type)
                     self._fixup_global_g_inner(pyEmptyAst)
-                    f.write("    %s = " % content.name)
+                    f.write("%s%s = " % (indent, content.name))
                     Unparser(pyEmptyAst, file=f)
                     f.write("\n")
                     bodyValueAst = self.interpreter.globalScope._getVarBodyValueAst(
                         content, decl_type, bodyAst, bodyType)
                     if bodyValueAst is not None:
                         self._fixup_global_g_inner(bodyValueAst)
-                        f.write("    helpers.assign(%s, " % content.name)
-                        Unparser(bodyValueAst, file=f)
-                        f.write(")\n")
+                        init_f = io.StringIO() if self.shard_dir else f
+                        init_f.write("%shelpers.assign(%s, " % (indent, content.name))
+                        Unparser(bodyValueAst, file=init_f)
+                        init_f.write(")\n")
+                        if self.shard_dir:
+                            self._shard_initializers.setdefault(self._cur_module, []).append(init_f.getvalue())
                 elif isinstance(content, cparser.CEnum):
                     int_type_name = content.getMinCIntType()
-                    f.write("    %s = ctypes_wrapped.%s\n" % (content.name, stdint_ctypes_name(int_type_name)))
+                    f.write("%s%s = ctypes_wrapped.%s\n" % (indent, content.name, stdint_ctypes_name(int_type_name)))
                 else:
                     raise Exception("unexpected content type: %s" % type(content))
             except Exception as exc:
                 print("!!! Exception while compiling %r" % content)
                 if content.name:
-                    f.write("    %s = 'Compile exception ' %r\n" % (content.name, str(exc)))
+                    f, indent = self._select_global_module(content)
+                    f.write("%s%s = 'Compile exception ' %r\n" % (indent, content.name, str(exc)))
                 sys.excepthook(*sys.exc_info())
         # We continue...
-        f.write("\n\n")
+        self.f.write("\n\n")
+        self._prerendered.clear()
+        self._cur_module = None
         self._py_in_globals = False
 
+    def write_dce_report(self, fn):
+        """
+        :param str fn: text file which lists the declarations dropped by dead-code elimination
+        """
+        with open(fn, "w") as f:
+            f.write("# Dropped by dead-code elimination, roots: %s\n" % ", ".join(self.dce_roots or []))
+            f.write("# %i functions and variables\n" % len(self.dropped))
+            for content in self.dropped:
+                f.write("%s %s  # %s\n" % (
+                    content.__class__.__name__, content.name, getattr(content, "defPos", "<unknown source>")))
+
+    def _render_func(self, content):
+        """
+        Translates the function. This does not write anything, so that it can run in a worker process,
+        except for the wrapped values which the translation registers (see _new_wrapped_value_callback).
+
+        :param cparser.CFunc content:
+        :return: dict with "text" (for the module), "code" ((name, code object) or None, see CodeGen.__init__)
+          and "source" (for the debug source file, or None)
+        :rtype: dict[str]
+        """
+        indent = "" if self.shard_dir else "    "
+        funcEnv = self.interpreter._translateFuncToPyAst(content, noBodyMode="code-with-exception")
+        pyAst = funcEnv.astNode
+        assert isinstance(pyAst, ast.FunctionDef)
+        rendered = {"code": None, "source": None}
+        if self.bytecode:
+            if self.emit_source:
+                source_f = io.StringIO()
+                Unparser(pyAst, file=source_f)
+                source_f.write("\n")
+                rendered["source"] = source_f.getvalue()
+            # Tracebacks then point to the C source file. The line numbers are from the Python AST though.
+            filename = str(getattr(content, "defPos", None) or "<cpython_static>").split(":")[0]
+            code = compile_func_ast(pyAst, filename)
+            if code is not None:
+                rendered["code"] = (pyAst.name, code)
+                if self.shard_dir:
+                    rendered["text"] = "%s%s = make_function(_code, %r, globals())\n" % (
+                        indent, content.name, pyAst.name)
+                else:
+                    rendered["text"] = "%s%s = staticmethod(make_function(_code, %r, globals()))\n" % (
+                        indent, content.name, pyAst.name)
+                return rendered
+            # Otherwise, fall back to the source.
+        if not self.shard_dir:
+            pyAst.decorator_list.append(ast.Name(id="staticmethod", ctx=ast.Load()))
+        text_f = io.StringIO()
+        Unparser(pyAst, indent=len(indent) // 4, file=text_f)
+        text_f.write("\n")
+        rendered["text"] = text_f.getvalue()
+        return rendered
+
+    def _write_rendered_func(self, f, rendered):
+        """
+        :param file f: module
+        :param dict[str] rendered: from _render_func()
+        """
+        if rendered["source"] is not None:
+            if f.name not in self._source_files:
+                self._source_files[f.name] = open(os.path.splitext(f.name)[0] + ".pyfuncs.py", "w")
+            self._source_files[f.name].write(rendered["source"])
+        if rendered["code"] is not None:
+            name, code = rendered["code"]
+            self._code_tables.setdefault(f.name, {})[name] = code
+        f.write(rendered["text"])
+
+    def write_code_tables(self):
+        """
+        Writes the marshal files with the function code objects, see CodeGen.__init__.
+        """
+        for module_fn, code_table in sorted(self._code_tables.items()):
+            write_code_table(module_fn, code_table)
+        for source_f in self._source_files.values():
+            source_f.close()
+        self._source_files.clear()
+
     def _new_wrapped_value_callback(self, name, value):
         assert self._py_in_globals
         assert isinstance(value, cparser.CWrapValue)
+        if compile_parallel.in_worker():
+            return  # The parent translates this function again, see compile_parallel.
+        if self.shard_dir:
+            # Other modules can refer to the same value, so all go to a common module,
+            # which the package imports right after _types.
+            f, indent = self._get_shard_file("_local_types"), ""
+        else:
+            f, indent = self.f, "    "
         if issubclass(value.value, (ctypes.Structure, ctypes.Union)):
             # Created via cparser._getCTypeStruct().
             assert isinstance(value.value._py, (cparser.CStruct, cparser.CUnion))
@@ -506,11 +733,15 @@ class CodeGen:
             base_type = {cparser.CStruct: "struct", cparser.CUnion: "union"}[type(t)]
             assert not t.name
             t.name = "_local_" + self._get_anonymous_name()
-            self._write_delayed_struct(t, indent="    ")
-            self.f.write("    values.%s = cparser.CWrapValue(%ss.%s)\n" % (name, base_type, t.name))
+            orig_f, self.f = self.f, f
+            try:
+                self._write_delayed_struct(t, indent=indent)
+            finally:
+                self.f = orig_f
+            f.write("%svalues.%s = cparser.CWrapValue(%ss.%s)\n" % (indent, name, base_type, t.name))
         else:
-            self.f.write("    values.%s = None  # TODO CWrapValue(value=%r, decl=%r, name=%r)\n" % (
-                name, value.value, value.decl, value.name))
+            f.write("%svalues.%s = None  # TODO CWrapValue(value=%r, decl=%r, name=%r)\n" % (
+                indent, name, value.value, value.decl, value.name))
 
     def write_values(self):
         f = self.f
@@ -536,24 +767,85 @@ class CodeGen:
             self.interpreter.wrappedValues.callbacks_register_new.append(self._new_wrapped_value_callback)
 
     def write_footer(self):
+        self.write_code_tables()
+        if self.shard_dir:
+            self._write_package_footer()
+            return
         f = self.f
         f.write("if __name__ == '__main__':\n")
-        f.write("    g.Py_Main(ctypes_wrapped.c_int(len(sys.argv)),\n"
-                "              (ctypes.POINTER(ctypes_wrapped.c_char) * (len(sys.argv) + 1))(\n"
-                "               *[ctypes.cast(intp._make_string(arg), ctypes.POINTER(ctypes_wrapped.c_char))\n"
-                "                 for arg in sys.argv]))\n")
+        self._write_main_call(f)
         f.write("\n")
 
+    def _write_main_call(self, f, indent="    "):
+        f.write(indent + "g.Py_Main(ctypes_wrapped.c_int(len(sys.argv)),\n" +
+                indent + "          (ctypes.POINTER(ctypes_wrapped.c_char) * (len(sys.argv) + 1))(\n" +
+                indent + "           *[ctypes.cast(intp._make_string(arg), ctypes.POINTER(ctypes_wrapped.c_char))\n" +
+                indent + "             for arg in sys.argv]))\n")
+
+    def _write_package_footer(self):
+        for module_name, initializers in sorted(self._shard_initializers.items()):
+            write_shard_initializers(self._get_shard_file(module_name), initializers)
+        self._shard_initializers.clear()
+        # Exists even if no value needed it, because the package imports it.
+        self._get_shard_file("_local_types")
+        for shard_f in self._shard_files.values():
+            shard_f.close()
+        self._shard_files.clear()
+
+        with open("%s/__init__.py" % self.shard_dir, "w") as f:
+            write_package_init(f, self._global_modules)
+
+        with open("%s/__main__.py" % self.shard_dir, "w") as f:
+            f.write("# PyCPython - interpret CPython in Python\n")
+            f.write("# Statically compiled CPython. Run via python -m.\n\n")
+            f.write("import sys\n")
+            f.write("import ctypes\n")
+            f.write("from . import g, intp, ctypes_wrapped\n")
+            f.write("\n")
+            self._write_main_call(f, indent="")
+
 
 def main(argv):
+    argparser = argparse.ArgumentParser(description="Compile CPython to Python code.")
+    argparser.add_argument(
+        '--sharded', action='store_true',
+        help="Write a package (cpython_static/) with one module per C source file, "
+             "where function modules are imported on first use.")
+    argparser.add_argument(
+        '--bytecode', action='store_true',
+        help="Compile the functions directly to code objects, stored in a marshal file next to the module, "
+             "instead of writing their source. Loads only with the same Python version.")
+    argparser.add_argument(
+        '--emit-source', action='store_true',
+        help="With --bytecode, also write the function source, for debugging.")
+    argparser.add_argument(
+        '--jobs', type=int, default=1, metavar="N",
+        help="Translate the functions in N worker processes. The output is the same as with one.")
+    argparser.add_argument(
+        '--dce', action='store_true',
+        help="Only write the functions and global variables which are reachable from Py_Main "
+             "(and the --dce-root ones). The dropped ones are listed in a report next to the output.")
+    argparser.add_argument(
+        '--dce-root', action='append', default=[], metavar="NAME",
+        help="Additional root for --dce, e.g. a function which is only called from Python.")
+    args_ns = argparser.parse_args(argv[1:])
+
     state = CPythonState()
 
-    out_fn = MyDir + "/cpython_static.py"
-    print("Compile CPython to %s." % os.path.basename(out_fn))
+    if args_ns.sharded:
+        shard_dir = MyDir + "/cpython_static"
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+        out_fn = shard_dir + "/_types.py"
+        print("Compile CPython to package %s." % os.path.basename(shard_dir))
+    else:
+        shard_dir = None
+        out_fn = MyDir + "/cpython_static.py"
+        print("Compile CPython to %s." % os.path.basename(out_fn))
 
     print("Parsing CPython...", end="")
     try:
-        state.parse_cpython()
+        parse_cache.parse_cpython(state)
     except Exception:
         print("!!! Exception while parsing. Should not happen. Cannot recover. Please report this bug.")
         print("The parser currently is here:", state.curPosAsStr())
@@ -570,7 +862,10 @@ def main(argv):
 
     print("Compile...")
     f = open(out_fn, "w")
-    code_gen = CodeGen(f, state, interpreter)
+    code_gen = CodeGen(
+        f, state, interpreter, shard_dir=shard_dir,
+        bytecode=args_ns.bytecode, emit_source=args_ns.emit_source, jobs=args_ns.jobs,
+        dce_roots=(["Py_Main"] + args_ns.dce_root) if args_ns.dce else None)
     code_gen.write_header()
     code_gen.fix_names()
     code_gen.write_structs()
@@ -580,6 +875,11 @@ def main(argv):
     code_gen.write_globals()
     code_gen.write_footer()
     f.close()
+    if code_gen.dce_roots is not None:
+        report_fn = (shard_dir or os.path.splitext(out_fn)[0]) + ".dropped.txt"
+        code_gen.write_dce_report(report_fn)
+        print("Dropped %i unreachable functions and variables, see %s." % (
+            len(code_gen.dropped), os.path.basename(report_fn)))
 
     print("Done.")
 
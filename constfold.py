@@ -0,0 +1,215 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Constant folding of C expressions at translation time.
+
+Macro-expanded constant expressions (Py_ARRAY_LENGTH, SIZEOF_*,
+_Py_SIZE_ROUND_UP, the obmalloc size class arithmetic, flag masks, ...)
+are translated to ctypes arithmetic which runs again on every execution.
+
+We hook into the translation of single C expressions
+(cparser.interpreter.astAndTypeForStatement). When the resulting Python
+expression refers only to ctypes and the C types (see ConstNames), we
+evaluate it once at translation time, with the same ctypes semantics
+(C integer types, wrap-around) as at runtime, and replace it by the
+construction of the result type from a literal. Subexpressions are
+translated first, so they are already folded when we see the outer
+expression.
+
+Only integer results are folded. As a self-check, we evaluate the folded
+expression as well and keep the original one if the results differ.
+"""
+
+from __future__ import print_function
+
+import ast
+import contextlib
+import copy
+import ctypes
+
+# Names which a constant expression can refer to.
+ConstNames = {"ctypes", "ctypes_wrapped", "structs", "unions"}
+
+# Functions of the ctypes module which a constant expression can call. Also all the c_* types.
+ConstCtypesFuncs = {"sizeof", "alignment", "cast", "POINTER"}
+
+_ConstNodeTypes = (
+    ast.Call, ast.Attribute, ast.Name, ast.Constant, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.keyword, ast.expr_context, ast.operator, ast.unaryop, ast.boolop, ast.cmpop)
+
+
+def _get_root_name(node):
+    """
+    :param ast.AST node:
+    :return: for an attribute chain like a.b.c, the name a, otherwise None
+    :rtype: str|None
+    """
+    while isinstance(node, ast.Attribute):
+        node = node.value
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+
+def _is_const_call(node):
+    """
+    :param ast.Call node:
+    :rtype: bool
+    """
+    root = _get_root_name(node.func)
+    if root not in ConstNames or not isinstance(node.func, ast.Attribute):
+        return False
+    if root == "ctypes":
+        return node.func.attr in ConstCtypesFuncs or node.func.attr.startswith("c_")
+    return True
+
+
+def is_const_expr(node):
+    """
+    :param ast.AST node: translated C expression
+    :return: whether it can be evaluated at translation time
+    :rtype: bool
+    """
+    for sub in ast.walk(node):
+        if not isinstance(sub, _ConstNodeTypes):
+            return False
+        if isinstance(sub, ast.Name) and (sub.id not in ConstNames or not isinstance(sub.ctx, ast.Load)):
+            return False
+        if isinstance(sub, ast.Call) and not _is_const_call(sub):
+            return False
+    return True
+
+
+def is_literal(node):
+    """
+    :param ast.AST node:
+    :return: whether it is a literal, or the construction of a type from a literal. nothing left to fold
+    :rtype: bool
+    """
+    if isinstance(node, ast.Constant):
+        return True
+    return (
+        isinstance(node, ast.Call) and _get_root_name(node.func) is not None
+        and not node.keywords and all(isinstance(arg, ast.Constant) for arg in node.args))
+
+
+def _get_int(value):
+    """
+    :param object value: result of a translated C expression
+    :return: the integer value, or None if it is not an integer
+    :rtype: int|None
+    """
+    if type(value) is int:
+        return value
+    if isinstance(value, ctypes._SimpleCData) and type(value.value) is int:
+        return value.value
+    return None
+
+
+class ConstFolder:
+
+    def __init__(self, interpreter):
+        """
+        :param cparser.interpreter.Interpreter interpreter:
+        """
+        self.interpreter = interpreter
+        self.num_folded = 0
+        self.num_failed = 0  # constant by the names, but the evaluation failed
+        self._namespace = None  # type: dict[str]|None
+        self._orig_ast_and_type_for_statement = None
+        self._ast_and_type_for_statement = None  # our hook, while installed
+
+    def _get_namespace(self):
+        if self._namespace is None:
+            namespace = getattr(self.interpreter, "globalsDict", None)
+            if namespace is None:
+                namespace = {"ctypes": ctypes, "ctypes_wrapped": self.interpreter.ctypes_wrapped}
+            self._namespace = namespace
+        return self._namespace
+
+    def evaluate(self, node):
+        """
+        :param ast.expr node: constant expression, see is_const_expr
+        :return: the value, as the translated code would compute it at runtime
+        """
+        expr = ast.fix_missing_locations(ast.Expression(body=copy.deepcopy(node)))
+        return eval(compile(expr, "<constfold>", "eval"), self._get_namespace())
+
+    def fold(self, funcEnv, node, c_type):
+        """
+        :param cparser.interpreter.FuncEnv funcEnv:
+        :param ast.expr node: translated C expression
+        :param c_type: C type of the expression
+        :return: the folded expression, or node if we cannot fold it
+        :rtype: ast.expr
+        """
+        if is_literal(node) or not is_const_expr(node):
+            return node
+        try:
+            value = self.evaluate(node)
+            int_value = _get_int(value)
+            if int_value is None:
+                return node
+            if type(value) is int:
+                folded = ast.Constant(value=int_value)
+            else:
+                import cparser.interpreter
+                folded = cparser.interpreter.getAstNode_newTypeInstance(
+                    funcEnv, c_type, ast.Constant(value=int_value))
+                check_value = self.evaluate(folded)
+                if type(check_value) is not type(value) or _get_int(check_value) != int_value:
+                    return node
+        except Exception:
+            self.num_failed += 1
+            return node
+        self.num_folded += 1
+        return folded
+
+    def install(self):
+        """
+        Hooks into the translation. Only the translation for our interpreter is folded.
+        """
+        import cparser.interpreter
+        assert self._ast_and_type_for_statement is None, "already installed"
+        orig_ast_and_type_for_statement = cparser.interpreter.astAndTypeForStatement
+
+        def astAndTypeForStatement(funcEnv, stmnt):
+            node, c_type = orig_ast_and_type_for_statement(funcEnv, stmnt)
+            owner = getattr(getattr(funcEnv, "globalScope", None), "interpreter", self.interpreter)
+            if owner is not self.interpreter:
+                return node, c_type
+            return self.fold(funcEnv, node, c_type), c_type
+
+        self._orig_ast_and_type_for_statement = orig_ast_and_type_for_statement
+        self._ast_and_type_for_statement = astAndTypeForStatement
+        cparser.interpreter.astAndTypeForStatement = astAndTypeForStatement
+
+    def uninstall(self):
+        """
+        Restores cparser.interpreter.astAndTypeForStatement. Hooks installed after ours must be uninstalled first.
+        """
+        import cparser.interpreter
+        assert self._ast_and_type_for_statement is not None, "not installed"
+        assert cparser.interpreter.astAndTypeForStatement is self._ast_and_type_for_statement, "hooked again after us"
+        cparser.interpreter.astAndTypeForStatement = self._orig_ast_and_type_for_statement
+        self._orig_ast_and_type_for_statement = self._ast_and_type_for_statement = None
+
+    @contextlib.contextmanager
+    def installed(self):
+        self.install()
+        try:
+            yield self
+        finally:
+            self.uninstall()
+
+
+def install(interpreter):
+    """
+    :param cparser.interpreter.Interpreter interpreter: after interpreter.register(state)
+    :return: the folder, for its statistics
+    :rtype: ConstFolder
+    """
+    folder = ConstFolder(interpreter)
+    folder.install()
+    return folder
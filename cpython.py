@@ -6,6 +6,7 @@
 from __future__ import print_function
 
 import argparse
+import atexit
 import os
 import sys
 
@@ -15,15 +16,134 @@ CPythonDir = MyDir + "/CPython"
 
 import cparser
 import cparser.interpreter
+import allocator
+import constfold
+import heap
+from include_cache import include_cache
+import lazy_parse
+import lineprofiler
+import native_bindings
+import overrides
+import parse_cache
+import parse_incremental
+import prefork
+import prelude
+import profiler
+import struct_layout
+import switch_dispatch
+import translate_cache
+import unboxing
+from stats import phase_stats
+
+
+class ParseUnit:
+    """
+    One translation unit of CPythonState.parse_cpython(), i.e. one cparser.parse() call.
+    """
+
+    def __init__(self, filename, macros=(), optional=False):
+        """
+        :param str filename: C file, relative to CPythonDir
+        :param list[(str,str|None)] macros: macro changes which we apply before we parse the file.
+          (name, rightside), or (name, None) to undefine the macro.
+        :param bool optional: if set, silently skip it if the file does not exist
+        """
+        self.filename = filename
+        self.macros = list(macros)
+        self.optional = optional
+
+    def __repr__(self):
+        return "ParseUnit(%r, macros=%r, optional=%r)" % (self.filename, self.macros, self.optional)
+
+
+# We keep all in the same state, i.e. the same static space.
+# This also means that we don't reset macro definitions. This speeds up header includes.
+# Usually this is not a problem. Where it is, we have the macro hacks below.
+CPythonParseUnits = [
+    # The common header prelude. Every C file includes it first.
+    # The parallel parsing (parse_parallel) starts every other unit from the state after this one.
+    ParseUnit("Include/Python.h", [
+        ("Py_BUILD_CORE", "1"),  # Makefile
+        ("Py_BUILD_CORE_BUILTIN", "1")]),  # Makefile
+    ParseUnit("Modules/main.c"),  # Py_Main
+    ParseUnit("Python/ceval.c", [  # PyEval_EvalFrameEx etc
+        ("FAST_LOOPS", "0")]),  # not sure where this would come from
+    ParseUnit("Python/getopt.c", [  # _PyOS_GetOpt
+        ("EMPTY", None)]),  # will be redefined later
+    ParseUnit("Python/pythonrun.c"),  # Py_Initialize
+    ParseUnit("Python/pystate.c"),  # PyInterpreterState_New
+    ParseUnit("Python/errors.c"),  # PyErr_Clear
+    ParseUnit("Python/import.c"),  # _PyImport_Fini2
+    ParseUnit("Python/thread.c"),  # PyThread_allocate_lock
+    ParseUnit("Python/bootstrap_hash.c"),  # _Py_ReadHashSeed
+    ParseUnit("Python/pylifecycle.c"),  # _PyRuntime_Initialize, _Py_SetLocaleFromEnv
+    ParseUnit("Python/sysmodule.c", [  # PySys_ResetWarnOptions
+        ("NAME", None)]),  # token.h defines NAME=1; sysmodule.c redefines it as "cpython"
+    ParseUnit("Python/random.c", optional=True),  # _PyRandom_Init
+    ParseUnit("Python/pyhash.c"),  # _Py_HashPointer, _Py_HashDouble, etc.
+    ParseUnit("Objects/object.c"),  # _Py_ReadyTypes etc
+    ParseUnit("Objects/unicodeobject.c"),  # PyUnicode_InternFromString etc.
+    ParseUnit("Objects/typeobject.c"),  # PyType_Ready
+    ParseUnit("Objects/tupleobject.c"),  # PyTuple_New
+    # We need these macro hacks because dictobject.c will use the same vars.
+    ParseUnit("Objects/dictobject.c", [  # PyDict_New
+        ("Return", None),  # will be used differently
+        ("length_hint_doc", "length_hint_doc__dict"),
+        ("numfree", "numfree__dict"),
+        ("free_list", "free_list__dict")]),
+    # We need this macro hack because stringobject.c will use the same var.
+    ParseUnit("Objects/stringobject.c", [  # PyString_FromString
+        ("sizeof__doc__", "sizeof__doc__str")], optional=True),
+    ParseUnit("Objects/obmalloc.c"),  # PyObject_Free
+    ParseUnit("Modules/gcmodule.c"),  # _PyObject_GC_NewVar
+    ParseUnit("Objects/descrobject.c"),  # PyDescr_NewWrapper
+    # We need these macro hacks because methodobject.c will use the same vars.
+    ParseUnit("Objects/methodobject.c", [  # PyCFunction_NewEx
+        ("numfree", "numfree__methodobj"),
+        ("free_list", "free_list__methodobj")]),
+    # We need these macro hacks because methodobject.c used the same vars.
+    ParseUnit("Objects/listobject.c", [  # PyList_New
+        ("numfree", "numfree__list"),
+        ("free_list", "free_list__list"),
+        ("sizeof_doc", "sizeof_doc__list"),
+        ("length_hint_doc", "length_hint_doc__list"),
+        ("index_doc", "index_doc__list"),
+        ("count_doc", "count__list"),
+        ("OFF", None)]),  # reused later
+    ParseUnit("Objects/abstract.c"),  # PySequence_List
+    ParseUnit("Python/modsupport.c"),  # Py_BuildValue
+    # fileutils.c must come before traceback.c (provides _Py_write_noraise)
+    ParseUnit("Python/fileutils.c"),  # _Py_ResetForceASCII, _Py_open_noraise
+    ParseUnit("Python/pathconfig.c"),  # _PyPathConfig_Init
+    ParseUnit("Python/traceback.c"),  # _Py_DumpTracebackThreads
+    ParseUnit("Modules/faulthandler.c", [  # _PyFaulthandler_Fini
+        ("PUTS", None),  # traceback.c and faulthandler.c both define PUTS identically
+        ("OFF", None)]),  # traceback.c and faulthandler.c both define OFF differently
+]
 
 
 class CPythonState(cparser.State):
+    parse_units = CPythonParseUnits
+    # See lazy_parse.
+    lazy_function_bodies = False
+    # See include_cache.
+    use_include_cache = True
 
     def __init__(self):
         super(CPythonState, self).__init__()
         self.autoSetupSystemMacros()
         self.autoSetupGlobalIncludeWrappers()
         self.included_files = set()  # type: set[str]
+        # All files we have read while parsing, in order. See parse_cache.
+        self.input_files = {}  # type: dict[str,None]
+        # If set, all files we have read while parsing the current unit. See parse_incremental.
+        self.unit_input_files = None  # type: dict[str,None]|None
+        # Number of units from parse_units which are already parsed into this state.
+        self.parsed_units = 0
+        # C file of the unit -> parse_incremental.entry_digest() right before it was parsed. See translate_cache.
+        self.unit_entry_digests = {}  # type: dict[str,str]
+        # Function name -> tokens of not yet parsed function bodies. See lazy_parse.
+        self.lazy_bodies = {}  # type: dict[str,(list,list)]
 
     def findIncludeFullFilename(self, filename, local):
         fullfn = CPythonDir + "/Include/" + filename
@@ -78,7 +198,9 @@ class CPythonState(cparser.State):
         # multiple times with different macro definitions (STRINGLIB=ucs1lib_ etc.)
         # and must NOT be deduplicated by filename.
         is_template_header = fullfn and os.path.join(CPythonDir, "Objects", "stringlib") in fullfn
+        if fullfn: self.add_input_file(fullfn)
         if not is_template_header:
+            if fullfn: include_cache.note_include(self, fullfn, fullfn in self.included_files)
             if fullfn and fullfn in self.included_files: return "", fullfn
             if fullfn: self.included_files.add(fullfn)
         return super(CPythonState, self).readLocalInclude(filename)
@@ -88,70 +210,87 @@ class CPythonState(cparser.State):
         fullfn = os.path.join(CPythonDir, "Include", filename)
         if os.path.exists(fullfn):
             return self.readLocalInclude(fullfn)
+        # E.g. a cparser include wrapper, which might do more than the preprocessing.
+        include_cache.note_uncacheable(self)
         return super(CPythonState, self).readGlobalInclude(filename)
 
+    def preprocess(self, reader, fullfilename, filename):
+        orig_preprocess = super(CPythonState, self).preprocess
+        if not self.use_include_cache:
+            return orig_preprocess(reader, fullfilename, filename)
+        return include_cache.preprocess(self, orig_preprocess, reader, fullfilename, filename)
+
+    def add_input_file(self, filename):
+        """
+        :param str filename: file which influences the parsing
+        """
+        self.input_files[filename] = None
+        if self.unit_input_files is not None:
+            self.unit_input_files[filename] = None
+        include_cache.note_input_file(self, filename)
+
+    def parse_file(self, filename, optional=False):
+        """
+        :param str filename: C file to parse into this state
+        :param bool optional: if set, silently skip it if it does not exist
+        """
+        # Also record it if it does not exist. If it appears later, the parse cache must be invalidated.
+        self.add_input_file(filename)
+        if optional and not os.path.exists(filename):
+            return
+        with phase_stats.phase("parse %s" % os.path.relpath(filename, CPythonDir)):
+            if self.lazy_function_bodies:
+                lazy_parse.parse_file(self, filename)
+            else:
+                cparser.parse(filename, self)
+
+    def apply_unit_macros(self, unit):
+        """
+        :param ParseUnit unit:
+        """
+        for name, rightside in unit.macros:
+            if rightside is None:
+                self.macros.pop(name, None)
+            else:
+                self.macros[name] = cparser.Macro(rightside=rightside)
+
+    def get_unit_filename(self, unit):
+        """
+        :param ParseUnit unit:
+        :return: full filename of the C file
+        :rtype: str
+        """
+        return CPythonDir + "/" + unit.filename
+
+    def parse_unit(self, unit):
+        """
+        :param ParseUnit unit:
+        """
+        self.apply_unit_macros(unit)
+        self.unit_entry_digests[self.get_unit_filename(unit)] = parse_incremental.entry_digest(self)
+        self.parse_file(self.get_unit_filename(unit), optional=unit.optional)
+        self.parsed_units += 1
+
     def parse_cpython(self):
-        # We keep all in the same state, i.e. the same static space.
-        # This also means that we don't reset macro definitions. This speeds up header includes.
-        # Usually this is not a problem.
-        self.macros["Py_BUILD_CORE"] = cparser.Macro(rightside="1")  # Makefile
-        self.macros["Py_BUILD_CORE_BUILTIN"] = cparser.Macro(rightside="1")  # Makefile
-        cparser.parse(CPythonDir + "/Modules/main.c", self) # Py_Main
-        self.macros["FAST_LOOPS"] = cparser.Macro(rightside="0")  # not sure where this would come from
-        cparser.parse(CPythonDir + "/Python/ceval.c", self) # PyEval_EvalFrameEx etc
-        del self.macros["EMPTY"]  # will be redefined later
-        cparser.parse(CPythonDir + "/Python/getopt.c", self) # _PyOS_GetOpt
-        cparser.parse(CPythonDir + "/Python/pythonrun.c", self) # Py_Initialize
-        cparser.parse(CPythonDir + "/Python/pystate.c", self) # PyInterpreterState_New
-        cparser.parse(CPythonDir + "/Python/errors.c", self) # PyErr_Clear
-        cparser.parse(CPythonDir + "/Python/import.c", self) # _PyImport_Fini2
-        cparser.parse(CPythonDir + "/Python/thread.c", self) # PyThread_allocate_lock
-        cparser.parse(CPythonDir + "/Python/bootstrap_hash.c", self) # _Py_ReadHashSeed
-        cparser.parse(CPythonDir + "/Python/pylifecycle.c", self) # _PyRuntime_Initialize, _Py_SetLocaleFromEnv
-        self.macros.pop("NAME", None)  # token.h defines NAME=1; sysmodule.c redefines it as "cpython"
-        cparser.parse(CPythonDir + "/Python/sysmodule.c", self) # PySys_ResetWarnOptions
-        if os.path.exists(CPythonDir + "/Python/random.c"):
-            cparser.parse(CPythonDir + "/Python/random.c", self) # _PyRandom_Init
-        cparser.parse(CPythonDir + "/Python/pyhash.c", self) # _Py_HashPointer, _Py_HashDouble, etc.
-        cparser.parse(CPythonDir + "/Objects/object.c", self) # _Py_ReadyTypes etc
-        cparser.parse(CPythonDir + "/Objects/unicodeobject.c", self) # PyUnicode_InternFromString etc.
-        cparser.parse(CPythonDir + "/Objects/typeobject.c", self) # PyType_Ready
-        cparser.parse(CPythonDir + "/Objects/tupleobject.c", self) # PyTuple_New
-        del self.macros["Return"]  # will be used differently
-        # We need these macro hacks because dictobject.c will use the same vars.
-        self.macros["length_hint_doc"] = cparser.Macro(rightside="length_hint_doc__dict")
-        self.macros["numfree"] = cparser.Macro(rightside="numfree__dict")
-        self.macros["free_list"] = cparser.Macro(rightside="free_list__dict")
-        cparser.parse(CPythonDir + "/Objects/dictobject.c", self)  # PyDict_New
-        # We need this macro hack because stringobject.c will use the same var.
-        self.macros["sizeof__doc__"] = cparser.Macro(rightside="sizeof__doc__str")
-        if os.path.exists(CPythonDir + "/Objects/stringobject.c"):
-            cparser.parse(CPythonDir + "/Objects/stringobject.c", self)  # PyString_FromString
-        cparser.parse(CPythonDir + "/Objects/obmalloc.c", self) # PyObject_Free
-        cparser.parse(CPythonDir + "/Modules/gcmodule.c", self) # _PyObject_GC_NewVar
-        cparser.parse(CPythonDir + "/Objects/descrobject.c", self) # PyDescr_NewWrapper
-        # We need these macro hacks because methodobject.c will use the same vars.
-        self.macros["numfree"] = cparser.Macro(rightside="numfree__methodobj")
-        self.macros["free_list"] = cparser.Macro(rightside="free_list__methodobj")
-        cparser.parse(CPythonDir + "/Objects/methodobject.c", self) # PyCFunction_NewEx
-        # We need these macro hacks because methodobject.c used the same vars.
-        self.macros["numfree"] = cparser.Macro(rightside="numfree__list")
-        self.macros["free_list"] = cparser.Macro(rightside="free_list__list")
-        self.macros["sizeof_doc"] = cparser.Macro(rightside="sizeof_doc__list")
-        self.macros["length_hint_doc"] = cparser.Macro(rightside="length_hint_doc__list")
-        self.macros["index_doc"] = cparser.Macro(rightside="index_doc__list")
-        self.macros["count_doc"] = cparser.Macro(rightside="count__list")
-        self.macros.pop("OFF", None)   # reused later
-        cparser.parse(CPythonDir + "/Objects/listobject.c", self) # PyList_New
-        cparser.parse(CPythonDir + "/Objects/abstract.c", self) # PySequence_List
-        cparser.parse(CPythonDir + "/Python/modsupport.c", self) # Py_BuildValue
-        # fileutils.c must come before traceback.c (provides _Py_write_noraise)
-        cparser.parse(CPythonDir + "/Python/fileutils.c", self) # _Py_ResetForceASCII, _Py_open_noraise
-        cparser.parse(CPythonDir + "/Python/pathconfig.c", self) # _PyPathConfig_Init
-        cparser.parse(CPythonDir + "/Python/traceback.c", self) # _Py_DumpTracebackThreads
-        self.macros.pop("PUTS", None)  # traceback.c and faulthandler.c both define PUTS identically
-        self.macros.pop("OFF", None)   # traceback.c and faulthandler.c both define OFF differently
-        cparser.parse(CPythonDir + "/Modules/faulthandler.c", self) # _PyFaulthandler_Fini
+        for unit in self.parse_units[self.parsed_units:]:
+            self.parse_unit(unit)
+
+    @classmethod
+    def from_prelude(cls, use_cache=True):
+        """
+        :param bool use_cache: whether to use the on-disk prelude cache
+        :return: new state where the header prelude (the first parse unit, Python.h) is already parsed.
+          It has its own copy of the prelude declarations, see prelude.
+        :rtype: CPythonState
+        """
+        return prelude.new_state(cls, use_cache=use_cache)
+
+
+class CPythonLazyState(CPythonState):
+    """
+    Function bodies are only parsed when they are needed. See lazy_parse.
+    """
+    lazy_function_bodies = True
 
 
 def init_faulthandler(sigusr1_chain=False):
@@ -201,15 +340,95 @@ def main(argv):
     argparser.add_argument(
         '--verbose-jit', action='store_true',
         help="Prints what functions and global vars we are going to translate.")
+    argparser.add_argument(
+        '--no-parse-cache', action='store_true',
+        help="Always parse CPython and don't use the on-disk parse cache.")
+    argparser.add_argument(
+        '--parse-jobs', type=int, default=1, metavar="N",
+        help="Parse the CPython C files in parallel in N worker processes.")
+    argparser.add_argument(
+        '--lazy-parse', action='store_true',
+        help="Only parse function bodies when the interpreter needs them.")
+    argparser.add_argument(
+        '--no-translate-cache', action='store_true',
+        help="Don't use the on-disk cache of the translated Python code of C functions.")
+    argparser.add_argument(
+        '--no-constfold', action='store_true',
+        help="Don't fold constant C expressions at translation time.")
+    argparser.add_argument(
+        '--no-switch-dispatch', action='store_true',
+        help="Don't lower the translated switch statements (e.g. the opcode switch) to a table dispatch.")
+    argparser.add_argument(
+        '--no-unboxing', action='store_true',
+        help="Keep all scalar C locals as ctypes objects, instead of plain Python ints/floats, see unboxing.")
+    argparser.add_argument(
+        '--struct-access', action='store_true',
+        help="Increment struct fields (e.g. in Py_INCREF) through the struct layout, instead of ctypes.")
+    argparser.add_argument(
+        '--profile', action='store_true',
+        help="Profile the interpreted C functions. Writes a pstats file and prints the top functions at exit.")
+    argparser.add_argument(
+        '--profile-output', default="pycpython.prof", metavar="FILE",
+        help="pstats file for --profile (default: %(default)s).")
+    argparser.add_argument(
+        '--profile-top', type=int, default=30, metavar="N",
+        help="Number of functions in the --profile summary (default: %(default)s).")
+    argparser.add_argument(
+        '--line-profile', action='store_true',
+        help="Count how often every C source line runs. Writes an annotated source report and JSON at exit. "
+             "Disables the translate cache.")
+    argparser.add_argument(
+        '--line-profile-output', default="pycpython-lines", metavar="PREFIX",
+        help="Output for --line-profile, PREFIX.txt and PREFIX.json (default: %(default)s).")
+    argparser.add_argument(
+        '--no-native-bindings', action='store_true',
+        help="Don't call hot libc/libm functions like memcpy or strlen directly, see native_bindings.")
+    argparser.add_argument(
+        '--no-overrides', action='store_true',
+        help="Interpret all parsed C functions, and don't use the Python-native overrides, see overrides.py. "
+             "Overrides for C code which we don't parse are still used.")
+    argparser.add_argument(
+        '--allocator', choices=["c", "pool", "heap"], default="c",
+        help="Memory allocator for PyMem_*/PyObject_*: interpret obmalloc.c (c), "
+             "use the Python-native pool allocator (pool), "
+             "or the pool allocator with mmap-backed large blocks and zero-copy memory ops (heap). "
+             "Default: %(default)s.")
+    argparser.add_argument(
+        '--stats', action='store_true',
+        help="Print time and allocated memory per startup phase, and object counts per top-level phase, at exit. "
+             "Memory tracing slows everything down.")
+    argparser.add_argument(
+        '--stats-json', metavar="FILE",
+        help="Like --stats, but write the phases to this JSON file.")
+    argparser.add_argument(
+        '--prefork-server', metavar="SOCKET",
+        help="Parse and register once, then serve Py_Main runs via this Unix socket, "
+             "each in a forked worker. Submit runs via prefork.py SOCKET [CPython options].")
+    argparser.add_argument(
+        '--prefork-jobs', type=int, default=1, metavar="N",
+        help="Max number of concurrent workers of the --prefork-server (default: %(default)s).")
     args_ns, argv_rest = argparser.parse_known_args(argv[1:])
     argv = argv[:1] + argv_rest
     print("PyCPython -", argparser.description,)
     print("(use --pycpython-help for help)")
 
-    state = CPythonState()
+    if args_ns.stats or args_ns.stats_json:
+        phase_stats.enable()
+
+        def write_stats():
+            if args_ns.stats:
+                phase_stats.print_table()
+            if args_ns.stats_json:
+                phase_stats.write_json(args_ns.stats_json)
+        atexit.register(write_stats)
+
+    with phase_stats.phase("create state"):
+        state = CPythonLazyState() if args_ns.lazy_parse else CPythonState()
 
     print("Parsing CPython...", end="")
-    state.parse_cpython()
+    with phase_stats.phase("parse CPython"):
+        parse_cache.parse_cpython(
+            state, use_cache=not args_ns.no_parse_cache, jobs=args_ns.parse_jobs)
 
     if state._errors:
         print("finished, parse errors:")
@@ -218,52 +437,57 @@ def main(argv):
     else:
         print("finished, no parse errors.")
 
-    interpreter = cparser.interpreter.Interpreter()
-    interpreter.register(state)
-
-    # Py_GetPrefix/ExecPrefix/Path/PythonHome/ProgramFullPath are defined in
-    # pathconfig.c, which is intentionally not parsed.  Their C implementation
-    # calls _PyPathConfig_Init() (from Modules/getpath.c, also not parsed),
-    # which walks the real filesystem to discover where CPython is installed.
-    # That filesystem-discovery logic is platform-specific, requires many
-    # unwrapped syscalls, and would return the *wrong* paths anyway — we want
-    # the host Python's prefix/path so the interpreted CPython can find its
-    # stdlib.  We therefore supply these values directly from the host runtime.
-    import ctypes as _ctypes
-
-    def _make_wchar_const(s):
-        """Create a wchar_t* constant string suitable for returning from Py_Get* functions."""
-        buf = interpreter._make_wchar_string(s)
-        return _ctypes.cast(buf, _ctypes.c_void_p).value or 0
-
-    for _fn, _s in [
-        ("Py_GetProgramFullPath", argv[0]),
-        ("Py_GetPrefix", sys.prefix),
-        ("Py_GetExecPrefix", sys.exec_prefix),
-        ("Py_GetPath", ":".join(sys.path)),
-        ("Py_GetPythonHome", ""),
-    ]:
-        def _make_path_func(s=_s):
-            return _make_wchar_const(s)
-        _make_path_func.C_argTypes = None
-        _make_path_func.C_resType = _ctypes.c_void_p
-        interpreter._func_cache[_fn] = _make_path_func
-
-    # _PyPathConfig_Calculate is defined in Modules/getpath.c (not parsed).
-    # It fills a _PyPathConfig struct from the filesystem.  We provide a stub
-    # that returns success (_PyInitError with msg=NULL) and leaves the config
-    # fields at zero — the public Py_Get* functions above supply the real values.
-    _PyInitError_ctype = interpreter.getCType(state.typedefs['_PyInitError'])
-
-    def _path_config_calculate_stub(*args):
-        return _PyInitError_ctype()  # all-zero = success (msg=NULL)
-
-    _path_config_calculate_stub.C_argTypes = None
-    _path_config_calculate_stub.C_resType = state.typedefs['_PyInitError']
-    interpreter._func_cache['_PyPathConfig_Calculate'] = _path_config_calculate_stub
+    if not args_ns.no_native_bindings:
+        native_bindings.install(state)
+    mem_heap = None
+    if args_ns.allocator == "heap":
+        mem_heap = heap.Heap()
+        heap.install_libc(state, mem_heap)
+
+    with phase_stats.phase("register"):
+        interpreter = cparser.interpreter.Interpreter()
+        interpreter.register(state)
+
+    with phase_stats.phase("install hooks and stubs"):
+        if state.lazy_function_bodies:
+            lazy_parse.install(interpreter, state)
+        if args_ns.struct_access:
+            struct_layout.install(interpreter)
+        if not args_ns.no_constfold:
+            constfold.install(interpreter)
+        if not args_ns.no_unboxing:
+            unboxing.install(interpreter)
+        if not args_ns.no_switch_dispatch:
+            switch_dispatch.install(interpreter)
+        if args_ns.line_profile:
+            line_profiler = lineprofiler.LineProfiler(state)
+            line_profiler.install(interpreter)
+
+            def write_line_profile():
+                line_profiler.uninstall()
+                line_profiler.write_annotated(args_ns.line_profile_output + ".txt")
+                line_profiler.write_json(args_ns.line_profile_output + ".json")
+                print("Line profile written to %s.txt/.json." % args_ns.line_profile_output)
+            atexit.register(write_line_profile)
+        elif not args_ns.no_translate_cache:
+            translation_cache = translate_cache.TranslationCache(state, variant=" ".join(
+                name for (name, disabled) in [
+                    ("struct", not args_ns.struct_access), ("constfold", args_ns.no_constfold),
+                    ("unboxing", args_ns.no_unboxing), ("switch", args_ns.no_switch_dispatch)]
+                if not disabled))
+            translation_cache.install(interpreter)
+            atexit.register(translation_cache.save)
+
+        # Replacements for C functions which we don't parse (path config), and for hot ones.
+        overrides.install(interpreter, state, optional=not args_ns.no_overrides, argv=argv)
+        if args_ns.allocator == "pool":
+            allocator.install(interpreter, state)
+        elif args_ns.allocator == "heap":
+            heap.install(interpreter, state, heap=mem_heap)
 
     if args_ns.dump_python:
         for fn in args_ns.dump_python:
+            lazy_parse.parse_func_body(state, fn)
             print()
             print("PyAST of %s:" % fn)
             interpreter.dumpFunc(fn)
@@ -273,9 +497,26 @@ def main(argv):
         interpreter.debug_print_getFunc = True
         interpreter.debug_print_getVar = True
 
+    if args_ns.profile:
+        func_profiler = profiler.Profiler()
+        func_profiler.install(interpreter, state)
+
+        def write_profile():
+            func_profiler.write_pstats(args_ns.profile_output)
+            func_profiler.print_summary(top=args_ns.profile_top)
+            print("Profile written to %s." % args_ns.profile_output)
+        atexit.register(write_profile)
+
+    if args_ns.prefork_server:
+        server = prefork.PreforkServer(
+            interpreter, args_ns.prefork_server, base_argv=argv, jobs=args_ns.prefork_jobs)
+        server.serve()
+        return
+
     args = ("Py_Main", len(argv), argv + [None])
     print("Run", args, ":")
-    interpreter.runFunc(*args)
+    with phase_stats.phase("run Py_Main"):
+        interpreter.runFunc(*args)
 
 
 if __name__ == '__main__':
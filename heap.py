@@ -0,0 +1,462 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+mmap-backed heap for the interpreted C memory, with zero-copy memory operations.
+
+Heap extends the pool allocator (allocator.PoolAllocator): small blocks
+come from the pools of its arenas, and large blocks get their own mmap
+region instead of going to the libc malloc. So all memory which the
+interpreted CPython allocates via PyMem_*/PyObject_* lives in regions
+which the heap owns. Freed large regions are kept for reuse up to
+LargeFreeCacheSize bytes, the others are unmapped.
+
+Pointers stay plain addresses, so the ctypes objects of the interpreter
+work on the same memory. The memory operations (memcpy, memset, memcmp,
+memchr, strlen, wcslen, ...) work on slices of a memoryview over the
+process memory (struct_layout.get_process_memory()), and the string scans
+on the heap regions use mmap.find. There are no per-byte Python loops and
+no copies through temporary ctypes objects. The operations also work for
+addresses outside of the heap.
+
+cpython.py selects it with --allocator heap. Then install_libc() routes
+the wrapped libc memory functions (LibcFunctions) through the heap, and
+install() makes it the allocator, the backend of Interpreter._make_string
+and _make_wchar_string, and available as helpers.heap.
+"""
+
+from __future__ import print_function
+
+import bisect
+import ctypes
+import mmap
+
+import allocator
+import struct_layout
+from overrides import get_address, get_int
+
+WcharSize = ctypes.sizeof(ctypes.c_wchar)
+WcharEncoding = {2: "utf-16-le", 4: "utf-32-le"}[WcharSize]
+
+# Max total size of the freed large regions which we keep mapped for reuse.
+LargeFreeCacheSize = 4 * 1024 * 1024
+
+
+def _encode_string(s):
+    """
+    :param bytes|str s: str is UTF-8 encoded
+    :return: NUL-terminated
+    :rtype: bytes
+    """
+    if isinstance(s, str):
+        s = s.encode("utf8")
+    return s + b"\0"
+
+
+def _encode_wchar_string(s):
+    """
+    :param str s:
+    :return: NUL-terminated wchar_t string
+    :rtype: bytes
+    """
+    return (s + "\0").encode(WcharEncoding, "surrogatepass")
+
+
+def _round_up_pages(size):
+    return (max(size, 1) + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+
+
+class Heap(allocator.PoolAllocator):
+
+    def __init__(self):
+        super(Heap, self).__init__()
+        self.memory = struct_layout.get_process_memory()
+        self._large_blocks = {}  # type: dict[int,int]  # address -> size (page multiple)
+        self._large_free = {}  # type: dict[int,list[int]]  # size -> free addresses
+        self._large_free_size = 0  # sum of the sizes in _large_free
+
+    # Allocation. Small blocks via the pools, large blocks via their own regions.
+
+    def get_block_size(self, addr):
+        """
+        :param int addr: from malloc()
+        :return: usable size of the block, or None if it is not one of our blocks
+        :rtype: int|None
+        """
+        size = self._large_blocks.get(addr)
+        if size is not None:
+            return size
+        return super(Heap, self).get_block_size(addr)
+
+    def malloc(self, size):
+        """
+        :param int size:
+        :return: address, 0 if we are out of memory
+        :rtype: int
+        """
+        if size <= allocator.SmallRequestThreshold:
+            return super(Heap, self).malloc(size)
+        self.num_allocs += 1
+        self.num_large_allocs += 1
+        size = _round_up_pages(size)
+        free_list = self._large_free.get(size)
+        if free_list:
+            self._large_free_size -= size
+            return free_list.pop()
+        try:
+            addr = self._map_region(size)
+        except (OSError, ValueError, OverflowError):
+            return 0
+        self._large_blocks[addr] = size
+        return addr
+
+    def calloc(self, nelem, elsize):
+        """
+        :param int nelem:
+        :param int elsize:
+        :rtype: int
+        """
+        size = nelem * elsize
+        addr = self.malloc(size)
+        if addr:
+            self.memset(addr, 0, size)
+        return addr
+
+    def realloc(self, addr, size):
+        """
+        :param int addr: 0 or from malloc()
+        :param int size:
+        :rtype: int
+        """
+        old_size = self._large_blocks.get(addr)
+        if old_size is not None and allocator.SmallRequestThreshold < size <= old_size:
+            return addr  # still fits into its pages
+        return super(Heap, self).realloc(addr, size)
+
+    def free(self, addr):
+        """
+        :param int addr: 0 or from malloc()
+        """
+        size = self._large_blocks.get(addr)
+        if size is None:
+            super(Heap, self).free(addr)
+            return
+        self.num_frees += 1
+        if self._large_free_size + size <= LargeFreeCacheSize:
+            self._large_free.setdefault(size, []).append(addr)
+            self._large_free_size += size
+            return
+        del self._large_blocks[addr]
+        self._unmap_region(addr)
+
+    # Memory access.
+
+    def _find_arena(self, addr):
+        """
+        :param int addr:
+        :return: the mmap of our region which contains addr, and the offset in it, or (None, None)
+        :rtype: (mmap.mmap|None,int|None)
+        """
+        index = bisect.bisect(self._arena_starts, addr) - 1
+        if index >= 0 and addr < self._arena_ends[index]:
+            return self._arenas[index], addr - self._arena_starts[index]
+        return None, None
+
+    def view(self, addr, size):
+        """
+        :param int addr:
+        :param int size:
+        :return: zero-copy view on the memory
+        :rtype: memoryview
+        """
+        return self.memory[addr:addr + size]
+
+    def read(self, addr, size):
+        """
+        :param int addr:
+        :param int size:
+        :rtype: bytes
+        """
+        return self.memory[addr:addr + size].tobytes()
+
+    def write(self, addr, data):
+        """
+        :param int addr:
+        :param bytes|bytearray|memoryview data:
+        """
+        self.memory[addr:addr + len(data)] = data
+
+    def memcpy(self, dst, src, size):
+        """
+        Like memmove: overlapping ranges are fine.
+
+        :param int dst:
+        :param int src:
+        :param int size:
+        :return: dst
+        :rtype: int
+        """
+        memory = self.memory
+        memory[dst:dst + size] = memory[src:src + size]
+        return dst
+
+    memmove = memcpy
+
+    def memset(self, addr, value, size):
+        """
+        :param int addr:
+        :param int value: byte value
+        :param int size:
+        :return: addr
+        :rtype: int
+        """
+        self.memory[addr:addr + size] = bytes((value & 0xff,)) * size
+        return addr
+
+    def memcmp(self, addr1, addr2, size):
+        """
+        :param int addr1:
+        :param int addr2:
+        :param int size:
+        :return: -1, 0 or 1
+        :rtype: int
+        """
+        memory = self.memory
+        a, b = memory[addr1:addr1 + size], memory[addr2:addr2 + size]
+        if a == b:
+            return 0
+        return -1 if a.tobytes() < b.tobytes() else 1
+
+    def memchr(self, addr, value, size):
+        """
+        :param int addr:
+        :param int value: byte value
+        :param int size:
+        :return: address of the first occurrence, or 0
+        :rtype: int
+        """
+        needle = bytes((value & 0xff,))
+        arena, offset = self._find_arena(addr)
+        if arena is not None and addr + size <= addr - offset + len(arena):
+            pos = arena.find(needle, offset, offset + size)
+            return addr - offset + pos if pos >= 0 else 0
+        pos = self.memory[addr:addr + size].tobytes().find(needle)
+        return addr + pos if pos >= 0 else 0
+
+    def strlen(self, addr):
+        """
+        :param int addr: of a NUL-terminated string
+        :rtype: int
+        """
+        arena, offset = self._find_arena(addr)
+        if arena is not None:
+            pos = arena.find(b"\0", offset)
+            if pos >= 0:
+                return pos - offset
+        return len(ctypes.string_at(addr))
+
+    def wcslen(self, addr):
+        """
+        :param int addr: of a NUL-terminated wchar_t string
+        :rtype: int
+        """
+        arena, offset = self._find_arena(addr)
+        if arena is not None:
+            pos = offset
+            while True:
+                pos = arena.find(b"\0" * WcharSize, pos)
+                if pos < 0:
+                    break
+                if (pos - offset) % WcharSize == 0:
+                    return (pos - offset) // WcharSize
+                pos += 1
+        return len(ctypes.wstring_at(addr))
+
+    def string_at(self, addr, size=None):
+        """
+        :param int addr:
+        :param int|None size: if None, up to the NUL
+        :rtype: bytes
+        """
+        if size is None:
+            size = self.strlen(addr)
+        return self.read(addr, size)
+
+    def wstring_at(self, addr, size=None):
+        """
+        :param int addr:
+        :param int|None size: number of wchar_t. if None, up to the NUL
+        :rtype: str
+        """
+        if size is None:
+            size = self.wcslen(addr)
+        return self.read(addr, size * WcharSize).decode(WcharEncoding, "surrogatepass")
+
+    def make_string(self, s):
+        """
+        :param bytes|str s: str is UTF-8 encoded
+        :return: address of a new NUL-terminated copy, to be freed with free()
+        :rtype: int
+        """
+        data = _encode_string(s)
+        addr = self.malloc(len(data))
+        self.write(addr, data)
+        return addr
+
+    def make_wchar_string(self, s):
+        """
+        :param str s:
+        :return: address of a new NUL-terminated wchar_t copy, to be freed with free()
+        :rtype: int
+        """
+        data = _encode_wchar_string(s)
+        addr = self.malloc(len(data))
+        self.write(addr, data)
+        return addr
+
+    def strdup(self, addr):
+        """
+        :param int addr: of a NUL-terminated string
+        :rtype: int
+        """
+        size = self.strlen(addr) + 1
+        return self.memcpy(self.malloc(size), addr, size)
+
+    def wcsdup(self, addr):
+        """
+        :param int addr: of a NUL-terminated wchar_t string
+        :rtype: int
+        """
+        size = (self.wcslen(addr) + 1) * WcharSize
+        return self.memcpy(self.malloc(size), addr, size)
+
+
+# libc function -> (Heap method, argument kinds: p for pointers, i for integers).
+# free and realloc are here because strdup/wcsdup memory is now ours. Both pass other addresses to libc.
+LibcFunctions = {
+    "memcpy": ("memcpy", "ppi"),
+    "memmove": ("memmove", "ppi"),
+    "memset": ("memset", "pii"),
+    "memcmp": ("memcmp", "ppi"),
+    "memchr": ("memchr", "pii"),
+    "strlen": ("strlen", "p"),
+    "wcslen": ("wcslen", "p"),
+    "strdup": ("strdup", "p"),
+    "wcsdup": ("wcsdup", "p"),
+    "realloc": ("realloc", "pi"),
+    "free": ("free", "p"),
+}
+
+
+def _make_result_converter(restype):
+    """
+    :param type|None restype: of the ctypes function which we replace
+    :return: function int result -> what a call of that ctypes function returns, or None if we don't know
+    :rtype: ((int)->object)|None
+    """
+    if restype is None:
+        return lambda value: None
+    if issubclass(restype, ctypes._Pointer):
+        return lambda value: ctypes.cast(ctypes.c_void_p(value), restype)
+    if issubclass(restype, ctypes._SimpleCData):
+        if restype.__bases__ == (ctypes._SimpleCData,):
+            return lambda value: restype(value).value  # ctypes converts fundamental types to Python values
+        return restype
+    return None
+
+
+def make_libc_function(heap, name, restype):
+    """
+    :param Heap heap:
+    :param str name: in LibcFunctions
+    :param type|None restype: of the ctypes function which we replace
+    :return: function which takes the arguments like the ctypes function, or None if we don't support restype
+    :rtype: function|None
+    """
+    method_name, arg_kinds = LibcFunctions[name]
+    method = getattr(heap, method_name)
+    convert_result = _make_result_converter(restype)
+    if convert_result is None:
+        return None
+    arg_getters = [get_address if kind == "p" else get_int for kind in arg_kinds]
+
+    if len(arg_getters) == 1:
+        get_arg, = arg_getters
+
+        def libc_function(arg):
+            return convert_result(method(get_arg(arg)))
+    else:
+        def libc_function(*args):
+            return convert_result(method(*[get_arg(arg) for (get_arg, arg) in zip(arg_getters, args)]))
+
+    libc_function.__name__ = name
+    libc_function.restype = restype
+    return libc_function
+
+
+def install_libc(state, heap):
+    """
+    Call this before interpreter.register(state), and after native_bindings.install(state).
+
+    :param cparser.State state: with the wrapped libc functions in state.funcs
+    :param Heap heap:
+    :return: names of the functions which go through the heap now
+    :rtype: list[str]
+    """
+    installed = []
+    for name in sorted(LibcFunctions):
+        value = state.funcs.get(name)
+        func = getattr(value, "value", None)
+        if not isinstance(func, ctypes._CFuncPtr):
+            continue  # not wrapped, e.g. implemented in the parsed C code, or not used
+        libc_function = make_libc_function(heap, name, func.restype)
+        if libc_function is None:
+            continue
+        value.value = libc_function
+        installed.append(name)
+    return installed
+
+
+def _make_string_factory(heap, encode, orig_make):
+    """
+    :param Heap heap:
+    :param (str|bytes)->bytes encode: incl. the NUL
+    :param (str|bytes)->ctypes._CData orig_make: the one of the interpreter. we return the same type
+    :rtype: (str|bytes)->ctypes._CData
+    """
+    res_type = type(orig_make(""))
+    if issubclass(res_type, ctypes.Array):
+        elem_type = res_type._type_
+        elem_size = ctypes.sizeof(elem_type)
+
+        def make_string(s):
+            data = encode(s)
+            addr = heap.malloc(len(data))
+            heap.write(addr, data)
+            return (elem_type * (len(data) // elem_size)).from_address(addr)
+    else:
+        def make_string(s):
+            data = encode(s)
+            addr = heap.malloc(len(data))
+            heap.write(addr, data)
+            return ctypes.cast(ctypes.c_void_p(addr), res_type)
+
+    return make_string
+
+
+def install(interpreter, state, heap=None):
+    """
+    :param cparser.interpreter.Interpreter interpreter: after interpreter.register(state)
+    :param cparser.State state:
+    :param Heap|None heap: the one from install_libc(), if that was used
+    :return: the heap, which is now the allocator of the interpreted CPython
+    :rtype: Heap
+    """
+    if heap is None:
+        heap = Heap()
+    allocator.install(interpreter, state, pool_allocator=heap)
+    # Like the interpreter, we keep these strings forever.
+    interpreter._make_string = _make_string_factory(heap, _encode_string, interpreter._make_string)
+    interpreter._make_wchar_string = _make_string_factory(heap, _encode_wchar_string, interpreter._make_wchar_string)
+    interpreter.helpers.heap = heap
+    return heap
@@ -0,0 +1,410 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Process-wide cache of the preprocessed C headers.
+
+cparser runs the preprocessor (cpreprocess) character by character, and the
+tokenizer with macro substitution (cpre2) consumes its output lazily. Every
+new state preprocesses the headers which its C files include again, and the
+stringlib template headers are even preprocessed once per STRINGLIB variant,
+because they are not deduplicated (see CPythonState.readLocalInclude).
+
+cparser calls state.preprocess() for every included file. For a header, we
+record what the preprocessor does, and replay it the next time the header is
+included with the same dependencies:
+
+* the output characters, which go to cpre2,
+* the macro definitions and undefs, at their position in the output,
+  because cpre2 substitutes the macros while it consumes the output,
+* the preprocessor position (state._preprocessIncludeLevel) at every output
+  character, so the declarations get the same defPos,
+* the files which were read (state.input_files, included_files),
+* the preprocessor errors.
+
+An entry is valid if the content of all its files is the same, and all
+macros which the preprocessor looked up (#ifdef, #if, ...) have the same
+definition, and the nested includes were deduplicated in the same way.
+Macro lookups of cpre2, while it consumes the output, don't count: the
+replayed output goes through cpre2 again.
+
+We don't cache the cpre2 tokens themselves. cpre2 substitutes macros across
+file boundaries and its tokens depend on the macro state at the include, while
+the preprocessor output of e.g. a stringlib header is the same for all
+variants. A header which includes a system header via a cparser include
+wrapper is not cached, because the wrapper might do more than preprocessing.
+"""
+
+from __future__ import print_function
+
+import os
+
+import parse_cache
+from parse_incremental import macro_signature
+
+# Attribute of cparser.State with the preprocessor position, a list with one [fullfilename, filename, line, char]
+# entry per include level.
+PosAttrib = "_preprocessIncludeLevel"
+
+_Deleted = object()
+
+
+def _copy_levels(levels):
+    """
+    :param list levels: e.g. state._preprocessIncludeLevel
+    :return: copy, where the entries are copied as well
+    :rtype: list
+    """
+    return [type(level)(level) if isinstance(level, (list, tuple)) else level for level in levels]
+
+
+def _advance(levels):
+    """
+    :param list levels: copy of the include levels
+    :return: the levels after the preprocessor read one more character in the same line, or None
+    :rtype: list|None
+    """
+    if not levels or not isinstance(levels[-1], (list, tuple)) or not levels[-1] \
+            or type(levels[-1][-1]) is not int:
+        return None
+    level = list(levels[-1])
+    level[-1] += 1
+    return levels[:-1] + [type(levels[-1])(level)]
+
+
+def _set_levels(state, start, levels):
+    """
+    :param cparser.State state:
+    :param int start: the include levels before this stay as they are
+    :param list levels: copy of the include levels from start on
+    """
+    setattr(state, PosAttrib, getattr(state, PosAttrib)[:start] + _copy_levels(levels))
+
+
+def _apply_macro_events(state, events):
+    """
+    :param cparser.State state:
+    :param list[(str,object)] events: (name, macro or _Deleted)
+    """
+    for name, macro in events:
+        if macro is _Deleted:
+            state.macros.pop(name, None)
+        else:
+            state.macros[name] = macro
+
+
+class _Entry:
+
+    def __init__(self, fullfilename):
+        """
+        :param str fullfilename: header
+        """
+        self.fullfilename = fullfilename
+        self.file_digests = {}  # type: dict[str,str|None]  # all read files -> content digest
+        self.macro_deps = {}  # type: dict[str,str|None]  # macro name -> macro_signature, or None if undefined
+        self.include_deps = {}  # type: dict[str,bool]  # nested include -> whether it was already included
+        self.text = ""
+        self.macro_events = {}  # type: dict[int,list[(str,object)]]  # output index -> [(name, macro or _Deleted)]
+        self.positions = {}  # type: dict[int,list]  # output index -> include levels, unless just one char further
+        self.end_levels = []  # include levels after the header
+        self.pos_start = 0  # the include levels from len(levels) - pos_start on belong to the header
+        self.input_files = []  # type: list[str]
+        self.included_files = []  # type: list[str]
+        self.errors = []  # type: list[str]
+
+
+class _Recording:
+
+    def __init__(self, fullfilename):
+        """
+        :param str fullfilename: header
+        """
+        self.entry = _Entry(fullfilename)
+        self.active = False  # whether the preprocessor runs right now, i.e. not cpre2
+        self.cacheable = True
+        self.written = set()  # type: set[str]  # macros which the header defined itself
+
+    def note_read(self, macros, name):
+        if self.active and name not in self.written and name not in self.entry.macro_deps:
+            macro = dict.get(macros, name)
+            self.entry.macro_deps[name] = None if macro is None else macro_signature(macro)
+
+    def note_write(self, name, macro):
+        if self.active:
+            self.written.add(name)
+            self.entry.macro_events.setdefault(len(self.entry.text), []).append((name, macro))
+
+
+class _MacroRecorder(dict):
+    """
+    Replaces state.macros while we record a header. Records the lookups and the changes of the preprocessor.
+    """
+
+    def __init__(self, macros, recording):
+        # dict.copy() does not go through the methods of a dict subclass, e.g. parse_parallel.RecordingDict.
+        dict.__init__(self, dict.copy(macros))
+        self.recording = recording
+
+    def __getitem__(self, key):
+        self.recording.note_read(self, key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.recording.note_read(self, key)
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        self.recording.note_read(self, key)
+        return dict.get(self, key, default)
+
+    # Definitions and undefs don't depend on the previous definition, e.g. stringlib/undef.h for every variant.
+
+    def __setitem__(self, key, value):
+        self.recording.note_write(key, value)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.recording.note_write(key, _Deleted)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        self.recording.note_write(key, _Deleted)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if not dict.__contains__(self, key):
+            self[key] = default
+        return self[key]
+
+    def _read_all(self):
+        if self.recording.active:
+            self.recording.cacheable = False
+
+    def __iter__(self):
+        self._read_all()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self._read_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._read_all()
+        return dict.values(self)
+
+    def items(self):
+        self._read_all()
+        return dict.items(self)
+
+
+class IncludeCache:
+
+    def __init__(self):
+        self._entries = {}  # type: dict[str,list[_Entry]]  # header -> entries with different dependencies
+        self._file_digests = {}  # type: dict[str,((int,int),str)]  # filename -> ((mtime, size), digest)
+        self.hits = 0
+        self.misses = 0
+
+    def _get_file_digest(self, filename):
+        """
+        :param str filename:
+        :return: content digest, or None if the file does not exist
+        :rtype: str|None
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        key = (st.st_mtime_ns, st.st_size)
+        entry = self._file_digests.get(filename)
+        if entry is None or entry[0] != key:
+            entry = self._file_digests[filename] = (key, parse_cache.file_digest(filename))
+        return entry[1]
+
+    def _is_valid(self, state, entry):
+        """
+        :param cparser.State state:
+        :param _Entry entry:
+        :rtype: bool
+        """
+        for name, signature in entry.macro_deps.items():
+            # Through state.macros, so that e.g. parse_parallel sees the lookup.
+            macro = state.macros.get(name)
+            if (None if macro is None else macro_signature(macro)) != signature:
+                return False
+        for fn, was_included in entry.include_deps.items():
+            if (fn in state.included_files) != was_included:
+                return False
+        for fn, digest in entry.file_digests.items():
+            if self._get_file_digest(fn) != digest:
+                return False
+        return True
+
+    def lookup(self, state, fullfilename):
+        """
+        :param cparser.State state:
+        :param str fullfilename: header
+        :return: the matching entry, or None
+        :rtype: _Entry|None
+        """
+        for entry in self._entries.get(fullfilename, ()):
+            if self._is_valid(state, entry):
+                return entry
+        return None
+
+    def preprocess(self, state, orig_preprocess, reader, fullfilename, filename):
+        """
+        Like state.preprocess(reader, fullfilename, filename), but replays or records the header.
+
+        :param cparser.State state:
+        :param (iterator,str,str)->iterator orig_preprocess: the preprocess method of cparser.State
+        :param iterator reader: chars of the file
+        :param str fullfilename:
+        :param str filename: as in the include
+        :return: chars of the preprocessed file
+        :rtype: iterator[str]
+        """
+        # A deduplicated include has the empty string as reader (see CPythonState.readLocalInclude).
+        # Its output does not depend on the file, so we don't cache it.
+        if getattr(state, "_include_recording", None) is not None or isinstance(reader, str) or not fullfilename \
+                or not fullfilename.endswith(".h") or not isinstance(getattr(state, PosAttrib, None), list):
+            return orig_preprocess(reader, fullfilename, filename)
+        entry = self.lookup(state, fullfilename)
+        if entry is not None:
+            self.hits += 1
+            return self._replay(state, entry)
+        self.misses += 1
+        return self._record(state, orig_preprocess(reader, fullfilename, filename), fullfilename)
+
+    def _record(self, state, chars, fullfilename):
+        """
+        :param cparser.State state:
+        :param iterator[str] chars: output of the preprocessor
+        :param str fullfilename: header
+        :rtype: iterator[str]
+        """
+        recording = _Recording(fullfilename)
+        entry = recording.entry
+        base = len(getattr(state, PosAttrib))
+        includer_level = _copy_levels(getattr(state, PosAttrib)[base - 1:base])
+        # From the include level of the includer on. We drop it at the end if the preprocessor did not touch it.
+        positions = {}  # type: dict[int,list]
+        prev_levels = None
+        text = entry.text = []  # the length is the index of the macro events
+        orig_macros = state.macros
+        included_files = set(state.included_files)
+        containers = [name for name in parse_cache.StateContainers if name not in ("macros", "lazy_bodies")]
+        state.macros = _MacroRecorder(orig_macros, recording)
+        state._include_recording = recording
+        completed = False
+        try:
+            while True:
+                sizes = [len(getattr(state, name)) for name in containers]
+                errors_len = len(state._errors)
+                recording.active = True
+                try:
+                    c = next(chars)
+                except StopIteration:
+                    break
+                finally:
+                    recording.active = False
+                    if [len(getattr(state, name)) for name in containers] != sizes:
+                        recording.cacheable = False  # e.g. a cparser include wrapper
+                    entry.errors.extend(state._errors[errors_len:])
+                levels = _copy_levels(getattr(state, PosAttrib)[max(base - 1, 0):])
+                if prev_levels is None or _advance(prev_levels) != levels:
+                    positions[len(text)] = levels
+                prev_levels = levels
+                text.append(c)
+                yield c
+            completed = True
+        finally:
+            state._include_recording = None
+            macros = state.macros
+            state.macros = orig_macros
+            dict.clear(orig_macros)
+            dict.update(orig_macros, dict.copy(macros))
+            for name in entry.macro_deps:
+                orig_macros.get(name)  # e.g. parse_parallel records the lookups
+        levels = getattr(state, PosAttrib)
+        if not completed or not recording.cacheable or len(levels) < base:
+            return
+        if base:
+            # Did the preprocessor change the include level of the includer? Then it belongs to the header.
+            includer_changed = levels[base - 1:base] != includer_level or any(
+                pos[:1] != includer_level for pos in positions.values())
+            entry.pos_start = 1 if includer_changed else 0
+            entry.positions = {i: pos[1 - entry.pos_start:] for (i, pos) in positions.items()}
+        else:
+            entry.positions = positions
+        entry.end_levels = _copy_levels(levels[base - entry.pos_start:])
+        entry.text = "".join(text)
+        entry.included_files = sorted(set(state.included_files) - included_files)
+        for fn in [fullfilename] + entry.input_files:
+            entry.file_digests[fn] = self._get_file_digest(fn)
+        self._entries.setdefault(fullfilename, []).append(entry)
+
+    def _replay(self, state, entry):
+        """
+        :param cparser.State state:
+        :param _Entry entry:
+        :rtype: iterator[str]
+        """
+        start = len(getattr(state, PosAttrib)) - entry.pos_start
+        macro_events, positions = entry.macro_events, entry.positions
+        for i, c in enumerate(entry.text):
+            if i in macro_events:
+                _apply_macro_events(state, macro_events[i])
+            levels = positions.get(i)
+            if levels is not None:
+                _set_levels(state, start, levels)
+            else:
+                cur = getattr(state, PosAttrib)
+                level = cur[-1]
+                if isinstance(level, list):
+                    level[-1] += 1
+                else:
+                    cur[-1] = type(level)(tuple(level[:-1]) + (level[-1] + 1,))
+            yield c
+        _apply_macro_events(state, macro_events.get(len(entry.text), ()))
+        _set_levels(state, start, entry.end_levels)
+        for fn in entry.input_files:
+            state.add_input_file(fn)
+        state.included_files.update(entry.included_files)
+        state._errors.extend(entry.errors)
+
+    def note_include(self, state, fullfilename, was_included):
+        """
+        Call this for every nested include, before it is deduplicated.
+
+        :param cparser.State state:
+        :param str fullfilename:
+        :param bool was_included: whether it is in state.included_files
+        """
+        recording = getattr(state, "_include_recording", None)
+        if recording is not None:
+            recording.entry.include_deps.setdefault(fullfilename, was_included)
+
+    def note_input_file(self, state, filename):
+        """
+        :param cparser.State state:
+        :param str filename: read while we record
+        """
+        recording = getattr(state, "_include_recording", None)
+        if recording is not None and filename not in recording.entry.input_files:
+            recording.entry.input_files.append(filename)
+
+    def note_uncacheable(self, state):
+        """
+        :param cparser.State state: the header which we record right now does more than preprocessing
+        """
+        recording = getattr(state, "_include_recording", None)
+        if recording is not None:
+            recording.cacheable = False
+
+    def clear(self):
+        self._entries.clear()
+        self._file_digests.clear()
+
+
+include_cache = IncludeCache()
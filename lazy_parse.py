@@ -0,0 +1,169 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Lazy parsing of function bodies.
+
+cparser.parse() runs in three stages: the preprocessor, the tokenizer with
+macro substitution (cpre2) and the parser which builds the declarations
+(cpre3). Most of the cpre3 time goes into function bodies, but a Py_Main run
+only reaches a fraction of all functions.
+
+In lazy mode, we filter the cpre2 token stream: for every top-level function
+definition, we keep the tokens of its body and pass only the prototype on to
+cpre3. The body is parsed when the function is first needed, e.g. when the
+interpreter asks for it (see install()).
+
+The body tokens are already macro-expanded, so a later parse does not depend
+on the macro state. Identifiers in the body are resolved against the state at
+the time of the lazy parse though, i.e. colliding static names from different
+files resolve to the last one. The macro hacks in the parse units avoid such
+collisions.
+"""
+
+from __future__ import print_function
+
+
+def _is_token(token, token_type, content=None):
+    """
+    :param str token: cpre2 token. cparser token classes are str subclasses, the token is its content
+    :param str token_type: name of the cparser token class (or a base class), e.g. "COpeningBracket"
+    :param str|None content:
+    :rtype: bool
+    """
+    if not any(cls.__name__ == token_type for cls in type(token).__mro__):
+        return False
+    return content is None or token == content
+
+
+def _get_func_name(decl_tokens):
+    """
+    :param list decl_tokens: the tokens of a top-level declaration, up to a closing ")"
+    :return: the function name, if this is a plain function declarator "name(...)", otherwise None
+    :rtype: str|None
+    """
+    depth = 0
+    groups = []  # indices of the depth-0 "(" tokens
+    for i, token in enumerate(decl_tokens):
+        if _is_token(token, "COpeningBracket"):
+            if depth == 0:
+                if token != "(":
+                    return None
+                groups.append(i)
+            depth += 1
+        elif _is_token(token, "CClosingBracket"):
+            depth -= 1
+        elif depth == 0 and _is_token(token, "COp", "="):
+            return None  # initializer
+    # E.g. function pointer return types or attributes have more than one group. Skip those.
+    if len(groups) != 1 or groups[0] == 0:
+        return None
+    name_token = decl_tokens[groups[0] - 1]
+    if not _is_token(name_token, "CIdentifier"):
+        return None
+    return str(name_token)
+
+
+def filter_function_bodies(state, tokens):
+    """
+    :param cparser.State state: gets state.lazy_bodies
+    :param iterator tokens: cpre2 tokens
+    :return: the same tokens, but top-level function bodies are replaced by ";"
+    :rtype: iterator
+    """
+    depth = 0
+    decl_tokens = []
+    semicolon = None  # we reuse a real token instance
+    tokens = iter(tokens)
+    for token in tokens:
+        if depth == 0 and semicolon is not None and decl_tokens and _is_token(token, "COpeningBracket", "{") \
+                and _is_token(decl_tokens[-1], "CClosingBracket", ")"):
+            name = _get_func_name(decl_tokens)
+            if name:
+                body_tokens = [token]
+                body_depth = 1
+                for body_token in tokens:
+                    body_tokens.append(body_token)
+                    if _is_token(body_token, "COpeningBracket"):
+                        body_depth += 1
+                    elif _is_token(body_token, "CClosingBracket"):
+                        body_depth -= 1
+                        if body_depth == 0:
+                            break
+                state.lazy_bodies[name] = (decl_tokens, body_tokens)
+                decl_tokens = []
+                yield semicolon
+                continue
+        yield token
+        if _is_token(token, "COpeningBracket"):
+            depth += 1
+        elif _is_token(token, "CClosingBracket"):
+            depth -= 1
+        if depth == 0 and (_is_token(token, "CSemicolon") or _is_token(token, "CClosingBracket", "}")):
+            if semicolon is None and _is_token(token, "CSemicolon"):
+                semicolon = token
+            decl_tokens = []
+        else:
+            decl_tokens.append(token)
+
+
+def parse_file(state, filename):
+    """
+    Like cparser.parse(filename, state), but keeps the function bodies for later.
+
+    :param cparser.State state: must have the lazy_bodies attrib
+    :param str filename:
+    """
+    import cparser
+    preprocessed = state.preprocess_file(filename, local=True)
+    tokens = cparser.cpre2_parse(state, preprocessed)
+    cparser.cpre3_parse(state, filter_function_bodies(state, tokens))
+
+
+def parse_func_body(state, funcname):
+    """
+    :param cparser.State state:
+    :param str funcname:
+    :return: whether we had a pending body for this function
+    :rtype: bool
+    """
+    entry = state.lazy_bodies.pop(funcname, None)
+    if entry is None:
+        return False
+    import cparser
+    decl_tokens, body_tokens = entry
+    prototype = state.funcs.get(funcname)
+    errors_len = len(state._errors)
+    cparser.cpre3_parse(state, iter(decl_tokens + body_tokens))
+    func = state.funcs.get(funcname)
+    if func is not None and func is not prototype and getattr(prototype, "defPos", None):
+        # The parser position does not mean anything for the lazy parse.
+        func.defPos = prototype.defPos
+    for m in state._errors[errors_len:]:
+        print("Parse error in lazy body of %s: %s" % (funcname, m))
+    return True
+
+
+def parse_all_func_bodies(state):
+    """
+    :param cparser.State state:
+    """
+    for funcname in list(state.lazy_bodies.keys()):
+        parse_func_body(state, funcname)
+
+
+def install(interpreter, state):
+    """
+    Parses function bodies when the interpreter first asks for the function.
+
+    :param cparser.interpreter.Interpreter interpreter:
+    :param cparser.State state:
+    """
+    orig_get_func = interpreter.getFunc
+
+    def getFunc(funcname):
+        if funcname not in interpreter._func_cache and funcname in state.lazy_bodies:
+            parse_func_body(state, funcname)
+        return orig_get_func(funcname)
+
+    interpreter.getFunc = getFunc
@@ -0,0 +1,195 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Line-level hit counts of the interpreted C code.
+
+The interpreter translates a C function body statement by statement
+(cparser.interpreter.cStatementToPyAst), appending the Python statements to
+the current body of the FuncEnv. We hook into that and put a
+helpers.lineprof_hit(<index>) call in front of every C statement, where the
+index refers to the C source position (file, line) of the statement. The
+generated Python statements also get the attribute c_pos with that position.
+
+C statements without their own defPos count for the position of their
+function. Case labels and goto labels don't get a hit call: they are no
+statements which run, and the switch and goto lowering of the interpreter
+starts new blocks at them, so a call right in front would end up in the
+block before.
+
+The hook is module-global, so it only touches the translations of the
+interpreter which we installed it for, and uninstall() removes it again.
+Functions which were translated in between keep their counting.
+
+The translated AST of a profiled function differs from the normal one,
+so the translate cache must not be used together with this.
+"""
+
+from __future__ import print_function
+
+import ast
+import codecs
+import contextlib
+import json
+
+
+# Class names of the cparser statements which we don't count, see above.
+LabelStatements = {"CCaseStatement", "CCaseDefaultStatement", "CGotoLabel"}
+
+
+def is_label_statement(c):
+    """
+    :param object c: C statement
+    :rtype: bool
+    """
+    return any(cls.__name__ in LabelStatements for cls in type(c).__mro__)
+
+
+def parse_pos(def_pos):
+    """
+    :param str|None def_pos: e.g. "Objects/dictobject.c:123:4"
+    :return: (filename, line), or None
+    :rtype: (str,int)|None
+    """
+    if not def_pos:
+        return None
+    parts = str(def_pos).split(":")
+    if len(parts) < 2 or not parts[1].isdigit():
+        return None
+    return parts[0], int(parts[1])
+
+
+class LineProfiler:
+
+    def __init__(self, state):
+        """
+        :param cparser.State state: for the positions of the functions
+        """
+        self.state = state
+        self.positions = []  # type: list[(str,int)]
+        self.counts = []  # type: list[int]  # same indices as positions
+        self._pos_indices = {}  # type: dict[(str,int),int]
+        self._orig_statement_to_py_ast = None
+        self._statement_to_py_ast = None  # our hook, while installed
+
+    def hit(self, index):
+        """
+        Called from the translated code.
+
+        :param int index:
+        """
+        self.counts[index] += 1
+
+    def get_pos_index(self, pos):
+        """
+        :param (str,int) pos:
+        :rtype: int
+        """
+        index = self._pos_indices.get(pos)
+        if index is None:
+            index = self._pos_indices[pos] = len(self.positions)
+            self.positions.append(pos)
+            self.counts.append(0)
+        return index
+
+    def _get_statement_pos(self, funcEnv, c):
+        pos = parse_pos(getattr(c, "defPos", None))
+        if pos is None:
+            func_name = getattr(getattr(funcEnv, "astNode", None), "name", None)
+            pos = parse_pos(getattr(self.state.funcs.get(func_name), "defPos", None))
+        return pos
+
+    def install(self, interpreter):
+        """
+        :param cparser.interpreter.Interpreter interpreter:
+        """
+        import cparser.interpreter
+        assert self._statement_to_py_ast is None, "already installed"
+        interpreter.helpers.lineprof_hit = self.hit
+        orig_statement_to_py_ast = cparser.interpreter.cStatementToPyAst
+
+        def cStatementToPyAst(funcEnv, c):
+            owner = getattr(getattr(funcEnv, "globalScope", None), "interpreter", interpreter)
+            pos = None
+            if owner is interpreter and not is_label_statement(c):
+                pos = self._get_statement_pos(funcEnv, c)
+            if pos is None:
+                return orig_statement_to_py_ast(funcEnv, c)
+            body = funcEnv.getBody()
+            start = len(body)
+            body.append(ast.Expr(value=ast.Call(
+                func=ast.Attribute(value=ast.Name(id="helpers", ctx=ast.Load()), attr="lineprof_hit", ctx=ast.Load()),
+                args=[ast.Constant(value=self.get_pos_index(pos))], keywords=[])))
+            res = orig_statement_to_py_ast(funcEnv, c)
+            for node in body[start:]:
+                node.c_pos = "%s:%i" % pos
+            return res
+
+        self._orig_statement_to_py_ast = orig_statement_to_py_ast
+        self._statement_to_py_ast = cStatementToPyAst
+        cparser.interpreter.cStatementToPyAst = cStatementToPyAst
+
+    def uninstall(self):
+        """
+        Restores cparser.interpreter.cStatementToPyAst. Hooks installed after ours must be uninstalled first.
+        """
+        import cparser.interpreter
+        assert self._statement_to_py_ast is not None, "not installed"
+        assert cparser.interpreter.cStatementToPyAst is self._statement_to_py_ast, "hooked again after us"
+        cparser.interpreter.cStatementToPyAst = self._orig_statement_to_py_ast
+        self._orig_statement_to_py_ast = self._statement_to_py_ast = None
+
+    @contextlib.contextmanager
+    def installed(self, interpreter):
+        """
+        :param cparser.interpreter.Interpreter interpreter:
+        """
+        self.install(interpreter)
+        try:
+            yield self
+        finally:
+            self.uninstall()
+
+    def get_file_counts(self):
+        """
+        :return: filename -> line -> hit count, only for lines which were hit
+        :rtype: dict[str,dict[int,int]]
+        """
+        res = {}
+        for (filename, line), count in zip(self.positions, self.counts):
+            if count:
+                file_counts = res.setdefault(filename, {})
+                file_counts[line] = file_counts.get(line, 0) + count
+        return res
+
+    def write_json(self, filename):
+        """
+        :param str filename: {"files": {C filename: {line: hit count}}}
+        """
+        file_counts = self.get_file_counts()
+        with open(filename, "w") as f:
+            json.dump({"files": {
+                fn: {str(line): count for (line, count) in sorted(counts.items())}
+                for (fn, counts) in sorted(file_counts.items())}}, f, indent=1, sort_keys=True)
+
+    def write_annotated(self, filename):
+        """
+        :param str filename: text file with the source of every C file which was hit, with the counts per line
+        """
+        file_counts = self.get_file_counts()
+        with open(filename, "w") as f:
+            for fn, counts in sorted(file_counts.items(), key=lambda item: -sum(item[1].values())):
+                f.write("=" * 78 + "\n")
+                f.write("%s: %i hits, %i lines hit\n" % (fn, sum(counts.values()), len(counts)))
+                f.write("=" * 78 + "\n")
+                try:
+                    with codecs.open(fn, "r", "utf-8") as source_file:
+                        source_lines = source_file.read().splitlines()
+                except (IOError, OSError):
+                    for line, count in sorted(counts.items()):
+                        f.write("%10i | %i\n" % (count, line))
+                    continue
+                for line, source_line in enumerate(source_lines, 1):
+                    count = counts.get(line)
+                    f.write("%10s | %s\n" % (count if count else "", source_line))
+                f.write("\n")
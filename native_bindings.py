@@ -0,0 +1,147 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Direct native bindings for hot libc/libm functions.
+
+cparser's global include wrappers put the libc functions into state.funcs
+as wrapped values (cparser.CWrapValue). For the functions registered here,
+we replace the wrapped value by the symbol from the C library of the host
+process, with argtypes and restype set once. Pointer arguments are declared
+as c_void_p, which takes the interpreter's ctypes pointers, arrays and ints
+as they are, without any conversion on our side. The restype stays the one
+of the wrapped ctypes function, so the interpreter gets the same result
+types as before, e.g. its typed pointers.
+
+Call install(state) before interpreter.register(state).
+"""
+
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+
+# name -> (restype, argtypes). install() uses the restype of the wrapped function instead
+NativeBindings = {}  # type: dict[str,(type|None,tuple[type])]
+
+
+def register(name, restype, argtypes):
+    """
+    :param str name: C function name
+    :param type|None restype: ctypes type
+    :param tuple[type] argtypes: ctypes types
+    """
+    NativeBindings[name] = (restype, tuple(argtypes))
+
+
+_p, _size = ctypes.c_void_p, ctypes.c_size_t
+_int, _double = ctypes.c_int, ctypes.c_double
+
+for _name in ["memcpy", "memmove"]:
+    register(_name, _p, (_p, _p, _size))
+register("memset", _p, (_p, _int, _size))
+register("memcmp", _int, (_p, _p, _size))
+register("memchr", _p, (_p, _int, _size))
+register("strlen", _size, (_p,))
+register("strcmp", _int, (_p, _p))
+register("strncmp", _int, (_p, _p, _size))
+register("strchr", _p, (_p, _int))
+register("strrchr", _p, (_p, _int))
+register("wcslen", _size, (_p,))
+register("wmemcmp", _int, (_p, _p, _size))
+for _name in ["sqrt", "floor", "ceil", "fabs", "exp", "log", "log10", "sin", "cos", "tan",
+              "asin", "acos", "atan", "sinh", "cosh", "tanh"]:
+    register(_name, _double, (_double,))
+for _name in ["fmod", "pow", "atan2", "hypot"]:
+    register(_name, _double, (_double, _double))
+del _name
+
+_libs = None  # type: list[ctypes.CDLL]|None
+
+
+def get_libs():
+    """
+    :return: the libraries where we look up the symbols: the process itself, then libc and libm
+    :rtype: list[ctypes.CDLL]
+    """
+    global _libs
+    if _libs is None:
+        _libs = []
+        try:
+            _libs.append(ctypes.CDLL(None))
+        except (OSError, TypeError):  # e.g. Windows
+            pass
+        for lib_name in ["c", "m"]:
+            lib_fn = ctypes.util.find_library(lib_name)
+            if lib_fn:
+                try:
+                    _libs.append(ctypes.CDLL(lib_fn))
+                except OSError:
+                    pass
+    return _libs
+
+
+def bind(name):
+    """
+    :param str name: registered in NativeBindings
+    :return: the native function with argtypes and restype set, or None if we don't find the symbol
+    :rtype: ctypes._CFuncPtr|None
+    """
+    restype, argtypes = NativeBindings[name]
+    return bind_symbol(name, restype, argtypes)
+
+
+def bind_symbol(name, restype, argtypes):
+    """
+    Like bind(), for any symbol. This does not register it, i.e. install() does not touch it.
+
+    :param str name: C function name
+    :param type|None restype: ctypes type
+    :param tuple[type] argtypes: ctypes types
+    :return: the native function with argtypes and restype set, or None if we don't find the symbol
+    :rtype: ctypes._CFuncPtr|None
+    """
+    for lib in get_libs():
+        try:
+            # Not getattr(lib, name): that one is cached in the lib and shared with other users.
+            func = lib[name]
+        except AttributeError:
+            continue
+        func.restype = restype
+        func.argtypes = argtypes
+        return func
+    return None
+
+
+def rebind(name, wrapped_func):
+    """
+    :param str name: registered in NativeBindings
+    :param ctypes._CFuncPtr|object wrapped_func: the wrapped function which we replace
+    :return: the native function with our argtypes and the restype of wrapped_func,
+      or None if wrapped_func is not a ctypes function (we would not know the result type
+      which the interpreter expects) or if we don't find the symbol
+    :rtype: ctypes._CFuncPtr|None
+    """
+    if not isinstance(wrapped_func, ctypes._CFuncPtr):
+        return None
+    return bind_symbol(name, wrapped_func.restype, NativeBindings[name][1])
+
+
+def install(state):
+    """
+    :param cparser.State state: with the wrapped libc functions in state.funcs
+    :return: names of the functions which we have bound
+    :rtype: list[str]
+    """
+    import cparser
+    bound = []
+    for name in sorted(NativeBindings):
+        value = state.funcs.get(name)
+        if not isinstance(value, cparser.CWrapValue):
+            continue  # not wrapped, e.g. implemented in the parsed C code, or not used
+        func = rebind(name, value.value)
+        if func is None:
+            continue
+        value.value = func
+        bound.append(name)
+    return bound
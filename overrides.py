@@ -0,0 +1,578 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Python-native implementations of CPython C functions.
+
+An override replaces a C function in interpreter._func_cache, so the
+translated code calls the Python function instead of interpreting the C
+code. Overrides work on the same ctypes memory as the interpreted code.
+
+There are two kinds:
+
+* required overrides, for functions whose C code we don't parse
+  (e.g. the path configuration), which are always installed,
+* optimizations of hot C functions. Each of those names its C source file
+  and an input generator, and tests/test_overrides.py runs the interpreted C
+  version against the override on random inputs (differential test).
+
+Register overrides with the @register decorator and install them with install().
+
+lookdict_unicode, the lookup of the dicts with only str keys, does the
+probing in Python. For other key types, it falls back to the C code, which
+switches the dict to the generic lookdict. lookdict itself and the split
+table variants are still interpreted from dictobject.c.
+"""
+
+from __future__ import print_function
+
+import ctypes
+import random
+import struct
+import sys
+from collections import OrderedDict
+
+import struct_layout
+
+
+class Override:
+
+    def __init__(self, name, factory, required=False, c_files=(), make_inputs=None):
+        """
+        :param str name: C function name
+        :param (cparser.interpreter.Interpreter,cparser.State,**context)->function factory:
+          returns the Python implementation. It can set C_argTypes and C_resType,
+          otherwise we take those from the parsed declaration
+        :param bool required: installed always, because we don't parse the C code
+        :param tuple[str] c_files: C files which we need to interpret the original implementation,
+          relative to CPythonDir
+        :param ((cparser.interpreter.Interpreter,cparser.State,random.Random)->tuple)|None make_inputs:
+          random arguments for the differential test
+        """
+        self.name = name
+        self.factory = factory
+        self.required = required
+        self.c_files = c_files
+        self.make_inputs = make_inputs
+
+    def __repr__(self):
+        return "<Override %s>" % self.name
+
+
+Overrides = OrderedDict()  # type: dict[str,Override]
+
+
+def register(name, required=False, c_files=(), make_inputs=None):
+    """
+    Decorator for the factory of an override. See Override for the args.
+    """
+    def decorator(factory):
+        assert name not in Overrides, "override %s registered twice" % name
+        Overrides[name] = Override(
+            name=name, factory=factory, required=required, c_files=c_files, make_inputs=make_inputs)
+        return factory
+    return decorator
+
+
+def create(interpreter, state, name, **context):
+    """
+    :param cparser.interpreter.Interpreter interpreter:
+    :param cparser.State state:
+    :param str name: registered override
+    :param context: for the factory, e.g. argv
+    :return: the Python implementation, with C_argTypes and C_resType
+    :rtype: function
+    """
+    func = Overrides[name].factory(interpreter, state, **context)
+    if not hasattr(func, "C_argTypes"):
+        func.C_argTypes = None
+    if not hasattr(func, "C_resType"):
+        func.C_resType = state.funcs[name].type
+    return func
+
+
+def install(interpreter, state, optional=True, names=None, **context):
+    """
+    :param cparser.interpreter.Interpreter interpreter: after interpreter.register(state)
+    :param cparser.State state:
+    :param bool optional: whether to install the optimizations, or only the required overrides
+    :param list[str]|None names: if given, only install these (and the required ones)
+    :param context: for the factories, e.g. argv
+    :return: the installed overrides
+    :rtype: list[str]
+    """
+    installed = []
+    for name, override in Overrides.items():
+        if not override.required:
+            if not optional or (names is not None and name not in names):
+                continue
+            if name not in state.funcs:
+                continue  # not parsed, nothing to override
+        interpreter._func_cache[name] = create(interpreter, state, name, **context)
+        installed.append(name)
+    return installed
+
+
+def get_address(p):
+    """
+    :param ctypes._Pointer|ctypes.c_void_p|ctypes.Array|int|None p: pointer argument, as the interpreter passes it
+    :rtype: int
+    """
+    if p is None:
+        return 0
+    if isinstance(p, int):
+        return p
+    if isinstance(p, ctypes.c_void_p):
+        return p.value or 0
+    if isinstance(p, ctypes._Pointer):
+        # Unlike ctypes.cast(), this does not create a reference cycle with p.
+        return ctypes.c_void_p.from_buffer(p).value or 0
+    return ctypes.cast(p, ctypes.c_void_p).value or 0
+
+
+def get_int(v):
+    """
+    :param ctypes._SimpleCData|int v: integer argument, as the interpreter passes it
+    :rtype: int
+    """
+    if isinstance(v, int):
+        return v
+    return int(v.value)
+
+
+def get_var_address(interpreter, name):
+    """
+    :param cparser.interpreter.Interpreter interpreter:
+    :param str name: C global variable
+    :return: address of the variable in the interpreted process memory
+    :rtype: int
+    """
+    return ctypes.addressof(interpreter.globalScope.getVar(name))
+
+
+# ---------------------------------------------------------------------------
+# Path configuration (Python/pathconfig.c, Modules/getpath.c).
+# ---------------------------------------------------------------------------
+
+# Py_GetPrefix/ExecPrefix/Path/PythonHome/ProgramFullPath are defined in
+# pathconfig.c, which is intentionally not parsed.  Their C implementation
+# calls _PyPathConfig_Init() (from Modules/getpath.c, also not parsed),
+# which walks the real filesystem to discover where CPython is installed.
+# That filesystem-discovery logic is platform-specific, requires many
+# unwrapped syscalls, and would return the *wrong* paths anyway — we want
+# the host Python's prefix/path so the interpreted CPython can find its
+# stdlib.  We therefore supply these values directly from the host runtime.
+
+def _make_path_func_factory(get_value):
+    def factory(interpreter, state, **context):
+        s = get_value(context)
+
+        def path_func():
+            """Returns a wchar_t* constant string."""
+            buf = interpreter._make_wchar_string(s)
+            return ctypes.cast(buf, ctypes.c_void_p).value or 0
+
+        path_func.C_argTypes = None
+        path_func.C_resType = ctypes.c_void_p
+        return path_func
+    return factory
+
+
+for _name, _get_value in [
+    ("Py_GetProgramFullPath", lambda context: context["argv"][0]),
+    ("Py_GetPrefix", lambda context: sys.prefix),
+    ("Py_GetExecPrefix", lambda context: sys.exec_prefix),
+    ("Py_GetPath", lambda context: ":".join(sys.path)),
+    ("Py_GetPythonHome", lambda context: ""),
+]:
+    register(_name, required=True)(_make_path_func_factory(_get_value))
+del _name, _get_value
+
+
+# _PyPathConfig_Calculate is defined in Modules/getpath.c (not parsed).
+# It fills a _PyPathConfig struct from the filesystem.  We provide a stub
+# that returns success (_PyInitError with msg=NULL) and leaves the config
+# fields at zero — the public Py_Get* functions above supply the real values.
+@register("_PyPathConfig_Calculate", required=True)
+def _path_config_calculate(interpreter, state, **context):
+    init_error_ctype = interpreter.getCType(state.typedefs['_PyInitError'])
+
+    def _path_config_calculate_stub(*args):
+        return init_error_ctype()  # all-zero = success (msg=NULL)
+
+    _path_config_calculate_stub.C_argTypes = None
+    _path_config_calculate_stub.C_resType = state.typedefs['_PyInitError']
+    return _path_config_calculate_stub
+
+
+# ---------------------------------------------------------------------------
+# Hashing (Python/pyhash.c).
+# ---------------------------------------------------------------------------
+
+# _Py_HashSecret is defined in bootstrap_hash.c.
+_HashCFiles = ("Python/pyhash.c", "Python/bootstrap_hash.c")
+_Mask64 = 0xffffffffffffffff
+
+
+def _rotl64(x, b):
+    return ((x << b) | (x >> (64 - b))) & _Mask64
+
+
+def siphash24(k0, k1, data):
+    """
+    SipHash-2-4, like siphash24() in Python/pyhash.c.
+
+    :param int k0: first 64 bit of the key
+    :param int k1: second 64 bit of the key
+    :param bytes data:
+    :rtype: int
+    """
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+
+    def sip_rounds(count):
+        nonlocal v0, v1, v2, v3
+        for _ in range(count):
+            v0 = (v0 + v1) & _Mask64
+            v1 = _rotl64(v1, 13) ^ v0
+            v0 = _rotl64(v0, 32)
+            v2 = (v2 + v3) & _Mask64
+            v3 = _rotl64(v3, 16) ^ v2
+            v0 = (v0 + v3) & _Mask64
+            v3 = _rotl64(v3, 21) ^ v0
+            v2 = (v2 + v1) & _Mask64
+            v1 = _rotl64(v1, 17) ^ v2
+            v2 = _rotl64(v2, 32)
+
+    num_words = len(data) // 8
+    for m in struct.unpack_from("<%iQ" % num_words, data):
+        v3 ^= m
+        sip_rounds(2)
+        v0 ^= m
+    b = ((len(data) & 0xff) << 56) | int.from_bytes(data[num_words * 8:], "little")
+    v3 ^= b
+    sip_rounds(2)
+    v0 ^= b
+    v2 ^= 0xff
+    sip_rounds(4)
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+def _to_py_hash_t(x):
+    """
+    :param int x: unsigned, as size_t
+    :return: signed, as Py_hash_t, where -1 is reserved for errors
+    :rtype: int
+    """
+    bits = ctypes.sizeof(ctypes.c_void_p) * 8
+    x &= (1 << bits) - 1
+    if x >= 1 << (bits - 1):
+        x -= 1 << bits
+    if x == -1:
+        x = -2
+    return x
+
+
+def _make_hash_bytes_inputs(interpreter, state, rnd):
+    length = rnd.choice([0, 1, 7, 8, 9, 15, 16, 17, rnd.randint(0, 100)])
+    buf = ctypes.create_string_buffer(bytes(rnd.getrandbits(8) for _ in range(length)), max(length, 1))
+    return ctypes.cast(buf, ctypes.c_void_p), length
+
+
+@register("_Py_HashBytes", c_files=_HashCFiles, make_inputs=_make_hash_bytes_inputs)
+def _hash_bytes(interpreter, state, **context):
+    # With the default Py_HASH_ALGORITHM (siphash24) and Py_HASH_CUTOFF 0.
+    secret_address = []  # lazily, the variable might not be there at install time
+    hash_t = interpreter.getCType(state.funcs["_Py_HashBytes"].type)
+
+    def _Py_HashBytes(src, length):
+        length = get_int(length)
+        if length == 0:
+            return hash_t(0)
+        if not secret_address:
+            secret_address.append(get_var_address(interpreter, "_Py_HashSecret"))
+        k0, k1 = struct.unpack("<QQ", ctypes.string_at(secret_address[0], 16))
+        x = siphash24(k0, k1, ctypes.string_at(get_address(src), length))
+        return hash_t(_to_py_hash_t(x))
+
+    return _Py_HashBytes
+
+
+def hash_pointer(address):
+    """
+    Like _Py_HashPointer() in Python/pyhash.c.
+
+    :param int address:
+    :rtype: int
+    """
+    bits = ctypes.sizeof(ctypes.c_void_p) * 8
+    y = address & ((1 << bits) - 1)
+    # Bottom 3 or 4 bits are likely to be 0; rotate by 4 to avoid excessive hash collisions.
+    y = (y >> 4) | (y << (bits - 4))
+    return _to_py_hash_t(y)
+
+
+def _make_hash_pointer_inputs(interpreter, state, rnd):
+    return ctypes.c_void_p(rnd.getrandbits(ctypes.sizeof(ctypes.c_void_p) * 8) or 1),
+
+
+@register("_Py_HashPointer", c_files=_HashCFiles, make_inputs=_make_hash_pointer_inputs)
+def _hash_pointer(interpreter, state, **context):
+    hash_t = interpreter.getCType(state.funcs["_Py_HashPointer"].type)
+
+    def _Py_HashPointer(p):
+        return hash_t(hash_pointer(get_address(p)))
+
+    return _Py_HashPointer
+
+
+# ---------------------------------------------------------------------------
+# Dict lookup (Objects/dictobject.c, Objects/dict-common.h).
+# ---------------------------------------------------------------------------
+
+_DictCFiles = ("Objects/dictobject.c",)
+_PerturbShift = 5
+_DKIX_EMPTY = -1
+_DKIX_DUMMY = -2
+
+
+class _DictLayout:
+    """
+    Offsets in PyObject, PyASCIIObject, PyDictObject, PyDictKeysObject and
+    PyDictKeyEntry, from the parsed structs.
+    """
+
+    def __init__(self, interpreter, state):
+        object_t = interpreter.getCType(state.typedefs["PyObject"])
+        ascii_t = interpreter.getCType(state.typedefs["PyASCIIObject"])
+        dict_t = interpreter.getCType(state.typedefs["PyDictObject"])
+        keys_t = interpreter.getCType(state.typedefs["PyDictKeysObject"])
+        entry_t = interpreter.getCType(state.typedefs["PyDictKeyEntry"])
+        self.object_t = object_t
+        self.dict_t = dict_t
+        self.hash_t = interpreter.getCType(state.typedefs["Py_hash_t"])
+        self.ob_type = object_t.ob_type.offset
+        self.ascii_size = ctypes.sizeof(ascii_t)
+        self.ascii_length = ascii_t.length.offset
+        self.ascii_hash = ascii_t.hash.offset
+        self.ascii_state = ascii_t.state.offset
+        self.dict_size = ctypes.sizeof(dict_t)
+        self.ma_used = dict_t.ma_used.offset
+        self.ma_keys = dict_t.ma_keys.offset
+        self.dk_refcnt = keys_t.dk_refcnt.offset
+        self.dk_size = keys_t.dk_size.offset
+        self.dk_usable = keys_t.dk_usable.offset
+        self.dk_nentries = keys_t.dk_nentries.offset
+        # char dk_indices[], right after dk_nentries.
+        self.dk_indices = keys_t.dk_nentries.offset + ctypes.sizeof(ctypes.c_ssize_t)
+        self.entry_size = ctypes.sizeof(entry_t)
+        self.me_hash = entry_t.me_hash.offset
+        self.me_key = entry_t.me_key.offset
+        self.me_value = entry_t.me_value.offset
+        # Typed direct reads for the lookup, faster than ctypes from_address(), see struct_layout.
+        self.get_ob_type = struct_layout.make_field_getter(object_t, "ob_type")
+        self.get_ma_keys = struct_layout.make_field_getter(dict_t, "ma_keys")
+        self.get_dk_size = struct_layout.make_field_getter(keys_t, "dk_size")
+        self.get_me_hash = struct_layout.make_field_getter(entry_t, "me_hash")
+        self.get_me_key = struct_layout.make_field_getter(entry_t, "me_key")
+        self.get_me_value = struct_layout.make_field_getter(entry_t, "me_value")
+        self.unicode_type = get_var_address(interpreter, "PyUnicode_Type")
+        self.dict_type = get_var_address(interpreter, "PyDict_Type")
+
+
+def _dk_index_type(dk_size):
+    """
+    Like dk_get_index() in Objects/dictobject.c.
+
+    :param int dk_size:
+    :return: the type of the entries of dk_indices
+    """
+    if dk_size <= 0xff:
+        return ctypes.c_int8
+    if dk_size <= 0xffff:
+        return ctypes.c_int16
+    if dk_size <= 0xffffffff:
+        return ctypes.c_int32
+    return ctypes.c_int64
+
+
+_IndexUnpackers = {
+    index_t: struct.Struct("@" + index_t._type_).unpack_from
+    for index_t in (ctypes.c_int8, ctypes.c_int16, ctypes.c_int32, ctypes.c_int64)}
+
+
+def _write_ptr(address, value):
+    ctypes.c_void_p.from_address(address).value = value or None
+
+
+def _make_ascii_object(layout, s, h, keep):
+    """
+    :param _DictLayout layout:
+    :param str s: ASCII
+    :param int h: hash
+    :param list keep: gets the buffer
+    :return: address of a new compact ASCII str object, like PyUnicode_New() creates it
+    :rtype: int
+    """
+    data = s.encode("ascii")
+    buf = ctypes.create_string_buffer(layout.ascii_size + len(data) + 1)
+    keep.append(buf)
+    address = ctypes.addressof(buf)
+    ctypes.c_ssize_t.from_address(address).value = 1  # ob_refcnt
+    _write_ptr(address + layout.ob_type, layout.unicode_type)
+    ctypes.c_ssize_t.from_address(address + layout.ascii_length).value = len(data)
+    ctypes.c_ssize_t.from_address(address + layout.ascii_hash).value = h
+    # state: interned 0, kind PyUnicode_1BYTE_KIND, compact, ascii, ready.
+    ctypes.c_uint.from_address(address + layout.ascii_state).value = (1 << 2) | (1 << 5) | (1 << 6) | (1 << 7)
+    ctypes.memmove(address + layout.ascii_size, data, len(data))
+    return address
+
+
+def _make_lookdict_unicode_inputs(interpreter, state, rnd):
+    """
+    Builds a dict with str keys in the layout of Objects/dict-common.h, inserted with the
+    probing of insertdict(), with some deleted entries, and a str key to look up.
+    """
+    layout = _DictLayout(interpreter, state)
+    keep = []
+    bits = ctypes.sizeof(ctypes.c_void_p) * 8
+    size = rnd.choice([8, 16, 64, 512])
+    mask = size - 1
+    index_t = _dk_index_type(size)
+    index_size = ctypes.sizeof(index_t)
+    keys_buf = ctypes.create_string_buffer(
+        layout.dk_indices + size * index_size + (2 * size // 3) * layout.entry_size)
+    keep.append(keys_buf)
+    keys = ctypes.addressof(keys_buf)
+    entries = keys + layout.dk_indices + size * index_size
+    ctypes.memset(keys + layout.dk_indices, 0xff, size * index_size)  # all DKIX_EMPTY
+
+    def find_slot(h):
+        perturb = h & ((1 << bits) - 1)
+        i = perturb & mask
+        while index_t.from_address(keys + layout.dk_indices + i * index_size).value != _DKIX_EMPTY:
+            perturb >>= _PerturbShift
+            i = mask & (i * 5 + perturb + 1)
+        return i
+
+    # Few hash bits, so that we get collisions.
+    def make_hash():
+        return _to_py_hash_t(rnd.getrandbits(rnd.choice([3, 8, bits])))
+
+    num_entries = rnd.randint(0, 2 * size // 3)
+    strs = {}  # str -> (hash, object address, slot)
+    for ix in range(num_entries):
+        s = "k%i_%i" % (ix, rnd.getrandbits(16))
+        h = make_hash()
+        key = _make_ascii_object(layout, s, h, keep)
+        value = _make_ascii_object(layout, "v" + s, make_hash(), keep)
+        slot = find_slot(h)
+        index_t.from_address(keys + layout.dk_indices + slot * index_size).value = ix
+        entry = entries + ix * layout.entry_size
+        ctypes.c_ssize_t.from_address(entry + layout.me_hash).value = h
+        _write_ptr(entry + layout.me_key, key)
+        _write_ptr(entry + layout.me_value, value)
+        strs[s] = (h, key, slot, entry)
+    deleted = []
+    for s in sorted(strs):
+        if rnd.random() < 0.2:
+            h, key, slot, entry = strs.pop(s)
+            index_t.from_address(keys + layout.dk_indices + slot * index_size).value = _DKIX_DUMMY
+            _write_ptr(entry + layout.me_key, 0)
+            _write_ptr(entry + layout.me_value, 0)
+            deleted.append((s, h))
+    ctypes.c_ssize_t.from_address(keys + layout.dk_refcnt).value = 1
+    ctypes.c_ssize_t.from_address(keys + layout.dk_size).value = size
+    ctypes.c_ssize_t.from_address(keys + layout.dk_usable).value = 2 * size // 3 - num_entries
+    ctypes.c_ssize_t.from_address(keys + layout.dk_nentries).value = num_entries
+
+    dict_buf = ctypes.create_string_buffer(layout.dict_size)
+    keep.append(dict_buf)
+    dict_address = ctypes.addressof(dict_buf)
+    ctypes.c_ssize_t.from_address(dict_address).value = 1  # ob_refcnt
+    _write_ptr(dict_address + layout.ob_type, layout.dict_type)
+    ctypes.c_ssize_t.from_address(dict_address + layout.ma_used).value = len(strs)
+    _write_ptr(dict_address + layout.ma_keys, keys)
+
+    # The key to look up: the same object, an equal str, a deleted or a missing one.
+    kind = rnd.choice(["same", "equal", "deleted", "missing"])
+    if kind in ("same", "equal") and strs:
+        s = rnd.choice(sorted(strs))
+        h, key, _, _ = strs[s]
+        if kind == "equal":
+            key = _make_ascii_object(layout, s, h, keep)
+    elif kind == "deleted" and deleted:
+        s, h = rnd.choice(deleted)
+        key = _make_ascii_object(layout, s, h, keep)
+    else:
+        h = make_hash()
+        key = _make_ascii_object(layout, "missing%i" % rnd.getrandbits(16), h, keep)
+    mp = ctypes.pointer(layout.dict_t.from_address(dict_address))
+    mp.keep = keep  # we refer to these by address
+    value_addr = ctypes.pointer(ctypes.POINTER(layout.object_t)())
+    return mp, ctypes.pointer(layout.object_t.from_address(key)), layout.hash_t(h), value_addr
+
+
+@register("lookdict_unicode", c_files=_DictCFiles, make_inputs=_make_lookdict_unicode_inputs)
+def _lookdict_unicode(interpreter, state, **context):
+    layout_cache = []  # lazily, the variables might not be there at install time
+    orig_func = []  # the interpreted C code, lazily
+    ix_t = interpreter.getCType(state.funcs["lookdict_unicode"].type)
+    bits = ctypes.sizeof(ctypes.c_void_p) * 8
+    memory = struct_layout.get_process_memory()
+
+    def lookdict_unicode(mp, key, key_hash, value_addr):
+        if not layout_cache:
+            layout_cache.append(_DictLayout(interpreter, state))
+        layout = layout_cache[0]
+        key_address = get_address(key)
+        if layout.get_ob_type(key_address) != layout.unicode_type:
+            # The C code switches the dict to lookdict and calls it.
+            if not orig_func:
+                orig_func.append(interpreter._translateFuncToPy("lookdict_unicode"))
+            return orig_func[0](mp, key, key_hash, value_addr)
+        key_hash = get_int(key_hash)
+        keys = layout.get_ma_keys(get_address(mp))
+        dk_size = layout.get_dk_size(keys)
+        index_t = _dk_index_type(dk_size)
+        index_size = ctypes.sizeof(index_t)
+        unpack_index = _IndexUnpackers[index_t]
+        indices = keys + layout.dk_indices
+        entries = indices + dk_size * index_size
+        mask = dk_size - 1
+        perturb = key_hash & ((1 << bits) - 1)
+        i = perturb & mask
+        while True:
+            ix = unpack_index(memory, indices + i * index_size)[0]
+            if ix == _DKIX_EMPTY:
+                _write_ptr(get_address(value_addr), 0)
+                return ix_t(_DKIX_EMPTY)
+            if ix >= 0:
+                entry = entries + ix * layout.entry_size
+                me_key = layout.get_me_key(entry)
+                if me_key == key_address or (
+                        layout.get_me_hash(entry) == key_hash
+                        and get_int(interpreter.getFunc("unicode_eq")(
+                            ctypes.pointer(layout.object_t.from_address(me_key)), key))):
+                    _write_ptr(get_address(value_addr), layout.get_me_value(entry))
+                    return ix_t(ix)
+            perturb >>= _PerturbShift
+            i = mask & (i * 5 + perturb + 1)
+
+    return lookdict_unicode
+
+
+def make_random_inputs(interpreter, state, name, count, seed=42):
+    """
+    :param cparser.interpreter.Interpreter interpreter:
+    :param cparser.State state:
+    :param str name: registered override with make_inputs
+    :param int count:
+    :param int seed:
+    :return: list of argument tuples for the differential test
+    :rtype: list[tuple]
+    """
+    rnd = random.Random(seed)
+    return [Overrides[name].make_inputs(interpreter, state, rnd) for _ in range(count)]
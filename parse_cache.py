@@ -0,0 +1,286 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+On-disk cache of a fully parsed CPythonState.
+
+Parsing all of CPython takes minutes. We pickle the resulting state
+(macros, typedefs, structs, funcs, vars, contentlist, ...) and load it back
+on the next run, as long as none of the inputs changed.
+
+The inputs are:
+
+* every file which was read while parsing (the .c files and all headers),
+  stored with a content digest inside the cache file,
+* the "recipe": the source of the state class (e.g. the pyconfig.h reader),
+  its parse units (incl. the macro hacks), the sources of our modules which
+  change the parsed state (RecipeModules), the cparser sources and the host
+  platform (the ctypes sizes end up in the SIZEOF_* macros).
+
+A fresh state already contains objects we cannot pickle, e.g. the ctypes
+function wrappers of the global include wrappers. All objects which are
+already in a fresh state are stored by reference, as (container, name), and
+resolved against a new fresh state on load.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import inspect
+import os
+import pickle
+import platform
+import sys
+
+MyDir = os.path.dirname(os.path.abspath(__file__))
+
+CacheDir = os.environ.get("PYCPYTHON_CACHE_DIR") or MyDir + "/.cache"
+
+# Increase this when the layout of the cache file changes.
+# 2: the states in the cache are compacted.
+CacheFormatVersion = 2
+
+# The attributes of cparser.State (and CPythonState) which we store.
+StateAttribs = [
+    "macros", "typedefs", "structs", "unions", "enums", "funcs", "vars", "enumconsts",
+    "contentlist", "_errors", "included_files", "input_files", "parsed_units", "unit_entry_digests",
+    "lazy_bodies"]
+
+# The containers in the state where we look for objects which a fresh state already has.
+StateContainers = [
+    "macros", "typedefs", "structs", "unions", "enums", "funcs", "vars", "enumconsts", "lazy_bodies"]
+
+# Our modules which change how we parse or what ends up in the pickled state.
+RecipeModules = ["parse_cache", "parse_incremental", "parse_parallel", "prelude", "lazy_parse", "compact",
+                 "include_cache"]
+
+# The pickled parse tree is deeply nested (long expressions, nested bodies).
+PickleRecursionLimit = 10000
+
+
+def file_digest(filename):
+    """
+    :param str filename:
+    :return: sha1 hex digest of the file content, or None if the file does not exist
+    :rtype: str|None
+    """
+    if not os.path.exists(filename):
+        return None
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while True:
+            buf = f.read(1 << 16)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+_recipe_digests = {}  # type: dict[(type,bool),str]
+
+
+def recipe_digest(state_type, with_units=True):
+    """
+    :param type state_type: e.g. CPythonState
+    :param bool with_units: whether to include the parse units.
+      The unit records of parse_incremental don't need them, as their entry digest covers the unit macros
+    :return: digest over everything which influences the parsing besides the input files
+    :rtype: str
+    """
+    key = (state_type, with_units)
+    if key not in _recipe_digests:
+        _recipe_digests[key] = _calc_recipe_digest(state_type, with_units=with_units)
+    return _recipe_digests[key]
+
+
+def _calc_recipe_digest(state_type, with_units):
+    import cparser
+    h = hashlib.sha1()
+    h.update(("format %i\n" % CacheFormatVersion).encode("utf8"))
+    h.update(("python %s\n" % sys.version).encode("utf8"))
+    h.update(("platform %s %s\n" % (platform.system(), platform.machine())).encode("utf8"))
+    for cls in state_type.__mro__:
+        if cls.__module__ == state_type.__module__:
+            h.update(inspect.getsource(cls).encode("utf8"))
+    if with_units:
+        h.update(("units %r\n" % (state_type.parse_units,)).encode("utf8"))
+    for module_name in RecipeModules:
+        fn = "%s/%s.py" % (MyDir, module_name)
+        h.update(("%s %s\n" % (module_name, file_digest(fn))).encode("utf8"))
+    cparser_dir = os.path.dirname(os.path.abspath(cparser.__file__))
+    for fn in sorted(os.listdir(cparser_dir)):
+        if fn.endswith(".py"):
+            h.update(("%s %s\n" % (fn, file_digest(os.path.join(cparser_dir, fn)))).encode("utf8"))
+    return h.hexdigest()
+
+
+def get_base_object_table(state):
+    """
+    :param cparser.State state: a fresh state, before parsing
+    :return: id(obj) -> ((container, name), obj), for all objects the fresh state already has.
+      We keep the objects alive here, so that the ids stay unique even when the parsing replaces them.
+    :rtype: dict[int,(tuple[str,str],object)]
+    """
+    table = {id(state): (("state",), state)}
+    for container in StateContainers:
+        for name, obj in getattr(state, container).items():
+            table.setdefault(id(obj), ((container, name), obj))
+    return table
+
+
+class StatePickler(pickle.Pickler):
+    """
+    Pickles objects of a state, where all objects from the table are stored as references.
+    """
+
+    def __init__(self, f, table):
+        """
+        :param file f:
+        :param dict[int,(tuple,object)] table: see get_base_object_table()
+        """
+        pickle.Pickler.__init__(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.table = table
+
+    def persistent_id(self, obj):
+        entry = self.table.get(id(obj))
+        if entry is None:
+            return None
+        return entry[0]
+
+
+class StateUnpickler(pickle.Unpickler):
+    """
+    Counterpart to StatePickler. Resolves the references against the given state.
+    """
+
+    def __init__(self, f, state):
+        """
+        :param file f:
+        :param cparser.State state: the state which provides the referenced objects
+        """
+        pickle.Unpickler.__init__(self, f)
+        self.state = state
+
+    def persistent_load(self, pid):
+        if pid == ("state",):
+            return self.state
+        container, name = pid
+        return getattr(self.state, container)[name]
+
+
+class _RecursionLimit:
+    def __init__(self, limit):
+        self.limit = limit
+        self.old_limit = None
+
+    def __enter__(self):
+        self.old_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(self.old_limit, self.limit))
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        sys.setrecursionlimit(self.old_limit)
+
+
+def get_cache_filename(state_type, num_units=None, mode="serial"):
+    """
+    :param type state_type:
+    :param int|None num_units: number of parse units in the state. by default all
+    :param str mode: how the state was parsed, "serial" or "parallel". see parse_cpython()
+    :rtype: str
+    """
+    units = state_type.parse_units[:num_units]
+    h = hashlib.sha1(recipe_digest(state_type).encode("utf8"))
+    h.update(("mode %s\n" % mode).encode("utf8"))
+    h.update(repr(units).encode("utf8"))
+    return "%s/parsed-%s-%s-%i-%s.pickle" % (
+        CacheDir, state_type.__name__, mode, len(units), h.hexdigest()[:16])
+
+
+def load_state(state, verbose=False, num_units=None, mode="serial"):
+    """
+    :param cparser.State state: a fresh state, e.g. CPythonState(). will be filled from the cache
+    :param bool verbose:
+    :param int|None num_units: number of parse units we want to have parsed. by default all
+    :param str mode: how the state was parsed, see get_cache_filename()
+    :return: whether the cache was valid and the state is now parsed
+    :rtype: bool
+    """
+    fn = get_cache_filename(type(state), num_units=num_units, mode=mode)
+    if not os.path.exists(fn):
+        return False
+    try:
+        with open(fn, "rb") as f, _RecursionLimit(PickleRecursionLimit):
+            files = pickle.load(f)
+            for input_fn, digest in sorted(files.items()):
+                if file_digest(input_fn) != digest:
+                    if verbose:
+                        print("Parse cache: %s changed." % input_fn)
+                    return False
+            attribs = StateUnpickler(f, state).load()
+    except Exception as exc:
+        print("Parse cache: cannot load %s: %s: %s" % (fn, type(exc).__name__, exc))
+        return False
+    for key, value in attribs.items():
+        setattr(state, key, value)
+    return True
+
+
+def save_state(state, table, mode="serial"):
+    """
+    :param cparser.State state: the parsed state, with state.input_files and state.parsed_units
+    :param dict[int,(tuple,object)] table: get_base_object_table() of the state before parsing
+    :param str mode: how the state was parsed, see get_cache_filename()
+    :return: whether we have written the cache
+    :rtype: bool
+    """
+    fn = get_cache_filename(type(state), num_units=state.parsed_units, mode=mode)
+    files = {input_fn: file_digest(input_fn) for input_fn in state.input_files}
+    attribs = {key: getattr(state, key) for key in StateAttribs}
+    if not os.path.exists(CacheDir):
+        os.makedirs(CacheDir)
+    tmp_fn = "%s.%i.tmp" % (fn, os.getpid())
+    try:
+        with open(tmp_fn, "wb") as f, _RecursionLimit(PickleRecursionLimit):
+            pickle.dump(files, f, protocol=pickle.HIGHEST_PROTOCOL)
+            StatePickler(f, table).dump(attribs)
+    except Exception as exc:
+        print("Parse cache: cannot save state: %s: %s" % (type(exc).__name__, exc))
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        return False
+    os.rename(tmp_fn, fn)
+    return True
+
+
+def parse_cpython(state, use_cache=True, jobs=1, compact=True):
+    """
+    Like state.parse_cpython(), but uses the cache if possible.
+
+    :param cparser.State state: a fresh state, e.g. CPythonState()
+    :param bool use_cache: if False, always parse and don't touch the cache
+    :param int jobs: if > 1, parse the units in parallel, see parse_parallel.
+      Such a state is cached apart from the serially parsed one
+    :param bool compact: reduce the memory footprint of the parsed state, see compact.compact_state.
+      We do that once after parsing. The cache only holds compacted states, and they stay compacted
+      when we load them (pickle keeps the sharing), so we don't save the state if this is False
+    """
+    import compact as compact_module
+    mode = "parallel" if jobs > 1 else "serial"
+    if use_cache and load_state(state, verbose=True, mode=mode):
+        print("(from cache)", end=" ")
+        return
+    # Start from the precompiled header prelude.
+    import prelude
+    table = prelude.load_into(state, use_cache=use_cache)
+    if jobs > 1:
+        import parse_parallel
+        parse_parallel.parse_cpython(state, jobs=jobs)
+    elif use_cache:
+        import parse_incremental
+        parse_incremental.parse_cpython(state)
+    else:
+        state.parse_cpython()
+    if compact:
+        compact_module.compact_state(state)
+        if use_cache:
+            save_state(state, table, mode=mode)
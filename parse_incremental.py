@@ -0,0 +1,346 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Incremental parsing of CPython, one translation unit (ParseUnit) at a time.
+
+CPythonState.parse_cpython() parses all units into one shared state, and later
+units depend on the macros and declarations which earlier units leave behind.
+For every unit, we record:
+
+* its entry state: the macro definitions, the known type names and the
+  already included headers, right before cparser.parse() runs,
+* all files it has read (the .c file and the headers it pulled in via
+  readLocalInclude/readGlobalInclude), with content digests,
+* the delta it applied to the state: new or replaced declarations and macros,
+  removed macros, declarations which it changed in place (e.g. a struct which
+  was forward-declared before and is completed by this unit), and the new
+  contentlist entries and errors.
+
+When we parse again, a unit is replayed from its record if its entry state and
+its files are unchanged. Otherwise it is parsed for real, which might change
+the entry state of the following units, so that those get parsed again as well.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import os
+import pickle
+import time
+
+import parse_cache
+from parse_cache import StateContainers, file_digest
+
+# Increase this when the layout of the unit files changes.
+UnitCacheFormatVersion = 2
+
+# The containers with declarations which cparser completes in place,
+# e.g. a forward-declared struct, or a function prototype which gets its body.
+MutableContainers = ["typedefs", "structs", "unions", "enums", "funcs", "vars"]
+
+
+def macro_signature(macro):
+    """
+    :param cparser.Macro|object macro:
+    :return: something which identifies the macro definition, stable across runs
+    :rtype: str
+    """
+    if hasattr(macro, "rightside"):
+        return repr((getattr(macro, "args", None), macro.rightside))
+    # Some builtin macro. Those don't change between runs.
+    return type(macro).__name__
+
+
+def _get_attribs(obj):
+    """
+    :param object obj: declaration
+    :return: the attributes of the object, or None if it has none (e.g. some builtin value)
+    :rtype: dict[str]|None
+    """
+    if hasattr(obj, "__dict__"):
+        return vars(obj)
+    slots = [name for cls in type(obj).__mro__ for name in getattr(cls, "__slots__", ())]
+    if not slots:
+        return None
+    return {name: getattr(obj, name) for name in slots if hasattr(obj, name)}
+
+
+def decl_signature(obj):
+    """
+    :param object obj: declaration
+    :return: something which identifies the declaration and its completeness, stable across runs.
+      E.g. a forward-declared struct and the completed struct differ, because only the latter has a body
+    :rtype: str
+    """
+    attribs = _get_attribs(obj)
+    if attribs is None:
+        return type(obj).__name__
+    return "%s %s" % (type(obj).__name__, ",".join(sorted(k for (k, v) in attribs.items() if v is not None)))
+
+
+def content_version(obj):
+    """
+    :param object obj: declaration
+    :return: something which changes when the object is changed in place. only valid in this process
+    :rtype: tuple
+    """
+    attribs = _get_attribs(obj)
+    if attribs is None:
+        return ()
+    res = []
+    for key, value in sorted(attribs.items()):
+        # E.g. cparser fills the CBody of a struct after it was assigned.
+        value_contents = getattr(value, "contentlist", value)
+        size = len(value_contents) if isinstance(value_contents, (list, dict)) else None
+        res.append((key, id(value), size))
+    return tuple(res)
+
+
+def entry_digest(state):
+    """
+    :param cparser.State state:
+    :return: digest over everything in the state which influences how the next unit is parsed
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    for name, macro in sorted(state.macros.items()):
+        h.update(("macro %s %s\n" % (name, macro_signature(macro))).encode("utf8"))
+    # Whether an identifier is a type name changes how C code is parsed,
+    # and how far a declaration is completed changes what the next definition does with it.
+    for container in MutableContainers:
+        for name, obj in sorted(getattr(state, container).items()):
+            h.update(("%s %s %s\n" % (container, name, decl_signature(obj))).encode("utf8"))
+    # Already included headers are skipped.
+    for fn in sorted(state.included_files):
+        h.update(("included %s\n" % fn).encode("utf8"))
+    return h.hexdigest()
+
+
+class StateSnapshot:
+    """
+    The state right before a unit is parsed.
+    """
+
+    def __init__(self, state):
+        """
+        :param cparser.State state:
+        """
+        self.containers = {container: dict(getattr(state, container)) for container in StateContainers}
+        self.versions = {
+            container: {name: content_version(obj) for (name, obj) in self.containers[container].items()}
+            for container in MutableContainers}
+        self.contentlist_len = len(state.contentlist)
+        self.errors_len = len(state._errors)
+        self.included_files = set(state.included_files)
+
+    def get_object_table(self, state):
+        """
+        :param cparser.State state:
+        :return: table for parse_cache.StatePickler, which references all objects from the snapshot
+        :rtype: dict[int,(tuple,object)]
+        """
+        table = {id(state): (("state",), state)}
+        for container, objs in self.containers.items():
+            for name, obj in objs.items():
+                table.setdefault(id(obj), ((container, name), obj))
+        # Anonymous declarations (e.g. typedef struct {...} X) are only in the contentlist.
+        for i in range(self.contentlist_len):
+            obj = state.contentlist[i]
+            pid = ("contentlist", i, type(obj).__name__, getattr(obj, "name", None))
+            table.setdefault(id(obj), (pid, obj))
+        return table
+
+    def get_delta(self, state):
+        """
+        :param cparser.State state: after the unit was parsed
+        :return: what the unit has changed in the state. see apply_delta()
+        :rtype: dict[str]
+        """
+        containers = {}
+        changed = {}
+        for container, before in self.containers.items():
+            after = getattr(state, container)
+            added = [(name, obj) for (name, obj) in after.items() if before.get(name) is not obj]
+            removed = [name for name in before if name not in after]
+            containers[container] = (added, removed)
+        for container, versions in self.versions.items():
+            before = self.containers[container]
+            after = getattr(state, container)
+            changed[container] = [
+                (name, dict(_get_attribs(obj))) for (name, obj) in after.items()
+                if before.get(name) is obj and content_version(obj) != versions[name]]
+        return {
+            "containers": containers,
+            "changed": changed,
+            "contentlist": state.contentlist[self.contentlist_len:],
+            "errors": state._errors[self.errors_len:],
+            "included_files": sorted(set(state.included_files) - self.included_files),
+            "input_files": list(state.unit_input_files)}
+
+
+def apply_delta(state, delta):
+    """
+    :param cparser.State state: in the same entry state as when the delta was recorded
+    :param dict[str] delta: see StateSnapshot.get_delta()
+    """
+    for container, (added, removed) in delta["containers"].items():
+        objs = getattr(state, container)
+        for name in removed:
+            del objs[name]
+        for name, obj in added:
+            objs[name] = obj
+    for container, changed in delta["changed"].items():
+        objs = getattr(state, container)
+        for name, attribs in changed:
+            for key, value in attribs.items():
+                setattr(objs[name], key, value)
+    state.contentlist.extend(delta["contentlist"])
+    state._errors.extend(delta["errors"])
+    state.included_files.update(delta["included_files"])
+    for fn in delta["input_files"]:
+        state.add_input_file(fn)
+
+
+class UnitUnpickler(parse_cache.StateUnpickler):
+    """
+    Resolves the references from StateSnapshot.get_object_table().
+    """
+
+    class InvalidReference(Exception):
+        pass
+
+    def __init__(self, f, state, snapshot=None):
+        """
+        :param file f:
+        :param cparser.State state:
+        :param StateSnapshot|None snapshot: if given, resolve declarations against it instead of the state
+        """
+        parse_cache.StateUnpickler.__init__(self, f, state)
+        self.snapshot = snapshot
+
+    def persistent_load(self, pid):
+        if self.snapshot is not None and pid[0] in self.snapshot.containers:
+            container, name = pid
+            return self.snapshot.containers[container][name]
+        if pid[0] == "contentlist":
+            _, i, type_name, name = pid
+            if i >= len(self.state.contentlist):
+                raise self.InvalidReference("contentlist[%i] does not exist" % i)
+            obj = self.state.contentlist[i]
+            if type(obj).__name__ != type_name or getattr(obj, "name", None) != name:
+                raise self.InvalidReference("contentlist[%i] is %r, expected %s %s" % (i, obj, type_name, name))
+            return obj
+        return parse_cache.StateUnpickler.persistent_load(self, pid)
+
+
+def get_unit_cache_filename(state_type, index, unit):
+    """
+    :param type state_type:
+    :param int index: of the unit in state_type.parse_units
+    :param cpython.ParseUnit unit:
+    :rtype: str
+    """
+    return "%s/units-%s-%s/%02i-%s.pickle" % (
+        parse_cache.CacheDir, state_type.__name__, parse_cache.recipe_digest(state_type, with_units=False)[:16],
+        index, unit.filename.replace("/", "_"))
+
+
+def load_unit(state, fn, digest):
+    """
+    :param cparser.State state: in the entry state of the unit
+    :param str fn: unit cache file
+    :param str digest: entry_digest() of the state
+    :return: the delta of the unit, or None if we don't have a valid record
+    :rtype: dict[str]|None
+    """
+    if not os.path.exists(fn):
+        return None
+    try:
+        with open(fn, "rb") as f, parse_cache._RecursionLimit(parse_cache.PickleRecursionLimit):
+            header = pickle.load(f)
+            if header["version"] != UnitCacheFormatVersion or header["entry"] != digest:
+                return None
+            for input_fn, file_digest_ in sorted(header["files"].items()):
+                if file_digest(input_fn) != file_digest_:
+                    return None
+            return UnitUnpickler(f, state).load()
+    except Exception as exc:
+        print("Parse cache: cannot load %s: %s: %s" % (fn, type(exc).__name__, exc))
+        return None
+
+
+def save_unit(state, fn, digest, snapshot, delta):
+    """
+    :param cparser.State state: after the unit was parsed
+    :param str fn: unit cache file
+    :param str digest: entry_digest() of the state before the unit was parsed
+    :param StateSnapshot snapshot: of the state before the unit was parsed
+    :param dict[str] delta: see StateSnapshot.get_delta()
+    """
+    header = {
+        "version": UnitCacheFormatVersion,
+        "entry": digest,
+        "files": {input_fn: file_digest(input_fn) for input_fn in delta["input_files"]}}
+    if not os.path.exists(os.path.dirname(fn)):
+        os.makedirs(os.path.dirname(fn))
+    tmp_fn = "%s.%i.tmp" % (fn, os.getpid())
+    try:
+        with open(tmp_fn, "wb") as f, parse_cache._RecursionLimit(parse_cache.PickleRecursionLimit):
+            pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+            parse_cache.StatePickler(f, snapshot.get_object_table(state)).dump(delta)
+    except Exception as exc:
+        print("Parse cache: cannot save %s: %s: %s" % (fn, type(exc).__name__, exc))
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        return
+    os.rename(tmp_fn, fn)
+
+
+def parse_unit(state, index, unit):
+    """
+    Parses the unit, or replays it from its record.
+
+    :param cpython.CPythonState state:
+    :param int index: of the unit in state.parse_units
+    :param cpython.ParseUnit unit:
+    :return: whether we replayed the unit from its record
+    :rtype: bool
+    """
+    state.apply_unit_macros(unit)
+    fn = get_unit_cache_filename(type(state), index, unit)
+    digest = entry_digest(state)
+    state.unit_entry_digests[state.get_unit_filename(unit)] = digest
+    delta = load_unit(state, fn, digest)
+    if delta is not None:
+        apply_delta(state, delta)
+        state.parsed_units += 1
+        return True
+    snapshot = StateSnapshot(state)
+    state.unit_input_files = {}
+    try:
+        state.parse_file(state.get_unit_filename(unit), optional=unit.optional)
+        delta = snapshot.get_delta(state)
+    finally:
+        state.unit_input_files = None
+    state.parsed_units += 1
+    save_unit(state, fn, digest, snapshot, delta)
+    return False
+
+
+def parse_cpython(state):
+    """
+    Like state.parse_cpython(), but only parses the units which changed.
+
+    :param cpython.CPythonState state: a fresh state, or with some units already parsed
+    """
+    count_replayed = 0
+    for index, unit in enumerate(state.parse_units):
+        if index < state.parsed_units:
+            continue
+        start_time = time.time()
+        if parse_unit(state, index, unit):
+            count_replayed += 1
+        else:
+            print("(parsed %s in %.1fs)" % (unit.filename, time.time() - start_time), end=" ")
+    print("(%i/%i units from cache)" % (count_replayed, len(state.parse_units)), end=" ")
@@ -0,0 +1,213 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Parallel parsing of the CPython translation units.
+
+The first parse unit is the common header prelude (Python.h). We parse it in
+this process, then fork one worker per remaining unit. Every worker starts
+from the prelude state, applies the macro changes of its unit, parses the C
+file and sends back the delta (see parse_incremental), where all references to
+prelude objects are stored by name.
+
+In the serial parse, a unit also sees the macros and declarations which the
+units before it leave behind. So a worker records all names it has looked up
+in the state containers, also the ones which were not there (e.g. #ifdef).
+We merge the deltas in the original unit order. A unit is independent of the
+units before it if none of its looked up names was changed by them (besides
+its own unit macros), and if it did not include a header which they have
+included already. Then it would have parsed the same from its serial entry
+state, and we apply its delta. Otherwise we parse it again in this process,
+on top of the merged state. Either way, the result is the same as the one of
+the serial parse.
+"""
+
+from __future__ import print_function
+
+import io
+import multiprocessing
+import time
+
+import parse_cache
+import parse_incremental
+
+# Set in the parent right before we fork the workers.
+_job_state = None  # type: cparser.State|None
+
+
+class RecordingDict(dict):
+    """
+    Dict which records all keys which were looked up, whether they exist or not.
+    """
+
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.reads = set()  # type: set[str]
+
+    def __getitem__(self, key):
+        self.reads.add(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.reads.add(key)
+        return dict.__contains__(self, key)
+
+    def __delitem__(self, key):
+        self.reads.add(key)
+        dict.__delitem__(self, key)
+
+    def get(self, key, default=None):
+        self.reads.add(key)
+        return dict.get(self, key, default)
+
+    def pop(self, key, *default):
+        self.reads.add(key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        self.reads.add(key)
+        return dict.setdefault(self, key, default)
+
+    def _read_all(self):
+        self.reads.update(dict.keys(self))
+
+    def __iter__(self):
+        self._read_all()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self._read_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._read_all()
+        return dict.values(self)
+
+    def items(self):
+        self._read_all()
+        return dict.items(self)
+
+
+def _parse_unit_job(index):
+    """
+    Runs in a forked worker.
+
+    :param int index: of the unit in state.parse_units
+    :return: (index, pickled (delta, reads), parse time),
+      where reads is container -> names which the unit has looked up
+    :rtype: (int,bytes,float)
+    """
+    state = _job_state
+    unit = state.parse_units[index]
+    start_time = time.time()
+    # References to the prelude objects are resolved by the parent, thus the table of the prelude state.
+    table = parse_incremental.StateSnapshot(state).get_object_table(state)
+    # The parent applies the unit macros itself, on top of the units before. They are not part of the delta.
+    state.apply_unit_macros(unit)
+    snapshot = parse_incremental.StateSnapshot(state)
+    for container in parse_cache.StateContainers:
+        setattr(state, container, RecordingDict(getattr(state, container)))
+    state.unit_input_files = {}
+    state.parse_file(state.get_unit_filename(unit), optional=unit.optional)
+    reads = {}
+    for container in parse_cache.StateContainers:
+        objs = getattr(state, container)
+        reads[container] = set(objs.reads)
+        setattr(state, container, dict.copy(objs))
+    delta = snapshot.get_delta(state)
+    f = io.BytesIO()
+    with parse_cache._RecursionLimit(parse_cache.PickleRecursionLimit):
+        parse_cache.StatePickler(f, table).dump((delta, reads))
+    return index, f.getvalue(), time.time() - start_time
+
+
+def get_changed_names(delta):
+    """
+    :param dict[str] delta: see StateSnapshot.get_delta()
+    :return: container -> names which the delta adds, replaces, removes or changes in place
+    :rtype: dict[str,set[str]]
+    """
+    res = {}
+    for container, (added, removed) in delta["containers"].items():
+        res.setdefault(container, set()).update([name for (name, _) in added] + removed)
+    for container, changed in delta["changed"].items():
+        res.setdefault(container, set()).update(name for (name, _) in changed)
+    return res
+
+
+def is_independent(state, delta, reads, changed_names, unit):
+    """
+    :param cparser.State state: the merged state of the units before, with the unit macros applied
+    :param dict[str] delta: of the unit, parsed from the prelude
+    :param dict[str,set[str]] reads: container -> names which the unit has looked up
+    :param dict[str,set[str]] changed_names: container -> names which the units before have changed
+    :param cpython.ParseUnit unit:
+    :return: whether the unit would give the same delta when parsed on top of the state
+    :rtype: bool
+    """
+    own_macros = set(name for (name, _) in unit.macros)
+    for container, names in reads.items():
+        conflicts = names & changed_names.get(container, set())
+        if container == "macros":
+            conflicts -= own_macros
+        if conflicts:
+            return False
+    # Headers which are already included are skipped.
+    if set(delta["included_files"]) & state.included_files:
+        return False
+    return True
+
+
+def parse_cpython(state, jobs):
+    """
+    Like state.parse_cpython(), but parses the units after the prelude in parallel.
+
+    :param cpython.CPythonState state: a fresh state, or with the prelude already parsed
+    :param int jobs: number of worker processes
+    """
+    global _job_state
+    units = state.parse_units
+    if state.parsed_units == 0:
+        state.parse_unit(units[0])
+    assert state.parsed_units == 1, "we fork from the state after the prelude"
+    snapshot = parse_incremental.StateSnapshot(state)
+    _job_state = state
+    try:
+        # Every job needs a fresh fork of the prelude state, thus maxtasksperchild=1.
+        # The pool forks new workers while jobs are pending, so we must not touch the state until all are done.
+        pool = multiprocessing.get_context("fork").Pool(processes=jobs, maxtasksperchild=1)
+        try:
+            results = pool.map(_parse_unit_job, range(1, len(units)), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _job_state = None
+    changed_names = {}  # type: dict[str,set[str]]
+    count_serial = 0
+    for index, data, parse_time in results:
+        unit = units[index]
+        with parse_cache._RecursionLimit(parse_cache.PickleRecursionLimit):
+            delta, reads = parse_incremental.UnitUnpickler(io.BytesIO(data), state, snapshot=snapshot).load()
+        state.apply_unit_macros(unit)
+        state.unit_entry_digests[state.get_unit_filename(unit)] = parse_incremental.entry_digest(state)
+        if is_independent(state, delta, reads, changed_names, unit):
+            parse_incremental.apply_delta(state, delta)
+            print("(parsed %s in %.1fs)" % (unit.filename, parse_time), end=" ")
+        else:
+            start_time = time.time()
+            unit_snapshot = parse_incremental.StateSnapshot(state)
+            state.unit_input_files = {}
+            try:
+                state.parse_file(state.get_unit_filename(unit), optional=unit.optional)
+                delta = unit_snapshot.get_delta(state)
+            finally:
+                state.unit_input_files = None
+            count_serial += 1
+            print("(parsed %s again in %.1fs, depends on the units before)" % (
+                unit.filename, time.time() - start_time), end=" ")
+        for container, names in get_changed_names(delta).items():
+            changed_names.setdefault(container, set()).update(names)
+        changed_names.setdefault("macros", set()).update(name for (name, _) in unit.macros)
+        state.parsed_units += 1
+    print("(%i/%i units parsed serially)" % (count_serial, len(units) - 1), end=" ")
@@ -0,0 +1,314 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Pre-fork server: parse and register CPython once, then run every Py_Main
+invocation in a forked worker.
+
+The workers share the parsed state and the translated functions of the
+server copy-on-write. The server itself never runs Py_Main, so every worker
+starts with fresh C globals. The worker writes its result to a file and
+exits, then the server sends the response. With learn=True, the server
+then translates the functions which the worker needed, so that later
+workers get them for free.
+
+The protocol is one JSON line per connection on a Unix socket in each
+direction. The request is {"argv": [...], "stdin": str|None} (or
+{"shutdown": true}); the response is {"exit_code": int, "stdout": str,
+"stderr": str, "error": str|None}.
+
+Start the server via ``cpython.py --prefork-server SOCKET``, submit via
+submit(), or from the shell via ``prefork.py SOCKET [CPython args]``.
+"""
+
+from __future__ import print_function
+
+import argparse
+import ctypes
+import json
+import os
+import select
+import socket
+import sys
+import tempfile
+import traceback
+
+# Reading the request is done by the server itself, so don't let a client block it.
+RequestTimeout = 10.0
+
+
+def _send_json(sock, obj):
+    """
+    :param socket.socket sock:
+    :param dict[str] obj:
+    """
+    sock.sendall(json.dumps(obj).encode("utf8") + b"\n")
+
+
+def _recv_json(sock):
+    """
+    :param socket.socket sock:
+    :rtype: dict[str]|None
+    """
+    with sock.makefile("rb") as f:
+        line = f.readline()
+    if not line:
+        return None
+    return json.loads(line.decode("utf8"))
+
+
+class _Worker:
+
+    def __init__(self, pid, conn, result_fn, ready_fd):
+        """
+        :param int pid:
+        :param socket.socket conn: to the client
+        :param str result_fn: where the worker writes the response and the names of the translated funcs
+        :param int ready_fd: read end of a pipe, which gets EOF when the worker exits
+        """
+        self.pid = pid
+        self.conn = conn
+        self.result_fn = result_fn
+        self.ready_fd = ready_fd
+
+
+class PreforkServer:
+
+    def __init__(self, interpreter, socket_path, base_argv, jobs=1, learn=True):
+        """
+        :param cparser.interpreter.Interpreter interpreter: after register and all installs
+        :param str socket_path: Unix socket where we listen
+        :param list[str] base_argv: argv[0] of the workers
+        :param int jobs: max number of workers running at the same time
+        :param bool learn: translate the functions which the workers needed, in the server
+        """
+        self.interpreter = interpreter
+        self.socket_path = socket_path
+        self.base_argv = base_argv[:1]
+        self.jobs = max(jobs, 1)
+        self.learn = learn
+        self.num_requests = 0
+        self._sock = None  # type: socket.socket|None
+        self._stop = False
+        self._workers = {}  # type: dict[int,_Worker]  # by ready_fd
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.socket_path)
+        self._sock.listen(self.jobs * 4)
+
+    def serve(self, max_requests=None):
+        """
+        Serves until a shutdown request, or until max_requests requests were handled.
+
+        :param int|None max_requests:
+        """
+        self._listen()
+        print("Prefork server listening on %s." % self.socket_path)
+        try:
+            while True:
+                if max_requests is not None and self.num_requests >= max_requests:
+                    self._stop = True
+                wait_for = list(self._workers)
+                if not self._stop and len(self._workers) < self.jobs:
+                    wait_for.append(self._sock.fileno())
+                if not wait_for:
+                    break
+                ready, _, _ = select.select(wait_for, [], [])
+                for fd in ready:
+                    if fd == self._sock.fileno():
+                        self._accept()
+                    else:
+                        self._finish_worker(self._workers.pop(fd))
+        finally:
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def _accept(self):
+        conn, _ = self._sock.accept()
+        try:
+            conn.settimeout(RequestTimeout)
+            request = _recv_json(conn)
+            conn.settimeout(None)
+        except (OSError, ValueError) as exc:
+            print("Prefork server: bad request: %s: %s" % (type(exc).__name__, exc))
+            conn.close()
+            return
+        if request is None:
+            conn.close()
+        elif request.get("shutdown"):
+            self._stop = True
+            _send_json(conn, {"exit_code": 0, "stdout": "", "stderr": "", "error": None})
+            conn.close()
+        else:
+            self.num_requests += 1
+            self._start_worker(conn, request)
+
+    def _start_worker(self, conn, request):
+        fd, result_fn = tempfile.mkstemp(prefix="pycpython-prefork-", suffix=".json")
+        os.close(fd)
+        ready_fd, ready_write_fd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                self._sock.close()
+                os.close(ready_fd)
+                conn.close()
+                self._run_worker(request, result_fn)
+                exit_code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(exit_code)  # no atexit handlers, those belong to the server
+        os.close(ready_write_fd)
+        self._workers[ready_fd] = _Worker(pid=pid, conn=conn, result_fn=result_fn, ready_fd=ready_fd)
+
+    def _finish_worker(self, worker):
+        """
+        Sends the response of the exited worker, and learns from it.
+
+        :param _Worker worker:
+        """
+        os.close(worker.ready_fd)
+        _, status = os.waitpid(worker.pid, 0)
+        try:
+            with open(worker.result_fn) as f:
+                result = json.load(f)
+        except (IOError, OSError, ValueError):
+            result = {"response": {
+                "exit_code": 1, "stdout": "", "stderr": "",
+                "error": "prefork worker died with status %i" % status}, "translated": []}
+        finally:
+            os.unlink(worker.result_fn)
+        try:
+            _send_json(worker.conn, result["response"])
+        except OSError:
+            pass  # client gone
+        worker.conn.close()
+        if self.learn:
+            for name in result["translated"]:
+                if name in self.interpreter._func_cache:
+                    continue
+                try:
+                    self.interpreter.getFunc(name)
+                except Exception:
+                    pass  # e.g. depends on values which only the worker has registered
+
+    def _run_worker(self, request, result_fn):
+        """
+        In the forked worker. Runs Py_Main with the argv of the request and writes the result.
+        """
+        argv = self.base_argv + [str(arg) for arg in request.get("argv", [])]
+        funcs_before = set(self.interpreter._func_cache)
+        response = {"exit_code": 1, "stdout": "", "stderr": "", "error": None}
+        with tempfile.TemporaryFile() as stdin, tempfile.TemporaryFile() as stdout, \
+                tempfile.TemporaryFile() as stderr:
+            stdin.write((request.get("stdin") or "").encode("utf8"))
+            stdin.seek(0)
+            os.dup2(stdin.fileno(), 0)
+            os.dup2(stdout.fileno(), 1)
+            os.dup2(stderr.fileno(), 2)
+            try:
+                res = self.interpreter.runFunc("Py_Main", len(argv), argv + [None])
+                response["exit_code"] = _get_exit_code(res)
+            except SystemExit as exc:
+                response["exit_code"] = _get_exit_code(exc.code)
+            except Exception:
+                response["error"] = traceback.format_exc()
+            _flush_all()
+            for key, f in [("stdout", stdout), ("stderr", stderr)]:
+                f.seek(0)
+                response[key] = f.read().decode("utf8", "replace")
+        with open(result_fn, "w") as f:
+            json.dump({"response": response, "translated": sorted(set(self.interpreter._func_cache) - funcs_before)}, f)
+
+
+def _get_exit_code(res):
+    """
+    :param int|ctypes._SimpleCData|str|None res: return value of Py_Main, or SystemExit.code
+    :rtype: int
+    """
+    if res is None:
+        return 0
+    if isinstance(res, ctypes._SimpleCData):
+        res = res.value
+    if isinstance(res, int):
+        return res
+    print(res, file=sys.stderr)
+    return 1
+
+
+def _flush_all():
+    """
+    Flushes our and the C stdio buffers, so that the output is in the files.
+    """
+    import native_bindings
+    sys.stdout.flush()
+    sys.stderr.flush()
+    fflush = native_bindings.bind_symbol("fflush", ctypes.c_int, (ctypes.c_void_p,))
+    if fflush is not None:
+        fflush(None)
+
+
+def submit(socket_path, argv, stdin=None, timeout=None):
+    """
+    :param str socket_path: of a running PreforkServer
+    :param list[str] argv: CPython args, without argv[0]
+    :param str|None stdin:
+    :param float|None timeout: seconds
+    :return: response, see the module docstring
+    :rtype: dict[str]
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        _send_json(sock, {"argv": list(argv), "stdin": stdin})
+        response = _recv_json(sock)
+    finally:
+        sock.close()
+    if response is None:
+        raise IOError("prefork server %s closed the connection without a response" % socket_path)
+    return response
+
+
+def shutdown(socket_path):
+    """
+    :param str socket_path: of a running PreforkServer. it stops after the running workers are done
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        _send_json(sock, {"shutdown": True})
+        _recv_json(sock)
+    finally:
+        sock.close()
+
+
+def main(argv):
+    argparser = argparse.ArgumentParser(
+        description="Run CPython args in a PyCPython prefork server (cpython.py --prefork-server).")
+    argparser.add_argument('socket', help="Unix socket of the server.")
+    argparser.add_argument('--shutdown', action='store_true', help="Stop the server.")
+    args_ns, argv_rest = argparser.parse_known_args(argv[1:])
+    if args_ns.shutdown:
+        shutdown(args_ns.socket)
+        return 0
+    stdin = None if sys.stdin.isatty() else sys.stdin.read()
+    response = submit(args_ns.socket, argv_rest, stdin=stdin)
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    if response["error"]:
+        sys.stderr.write(response["error"])
+    return response["exit_code"]
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,150 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Precompiled header prelude.
+
+The first parse unit is Python.h, which every CPython C file includes first.
+We parse it once per process (or load it from the on-disk cache, see parse_cache)
+and use it as the starting point for every parse, test fixture and compile_to_py run.
+
+Per state type, we keep a template in memory: the attributes of a fresh
+state, i.e. right after autoSetupSystemMacros and autoSetupGlobalIncludeWrappers,
+and the parsed prelude, pickled in the format of parse_cache.
+
+new_state() does not run the state constructor. It creates the state via
+__new__, copies the containers of the fresh state and makes shallow copies of
+the base objects in them (e.g. the CWrapValues of the libc functions), and then
+unpickles the prelude into it. So every state has its own declarations and its
+own base objects, and modifying them (native_bindings, compile_to_py, the
+interpreter) does not affect other states.
+"""
+
+import copy
+import io
+
+import parse_cache
+
+
+class _Template:
+    """
+    Everything we need to create a new state with the prelude parsed.
+    """
+
+    def __init__(self, state_type, use_cache=True):
+        """
+        :param type state_type: e.g. CPythonState
+        :param bool use_cache: whether to use the on-disk cache
+        """
+        state = state_type()
+        # The containers get filled by the parsing, so we keep copies of them.
+        self.fresh_attribs = {key: _copy_container(value) for (key, value) in vars(state).items()}
+        table = parse_cache.get_base_object_table(state)
+        if not (use_cache and parse_cache.load_state(state, num_units=1)):
+            state.parse_unit(state.parse_units[0])
+            if use_cache:
+                parse_cache.save_state(state, table)
+        f = io.BytesIO()
+        with parse_cache._RecursionLimit(parse_cache.PickleRecursionLimit):
+            parse_cache.StatePickler(f, table).dump({key: getattr(state, key) for key in parse_cache.StateAttribs})
+        # The pickled state attributes after the prelude, see parse_cache.StatePickler.
+        self.data = f.getvalue()
+
+
+# state type -> template
+_templates = {}  # type: dict[type,_Template]
+
+
+def _copy_container(value):
+    """
+    :param object value: attribute of a state
+    :return: a copy of it if it is a container, otherwise the value itself
+    :rtype: object
+    """
+    if type(value) in (dict, list, set):
+        return type(value)(value)
+    return value
+
+
+def _copy_base_object(obj):
+    """
+    :param object obj: e.g. a CWrapValue
+    :return: shallow copy, or the object itself if it cannot be copied (e.g. some ctypes object)
+    :rtype: object
+    """
+    try:
+        return copy.copy(obj)
+    except (TypeError, ValueError):
+        return obj
+
+
+def get_template(state_type, use_cache=True):
+    """
+    :param type state_type: e.g. CPythonState
+    :param bool use_cache: whether to use the on-disk cache
+    :rtype: _Template
+    """
+    if state_type not in _templates:
+        _templates[state_type] = _Template(state_type, use_cache=use_cache)
+    return _templates[state_type]
+
+
+def get_prelude_data(state_type, use_cache=True):
+    """
+    :param type state_type: e.g. CPythonState
+    :param bool use_cache: whether to use the on-disk cache
+    :return: the prelude state, pickled with parse_cache.StatePickler
+    :rtype: bytes
+    """
+    return get_template(state_type, use_cache=use_cache).data
+
+
+def new_state(state_type, use_cache=True):
+    """
+    :param type state_type: e.g. CPythonState
+    :param bool use_cache: whether to use the on-disk cache
+    :return: new state with the prelude parsed. the state constructor is not called
+    :rtype: cparser.State
+    """
+    template = get_template(state_type, use_cache=use_cache)
+    state = state_type.__new__(state_type)
+    for key, value in template.fresh_attribs.items():
+        setattr(state, key, _copy_container(value))
+    copies = {}  # type: dict[int,object]  # id(base object) -> its copy
+    for container in parse_cache.StateContainers:
+        objs = getattr(state, container)
+        for name, obj in objs.items():
+            if id(obj) not in copies:
+                copies[id(obj)] = _copy_base_object(obj)
+            objs[name] = copies[id(obj)]
+    # References between the base objects should point to the copies as well.
+    for orig_id, obj in copies.items():
+        if id(obj) == orig_id:
+            continue  # not copied
+        attribs = getattr(obj, "__dict__", None)
+        if attribs:
+            for key, value in list(attribs.items()):
+                if id(value) in copies:
+                    attribs[key] = copies[id(value)]
+    with parse_cache._RecursionLimit(parse_cache.PickleRecursionLimit):
+        attribs = parse_cache.StateUnpickler(io.BytesIO(template.data), state).load()
+    for key, value in attribs.items():
+        setattr(state, key, value)
+    return state
+
+
+def load_into(state, use_cache=True):
+    """
+    :param cparser.State state: a fresh state. afterwards, the prelude is parsed
+    :param bool use_cache: whether to use the on-disk cache
+    :return: the object table of the base objects of the state, see parse_cache.get_base_object_table
+    :rtype: dict[int,(tuple,object)]
+    """
+    assert state.parsed_units == 0
+    data = get_prelude_data(type(state), use_cache=use_cache)
+    table = parse_cache.get_base_object_table(state)
+    with parse_cache._RecursionLimit(parse_cache.PickleRecursionLimit):
+        attribs = parse_cache.StateUnpickler(io.BytesIO(data), state).load()
+    for key, value in attribs.items():
+        setattr(state, key, value)
+    return table
@@ -0,0 +1,168 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Function-level profiler for the interpreted C code.
+
+We wrap every Python function which the interpreter returns from getFunc()
+(the translated C functions and the stubs in _func_cache). The translated
+code gets its callees via getFunc() as well, and function pointers, e.g. type
+slots, are created from those same functions, so calls through function
+pointers are counted too.
+
+Per C function, we count the calls and the inclusive and exclusive time, and
+per caller the same. The result can be written in the pstats format, i.e.
+it can be loaded with pstats.Stats() or tools like snakeviz, where the file
+and line refer to the C source.
+"""
+
+from __future__ import print_function
+
+import functools
+import marshal
+import time
+
+
+def get_func_key(name, decl=None):
+    """
+    :param str name: C function name
+    :param object|None decl: the parsed declaration, e.g. cparser.CFunc, for its defPos
+    :return: pstats key: (filename, line, name)
+    :rtype: (str,int,str)
+    """
+    def_pos = str(getattr(decl, "defPos", None) or "")
+    parts = def_pos.split(":")
+    if len(parts) >= 2 and parts[1].isdigit():
+        return parts[0], int(parts[1]), name
+    return def_pos or "~", 0, name
+
+
+class _FuncStats:
+
+    def __init__(self):
+        self.primitive_calls = 0  # not counting recursive calls
+        self.calls = 0
+        self.exclusive_time = 0.0
+        self.inclusive_time = 0.0
+        self.callers = {}  # type: dict[tuple,list[int|float]]  # key -> [primitive calls, calls, excl, incl]
+
+
+class Profiler:
+
+    def __init__(self, timer=time.perf_counter):
+        """
+        :param ()->float timer:
+        """
+        self.timer = timer
+        self.stats = {}  # type: dict[tuple,_FuncStats]
+        self._stack = []  # type: list[list]  # [key, start time, time in callees]
+        self._active = {}  # type: dict[tuple,int]  # key -> number of frames on the stack
+        self._wrappers = {}  # type: dict[str,(object,object)]  # name -> (orig func, wrapper)
+
+    def _enter(self, key):
+        self._active[key] = self._active.get(key, 0) + 1
+        self._stack.append([key, self.timer(), 0.0])
+
+    def _leave(self):
+        key, start_time, callee_time = self._stack.pop()
+        inclusive_time = self.timer() - start_time
+        exclusive_time = inclusive_time - callee_time
+        self._active[key] -= 1
+        primitive = self._active[key] == 0
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = _FuncStats()
+        stats.calls += 1
+        stats.exclusive_time += exclusive_time
+        if primitive:
+            # Like cProfile: the inclusive time only counts for the outermost call.
+            stats.primitive_calls += 1
+            stats.inclusive_time += inclusive_time
+        if self._stack:
+            caller = self._stack[-1]
+            caller[2] += inclusive_time
+            caller_stats = stats.callers.setdefault(caller[0], [0, 0, 0.0, 0.0])
+            caller_stats[0] += int(primitive)
+            caller_stats[1] += 1
+            caller_stats[2] += exclusive_time
+            caller_stats[3] += inclusive_time if primitive else 0.0
+
+    def wrap(self, name, func, decl=None):
+        """
+        :param str name: C function name
+        :param function func: the Python function which implements it
+        :param object|None decl: parsed declaration, see get_func_key()
+        :return: wrapped func. the same wrapper for the same func
+        :rtype: function
+        """
+        entry = self._wrappers.get(name)
+        if entry is not None and (entry[0] is func or entry[1] is func):
+            return entry[1]
+        key = get_func_key(name, decl)
+
+        @functools.wraps(func)  # also copies C_argTypes, C_resType etc.
+        def wrapper(*args, **kwargs):
+            self._enter(key)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._leave()
+
+        self._wrappers[name] = (func, wrapper)
+        return wrapper
+
+    def install(self, interpreter, state=None):
+        """
+        Call this after everything else which hooks into getFunc() or _func_cache.
+
+        :param cparser.interpreter.Interpreter interpreter:
+        :param cparser.State|None state: for the source positions
+        """
+        funcs = state.funcs if state is not None else {}
+        for name, func in list(interpreter._func_cache.items()):
+            if callable(func):
+                interpreter._func_cache[name] = self.wrap(name, func, funcs.get(name))
+        orig_get_func = interpreter.getFunc
+
+        def getFunc(funcname):
+            func = orig_get_func(funcname)
+            if not callable(func):
+                return func
+            wrapper = self.wrap(funcname, func, funcs.get(funcname))
+            if interpreter._func_cache.get(funcname) is func:
+                interpreter._func_cache[funcname] = wrapper
+            return wrapper
+
+        interpreter.getFunc = getFunc
+
+    def get_pstats_dict(self):
+        """
+        :return: in the format of cProfile.Profile.stats, which pstats.Stats() loads
+        :rtype: dict[tuple,tuple]
+        """
+        return {
+            key: (s.primitive_calls, s.calls, s.exclusive_time, s.inclusive_time,
+                  {caller: tuple(c) for (caller, c) in s.callers.items()})
+            for (key, s) in self.stats.items()}
+
+    def write_pstats(self, filename):
+        """
+        :param str filename:
+        """
+        with open(filename, "wb") as f:
+            marshal.dump(self.get_pstats_dict(), f)
+
+    def print_summary(self, top=30, file=None):
+        """
+        :param int top: number of functions, sorted by exclusive time
+        :param file|None file: by default stdout
+        """
+        items = sorted(self.stats.items(), key=lambda item: item[1].exclusive_time, reverse=True)
+        total_time = sum(s.exclusive_time for s in self.stats.values())
+        print("Profile: %i C functions, %i calls, %.3fs in total. Top %i by exclusive time:" % (
+            len(self.stats), sum(s.calls for s in self.stats.values()), total_time, top), file=file)
+        print("%10s %10s %7s %10s  %s" % ("calls", "excl[s]", "excl%", "incl[s]", "function"), file=file)
+        for (filename, line, name), s in items[:top]:
+            print("%10i %10.3f %6.1f%% %10.3f  %s (%s:%i)" % (
+                s.calls, s.exclusive_time, 100.0 * s.exclusive_time / (total_time or 1.0), s.inclusive_time,
+                name, filename, line), file=file)
@@ -0,0 +1,138 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Timing and memory instrumentation of the startup phases.
+
+Code marks its phases with::
+
+    with phase_stats.phase("parse"):
+        ...
+
+Phases can be nested. For every phase, we record the wall time and the
+memory allocated in it (via tracemalloc: the net change and the peak). For
+top-level phases, we also record the change in the number of objects
+tracked by the GC. Counting them walks the whole heap, so we don't do that
+for nested phases like the per-file parsing, and always outside of the
+timed part. When not enabled, phase() does nothing.
+
+cpython.py enables this via --stats (table at exit) and --stats-json FILE.
+"""
+
+from __future__ import print_function
+
+import contextlib
+import gc
+import json
+import time
+import tracemalloc
+
+
+class PhaseRecord:
+
+    def __init__(self, name, depth):
+        """
+        :param str name:
+        :param int depth: nesting level, 0 for top-level phases
+        """
+        self.name = name
+        self.depth = depth
+        self.duration = None  # type: float|None  # seconds
+        self.mem_allocated = None  # type: int|None  # bytes, net
+        self.mem_peak = None  # type: int|None  # bytes, above the start of the phase
+        self.objects = None  # type: int|None  # change in the number of GC tracked objects. only top-level
+        self.exception = None  # type: str|None
+        self.abs_peak = 0  # traced memory peak while active, absolute
+
+    def as_json(self):
+        return {
+            "name": self.name, "depth": self.depth, "duration": self.duration,
+            "mem_allocated": self.mem_allocated, "mem_peak": self.mem_peak,
+            "objects": self.objects, "exception": self.exception}
+
+
+class PhaseStats:
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.records = []  # type: list[PhaseRecord]
+        self._stack = []  # type: list[PhaseRecord]  # active phases
+
+    def enable(self, trace_memory=True):
+        """
+        :param bool trace_memory: via tracemalloc. this slows down everything
+        """
+        self.enabled = True
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _update_peaks(self):
+        # The tracemalloc peak is global. We reset it for every new phase,
+        # so we must take it over into all phases which are active.
+        _, peak = tracemalloc.get_traced_memory()
+        for record in self._stack:
+            record.abs_peak = max(record.abs_peak, peak)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        :param str name:
+        """
+        if not self.enabled:
+            yield
+            return
+        record = PhaseRecord(name, len(self._stack))
+        self.records.append(record)
+        if self.trace_memory:
+            self._update_peaks()
+            tracemalloc.reset_peak()
+            mem_start, record.abs_peak = tracemalloc.get_traced_memory()
+        objects_start = len(gc.get_objects()) if record.depth == 0 else None
+        self._stack.append(record)
+        start_time = time.perf_counter()
+        try:
+            yield
+        except BaseException as exc:
+            record.exception = type(exc).__name__
+            raise
+        finally:
+            record.duration = time.perf_counter() - start_time
+            if objects_start is not None:
+                record.objects = len(gc.get_objects()) - objects_start
+            if self.trace_memory:
+                self._update_peaks()
+                record.mem_allocated = tracemalloc.get_traced_memory()[0] - mem_start
+                record.mem_peak = record.abs_peak - mem_start
+            self._stack.pop()
+
+    def print_table(self, file=None):
+        """
+        :param file|None file: by default stdout
+        """
+        def mb(value):
+            return "-" if value is None else "%.1f" % (value / 1024.0 / 1024.0)
+
+        def count(value):
+            return "-" if value is None else "%i" % value
+
+        print("%-50s %10s %10s %10s %10s" % ("phase", "time[s]", "alloc[MB]", "peak[MB]", "objects"), file=file)
+        for record in self.records:
+            name = "  " * record.depth + record.name
+            if record.exception:
+                name += " (%s)" % record.exception
+            print("%-50s %10.3f %10s %10s %10s" % (
+                name[:50], record.duration or 0.0, mb(record.mem_allocated), mb(record.mem_peak),
+                count(record.objects)), file=file)
+
+    def write_json(self, filename):
+        """
+        :param str filename:
+        """
+        with open(filename, "w") as f:
+            json.dump({"phases": [record.as_json() for record in self.records]}, f, indent=1)
+            f.write("\n")
+
+
+phase_stats = PhaseStats()
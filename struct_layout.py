@@ -0,0 +1,422 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Precomputed struct field layouts and direct memory access to scalar fields.
+
+Through ctypes, ob->ob_refcnt goes through pointer.contents, which creates
+a temporary Structure object, and then through the field descriptor,
+which creates the field object. For scalar fields we can do better: we
+precompute the offset and a struct.Struct for every field, and read and
+write the field via unpack_from/pack_into on a memoryview which spans the
+process address space (get_process_memory()). That is one C call, and no
+temporary ctypes objects.
+
+get_layout(ctype) gives the layout of a ctypes Structure or Union, and
+make_field_getter()/make_field_setter() the accessors for Python code which
+knows the struct type and has the address, e.g. the lookdict_unicode override
+(ob_type, ma_keys, the dict key entries). There, the getter is about 1.5x as
+fast as ctypes from_address() (known_type in benchmarks/bench_struct_access.py).
+
+The translated code does not get typed direct reads, and Interpreter.getCType
+is not changed:
+
+* the translated expressions are ctypes objects. A direct read would have to
+  create one again, e.g. the pointer for ob_type->tp_flags, which costs more
+  than it saves,
+* x.contents.f.value runs completely in C (type_flags in the benchmark),
+* a NULL pointer must raise like in ctypes, not read from address 0.
+
+What we do for the translated code: install(interpreter) adds a pass after
+the translation (StructAccessPass), which rewrites the increments and
+decrements of fields, e.g. in Py_INCREF/Py_DECREF, to helpers which find the
+layout by the type of the pointer at runtime. It is only installed with
+cpython.py --struct-access, because only the micro-benchmark showed a win so
+far, not the interpreted code.
+"""
+
+from __future__ import print_function
+
+import ast
+import ctypes
+import struct
+import sys
+
+from unboxing import wrap_int
+
+# ctypes type codes (ctype._type_) which the struct module understands with the same native size.
+ScalarTypeCodes = "bBhHiIlLqQfd?P"
+
+SignedIntTypeCodes = "bhilq"
+UnsignedIntTypeCodes = "BHILQP"
+
+# The memoryview must not go beyond what a ctypes array can have.
+ProcessMemorySize = min(1 << 47, sys.maxsize) - 1
+
+_process_memory = None  # type: memoryview|None
+
+
+def get_process_memory():
+    """
+    :return: bytes view of the whole (user-space) address space of this process.
+      Accessing unmapped addresses crashes, like in C
+    :rtype: memoryview
+    """
+    global _process_memory
+    if _process_memory is None:
+        _process_memory = memoryview((ctypes.c_char * ProcessMemorySize).from_address(0)).cast("B")
+    return _process_memory
+
+
+def _get_type_code(ctype):
+    """
+    :param type ctype: field type
+    :return: struct format code for scalar and pointer fields, otherwise None
+    :rtype: str|None
+    """
+    if issubclass(ctype, ctypes._Pointer):
+        return "P"
+    if issubclass(ctype, ctypes._SimpleCData):
+        code = ctype._type_
+        if isinstance(code, str) and code in ScalarTypeCodes:
+            return code
+    return None
+
+
+class FieldLayout:
+
+    def __init__(self, name, offset, size, ctype):
+        """
+        :param str name:
+        :param int offset: in bytes, from the start of the struct
+        :param int size: in bytes
+        :param type ctype: field type
+        """
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.ctype = ctype
+        code = _get_type_code(ctype)
+        self.struct = struct.Struct("@" + code) if code else None  # type: struct.Struct|None
+
+    @property
+    def is_scalar(self):
+        """
+        :return: whether we can access it directly. pointers count as scalar, their value is the address
+        :rtype: bool
+        """
+        return self.struct is not None
+
+    def read(self, addr):
+        """
+        :param int addr: address of the struct
+        :rtype: int|float|bool
+        """
+        return self.struct.unpack_from(get_process_memory(), addr + self.offset)[0]
+
+    def wrap(self, value):
+        """
+        :param int|float|bool value:
+        :return: value like the C assignment to the field converts it, e.g. with wrap-around
+        :rtype: int|float|bool
+        """
+        code = self.struct.format[-1]
+        if code in SignedIntTypeCodes or code in UnsignedIntTypeCodes:
+            return wrap_int(value, self.struct.size * 8, code in SignedIntTypeCodes)
+        if code == "?":
+            return bool(value)
+        return value
+
+    def write(self, addr, value):
+        """
+        :param int addr: address of the struct
+        :param int|float|bool value:
+        """
+        self.struct.pack_into(get_process_memory(), addr + self.offset, self.wrap(value))
+
+    def __repr__(self):
+        return "<FieldLayout %s offset=%i size=%i %s>" % (self.name, self.offset, self.size, self.ctype.__name__)
+
+
+class StructLayout:
+
+    def __init__(self, ctype):
+        """
+        :param type ctype: subclass of ctypes.Structure or ctypes.Union, with _fields_
+        """
+        self.ctype = ctype
+        self.size = ctypes.sizeof(ctype)
+        self.fields = {}  # type: dict[str,FieldLayout]
+        for field in getattr(ctype, "_fields_", ()):
+            if len(field) != 2:
+                continue  # bit field
+            name, field_ctype = field
+            descr = getattr(ctype, name)
+            self.fields[name] = FieldLayout(name, offset=descr.offset, size=descr.size, ctype=field_ctype)
+
+    def __repr__(self):
+        return "<StructLayout %s size=%i fields=%i>" % (self.ctype.__name__, self.size, len(self.fields))
+
+
+_layouts = {}  # type: dict[type,StructLayout]
+
+
+def get_layout(ctype):
+    """
+    :param type ctype: subclass of ctypes.Structure or ctypes.Union. its fields must be complete
+    :rtype: StructLayout
+    """
+    layout = _layouts.get(ctype)
+    if layout is None:
+        layout = _layouts[ctype] = StructLayout(ctype)
+    return layout
+
+
+def make_field_getter(ctype, name):
+    """
+    :param type ctype: struct type
+    :param str name: scalar field
+    :return: function address of the struct -> field value
+    :rtype: (int)->int|float|bool
+    """
+    field = get_layout(ctype).fields[name]
+    assert field.is_scalar, "%r is not a scalar field" % field
+    unpack_from, memory, offset = field.struct.unpack_from, get_process_memory(), field.offset
+
+    def getter(addr):
+        return unpack_from(memory, addr + offset)[0]
+
+    getter.__name__ = "get_%s_%s" % (ctype.__name__, name)
+    return getter
+
+
+def make_field_setter(ctype, name):
+    """
+    :param type ctype: struct type
+    :param str name: scalar field
+    :return: function (address of the struct, value) -> None
+    :rtype: (int,int|float|bool)->None
+    """
+    field = get_layout(ctype).fields[name]
+    assert field.is_scalar, "%r is not a scalar field" % field
+    pack_into, memory, offset, wrap = field.struct.pack_into, get_process_memory(), field.offset, field.wrap
+
+    def setter(addr, value):
+        pack_into(memory, addr + offset, wrap(value))
+
+    setter.__name__ = "set_%s_%s" % (ctype.__name__, name)
+    return setter
+
+
+_unpack_pointer = struct.Struct("@P").unpack_from
+
+
+def get_pointer_address(p):
+    """
+    Reads the pointer value from the buffer of the pointer object.
+    Faster than ctypes.cast(p, ctypes.c_void_p).value and ctypes.c_void_p.from_buffer(p).value.
+
+    :param ctypes._Pointer p:
+    :rtype: int
+    """
+    return _unpack_pointer(p)[0]
+
+
+# Fields which we increment directly: integers and double. The rounding of float and bool is left to ctypes.
+IncTypeCodes = SignedIntTypeCodes + "BHILQd"
+
+# helpers.<name>(x) -> (value which is added to x, whether it returns the old value).
+IncHelpers = {"postInc": (1, True), "prefixInc": (1, False), "postDec": (-1, True), "prefixDec": (-1, False)}
+
+
+def _get_inc_helper_name(delta, post):
+    for name, (helper_delta, helper_post) in IncHelpers.items():
+        if (helper_delta, helper_post) == (delta, post):
+            return name
+    raise ValueError("no inc helper for delta %r" % delta)
+
+
+class StructFieldAccess:
+    """
+    Runtime part of StructAccessPass: x->f++ etc. through the layout of the struct.
+    Every access checks the type of the pointer, and falls back to the ctypes
+    semantics of x.contents.f with the original helper for anything else.
+    """
+
+    def __init__(self, helpers):
+        """
+        :param cparser.interpreter.Helpers helpers: for the fallback
+        """
+        self.helpers = helpers
+        self.memory = get_process_memory()
+        # field name -> pointer type -> (unpack_from, pack_into, offset, wrap), or None for the fallback
+        self._fields = {}  # type: dict[str,dict[type,tuple|None]]
+
+    def _get_field(self, ptr_type, name):
+        """
+        :param type ptr_type:
+        :param str name:
+        :rtype: tuple|None
+        """
+        struct_type = getattr(ptr_type, "_type_", None) if issubclass(ptr_type, ctypes._Pointer) else None
+        res = None
+        if isinstance(struct_type, type) and issubclass(struct_type, (ctypes.Structure, ctypes.Union)):
+            if not hasattr(struct_type, "_fields_"):
+                return None  # incomplete yet
+            field = get_layout(struct_type).fields.get(name)
+            # Fields of the fundamental types give plain Python values via ctypes, and the helpers don't accept them.
+            if (field and field.is_scalar and ctypes._SimpleCData not in field.ctype.__bases__
+                    and field.struct.format[-1] in IncTypeCodes):
+                res = (field.struct.unpack_from, field.struct.pack_into, field.offset, field.wrap)
+        self._fields.setdefault(name, {})[ptr_type] = res
+        return res
+
+    def inc(self, p, name, delta, post=None):
+        """
+        Like helpers.postInc(p.contents.<name>) etc.
+
+        :param ctypes._Pointer p: to the struct
+        :param str name: field
+        :param int delta: 1 or -1
+        :param bool|None post: for the value of the expression: True for the old value, like x->f++,
+          False for the new one, like ++x->f. None for a statement
+        :return: the value, or None for a statement
+        :rtype: int|float|None
+        """
+        try:
+            field = self._fields[name][type(p)]
+        except KeyError:  # not seen yet
+            field = self._get_field(type(p), name)
+        if field is None:
+            res = getattr(self.helpers, _get_inc_helper_name(delta, bool(post)))(getattr(p.contents, name))
+            return None if post is None else res.value
+        unpack_from, pack_into, offset, wrap = field
+        addr = _unpack_pointer(p)[0]
+        if not addr:
+            raise ValueError("NULL pointer access")  # like ctypes
+        addr += offset
+        memory = self.memory
+        old = unpack_from(memory, addr)[0]
+        new = old + delta
+        try:
+            pack_into(memory, addr, new)
+        except struct.error:  # out of range
+            new = wrap(new)
+            pack_into(memory, addr, new)
+        if post is None:
+            return None
+        return old if post else new
+
+
+def _helpers_call(name, args):
+    return ast.Call(
+        func=ast.Attribute(value=ast.Name(id="helpers", ctx=ast.Load()), attr=name, ctx=ast.Load()),
+        args=args, keywords=[])
+
+
+def match_field_ref(node):
+    """
+    :param ast.expr node:
+    :return: for x.contents.f, the pointer expr x and f, otherwise None
+    :rtype: (ast.expr,str)|None
+    """
+    if (isinstance(node, ast.Attribute) and isinstance(node.ctx, ast.Load)
+            and isinstance(node.value, ast.Attribute) and node.value.attr == "contents"):
+        return node.value.value, node.attr
+    return None
+
+
+def _match_inc(node):
+    """
+    :param ast.expr node:
+    :return: for helpers.postInc(x.contents.f) etc., x, f and IncHelpers[...], otherwise None
+    :rtype: (ast.expr,str,(int,bool))|None
+    """
+    if not (isinstance(node, ast.Call) and len(node.args) == 1 and not node.keywords):
+        return None
+    func = node.func
+    if not (isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == "helpers"
+            and func.attr in IncHelpers):
+        return None
+    ref = match_field_ref(node.args[0])
+    if ref is None:
+        return None
+    return ref[0], ref[1], IncHelpers[func.attr]
+
+
+class StructAccessPass(ast.NodeTransformer):
+    """
+    After the translation of a function, rewrites the increments and decrements of struct fields
+    (op->ob_refcnt++ in Py_INCREF, --op->ob_refcnt in Py_DECREF)::
+
+        helpers.postInc(op.contents.ob_refcnt)  ->  helpers.struct_field_inc(op, "ob_refcnt", 1)
+        helpers.prefixDec(op.contents.ob_refcnt).value  ->  helpers.struct_field_inc(op, "ob_refcnt", -1, False)
+
+    Through ctypes, they create the temporary Structure object, the field object and
+    the copy of the helper; through the layout it is one read and one write of the memory.
+    Plain reads and assignments stay as they are: x.contents.f.value is all in C,
+    and was faster than any Python function via the layout (see benchmarks/bench_struct_access.py).
+    """
+
+    def __init__(self):
+        self.num_rewritten = 0
+        self.num_rewritten_by_func = {}  # type: dict[str,int]  # translated function name -> rewritten accesses
+
+    def visit_Expr(self, node):
+        match = _match_inc(node.value)
+        if match is None:
+            return self.generic_visit(node)
+        ptr, name, (delta, _) = match
+        self.num_rewritten += 1
+        call = _helpers_call("struct_field_inc", [self.visit(ptr), ast.Constant(name), ast.Constant(delta)])
+        return ast.copy_location(ast.Expr(value=ast.copy_location(call, node.value)), node)
+
+    def visit_Attribute(self, node):
+        match = _match_inc(node.value) if node.attr == "value" and isinstance(node.ctx, ast.Load) else None
+        if match is None:
+            return self.generic_visit(node)
+        ptr, name, (delta, post) = match
+        self.num_rewritten += 1
+        call = _helpers_call(
+            "struct_field_inc", [self.visit(ptr), ast.Constant(name), ast.Constant(delta), ast.Constant(post)])
+        return ast.copy_location(call, node)
+
+    def transform_func(self, func_ast):
+        """
+        :param ast.FunctionDef func_ast: translated function, transformed in-place
+        :return: number of rewritten accesses
+        :rtype: int
+        """
+        num_rewritten = self.num_rewritten
+        self.visit(func_ast)
+        ast.fix_missing_locations(func_ast)
+        if self.num_rewritten > num_rewritten:
+            self.num_rewritten_by_func[func_ast.name] = self.num_rewritten - num_rewritten
+        return self.num_rewritten - num_rewritten
+
+    def install(self, interpreter):
+        """
+        :param cparser.interpreter.Interpreter interpreter:
+        """
+        interpreter.helpers.struct_field_inc = StructFieldAccess(interpreter.helpers).inc
+        orig_translate = interpreter._translateFuncToPyAst
+
+        def _translateFuncToPyAst(func, *args, **kwargs):
+            funcEnv = orig_translate(func, *args, **kwargs)
+            self.transform_func(funcEnv.astNode)
+            return funcEnv
+
+        interpreter._translateFuncToPyAst = _translateFuncToPyAst
+
+
+def install(interpreter):
+    """
+    Call this after interpreter.register(state), and before the translate cache.
+
+    :param cparser.interpreter.Interpreter interpreter:
+    :return: the pass, for its statistics
+    :rtype: StructAccessPass
+    """
+    access_pass = StructAccessPass()
+    access_pass.install(interpreter)
+    return access_pass
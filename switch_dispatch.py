@@ -0,0 +1,444 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Table dispatch for the translated C switch statements, e.g. switch (opcode) in ceval.c.
+
+cparser translates a switch to a sequence of if blocks with a fallthrough
+flag F and the switch value V::
+
+    if F or V == K0:
+        F = True
+        body0
+    if F or V == K1 or V == K2:
+        F = True
+        body1
+    ...
+
+Every dispatch evaluates the tests of all blocks before the matching one,
+so it costs O(number of cases). When V is a pure expression (names,
+attributes, constant subscripts) and all K are integer constants (see
+constfold), we lower such a run of blocks after the translation of the
+function to::
+
+    key = V
+    if F:
+        idx = 0
+    else:
+        idx = <lookup of key in the dispatch table, number of blocks as default>
+    if idx < <number of blocks>:
+        <binary search over idx, where the first half of the blocks runs
+         only if idx is in it, and the second half follows, like the fallthrough>
+
+Hand-written if/elif chains of "S == K" tests are lowered the same way,
+with the table lookup and a binary search over the branch index which
+runs exactly one of the bodies.
+
+The dispatch table is a tuple constant of the function, with the branch
+index for every value in range(max case value + 1), so it survives the
+marshalling of the translate cache. Keys which are no ints (e.g. a
+float), and sparse case values, go through the tuple of the case values
+instead, whose index() compares with == like the tests did. So
+the bytes of a char, or a ctypes object, still match no case.
+
+The bodies stay in the same place of the function, so break, continue
+and return behave as before. Python has no computed jump, so the branch
+index still needs O(log(number of branches)) comparisons of ints, but
+the switch value is looked up only once.
+
+The flag must only be set to True in the blocks, and every block must
+set it at its top level, otherwise the run stays as it is. The blocks
+after a run, e.g. cparser's default block, still read the same flag.
+
+We only take case values in [0, 2**31), where the C integer conversions
+of the comparison don't matter.
+"""
+
+from __future__ import print_function
+
+import ast
+
+import constfold
+
+# Shorter chains are not worth it.
+MinCases = 8
+
+MaxCaseValue = 2 ** 31
+
+# The dense dispatch table has at most this many entries per case value.
+MaxTableSizeFactor = 4
+
+_PureNodeTypes = (ast.Name, ast.Attribute, ast.Subscript, ast.Constant, ast.expr_context)
+
+
+def is_pure_expr(node):
+    """
+    :param ast.AST node:
+    :return: whether evaluating it has no side effects, so we can evaluate it once instead of per test
+    :rtype: bool
+    """
+    for sub in ast.walk(node):
+        if not isinstance(sub, _PureNodeTypes):
+            return False
+        if isinstance(sub, ast.Subscript) and not isinstance(sub.slice, ast.Constant):
+            return False
+    return True
+
+
+def _match_eq(test):
+    """
+    :param ast.expr test:
+    :return: (subject, constant expr), or None
+    :rtype: (ast.expr,ast.expr)|None
+    """
+    if not isinstance(test, ast.Compare) or len(test.ops) != 1 or not isinstance(test.ops[0], ast.Eq):
+        return None
+    left, right = test.left, test.comparators[0]
+    for subject, const in [(left, right), (right, left)]:
+        if constfold.is_const_expr(const) and not constfold.is_const_expr(subject) and is_pure_expr(subject):
+            return subject, const
+    return None
+
+
+def match_case_test(test):
+    """
+    :param ast.expr test: e.g. "S == K" or "S == K1 or S == K2"
+    :return: (dump of the subject, subject, constant exprs), or None
+    :rtype: (str,ast.expr,list[ast.expr])|None
+    """
+    tests = test.values if isinstance(test, ast.BoolOp) and isinstance(test.op, ast.Or) else [test]
+    subject_dump, subject, consts = None, None, []
+    for sub_test in tests:
+        match = _match_eq(sub_test)
+        if match is None:
+            return None
+        if subject_dump is None:
+            subject, subject_dump = match[0], ast.dump(match[0])
+        elif ast.dump(match[0]) != subject_dump:
+            return None
+        consts.append(match[1])
+    return subject_dump, subject, consts
+
+
+def get_chain(if_node):
+    """
+    :param ast.If if_node:
+    :return: [(test, body)], else body
+    :rtype: (list[(ast.expr,list[ast.stmt])],list[ast.stmt])
+    """
+    branches = []
+    node = if_node
+    while True:
+        branches.append((node.test, node.body))
+        if len(node.orelse) == 1 and isinstance(node.orelse[0], ast.If):
+            node = node.orelse[0]
+            continue
+        return branches, node.orelse
+
+
+def _name(name, store=False):
+    return ast.Name(id=name, ctx=ast.Store() if store else ast.Load())
+
+
+def _assign(name, value):
+    return ast.Assign(targets=[_name(name, store=True)], value=value)
+
+
+def _if(test, body, orelse=()):
+    return ast.If(test=test, body=list(body) or [ast.Pass()], orelse=list(orelse))
+
+
+def _compare(name, op, value):
+    return ast.Compare(left=_name(name), ops=[op], comparators=[ast.Constant(value=value)])
+
+
+def match_fallthrough_block(stmt):
+    """
+    :param ast.stmt stmt: e.g. "if F or V == K: F = True; ..."
+    :return: (flag name, dump of the subject, subject, constant exprs), or None
+    :rtype: (str,str,ast.expr,list[ast.expr])|None
+    """
+    if not isinstance(stmt, ast.If) or stmt.orelse:
+        return None
+    test = stmt.test
+    if not isinstance(test, ast.BoolOp) or not isinstance(test.op, ast.Or) or len(test.values) < 2:
+        return None
+    flag = test.values[0]
+    if not isinstance(flag, ast.Name):
+        return None
+    case_tests = test.values[1:]
+    match = match_case_test(case_tests[0] if len(case_tests) == 1 else ast.BoolOp(op=ast.Or(), values=case_tests))
+    if match is None or not any(_is_flag_set(body_stmt, flag.id) for body_stmt in stmt.body):
+        return None
+    return (flag.id,) + match
+
+
+def _is_flag_set(stmt, flag_name):
+    """
+    :param ast.stmt stmt:
+    :param str flag_name:
+    :return: whether this is "F = True"
+    :rtype: bool
+    """
+    return (
+        isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name)
+        and stmt.targets[0].id == flag_name and isinstance(stmt.value, ast.Constant) and stmt.value.value is True)
+
+
+def _only_sets_flag(blocks, flag_name):
+    """
+    :param list[ast.If] blocks:
+    :param str flag_name:
+    :return: whether the blocks assign nothing but True to the flag, at their top level
+    :rtype: bool
+    """
+    for block in blocks:
+        allowed = {id(stmt.targets[0]) for stmt in block.body if _is_flag_set(stmt, flag_name)}
+        for node in ast.walk(block):
+            if isinstance(node, ast.Name) and node.id == flag_name and not isinstance(node.ctx, ast.Load) \
+                    and id(node) not in allowed:
+                return False
+            if isinstance(node, (ast.Global, ast.Nonlocal)) and flag_name in node.names:
+                return False
+    return True
+
+
+class SwitchLowering:
+
+    def __init__(self, interpreter, min_cases=MinCases):
+        """
+        :param cparser.interpreter.Interpreter interpreter: to evaluate the case constants
+        :param int min_cases: min number of case values of a chain which we lower
+        """
+        self.folder = constfold.ConstFolder(interpreter)
+        self.min_cases = min_cases
+        self.num_lowered = 0
+        self.num_lowered_by_func = {}  # type: dict[str,int]  # translated function name -> lowered chains
+        self._counter = 0
+
+    def _get_case_value(self, const):
+        """
+        :param ast.expr const:
+        :rtype: int|None
+        """
+        try:
+            value = self.folder.evaluate(const)
+        except Exception:
+            return None
+        if type(value) is not int or not 0 <= value < MaxCaseValue:
+            return None  # e.g. a ctypes object, which would only compare equal to itself
+        return value
+
+    def _get_value_branches(self, tests):
+        """
+        :param list[list[ast.expr]] tests: per branch, the constant exprs of its case values
+        :return: case value -> branch index, where the first test wins. None if some value is no case value
+        :rtype: dict[int,int]|None
+        """
+        value_branches = {}  # type: dict[int,int]
+        for branch_idx, consts in enumerate(tests):
+            for const in consts:
+                value = self._get_case_value(const)
+                if value is None:
+                    return None
+                value_branches.setdefault(value, branch_idx)
+        return value_branches
+
+    @staticmethod
+    def _build_lookup(key_name, idx_name, value_branches, default_idx):
+        """
+        :param str key_name: variable with the switch value
+        :param str idx_name: variable which gets the branch index
+        :param dict[int,int] value_branches: case value -> branch index
+        :param int default_idx: branch index when no case value matches
+        :return: statements which set idx_name
+        :rtype: list[ast.stmt]
+        """
+        values = sorted(value_branches)
+        # The lookup via index() compares with ==, like the tests of the translated code.
+        lookup = _if(
+            ast.Compare(left=_name(key_name), ops=[ast.In()], comparators=[ast.Constant(value=tuple(values))]),
+            [_assign(idx_name, ast.Subscript(
+                value=ast.Constant(value=tuple(value_branches[value] for value in values)),
+                slice=ast.Call(
+                    func=ast.Attribute(value=ast.Constant(value=tuple(values)), attr="index", ctx=ast.Load()),
+                    args=[_name(key_name)], keywords=[]),
+                ctx=ast.Load()))],
+            [_assign(idx_name, ast.Constant(value=default_idx))])
+        table_size = values[-1] + 1
+        if table_size > MaxTableSizeFactor * len(values):
+            return [lookup]
+        table = tuple(value_branches.get(value, default_idx) for value in range(table_size))
+        is_table_key = ast.BoolOp(op=ast.And(), values=[
+            ast.Call(func=_name("isinstance"), args=[_name(key_name), _name("int")], keywords=[]),
+            ast.Compare(
+                left=ast.Constant(value=0), ops=[ast.LtE(), ast.Lt()],
+                comparators=[_name(key_name), ast.Constant(value=table_size)])])
+        table_lookup = _assign(
+            idx_name, ast.Subscript(value=ast.Constant(value=table), slice=_name(key_name), ctx=ast.Load()))
+        return [_if(is_table_key, [table_lookup], [lookup])]
+
+    def _new_names(self):
+        """
+        :return: names of the variables for the key and the branch index
+        :rtype: (str,str)
+        """
+        self._counter += 1
+        return "_switch_key_%i" % self._counter, "_switch_idx_%i" % self._counter
+
+    def lower_chain(self, if_node):
+        """
+        :param ast.If if_node: hand-written if/elif chain
+        :return: replacement statements, or None if this is not a chain which we lower
+        :rtype: list[ast.stmt]|None
+        """
+        branches, default_body = get_chain(if_node)
+        subject_dump, subject, tests = None, None, []
+        for test, _ in branches:
+            match = match_case_test(test)
+            if match is None:
+                return None
+            if subject_dump is None:
+                subject_dump, subject = match[0], match[1]
+            elif match[0] != subject_dump:
+                return None
+            tests.append(match[2])
+        value_branches = self._get_value_branches(tests)
+        if value_branches is None or len(value_branches) < self.min_cases:
+            return None
+
+        key_name, idx_name = self._new_names()
+        bodies = [self.transform_stmts(body) for (_, body) in branches] + [self.transform_stmts(default_body)]
+
+        def build_idx_tree(lo, hi):
+            if hi - lo == 1:
+                return bodies[lo] or [ast.Pass()]
+            mid = (lo + hi) // 2
+            return [_if(_compare(idx_name, ast.Lt(), mid), build_idx_tree(lo, mid), build_idx_tree(mid, hi))]
+
+        stmts = [_assign(key_name, subject)]
+        stmts += self._build_lookup(key_name, idx_name, value_branches, default_idx=len(branches))
+        stmts += build_idx_tree(0, len(bodies))
+        for stmt in stmts:
+            _copy_missing_locations(stmt, if_node)
+        self.num_lowered += 1
+        return stmts
+
+    def lower_fallthrough_run(self, blocks):
+        """
+        :param list[ast.If] blocks: consecutive blocks of a translated switch, see match_fallthrough_block
+        :return: replacement statements, or None if this is not a run which we lower
+        :rtype: list[ast.stmt]|None
+        """
+        matches = [match_fallthrough_block(block) for block in blocks]
+        flag_name, subject_dump, subject = matches[0][:3]
+        assert all(match[:2] == (flag_name, subject_dump) for match in matches)
+        if not _only_sets_flag(blocks, flag_name):
+            return None
+        value_branches = self._get_value_branches([match[3] for match in matches])
+        if value_branches is None or len(value_branches) < self.min_cases:
+            return None
+
+        key_name, idx_name = self._new_names()
+        bodies = [self.transform_stmts(block.body) for block in blocks]
+
+        def build_fallthrough_tree(lo, hi):
+            # We know idx < hi. From the entry block on, all blocks run, until a break etc.
+            if hi - lo == 1:
+                return bodies[lo]
+            mid = (lo + hi) // 2
+            return [_if(_compare(idx_name, ast.Lt(), mid), build_fallthrough_tree(lo, mid))] \
+                + build_fallthrough_tree(mid, hi)
+
+        lookup = [_assign(key_name, subject)]
+        lookup += self._build_lookup(key_name, idx_name, value_branches, default_idx=len(blocks))
+        stmts = [
+            _if(_name(flag_name), [_assign(idx_name, ast.Constant(value=0))], lookup),
+            _if(_compare(idx_name, ast.Lt(), len(blocks)), build_fallthrough_tree(0, len(blocks)))]
+        for stmt in stmts:
+            _copy_missing_locations(stmt, blocks[0])
+        self.num_lowered += 1
+        return stmts
+
+    def transform_stmts(self, stmts):
+        """
+        :param list[ast.stmt] stmts:
+        :return: stmts, with all switches and chains lowered, also nested ones
+        :rtype: list[ast.stmt]
+        """
+        res = []
+        i = 0
+        while i < len(stmts):
+            stmt = stmts[i]
+            match = match_fallthrough_block(stmt)
+            if match is not None:
+                end = i + 1
+                while end < len(stmts):
+                    next_match = match_fallthrough_block(stmts[end])
+                    if next_match is None or next_match[:2] != match[:2]:
+                        break
+                    end += 1
+                lowered = self.lower_fallthrough_run(stmts[i:end])
+                if lowered is not None:
+                    res.extend(lowered)
+                    i = end
+                    continue
+            elif isinstance(stmt, ast.If):
+                lowered = self.lower_chain(stmt)
+                if lowered is not None:
+                    res.extend(lowered)
+                    i += 1
+                    continue
+            self._transform_children(stmt)
+            res.append(stmt)
+            i += 1
+        return res
+
+    def _transform_children(self, stmt):
+        for field in ("body", "orelse", "finalbody"):
+            value = getattr(stmt, field, None)
+            if isinstance(value, list) and value and isinstance(value[0], ast.stmt):
+                setattr(stmt, field, self.transform_stmts(value))
+        for handler in getattr(stmt, "handlers", None) or []:
+            handler.body = self.transform_stmts(handler.body)
+
+    def transform_func(self, func_ast):
+        """
+        :param ast.FunctionDef func_ast: translated function, transformed in-place
+        """
+        num_lowered = self.num_lowered
+        func_ast.body = self.transform_stmts(func_ast.body)
+        if self.num_lowered > num_lowered:
+            self.num_lowered_by_func[func_ast.name] = self.num_lowered - num_lowered
+
+    def install(self, interpreter):
+        """
+        :param cparser.interpreter.Interpreter interpreter:
+        """
+        orig_translate = interpreter._translateFuncToPyAst
+
+        def _translateFuncToPyAst(func, *args, **kwargs):
+            funcEnv = orig_translate(func, *args, **kwargs)
+            self.transform_func(funcEnv.astNode)
+            return funcEnv
+
+        interpreter._translateFuncToPyAst = _translateFuncToPyAst
+
+
+def _copy_missing_locations(node, ref):
+    for sub in ast.walk(node):
+        if "lineno" in sub._attributes and not hasattr(sub, "lineno"):
+            ast.copy_location(sub, ref)
+
+
+def install(interpreter):
+    """
+    Call this after interpreter.register(state), and before the translate cache.
+
+    :param cparser.interpreter.Interpreter interpreter:
+    :return: the lowering, for its statistics
+    :rtype: SwitchLowering
+    """
+    lowering = SwitchLowering(interpreter)
+    lowering.install(interpreter)
+    return lowering
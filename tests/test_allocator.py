@@ -0,0 +1,61 @@
+import ctypes
+
+from allocator import PoolAllocator, Alignment, SmallRequestThreshold
+
+
+def test_malloc_alignment_and_reuse():
+    a = PoolAllocator()
+    addrs = [a.malloc(size) for size in [0, 1, 15, 16, 17, 100, SmallRequestThreshold]]
+    assert all(addr and addr % Alignment == 0 for addr in addrs)
+    assert len(set(addrs)) == len(addrs)
+    assert a.get_block_size(addrs[3]) == 16
+    assert a.get_block_size(addrs[4]) == 32
+    a.free(addrs[5])
+    assert a.malloc(100) == addrs[5]
+    assert a.malloc(100) != addrs[5]
+
+
+def test_many_allocs_new_pools():
+    a = PoolAllocator()
+    addrs = [a.malloc(48) for _ in range(10000)]
+    assert len(set(addrs)) == len(addrs)
+    for addr in addrs:
+        ctypes.memset(addr, 0xab, 48)
+    for addr in addrs:
+        a.free(addr)
+    assert sorted(a.malloc(48) for _ in range(10000)) == sorted(addrs)
+
+
+def test_calloc_zeroes_reused_block():
+    a = PoolAllocator()
+    addr = a.malloc(64)
+    ctypes.memset(addr, 0xff, 64)
+    a.free(addr)
+    addr2 = a.calloc(8, 8)
+    assert addr2 == addr
+    assert ctypes.string_at(addr2, 64) == b"\0" * 64
+
+
+def test_realloc_copies():
+    a = PoolAllocator()
+    addr = a.malloc(10)
+    ctypes.memmove(addr, b"0123456789", 10)
+    assert a.realloc(addr, 12) == addr  # same size class
+    addr2 = a.realloc(addr, 200)
+    assert addr2 != addr
+    assert ctypes.string_at(addr2, 10) == b"0123456789"
+    addr3 = a.realloc(addr2, 100000)  # large, from libc
+    assert not a.is_own(addr3)
+    assert ctypes.string_at(addr3, 10) == b"0123456789"
+    addr4 = a.realloc(addr3, 200000)
+    assert ctypes.string_at(addr4, 10) == b"0123456789"
+    a.free(addr4)
+
+
+def test_large_and_foreign_blocks_go_to_libc():
+    a = PoolAllocator()
+    addr = a.malloc(SmallRequestThreshold + 1)
+    assert addr and not a.is_own(addr)
+    a.free(addr)
+    assert a.calloc(1000, 1000)
+    a.free(0)
@@ -0,0 +1,119 @@
+"""
+Tests for callgraph, the reference graph for the dead-code elimination of compile_to_py.
+"""
+
+from callgraph import build_graph, find_reachable, get_global_decls, get_references, rename_graph
+from compile_output import fixed_name
+
+
+# Stand-ins for the cparser declarations, with the attributes as cparser links them after parsing.
+
+class CNode:
+
+    def __init__(self, **kwargs):
+        vars(self).update(kwargs)
+
+
+class CFunc(CNode):
+    pass
+
+
+class CVarDecl(CNode):
+    pass
+
+
+class CStruct(CNode):
+    pass
+
+
+class CFuncCall(CNode):
+    pass
+
+
+class CCurlyArrayArgs(CNode):
+    pass
+
+
+class FakeState:
+
+    def __init__(self, contentlist):
+        self.contentlist = contentlist
+        self.funcs = {obj.name: obj for obj in contentlist if isinstance(obj, CFunc)}
+        self.vars = {obj.name: obj for obj in contentlist if isinstance(obj, CVarDecl)}
+
+
+DeclTypes = (CFunc, CVarDecl)
+StopTypes = (CStruct,)
+Modules = (__name__,)
+
+
+def _make_state():
+    """
+    Like dictobject.c: a static type object whose slots are function pointers,
+    and Py_Main which refers to the type object.
+    """
+    helper_proto = CFunc(name="helper", body=None)
+    repr_proto = CFunc(name="dict_repr", body=None)
+    unused = CFunc(name="unused", body=None)
+    dict_struct = CStruct(name="_typeobject", body=[CNode(ref=unused)])  # types are not walked into
+    dict_type = CVarDecl(name="PyDict_Type", type=dict_struct, body=CCurlyArrayArgs(args=[
+        CNode(value="dict"), repr_proto, [CNode(value=0)]]))
+    # The call refers to the prototype.
+    repr_def = CFunc(name="dict_repr", body=[CFuncCall(base=helper_proto)])
+    helper = CFunc(name="helper", body=[], parent=CNode(scope=[unused]))  # parent links are not walked into
+    py_main = CFunc(name="Py_Main", body=[CNode(expr=dict_type)])
+    py_main.body.append(CFuncCall(base=py_main))  # recursion
+    return FakeState([helper_proto, repr_proto, dict_struct, unused, dict_type, repr_def, helper, py_main])
+
+
+def test_find_reachable():
+    graph = {
+        "Py_Main": {"Py_Initialize", "run"},
+        "Py_Initialize": {"_PyType_Ready", "type_slots"},
+        "type_slots": {"tp_repr_impl"},
+        "run": {"run"},  # recursion
+        "unused": {"Py_Main", "unused_helper"},
+        "unused_helper": set(),
+    }
+    assert find_reachable(graph, ["Py_Main"]) == {
+        "Py_Main", "Py_Initialize", "_PyType_Ready", "type_slots", "tp_repr_impl", "run"}
+    assert find_reachable(graph, ["Py_Main", "unused"]) == set(graph) | {"_PyType_Ready", "tp_repr_impl"}
+    assert find_reachable(graph, []) == set()
+    assert find_reachable(graph, ["not_in_graph"]) == {"not_in_graph"}
+
+
+def test_fixed_name():
+    assert fixed_name("__foo") == "_M_foo"
+    assert fixed_name("_M_foo") == "_M_foo"
+    assert fixed_name("_foo") == "_foo"
+
+
+def test_roots_with_renamed_names():
+    # Some declarations are renamed before we build the graph, others not. Roots are given by their C names.
+    graph = {"Py_Main": {"_M_helper"}, "__helper": {"__inner"}, "__inner": set(), "__unused": set()}
+    graph = rename_graph(graph, fixed_name)
+    assert graph == {"Py_Main": {"_M_helper"}, "_M_helper": {"_M_inner"}, "_M_inner": set(), "_M_unused": set()}
+    assert find_reachable(graph, [fixed_name("Py_Main")]) == {"Py_Main", "_M_helper", "_M_inner"}
+    assert find_reachable(graph, [fixed_name("__unused")]) == {"_M_unused"}
+
+
+def test_get_references():
+    state = _make_state()
+    decls = get_global_decls(state, decl_types=DeclTypes)
+    assert set(decls.values()) == {"Py_Main", "PyDict_Type", "dict_repr", "helper", "unused"}
+    dict_type = state.vars["PyDict_Type"]
+    assert get_references(dict_type, decls, stop_types=StopTypes, modules=Modules) == {"dict_repr"}
+    # Without the stop types, we would walk into the struct type.
+    assert get_references(dict_type, decls, stop_types=(), modules=Modules) == {"dict_repr", "unused"}
+    # Objects from other modules are not walked into.
+    assert get_references(dict_type, decls, stop_types=StopTypes, modules=("cparser",)) == set()
+
+
+def test_build_graph():
+    state = _make_state()
+    graph = build_graph(state, decl_types=DeclTypes, stop_types=StopTypes, modules=Modules)
+    # The prototypes and the definitions are merged by name.
+    assert graph == {
+        "helper": set(), "dict_repr": {"helper"}, "unused": set(), "PyDict_Type": {"dict_repr"},
+        "Py_Main": {"PyDict_Type"}}
+    assert find_reachable(graph, ["Py_Main"]) == {"Py_Main", "PyDict_Type", "dict_repr", "helper"}
@@ -0,0 +1,45 @@
+from compact import Compactor
+
+
+class Builtin:
+    def __init__(self, builtin_type):
+        self.builtin_type = builtin_type
+
+
+class Decl:
+    def __init__(self, name, type, parent=None):
+        self.name = name
+        self.type = type
+        self.parent = parent
+
+
+def make_str(s):
+    return "".join(list(s))  # a new, not interned string object
+
+
+def test_intern_and_share():
+    decls = [Decl(make_str("x_%i" % (i % 2)), Builtin((make_str("unsigned"), make_str("int")))) for i in range(4)]
+    decls[1].parent = decls[0]
+    funcs = {make_str("f"): decls[0]}
+    compactor = Compactor(shared_types=(Builtin,), modules=(__name__,))
+    compactor.compact(decls, funcs)
+    assert decls[0].name is decls[2].name
+    assert all(d.type is decls[0].type for d in decls)
+    assert decls[0].type.builtin_type == ("unsigned", "int")
+    assert decls[1].parent is decls[0]
+    assert list(funcs.keys()) == ["f"] and funcs["f"] is decls[0]
+    assert compactor.num_shared >= 3
+
+
+def test_not_shared_when_not_atomic():
+    a, b = Builtin([1]), Builtin([1])
+    decls = [Decl("a", a), Decl("b", b)]
+    Compactor(shared_types=(Builtin,), modules=(__name__,)).compact(decls)
+    assert decls[0].type is a and decls[1].type is b
+
+
+def test_other_modules_not_walked():
+    decl = Decl(make_str("y"), None)
+    compactor = Compactor()
+    compactor.compact([decl])
+    assert compactor.num_interned == 0
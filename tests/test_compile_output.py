@@ -0,0 +1,141 @@
+"""
+Tests for compile_output, the parts of compile_to_py which don't need cparser.
+"""
+
+import ast
+import importlib
+import importlib.util
+import sys
+import types
+
+import pytest
+
+from compile_output import get_shard_module_name, write_package_init, write_shard_header, write_shard_initializers
+from compile_output import compile_func_ast, get_code_table_loader_source, load_code_table, write_code_table
+
+
+class FakeFunc:
+
+    def __init__(self, def_pos):
+        self.defPos = def_pos
+
+
+def test_shard_module_name():
+    assert get_shard_module_name(FakeFunc("Objects/dictobject.c:123:4")) == "_f_dictobject_c"
+    assert get_shard_module_name(FakeFunc("Include/pyport-x.h:1")) == "_f_pyport_x_h"
+    assert get_shard_module_name(FakeFunc(None)) == "_f_unknown"
+
+
+@pytest.fixture
+def package_dir(tmp_path):
+    sys.path.insert(0, str(tmp_path))
+    yield tmp_path
+    sys.path.remove(str(tmp_path))
+    for name in list(sys.modules):
+        if name == "shardpkg" or name.startswith("shardpkg."):
+            del sys.modules[name]
+
+
+def _write_module(package, module_name, body, initializers=()):
+    with open(str(package / ("%s.py" % module_name)), "w") as f:
+        write_shard_header(f, module_name)
+        f.write(body)
+        if initializers:
+            write_shard_initializers(f, list(initializers))
+
+
+def test_sharded_package_imports_lazily(package_dir):
+    package = package_dir / "shardpkg"
+    package.mkdir()
+    (package / "_types.py").write_text("Py_ssize_t = int\n")
+    _write_module(package, "_local_types", "")
+    _write_module(package, "_f_a_c", "counter = [0]\ndef f(x):\n    g.counter[0] += 1\n    return g.h(x) + 1\n")
+    _write_module(package, "_f_b_c", "def h(x):\n    return Py_ssize_t(x) * 2\n")
+    with open(str(package / "__init__.py"), "w") as f:
+        write_package_init(f, {
+            "f": "_f_a_c", "h": "_f_b_c", "counter": "_f_a_c", "Py_ssize_t": "_types"})
+
+    pkg = importlib.import_module("shardpkg")
+    assert pkg._global_modules == {"f": "_f_a_c", "h": "_f_b_c", "counter": "_f_a_c"}
+    assert "shardpkg._local_types" in sys.modules
+    assert "shardpkg._f_a_c" not in sys.modules
+    assert pkg.g.f(3) == 7
+    assert pkg.g.counter == [1]
+    assert "shardpkg._f_b_c" in sys.modules
+    assert pkg.g.Py_ssize_t is int
+    assert "f" in vars(pkg.g)  # cached after the first access
+
+
+def test_touching_a_global_imports_only_its_module(package_dir):
+    # Like the static type objects: the slots refer to functions of the same module.
+    package = package_dir / "shardpkg"
+    package.mkdir()
+    (package / "_types.py").write_text("")
+    _write_module(package, "_local_types", "")
+    modules = {}
+    for i in range(10):
+        module_name = "_f_obj%i_c" % i
+        modules.update({"Type%i" % i: module_name, "repr%i" % i: module_name, "other%i" % i: module_name})
+        _write_module(
+            package, module_name,
+            "Type%i = {}\ndef repr%i(obj):\n    return 'obj%i'\ndef other%i(obj):\n    return g.repr%i(obj)\n" % (
+                i, i, i, i, (i + 1) % 10),
+            initializers=["Type%i['tp_repr'] = repr%i\n" % (i, i)])
+    with open(str(package / "__init__.py"), "w") as f:
+        write_package_init(f, modules)
+
+    pkg = importlib.import_module("shardpkg")
+    before = set(name for name in sys.modules if name.startswith("shardpkg."))
+    assert pkg.g.Type3["tp_repr"](None) == "obj3"
+    after = set(name for name in sys.modules if name.startswith("shardpkg."))
+    assert after - before == {"shardpkg._f_obj3_c"}
+
+
+def _parse_func(source):
+    func_ast = ast.parse(source).body[0]
+    assert isinstance(func_ast, ast.FunctionDef)
+    return func_ast
+
+
+def test_compile_func_ast():
+    code = compile_func_ast(_parse_func("def f(a, b):\n    return helper(a) + b\n"), "Objects/foo.c")
+    assert code.co_name == "f"
+    assert code.co_filename == "Objects/foo.c"
+    func = types.FunctionType(code, {"helper": lambda x: x * 10}, "f")
+    assert func(2, 3) == 23
+    # These need the def statement.
+    assert compile_func_ast(_parse_func("def f(a=1):\n    return a\n"), "foo.c") is None
+    assert compile_func_ast(_parse_func("@staticmethod\ndef f():\n    pass\n"), "foo.c") is None
+
+
+def test_code_table_round_trip(tmp_path):
+    module_fn = str(tmp_path / "_f_foo_c.py")
+    code_table = {
+        "f": compile_func_ast(_parse_func("def f(x):\n    return g(x) * 2\n"), "foo.c"),
+        "g": compile_func_ast(_parse_func("def g(x):\n    return x + 1\n"), "foo.c")}
+    write_code_table(module_fn, code_table)
+    with open(str(tmp_path / "_f_foo_c.pyfuncs"), "rb") as f:
+        assert f.read(len(importlib.util.MAGIC_NUMBER)) == importlib.util.MAGIC_NUMBER
+
+    # Like the compiled module does it, with the loader source which we write into its header.
+    namespace = {"__file__": module_fn}
+    exec("import importlib.util\nimport marshal\nimport os\nimport types\n\n" + get_code_table_loader_source(),
+         namespace)
+    loaded = namespace["load_code_table"](module_fn)
+    assert sorted(loaded) == ["f", "g"]
+    for name in loaded:
+        namespace[name] = namespace["make_function"](loaded, name, namespace)
+    assert namespace["f"](4) == 10
+    assert namespace["f"].__name__ == "f"
+
+
+def test_code_table_of_other_python_version(tmp_path):
+    module_fn = str(tmp_path / "_f_foo_c.py")
+    write_code_table(module_fn, {})
+    fn = str(tmp_path / "_f_foo_c.pyfuncs")
+    with open(fn, "rb") as f:
+        data = f.read()
+    with open(fn, "wb") as f:
+        f.write(b"\0\0\0\0" + data[len(importlib.util.MAGIC_NUMBER):])
+    with pytest.raises(ImportError):
+        load_code_table(module_fn)
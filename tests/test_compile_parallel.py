@@ -0,0 +1,85 @@
+"""
+Tests for compile_parallel, the translation of the functions in forked workers.
+"""
+
+import io
+
+import compile_parallel
+
+
+class FakeFunc:
+
+    def __init__(self, name, kind="source"):
+        """
+        :param str name:
+        :param str kind: how the fake translation behaves, see FakeCodeGen._render_func
+        """
+        self.name = name
+        self.kind = kind
+
+
+class FakeWrappedValues:
+
+    def __init__(self):
+        self.list = set()
+
+
+class FakeInterpreter:
+
+    def __init__(self):
+        self.wrappedValues = FakeWrappedValues()
+
+
+class FakeCodeGen:
+    """Like compile_to_py.CodeGen, as far as compile_parallel uses it."""
+
+    def __init__(self, funcs):
+        self.f = io.StringIO()
+        self._shard_files = {}
+        self.interpreter = FakeInterpreter()
+        self.funcs = funcs
+
+    def get_funcs_to_translate(self):
+        return list(self.funcs)
+
+    def _render_func(self, func):
+        assert compile_parallel.in_worker()
+        if func.kind == "raises":
+            raise Exception("cannot translate %s" % func.name)
+        if func.kind == "registers":
+            self.interpreter.wrappedValues.list.add("value_%s" % func.name)
+        rendered = {"text": "def %s(): pass\n" % func.name, "code": None, "source": None}
+        if func.kind == "code":
+            code = compile("def %s():\n    return 42\n" % func.name, "foo.c", "exec").co_consts[0]
+            rendered["code"] = (func.name, code)
+            rendered["text"] = "%s = make_function(_code, %r, globals())\n" % (func.name, func.name)
+        if func.kind == "refers":
+            rendered["text"] = "def %s(): return values.value_d\n" % func.name
+        return rendered
+
+
+def test_render_funcs():
+    funcs = [
+        FakeFunc("a"), FakeFunc("b", "code"), FakeFunc("c", "raises"), FakeFunc("d", "registers"),
+        FakeFunc("e", "refers"), FakeFunc("f")]
+    code_gen = FakeCodeGen(funcs)
+    # With one worker, the chunks run in order in the same process, so e sees the value which d registered.
+    results = compile_parallel.render_funcs(code_gen, jobs=1)
+    assert not compile_parallel.in_worker()
+    assert sorted(results) == sorted(id(funcs[i]) for i in [0, 1, 5])
+    assert results[id(funcs[0])]["text"] == "def a(): pass\n"
+    name, code = results[id(funcs[1])]["code"]
+    assert name == "b"
+    assert eval(code) == 42
+    # Nothing was registered in the parent.
+    assert code_gen.interpreter.wrappedValues.list == set()
+
+
+def test_refers_to_values():
+    code = compile("def f():\n    return values_helper(value_x)\n", "foo.c", "exec")
+    rendered = {"text": "", "code": ("f", code)}
+    assert compile_parallel._refers_to_values(rendered, {"value_x"})
+    assert not compile_parallel._refers_to_values(rendered, {"value_y"})
+    assert not compile_parallel._refers_to_values(rendered, set())
+    rendered = {"text": "x = values.value_y\n", "code": None}
+    assert compile_parallel._refers_to_values(rendered, {"value_y"})
@@ -0,0 +1,99 @@
+import ast
+import ctypes
+
+import pytest
+
+from constfold import ConstFolder, is_const_expr, is_literal
+
+
+def parse_expr(source):
+    return ast.parse(source, mode="eval").body
+
+
+class FakeInterpreter:
+    globalsDict = {"ctypes": ctypes, "ctypes_wrapped": ctypes}
+
+
+def test_is_const_expr():
+    assert is_const_expr(parse_expr("ctypes_wrapped.c_int(ctypes.sizeof(ctypes.c_long) * 2 + 1)"))
+    assert is_const_expr(parse_expr("(1 << 3) - 1 if 2 > 1 else 0"))
+    assert not is_const_expr(parse_expr("g.x + 1"))
+    assert not is_const_expr(parse_expr("helpers.foo(1)"))
+    assert not is_const_expr(parse_expr("ctypes.memset(0, 0, 1)"))
+    assert not is_const_expr(parse_expr("(lambda: 1)()"))
+
+
+def test_is_literal():
+    assert is_literal(parse_expr("3"))
+    assert is_literal(parse_expr("ctypes_wrapped.c_int(3)"))
+    assert not is_literal(parse_expr("ctypes_wrapped.c_int(3 + 1)"))
+
+
+def test_fold_python_int():
+    folder = ConstFolder(FakeInterpreter())
+    folded = folder.fold(None, parse_expr("(ctypes.sizeof(ctypes.c_int) + 7) & ~7"), None)
+    assert isinstance(folded, ast.Constant) and folded.value == 8
+    assert folder.num_folded == 1
+
+
+def test_no_fold():
+    folder = ConstFolder(FakeInterpreter())
+    for source in ["x + 1", "ctypes.c_double(1.5)", "ctypes_wrapped.c_int(5)", "1 // 0"]:
+        node = parse_expr(source)
+        assert folder.fold(None, node, None) is node
+    assert folder.num_folded == 0 and folder.num_failed == 1
+
+
+class FakeFuncEnv:
+
+    def __init__(self, interpreter):
+        class globalScope:
+            pass
+        self.globalScope = globalScope
+        self.globalScope.interpreter = interpreter
+
+
+def test_only_folds_for_its_interpreter(monkeypatch):
+    interpreter_module = pytest.importorskip("cparser.interpreter")
+    monkeypatch.setattr(interpreter_module, "astAndTypeForStatement", lambda funcEnv, stmnt: (parse_expr(stmnt), None))
+    orig = interpreter_module.astAndTypeForStatement
+    ours, other = FakeInterpreter(), FakeInterpreter()
+    folder = ConstFolder(ours)
+    with folder.installed():
+        with pytest.raises(AssertionError):
+            folder.install()
+        node, _ = interpreter_module.astAndTypeForStatement(FakeFuncEnv(ours), "(2 + 3) * 4")
+        assert isinstance(node, ast.Constant) and node.value == 20
+        node, _ = interpreter_module.astAndTypeForStatement(FakeFuncEnv(other), "(2 + 3) * 4")
+        assert isinstance(node, ast.BinOp)
+    assert interpreter_module.astAndTypeForStatement is orig
+    assert folder.num_folded == 1
+
+
+ConstSource = """
+long twice_size(void) {
+    return sizeof(long) * 2 + 1;
+}
+"""
+
+
+def test_other_interpreter_is_not_folded(tmp_path):
+    cparser = pytest.importorskip("cparser")
+    import cparser.interpreter
+    src = tmp_path / "const.c"
+    src.write_text(ConstSource)
+    state = cparser.State()
+    state.autoSetupSystemMacros()
+    cparser.parse(str(src), state)
+    assert not state._errors
+    folded = cparser.interpreter.Interpreter()
+    folded.register(state)
+    plain = cparser.interpreter.Interpreter()
+    plain.register(state)
+    folder = ConstFolder(folded)
+    with folder.installed():
+        assert folded.runFunc("twice_size").value == ctypes.sizeof(ctypes.c_long) * 2 + 1
+        num_folded = folder.num_folded
+        assert num_folded > 0
+        assert plain.runFunc("twice_size").value == ctypes.sizeof(ctypes.c_long) * 2 + 1
+        assert folder.num_folded == num_folded
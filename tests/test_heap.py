@@ -0,0 +1,175 @@
+import ctypes
+import mmap
+
+import allocator
+import heap
+import native_bindings
+from heap import Heap, WcharSize
+
+
+def test_large_blocks_owned_and_reused():
+    h = Heap()
+    addr = h.malloc(allocator.SmallRequestThreshold + 1)
+    assert h.is_own(addr) and h.get_block_size(addr) >= allocator.SmallRequestThreshold + 1
+    h.memset(addr, 0xab, 1000)
+    h.free(addr)
+    addr2 = h.calloc(10, 100)
+    assert addr2 == addr
+    assert h.read(addr2, 1000) == b"\0" * 1000
+    small = h.malloc(40)
+    assert h.is_own(small) and h.get_block_size(small) == 48
+
+
+def test_memory_ops():
+    h = Heap()
+    a = h.malloc(100000)
+    b = h.malloc(64)
+    h.write(a, b"hello world\0")
+    assert h.strlen(a) == 11
+    assert h.string_at(a) == b"hello world"
+    h.memcpy(b, a, 12)
+    assert ctypes.string_at(b) == b"hello world"
+    assert h.memcmp(a, b, 12) == 0
+    h.write(b, b"hellp")
+    assert h.memcmp(a, b, 5) == -1 and h.memcmp(b, a, 5) == 1
+    assert h.memchr(a, ord("w"), 12) == a + 6
+    assert h.memchr(a, ord("z"), 12) == 0
+    h.memmove(a + 2, a, 5)
+    assert h.read(a, 7) == b"hehello"
+    c = h.strdup(a)
+    assert c != a and h.string_at(c) == h.string_at(a)
+
+
+def test_strings_outside_heap():
+    h = Heap()
+    buf = ctypes.create_string_buffer(b"abc")
+    assert h.strlen(ctypes.addressof(buf)) == 3
+    wbuf = ctypes.create_unicode_buffer("xyz€")
+    assert h.wcslen(ctypes.addressof(wbuf)) == 4
+
+
+def test_wchar_strings():
+    h = Heap()
+    addr = h.make_wchar_string("aĀb")
+    assert h.wcslen(addr) == 3
+    assert h.wstring_at(addr) == "aĀb"
+    assert ctypes.wstring_at(addr) == "aĀb"
+    copy = h.wcsdup(addr)
+    assert h.read(copy, 4 * WcharSize) == h.read(addr, 4 * WcharSize)
+    s = h.make_string("ä")
+    assert h.string_at(s) == "ä".encode("utf8")
+
+
+def test_malloc_out_of_memory():
+    h = Heap()
+    assert h.malloc(2 ** 62) == 0
+    assert h.calloc(2 ** 31, 2 ** 31) == 0
+
+
+def test_realloc_large_in_place():
+    h = Heap()
+    addr = h.malloc(5 * mmap.PAGESIZE)
+    h.write(addr, b"data")
+    assert h.realloc(addr, 2 * mmap.PAGESIZE) == addr
+    assert h.realloc(addr, 5 * mmap.PAGESIZE) == addr
+    addr2 = h.realloc(addr, 6 * mmap.PAGESIZE)
+    assert addr2 != addr and h.read(addr2, 4) == b"data"
+
+
+def test_freed_large_regions_unmapped():
+    h = Heap()
+    num_arenas = len(h._arenas)
+    addr = 0
+    for num_pages in range(1, 200):  # like a growing buffer
+        new_addr = h.malloc(num_pages * mmap.PAGESIZE)
+        h.free(addr)
+        addr = new_addr
+    h.free(addr)
+    mapped = sum(len(arena) for arena in h._arenas[num_arenas:])
+    assert mapped <= heap.LargeFreeCacheSize
+    assert len(h._arenas) == len(h._arena_starts) == len(h._arena_ends)
+    assert h.malloc(3 * mmap.PAGESIZE)
+
+
+class CountingHeap(Heap):
+
+    def __init__(self):
+        super(CountingHeap, self).__init__()
+        self.calls = []
+
+    def memcpy(self, dst, src, size):
+        self.calls.append("memcpy")
+        return super(CountingHeap, self).memcpy(dst, src, size)
+
+    def strlen(self, addr):
+        self.calls.append("strlen")
+        return super(CountingHeap, self).strlen(addr)
+
+
+class WrapValue:
+    # Like cparser.CWrapValue, for the wrapped libc functions.
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeState:
+
+    def __init__(self):
+        lib = native_bindings.get_libs()[0]
+        self.funcs = {}
+        for name, restype in [
+                ("memcpy", ctypes.POINTER(ctypes.c_char)), ("strlen", ctypes.c_size_t),
+                ("memchr", ctypes.c_void_p), ("wcsdup", ctypes.POINTER(ctypes.c_wchar)), ("free", None)]:
+            func = lib[name]
+            func.restype = restype
+            self.funcs[name] = WrapValue(func)
+        self.funcs["memset"] = object()  # e.g. parsed, not wrapped
+
+
+def test_libc_functions_use_heap():
+    h = CountingHeap()
+    state = FakeState()
+    assert heap.install_libc(state, h) == ["free", "memchr", "memcpy", "strlen", "wcsdup"]
+    funcs = {name: value.value for (name, value) in state.funcs.items() if isinstance(value, WrapValue)}
+    src = ctypes.create_string_buffer(b"hello")
+    dst = ctypes.create_string_buffer(10)
+    src_p = ctypes.cast(src, ctypes.POINTER(ctypes.c_char))
+    res = funcs["memcpy"](ctypes.cast(dst, ctypes.POINTER(ctypes.c_char)), src_p, ctypes.c_size_t(6))
+    assert isinstance(res, ctypes.POINTER(ctypes.c_char))  # typed like the replaced function
+    assert ctypes.addressof(res.contents) == ctypes.addressof(dst) and dst.value == b"hello"
+    assert funcs["strlen"](src_p) == 5
+    assert funcs["memchr"](src, ord("l"), 5) == ctypes.addressof(src) + 2
+    assert funcs["memchr"](src, ord("z"), 5) is None
+    assert h.calls == ["memcpy", "strlen"]
+    wsrc = ctypes.create_unicode_buffer("abc")
+    copy = funcs["wcsdup"](wsrc)
+    copy_addr = ctypes.cast(copy, ctypes.c_void_p).value
+    assert h.is_own(copy_addr) and ctypes.wstring_at(copy_addr) == "abc"
+    funcs["free"](copy)
+    assert h.num_frees == 1
+
+
+class FakeInterpreter:
+
+    class helpers:
+        pass
+
+    def __init__(self):
+        self._func_cache = {}
+
+    def _make_string(self, s):
+        return ctypes.create_string_buffer(s.encode("utf8") if isinstance(s, str) else s)
+
+    def _make_wchar_string(self, s):
+        return ctypes.create_unicode_buffer(s)
+
+
+def test_make_string_on_heap():
+    interpreter = FakeInterpreter()
+    h = heap.install(interpreter, FakeState())
+    assert interpreter.helpers.heap is h
+    buf = interpreter._make_string("abc")
+    assert isinstance(buf, ctypes.Array) and buf._type_ is ctypes.c_char and len(buf) == 4
+    assert h.is_own(ctypes.addressof(buf)) and buf.value == b"abc"
+    wbuf = interpreter._make_wchar_string("xyz")
+    assert h.is_own(ctypes.addressof(wbuf)) and wbuf.value == "xyz" and len(wbuf) == 4
@@ -0,0 +1,218 @@
+"""
+Tests for include_cache, which replays the preprocessor output of the headers.
+ToyState stands in for CPythonState. Its preprocessor works line by line, but
+keeps the position and calls state.preprocess() for includes like cparser.
+"""
+
+import os
+
+import pytest
+
+import parse_cache
+from include_cache import IncludeCache
+
+
+class ToyMacro:
+    # Like cparser.Macro.
+    def __init__(self, rightside):
+        self.args = None
+        self.rightside = rightside
+
+
+class ToyState:
+    """
+    Directives: #define NAME [VALUE], #undef NAME, #ifdef NAME, #endif, #include FILE, #error MSG.
+    Headers starting with "t" are template headers, which are not deduplicated.
+    """
+
+    def __init__(self, src_dir, cache=None):
+        for container in parse_cache.StateContainers:
+            setattr(self, container, {})
+        self.src_dir = src_dir
+        self.cache = cache
+        self._errors = []
+        self._preprocessIncludeLevel = []
+        self.included_files = set()
+        self.input_files = {}
+        self.unit_input_files = None
+
+    def add_input_file(self, filename):
+        self.input_files[filename] = None
+        if self.cache:
+            self.cache.note_input_file(self, filename)
+
+    def readLocalInclude(self, filename):
+        fullfn = os.path.join(self.src_dir, filename)
+        self.add_input_file(fullfn)
+        if not filename.startswith("t"):
+            if self.cache:
+                self.cache.note_include(self, fullfn, fullfn in self.included_files)
+            if fullfn in self.included_files:
+                return "", fullfn
+            self.included_files.add(fullfn)
+        with open(fullfn) as f:
+            return iter(f.read()), fullfn
+
+    def preprocess(self, reader, fullfilename, filename):
+        if not self.cache:
+            return self._preprocess(reader, fullfilename, filename)
+        return self.cache.preprocess(self, self._preprocess, reader, fullfilename, filename)
+
+    def _preprocess(self, reader, fullfilename, filename):
+        self._preprocessIncludeLevel += [[fullfilename, filename, 1, 1]]
+        skipping = 0
+        for line in "".join(reader).splitlines(True):
+            words = line.split()
+            if words and words[0].startswith("#"):
+                if words[0] == "#endif":
+                    skipping = max(skipping - 1, 0)
+                elif skipping:
+                    skipping += words[0] == "#ifdef"
+                elif words[0] == "#ifdef":
+                    skipping = int(words[1] not in self.macros)
+                elif words[0] == "#define":
+                    self.macros[words[1]] = ToyMacro(" ".join(words[2:]))
+                elif words[0] == "#undef":
+                    self.macros.pop(words[1], None)
+                elif words[0] == "#error":
+                    self._errors.append("%s: %s" % (filename, " ".join(words[1:])))
+                elif words[0] == "#include":
+                    reader2, fullfn2 = self.readLocalInclude(words[1])
+                    for c in self.preprocess(reader2, fullfn2, words[1]):
+                        yield c
+                self._preprocessIncludeLevel[-1][2] += 1
+                self._preprocessIncludeLevel[-1][3] = 1
+                continue
+            for c in line:
+                if not skipping:
+                    yield c
+                if c == "\n":
+                    self._preprocessIncludeLevel[-1][2] += 1
+                    self._preprocessIncludeLevel[-1][3] = 1
+                else:
+                    self._preprocessIncludeLevel[-1][3] += 1
+        self._preprocessIncludeLevel = self._preprocessIncludeLevel[:-1]
+
+    def parse_file(self, filename):
+        """
+        :return: like cpre2: per output line, the position at its first char and its macro-expanded words
+        :rtype: list
+        """
+        res = []
+        line, pos = [], None
+        for c in self.preprocess(iter(open(os.path.join(self.src_dir, filename)).read()), filename, filename):
+            if pos is None:
+                pos = [list(level) for level in self._preprocessIncludeLevel]
+            if c != "\n":
+                line.append(c)
+                continue
+            # Looked up while the preprocessor waits, like cpre2.
+            words = []
+            for word in "".join(line).split():
+                macro = self.macros.get(word)
+                words.append(macro.rightside if macro else word)
+            res.append((pos, words))
+            line, pos = [], None
+        return res
+
+
+def dump_state(state):
+    return {
+        "macros": {name: macro.rightside for (name, macro) in state.macros.items()},
+        "included_files": sorted(state.included_files),
+        "input_files": list(state.input_files),
+        "errors": list(state._errors),
+        "levels": state._preprocessIncludeLevel}
+
+
+Files = {
+    "a.h": "#define A 1\nint a = A ;\n#ifdef FEATURE\nint feature ;\n#endif\n#include b.h\nint after_b = TMP ;\n#undef TMP\n",
+    "b.h": "int b ;\n#error from b\n",
+    "t.h": "#ifdef WIDE\nint wide ;\n#endif\n  int T_NAME ;\n#define T_DONE T_NAME\n",
+    "u.c": (
+        "#define TMP 5\n#include a.h\n#define T_NAME x1\n#include t.h\n#undef T_NAME\n#define T_NAME x2\n"
+        "#include t.h\nint done = T_DONE ;\n#define WIDE\n#include t.h\n#include a.h\nint end ;\n")}
+
+
+def write_files(src_dir, files):
+    for fn, content in files.items():
+        with open(os.path.join(src_dir, fn), "w") as f:
+            f.write(content)
+
+
+def parse(src_dir, cache=None):
+    state = ToyState(str(src_dir), cache=cache)
+    return state.parse_file("u.c"), dump_state(state)
+
+
+def test_replay_same_as_preprocessing(tmp_path):
+    write_files(str(tmp_path), Files)
+    expected = parse(tmp_path)
+    assert expected[0][1] == ([[
+        "u.c", "u.c", 2, 1], [str(tmp_path / "a.h"), "a.h", 6, 1], [str(tmp_path / "b.h"), "b.h", 1, 1]],
+        ["int", "b", ";"])
+    cache = IncludeCache()
+    assert parse(tmp_path, cache) == expected
+    # The second t.h has the same preprocessor dependencies, the third one has WIDE defined.
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert parse(tmp_path, cache) == expected
+    assert (cache.hits, cache.misses) == (5, 3)
+
+
+def test_changed_file_is_a_miss(tmp_path):
+    write_files(str(tmp_path), Files)
+    cache = IncludeCache()
+    parse(tmp_path, cache)
+    write_files(str(tmp_path), {"b.h": "int b2 ;\n"})
+    hits = cache.hits
+    expected = parse(tmp_path)
+    assert parse(tmp_path, cache) == expected
+    assert cache.hits == hits + 3  # only t.h
+    assert ["int", "b2", ";"] in [words for (_, words) in expected[0]]
+
+
+def test_macro_iteration_is_not_cached(tmp_path):
+    write_files(str(tmp_path), {"x.h": "int x ;\n", "u.c": "#include x.h\n"})
+
+    class IteratingState(ToyState):
+        def _preprocess(self, reader, fullfilename, filename):
+            list(self.macros.keys())
+            for c in ToyState._preprocess(self, reader, fullfilename, filename):
+                yield c
+
+    cache = IncludeCache()
+    for _ in range(2):
+        IteratingState(str(tmp_path), cache=cache).parse_file("u.c")
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_real_preprocessor_same_parse(tmp_path):
+    cparser = pytest.importorskip("cparser")
+    (tmp_path / "twice.h").write_text(
+        "#define TWICE(x) ((x) * 2)\n"
+        "#ifdef WITH_OFFSET\nstatic int offset(void) { return 3; }\n#endif\n"
+        "static int twice(int x) { return TWICE(x); }\n")
+    (tmp_path / "u.c").write_text('#include "twice.h"\nint use(int x) { return twice(x) + 1; }\n')
+    cache = IncludeCache()
+
+    class State(cparser.State):
+        def readLocalInclude(self, filename):
+            fullfn = str(tmp_path / filename)
+            with open(fullfn) as f:
+                return iter(f.read()), fullfn
+
+        def preprocess(self, reader, fullfilename, filename):
+            orig_preprocess = super(State, self).preprocess
+            return cache.preprocess(self, orig_preprocess, reader, fullfilename, filename)
+
+    def parse_real():
+        state = State()
+        state.autoSetupSystemMacros()
+        cparser.parse(str(tmp_path / "u.c"), state)
+        assert not state._errors
+        return sorted(state.funcs), sorted(state.macros), state.funcs["twice"].defPos
+
+    expected = parse_real()
+    assert "offset" not in expected[0]
+    assert parse_real() == expected
+    assert (cache.hits, cache.misses) == (1, 1)
@@ -0,0 +1,159 @@
+"""
+Tests for lazy_parse, which keeps the top-level function bodies out of the parse until they are needed.
+The tokens here stand in for the cpre2 tokens, which lazy_parse matches by their class names.
+Like the cparser token classes, they are str subclasses.
+"""
+
+import pytest
+
+import lazy_parse
+
+
+class CToken(str):
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, str.__repr__(self))
+
+
+class CIdentifier(CToken):
+    pass
+
+
+class COpeningBracket(CToken):
+    pass
+
+
+class CClosingBracket(CToken):
+    pass
+
+
+class CSemicolon(CToken):
+    pass
+
+
+class COp(CToken):
+    pass
+
+
+class CNumber(CToken):
+    pass
+
+
+def tokenize(s):
+    """
+    :param str s: C code with all tokens separated by spaces
+    :rtype: list[CToken]
+    """
+    res = []
+    for part in s.split():
+        if part in "([{":
+            res.append(COpeningBracket(part))
+        elif part in ")]}":
+            res.append(CClosingBracket(part))
+        elif part == ";":
+            res.append(CSemicolon(part))
+        elif part.isdigit():
+            res.append(CNumber(part))
+        elif part[0].isalpha() or part[0] == "_":
+            res.append(CIdentifier(part))
+        else:
+            res.append(COp(part))
+    return res
+
+
+def untokenize(tokens):
+    return " ".join(tokens)
+
+
+class FakeState:
+
+    def __init__(self):
+        self.lazy_bodies = {}
+
+
+def test_bodies_are_kept_for_later():
+    state = FakeState()
+    tokens = tokenize(
+        "int x ; "
+        "static int f ( int a ) { if ( a ) { return 1 ; } return 0 ; } "
+        "int g ( void ) ; "
+        "void h ( void ) { } "
+        "int y = 3 ;")
+    res = list(lazy_parse.filter_function_bodies(state, tokens))
+    assert untokenize(res) == "int x ; static int f ( int a ) ; int g ( void ) ; void h ( void ) ; int y = 3 ;"
+    assert sorted(state.lazy_bodies) == ["f", "h"]
+    decl_tokens, body_tokens = state.lazy_bodies["f"]
+    assert untokenize(decl_tokens) == "static int f ( int a )"
+    assert untokenize(body_tokens) == "{ if ( a ) { return 1 ; } return 0 ; }"
+    assert untokenize(sum(state.lazy_bodies["h"], [])) == "void h ( void ) { }"
+
+
+def test_other_braces_are_not_bodies():
+    state = FakeState()
+    code = (
+        "int z ; "
+        "struct s { int a ; } ; "
+        "int arr [ 2 ] = { 1 , 2 } ; "
+        "static void ( * fp ( int a ) ) ( void ) { return 0 ; } "
+        "void k ( void ) { }")
+    res = list(lazy_parse.filter_function_bodies(state, tokenize(code)))
+    # The function returning a function pointer has two bracket groups, we keep it.
+    assert untokenize(res) == code.replace("void k ( void ) { }", "void k ( void ) ;")
+    assert sorted(state.lazy_bodies) == ["k"]
+
+
+def test_no_semicolon_token_yet():
+    # We replace the bodies by a real semicolon token of the stream, so before the first one, we keep them.
+    state = FakeState()
+    code = "void f ( void ) { } int x ; void g ( void ) { }"
+    res = list(lazy_parse.filter_function_bodies(state, tokenize(code)))
+    assert untokenize(res) == "void f ( void ) { } int x ; void g ( void ) ;"
+    assert sorted(state.lazy_bodies) == ["g"]
+    assert isinstance(res[-1], CSemicolon)
+
+
+def test_get_func_name():
+    assert lazy_parse._get_func_name(tokenize("int f ( int a , char * b )")) == "f"
+    assert lazy_parse._get_func_name(tokenize("( f ) ( void )")) is None
+    assert lazy_parse._get_func_name(tokenize("int x = ( 1 )")) is None
+
+
+class FakeInterpreter:
+
+    def __init__(self):
+        self._func_cache = {}
+        self.requested = []
+
+    def getFunc(self, funcname):
+        self.requested.append(funcname)
+        return funcname
+
+
+def test_install_without_pending_body():
+    state = FakeState()
+    interpreter = FakeInterpreter()
+    lazy_parse.install(interpreter, state)
+    assert interpreter.getFunc("f") == "f"
+    assert interpreter.requested == ["f"]
+    assert not lazy_parse.parse_func_body(state, "f")
+
+
+def test_real_cpre2_tokens(tmp_path):
+    cparser = pytest.importorskip("cparser")
+    src = tmp_path / "lazy.c"
+    # The first ";" comes before the bodies, see test_no_semicolon_token_yet.
+    src.write_text(
+        "int counter;\n"
+        "#define TWICE(x) ((x) * 2)\n"
+        "static int twice(int x) { return TWICE(x); }\n"
+        "int use(int x) { if (x) { return twice(x); } return 0; }\n")
+    state = cparser.State()
+    state.autoSetupSystemMacros()
+    state.lazy_bodies = {}
+    lazy_parse.parse_file(state, str(src))
+    assert not state._errors
+    assert sorted(state.lazy_bodies) == ["twice", "use"]
+    assert "use" in state.funcs
+    lazy_parse.parse_all_func_bodies(state)
+    assert not state.lazy_bodies
+    assert not state._errors
@@ -0,0 +1,149 @@
+"""
+Tests for lineprofiler, the line-level hit counts of the interpreted C code.
+"""
+
+import json
+
+import pytest
+
+from lineprofiler import LineProfiler, parse_pos
+
+
+class FakeFunc:
+
+    def __init__(self, def_pos):
+        self.defPos = def_pos
+
+
+class FakeState:
+
+    def __init__(self, funcs=None):
+        self.funcs = funcs or {}
+
+
+class FakeStatement:
+
+    def __init__(self, def_pos=None):
+        self.defPos = def_pos
+
+
+class FakeFuncAst:
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeFuncEnv:
+
+    def __init__(self, func_name):
+        self.astNode = FakeFuncAst(func_name)
+
+
+def test_parse_pos():
+    assert parse_pos("Objects/dictobject.c:123:4") == ("Objects/dictobject.c", 123)
+    assert parse_pos("foo.c:7") == ("foo.c", 7)
+    assert parse_pos("foo.c") is None
+    assert parse_pos(None) is None
+
+
+def test_hits_are_counted_per_line():
+    profiler = LineProfiler(FakeState())
+    a = profiler.get_pos_index(("a.c", 1))
+    b = profiler.get_pos_index(("a.c", 2))
+    c = profiler.get_pos_index(("b.c", 1))
+    assert profiler.get_pos_index(("a.c", 1)) == a
+    for _ in range(3):
+        profiler.hit(a)
+    profiler.hit(c)
+    assert profiler.counts[b] == 0
+    assert profiler.get_file_counts() == {"a.c": {1: 3}, "b.c": {1: 1}}
+
+
+def test_statement_without_pos_counts_for_its_function():
+    profiler = LineProfiler(FakeState({"f": FakeFunc("f.c:10:1")}))
+    func_env = FakeFuncEnv("f")
+    assert profiler._get_statement_pos(func_env, FakeStatement("f.c:12:5")) == ("f.c", 12)
+    assert profiler._get_statement_pos(func_env, FakeStatement()) == ("f.c", 10)
+    assert profiler._get_statement_pos(FakeFuncEnv("g"), FakeStatement()) is None
+
+
+def test_write_json(tmp_path):
+    profiler = LineProfiler(FakeState())
+    profiler.hit(profiler.get_pos_index(("a.c", 10)))
+    profiler.hit(profiler.get_pos_index(("a.c", 2)))
+    profiler.get_pos_index(("b.c", 1))
+    fn = str(tmp_path / "prof.json")
+    profiler.write_json(fn)
+    with open(fn) as f:
+        assert json.load(f) == {"files": {"a.c": {"2": 1, "10": 1}}}
+
+
+def test_write_annotated(tmp_path):
+    src = tmp_path / "a.c"
+    src.write_text("int x;\nint f() {\n  return x;\n}\n")
+    profiler = LineProfiler(FakeState())
+    for _ in range(5):
+        profiler.hit(profiler.get_pos_index((str(src), 3)))
+    profiler.hit(profiler.get_pos_index((str(tmp_path / "missing.c"), 7)))
+    fn = str(tmp_path / "prof.txt")
+    profiler.write_annotated(fn)
+    with open(fn) as f:
+        lines = f.read().splitlines()
+    assert "%s: 5 hits, 1 lines hit" % src in lines
+    assert "%10i | %s" % (5, "  return x;") in lines
+    assert "%10s | %s" % ("", "int x;") in lines
+    assert "%10i | %i" % (1, 7) in lines  # no source
+
+
+def test_uninstall_restores_the_translation():
+    interpreter_module = pytest.importorskip("cparser.interpreter")
+    orig = interpreter_module.cStatementToPyAst
+
+    class FakeInterpreter:
+        class helpers:
+            pass
+
+    profiler = LineProfiler(FakeState())
+    with profiler.installed(FakeInterpreter()):
+        assert interpreter_module.cStatementToPyAst is not orig
+    assert interpreter_module.cStatementToPyAst is orig
+
+
+SwitchSource = """
+int classify(int x) {
+    int r = 0;
+    switch (x) {
+    case 0: r += 1;
+    case 1: r += 10; break;
+    case 2:
+    case 3: r += 100;
+    default: r += 1000;
+    }
+    if (r > 1000) goto big;
+    return r;
+big:
+    return -r;
+}
+"""
+
+
+def test_switch_with_fallthrough_gives_same_results(tmp_path):
+    cparser = pytest.importorskip("cparser")
+    import cparser.interpreter
+    src = tmp_path / "switch.c"
+    src.write_text(SwitchSource)
+    state = cparser.State()
+    state.autoSetupSystemMacros()
+    cparser.parse(str(src), state)
+    assert not state._errors
+    plain = cparser.interpreter.Interpreter()
+    plain.register(state)
+    profiled = cparser.interpreter.Interpreter()
+    profiled.register(state)
+    profiler = LineProfiler(state)
+    with profiler.installed(profiled):
+        profiled.getFunc("classify")  # translated with the hit calls
+    for x in range(-1, 6):
+        assert profiled.runFunc("classify", x).value == plain.runFunc("classify", x).value, x
+    counts = profiler.get_file_counts()[str(src)]
+    assert sum(counts.values()) >= 7  # at least one statement per call
@@ -0,0 +1,45 @@
+import ctypes
+
+import native_bindings
+
+
+def test_bind_memcpy_strlen():
+    src = ctypes.create_string_buffer(b"hello")
+    dst = ctypes.create_string_buffer(10)
+    memcpy = native_bindings.bind("memcpy")
+    strlen = native_bindings.bind("strlen")
+    # Pointers as the interpreter has them, passed without conversion.
+    src_p = ctypes.cast(src, ctypes.POINTER(ctypes.c_char))
+    dst_p = ctypes.cast(dst, ctypes.POINTER(ctypes.c_char))
+    memcpy(dst_p, src_p, 6)
+    assert dst.value == b"hello"
+    assert strlen(dst_p) == 5
+    assert strlen(dst) == 5
+
+
+def test_bind_libm():
+    assert native_bindings.bind("sqrt")(2.0) == 2.0 ** 0.5
+    assert native_bindings.bind("fmod")(7.5, 2.0) == 1.5
+
+
+def test_bind_does_not_touch_shared_symbols():
+    lib = native_bindings.get_libs()[0]
+    shared_memset = lib.memset
+    native_bindings.bind("memset")
+    assert shared_memset.argtypes is None
+
+
+def test_rebind_keeps_restype():
+    char_p = ctypes.POINTER(ctypes.c_char)
+    wrapped = native_bindings.get_libs()[0]["memset"]
+    wrapped.restype = char_p
+    memset = native_bindings.rebind("memset", wrapped)
+    assert memset.restype is char_p and memset.argtypes == native_bindings.NativeBindings["memset"][1]
+    buf = ctypes.create_string_buffer(4)
+    res = memset(buf, ord("a"), 3)
+    assert isinstance(res, char_p) and res[1] == b"a"
+    assert ctypes.addressof(res.contents) == ctypes.addressof(buf)
+    strchr = native_bindings.get_libs()[0]["strchr"]
+    strchr.restype = char_p
+    assert not native_bindings.rebind("strchr", strchr)(buf, ord("z"))  # NULL pointer
+    assert native_bindings.rebind("memset", lambda *args: None) is None
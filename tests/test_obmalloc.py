@@ -8,6 +8,10 @@ C code run as-is through the interpreter.
 
 Each runFunc call is guarded with a timeout so a hung interpreter surfaces
 as a TimeoutError rather than an infinite wait.
+
+All tests run for all allocator backends: "c" interprets obmalloc.c as-is,
+"pool" uses the Python-native pool allocator (allocator.py), "heap" the
+mmap-backed heap (heap.py).
 """
 
 import sys
@@ -20,6 +24,8 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import cparser
 import cparser.interpreter
 from cpython import CPythonState  # re-use the CPython include-path setup
+import allocator
+import heap
 
 TIMEOUT = 10  # seconds per runFunc call
 
@@ -33,9 +39,8 @@ CPYTHON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__fil
 
 @pytest.fixture(scope="module")
 def obmalloc_state():
-    state = CPythonState()
-    state.macros["Py_BUILD_CORE"] = cparser.Macro(rightside="1")
-    state.macros["Py_BUILD_CORE_BUILTIN"] = cparser.Macro(rightside="1")
+    # Python.h and the Py_BUILD_CORE macros come from the precompiled prelude.
+    state = CPythonState.from_prelude(use_cache=False)
     cparser.parse(os.path.join(CPYTHON_DIR, "Objects", "obmalloc.c"), state)
     if state._errors:
         # Non-fatal parse errors can occur in the debug-malloc portions of
@@ -48,10 +53,14 @@ def obmalloc_state():
     return state
 
 
-@pytest.fixture(scope="module")
-def interp(obmalloc_state):
+@pytest.fixture(scope="module", params=["c", "pool", "heap"])
+def interp(request, obmalloc_state):
     interp = cparser.interpreter.Interpreter()
     interp.register(obmalloc_state)
+    if request.param == "pool":
+        allocator.install(interp, obmalloc_state)
+    elif request.param == "heap":
+        heap.install(interp, obmalloc_state)
     return interp
 
 
@@ -0,0 +1,203 @@
+"""
+Tests for the Python-native overrides.
+
+The differential tests run the interpreted C version of every override
+against the override itself, on random inputs.
+"""
+
+import ctypes
+import os
+import random
+import struct
+
+import pytest
+
+import overrides
+
+TIMEOUT = 10  # seconds per runFunc call
+
+CPYTHON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "CPython")
+
+
+# Reference vectors from the SipHash paper: key 00 01 .. 0f, message 00 01 .. (n-1).
+@pytest.mark.parametrize("length,expected", [
+    (0, 0x726fdb47dd0e0e31),
+    (1, 0x74f839c593dc67fd),
+    (2, 0x0d6c8009d9a94f5a),
+    (3, 0x85676696d7fb7e2d),
+    (63, 0x958a324ceb064572),
+])
+def test_siphash24_reference_vectors(length, expected):
+    k0, k1 = struct.unpack("<QQ", bytes(range(16)))
+    assert overrides.siphash24(k0, k1, bytes(range(length))) == expected
+
+
+def _c_hash_pointer(p):
+    # The C code of _Py_HashPointer, with the C integer types from ctypes:
+    #   size_t y = (size_t)p;
+    #   y = (y >> 4) | (y << (8 * SIZEOF_VOID_P - 4));
+    #   x = (Py_hash_t)y;
+    #   if (x == -1) x = -2;
+    y = ctypes.c_size_t(p).value
+    y = ctypes.c_size_t((y >> 4) | (y << (8 * ctypes.sizeof(ctypes.c_void_p) - 4))).value
+    x = ctypes.c_ssize_t(y).value
+    if x == -1:
+        x = -2
+    return x
+
+
+def test_hash_pointer_matches_c_formula():
+    bits = ctypes.sizeof(ctypes.c_void_p) * 8
+    rnd = random.Random(1)
+    addresses = [0, 1, 0xf, 0x10, 0x7fff1234abc0, (1 << bits) - 1, (1 << bits) - 0x10, 1 << (bits - 1)]
+    addresses += [rnd.getrandbits(bits) for _ in range(1000)]
+    for p in addresses:
+        assert overrides.hash_pointer(p) == _c_hash_pointer(p), hex(p)
+    assert overrides.hash_pointer((1 << bits) - 1) == -2  # -1 is reserved for errors
+
+
+def test_required_overrides_registered():
+    for name in ["Py_GetPrefix", "Py_GetPath", "_PyPathConfig_Calculate"]:
+        assert overrides.Overrides[name].required
+
+
+# The structs of Include/object.h, Include/unicodeobject.h, Include/dictobject.h and Objects/dict-common.h.
+class PyObject(ctypes.Structure):
+    _fields_ = [("ob_refcnt", ctypes.c_ssize_t), ("ob_type", ctypes.c_void_p)]
+
+
+class PyASCIIObject(ctypes.Structure):
+    _fields_ = [
+        ("ob_base", PyObject), ("length", ctypes.c_ssize_t), ("hash", ctypes.c_ssize_t), ("state", ctypes.c_uint),
+        ("wstr", ctypes.c_void_p)]
+
+
+class PyDictObject(ctypes.Structure):
+    _fields_ = [
+        ("ob_base", PyObject), ("ma_used", ctypes.c_ssize_t), ("ma_version_tag", ctypes.c_uint64),
+        ("ma_keys", ctypes.c_void_p), ("ma_values", ctypes.c_void_p)]
+
+
+class PyDictKeysObject(ctypes.Structure):
+    _fields_ = [
+        ("dk_refcnt", ctypes.c_ssize_t), ("dk_size", ctypes.c_ssize_t), ("dk_lookup", ctypes.c_void_p),
+        ("dk_usable", ctypes.c_ssize_t), ("dk_nentries", ctypes.c_ssize_t)]
+
+
+class PyDictKeyEntry(ctypes.Structure):
+    _fields_ = [("me_hash", ctypes.c_ssize_t), ("me_key", ctypes.c_void_p), ("me_value", ctypes.c_void_p)]
+
+
+def _get_str(address):
+    """
+    :param int address: compact ASCII str object
+    :rtype: str
+    """
+    obj = PyASCIIObject.from_address(address)
+    return ctypes.string_at(address + ctypes.sizeof(PyASCIIObject), obj.length).decode("ascii")
+
+
+class FakeDictFunc:
+    type = ctypes.c_ssize_t
+
+
+class FakeDictState:
+    typedefs = {
+        "PyObject": PyObject, "PyASCIIObject": PyASCIIObject, "PyDictObject": PyDictObject,
+        "PyDictKeysObject": PyDictKeysObject, "PyDictKeyEntry": PyDictKeyEntry, "Py_hash_t": ctypes.c_ssize_t}
+    funcs = {"lookdict_unicode": FakeDictFunc()}
+
+
+class FakeDictInterpreter:
+    """Only what lookdict_unicode and its input generator use."""
+
+    def __init__(self):
+        self.vars = {"PyUnicode_Type": ctypes.c_int(), "PyDict_Type": ctypes.c_int()}
+        self.globalScope = self
+        self.translated = []
+
+    def getVar(self, name):
+        return self.vars[name]
+
+    def getCType(self, t):
+        return t
+
+    def getFunc(self, funcname):
+        assert funcname == "unicode_eq"
+        return lambda a, b: ctypes.c_int(_get_str(overrides.get_address(a)) == _get_str(overrides.get_address(b)))
+
+    def _translateFuncToPy(self, funcname):
+        self.translated.append(funcname)
+        return lambda mp, key, key_hash, value_addr: ctypes.c_ssize_t(-3)
+
+
+def test_lookdict_unicode_finds_the_str_keys():
+    interp, state = FakeDictInterpreter(), FakeDictState()
+    func = overrides.create(interp, state, "lookdict_unicode")
+    found = 0
+    for mp, key, key_hash, value_addr in overrides.make_random_inputs(interp, state, "lookdict_unicode", count=300):
+        # Compare with a linear search over the entries.
+        keys = mp.contents.ma_keys
+        dk = PyDictKeysObject.from_address(keys)
+        index_size = ctypes.sizeof(overrides._dk_index_type(dk.dk_size))
+        entries = keys + ctypes.sizeof(PyDictKeysObject) + dk.dk_size * index_size
+        expected_ix, expected_value = -1, None
+        for ix in range(dk.dk_nentries):
+            entry = PyDictKeyEntry.from_address(entries + ix * ctypes.sizeof(PyDictKeyEntry))
+            if entry.me_key and _get_str(entry.me_key) == _get_str(overrides.get_address(key)):
+                expected_ix, expected_value = ix, entry.me_value
+        value_addr.contents = ctypes.cast(1, type(value_addr.contents))
+        assert func(mp, key, key_hash, value_addr).value == expected_ix
+        assert overrides.get_address(value_addr.contents) == (expected_value or 0)
+        found += expected_ix >= 0
+    assert 0 < found < 300
+    assert interp.translated == []
+
+
+def test_lookdict_unicode_other_keys_use_the_c_code():
+    interp, state = FakeDictInterpreter(), FakeDictState()
+    func = overrides.create(interp, state, "lookdict_unicode")
+    mp, key, key_hash, value_addr = overrides.make_random_inputs(interp, state, "lookdict_unicode", count=1)[0]
+    key.contents.ob_type = None  # not a str
+    assert func(mp, key, key_hash, value_addr).value == -3
+    assert interp.translated == ["lookdict_unicode"]
+
+
+# ---------------------------------------------------------------------------
+# Differential tests against the interpreted C code
+# ---------------------------------------------------------------------------
+
+DifferentialOverrides = [name for (name, o) in overrides.Overrides.items() if o.make_inputs]
+
+_states = {}  # c_files -> (state, interpreter)
+
+
+def _get_interpreter(c_files):
+    cparser = pytest.importorskip("cparser")
+    import cparser.interpreter
+    from cpython import CPythonState
+    if c_files not in _states:
+        state = CPythonState.from_prelude(use_cache=False)
+        for c_file in c_files:
+            cparser.parse(os.path.join(CPYTHON_DIR, c_file), state)
+        interp = cparser.interpreter.Interpreter()
+        interp.register(state)
+        _states[c_files] = (state, interp)
+    return _states[c_files]
+
+
+@pytest.mark.parametrize("name", DifferentialOverrides)
+def test_override_matches_c(name):
+    override = overrides.Overrides[name]
+    if not os.path.exists(os.path.join(CPYTHON_DIR, override.c_files[0])):
+        pytest.skip("CPython source not available")
+    state, interp = _get_interpreter(override.c_files)
+    if name not in state.funcs:
+        pytest.skip("%s not parsed" % name)
+    if "_Py_HashSecret" in state.vars:
+        secret = bytes(random.Random(1).getrandbits(8) for _ in range(16))
+        ctypes.memmove(overrides.get_var_address(interp, "_Py_HashSecret"), secret, 16)
+    func = overrides.create(interp, state, name)
+    for args in overrides.make_random_inputs(interp, state, name, count=50):
+        expected = interp.runFunc(name, *args, timeout=TIMEOUT)
+        assert func(*args).value == expected.value, "%s%r" % (name, args)
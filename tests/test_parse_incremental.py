@@ -0,0 +1,220 @@
+"""
+Tests for parse_incremental, which replays the parse units from their records.
+ToyState stands in for CPythonState. It parses a line-based toy language with the
+same kind of state changes as cparser: macros, includes, and structs which are
+forward-declared and completed in place later.
+"""
+
+import os
+
+import parse_cache
+import parse_incremental
+
+
+class ToyUnit:
+
+    def __init__(self, filename, macros=(), optional=False):
+        self.filename = filename
+        self.macros = list(macros)
+        self.optional = optional
+
+    def __repr__(self):
+        return "ToyUnit(%r, macros=%r, optional=%r)" % (self.filename, self.macros, self.optional)
+
+
+class ToyMacro:
+    # Like cparser.Macro.
+    def __init__(self, rightside):
+        self.args = None
+        self.rightside = rightside
+
+
+class Decl:
+
+    def __init__(self, name, body=None):
+        self.name = name
+        self.body = body
+
+
+class ToyState:
+    """
+    Lines of the toy language:
+
+      #define NAME VALUE...    #undef NAME    #include FILE    #ifdef NAME ... #endif
+      struct NAME [BODY...]    (without a body: forward declaration)
+      int NAME = VALUE...
+    """
+    parse_units = []  # type: list[ToyUnit]
+    src_dir = None  # type: str
+    lazy_function_bodies = False
+    num_parsed_files = 0
+
+    def __init__(self):
+        for container in parse_cache.StateContainers:
+            setattr(self, container, {})
+        self.contentlist, self._errors = [], []
+        self.included_files = set()
+        self.input_files = {}
+        self.unit_input_files = None
+        self.parsed_units = 0
+        self.unit_entry_digests = {}
+
+    def add_input_file(self, filename):
+        self.input_files[filename] = None
+        if self.unit_input_files is not None:
+            self.unit_input_files[filename] = None
+
+    def apply_unit_macros(self, unit):
+        for name, rightside in unit.macros:
+            if rightside is None:
+                self.macros.pop(name, None)
+            else:
+                self.macros[name] = ToyMacro(rightside)
+
+    def get_unit_filename(self, unit):
+        return os.path.join(self.src_dir, unit.filename)
+
+    def parse_unit(self, unit):
+        self.apply_unit_macros(unit)
+        self.unit_entry_digests[self.get_unit_filename(unit)] = parse_incremental.entry_digest(self)
+        self.parse_file(self.get_unit_filename(unit), optional=unit.optional)
+        self.parsed_units += 1
+
+    def parse_cpython(self):
+        for unit in self.parse_units[self.parsed_units:]:
+            self.parse_unit(unit)
+
+    def parse_file(self, filename, optional=False):
+        self.add_input_file(filename)
+        if optional and not os.path.exists(filename):
+            return
+        type(self).num_parsed_files += 1
+        self._parse_lines(filename)
+
+    def _expand(self, words):
+        return " ".join(self.macros[w].rightside if w in self.macros else w for w in words)
+
+    def _parse_lines(self, filename):
+        skipping = False
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        for line in lines:
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == "#endif":
+                skipping = False
+            elif skipping:
+                continue
+            elif words[0] == "#ifdef":
+                skipping = words[1] not in self.macros
+            elif words[0] == "#define":
+                self.macros[words[1]] = ToyMacro(" ".join(words[2:]))
+            elif words[0] == "#undef":
+                self.macros.pop(words[1], None)
+            elif words[0] == "#include":
+                fn = os.path.join(self.src_dir, words[1])
+                self.add_input_file(fn)
+                if fn not in self.included_files:
+                    self.included_files.add(fn)
+                    self._parse_lines(fn)
+            elif words[0] == "struct":
+                struct = self.structs.get(words[1])
+                if struct is None:
+                    struct = self.structs[words[1]] = Decl(words[1])
+                    self.contentlist.append(struct)
+                if len(words) > 2:
+                    struct.body = self._expand(words[2:])  # completed in place, like cparser
+            elif words[0] == "int":
+                self.vars[words[1]] = Decl(words[1], body=self._expand(words[3:]))
+                self.contentlist.append(self.vars[words[1]])
+            else:
+                self._errors.append("%s: cannot parse %r" % (filename, line))
+
+
+def write_files(src_dir, files):
+    """
+    :param str src_dir:
+    :param dict[str,str] files: filename -> content
+    """
+    for fn, content in files.items():
+        with open(os.path.join(src_dir, fn), "w") as f:
+            f.write(content)
+
+
+def dump_state(state):
+    """
+    :param ToyState state:
+    :return: the declarations and macros of the state, comparable between states
+    :rtype: dict[str]
+    """
+    res = {container: {name: (type(obj).__name__, sorted(vars(obj).items()))
+                       for (name, obj) in getattr(state, container).items()}
+           for container in parse_cache.StateContainers}
+    res["contentlist"] = [(type(obj).__name__, obj.name) for obj in state.contentlist]
+    res["errors"] = list(state._errors)
+    res["included_files"] = sorted(state.included_files)
+    return res
+
+
+def make_state_type(tmp_path, monkeypatch, units):
+    """
+    :param tmp_path:
+    :param monkeypatch:
+    :param list[ToyUnit] units:
+    :return: ToyState subclass with these parse units, and the caches in tmp_path
+    :rtype: type
+    """
+    src_dir = tmp_path / "src"
+    src_dir.mkdir()
+    state_type = type("ToyState", (ToyState,), {"parse_units": units, "src_dir": str(src_dir)})
+    monkeypatch.setattr(parse_cache, "CacheDir", str(tmp_path / "cache"))
+    monkeypatch.setitem(parse_cache._recipe_digests, (state_type, False), "toy-recipe")
+    return state_type
+
+
+def test_replays_struct_completed_in_later_unit(tmp_path, monkeypatch):
+    state_type = make_state_type(tmp_path, monkeypatch, [
+        ToyUnit("Python.h"), ToyUnit("a.c"), ToyUnit("b.c")])
+    write_files(state_type.src_dir, {
+        "Python.h": "#define SIZE 8\n",
+        "a.c": "struct S\n",
+        "b.c": "struct S char data [ SIZE ]\nint x = SIZE\n"})
+    serial = state_type()
+    serial.parse_cpython()
+    parsed = state_type()
+    parse_incremental.parse_cpython(parsed)
+    assert state_type.num_parsed_files == 6
+    replayed = state_type()
+    parse_incremental.parse_cpython(replayed)
+    assert state_type.num_parsed_files == 6
+    assert replayed.structs["S"].body == "char data [ 8 ]"
+    assert replayed.contentlist == [replayed.structs["S"], replayed.vars["x"]]
+    assert dump_state(replayed) == dump_state(parsed) == dump_state(serial)
+
+
+def test_reparses_from_changed_unit(tmp_path, monkeypatch):
+    state_type = make_state_type(tmp_path, monkeypatch, [
+        ToyUnit("Python.h"), ToyUnit("a.c", [("SIZE", "16")]), ToyUnit("b.c")])
+    write_files(state_type.src_dir, {
+        "Python.h": "#define SIZE 8\n",
+        "a.c": "struct S\n",
+        "b.c": "struct S char data [ SIZE ]\n"})
+    parse_incremental.parse_cpython(state_type())
+    write_files(state_type.src_dir, {"a.c": "#define SIZE 32\nstruct S\n"})
+    state = state_type()
+    parse_incremental.parse_cpython(state)
+    assert state_type.num_parsed_files == 3 + 2
+    assert state.structs["S"].body == "char data [ 32 ]"
+
+
+def test_entry_digest_covers_completed_decls():
+    state = ToyState()
+    state.structs["S"] = Decl("S")
+    state.funcs["f"] = Decl("f")
+    digest = parse_incremental.entry_digest(state)
+    state.structs["S"].body = "int x"
+    assert parse_incremental.entry_digest(state) != digest
+    digest = parse_incremental.entry_digest(state)
+    state.funcs["f"].body = "return 0"
+    assert parse_incremental.entry_digest(state) != digest
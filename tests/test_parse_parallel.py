@@ -0,0 +1,45 @@
+"""
+Tests for parse_parallel. The units are parsed in forked workers from the prelude,
+and the merged state must be the same as the one of the serial parse.
+"""
+
+import parse_parallel
+from test_parse_incremental import ToyUnit, dump_state, make_state_type, write_files
+
+
+def test_parallel_parse_equals_serial(tmp_path, monkeypatch):
+    state_type = make_state_type(tmp_path, monkeypatch, [
+        ToyUnit("Python.h"), ToyUnit("a.c"), ToyUnit("b.c"), ToyUnit("c.c", [("SIZE", "4")]),
+        ToyUnit("d.c"), ToyUnit("e.c")])
+    write_files(state_type.src_dir, {
+        "Python.h": "struct S\n",
+        "common.h": "struct Common int z\n",
+        "a.c": "#define SIZE 32\n#include common.h\nint a = 1\n",
+        # Depends on the macro of a.c.
+        "b.c": "#ifdef SIZE\nint b = SIZE\n#endif\n",
+        # Only depends on its own unit macro.
+        "c.c": "int c = SIZE\n",
+        # Depends on the include of a.c.
+        "d.c": "#include common.h\nint d = 2\n",
+        # Completes the prelude struct in place.
+        "e.c": "struct S int x\n"})
+    serial = state_type()
+    serial.parse_cpython()
+    assert serial.vars["b"].body == "32" and serial.vars["c"].body == "4"
+    state_type.num_parsed_files = 0
+    state = state_type()
+    parse_parallel.parse_cpython(state, jobs=3)
+    # The prelude, and b.c and d.c again in the parent. The others only in the workers.
+    assert state_type.num_parsed_files == 3
+    assert state.parsed_units == len(state_type.parse_units)
+    assert dump_state(state) == dump_state(serial)
+    assert state.unit_entry_digests == serial.unit_entry_digests
+
+
+def test_recording_dict():
+    d = parse_parallel.RecordingDict({"a": 1, "b": 2})
+    assert "x" not in d and d.get("a") == 1
+    d["c"] = 3
+    assert d.reads == {"x", "a"}
+    list(d.items())
+    assert d.reads == {"x", "a", "b", "c"}
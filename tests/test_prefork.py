@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+import sys
+import time
+
+import pytest
+
+import prefork
+
+
+class FakeInterpreter:
+    """
+    Py_Main prints its args and the translated funcs, and translates func_<arg> for every arg.
+    """
+
+    def __init__(self):
+        self._func_cache = {"Py_Main": None}
+        self.globals_touched = False
+
+    def getFunc(self, name):
+        self._func_cache[name] = None
+
+    def runFunc(self, name, argc, argv):
+        assert name == "Py_Main" and argv[-1] is None and argc == len(argv) - 1
+        if "fresh" in argv:
+            assert not self.globals_touched
+        self.globals_touched = True
+        line = "%s %s %s\n" % (argv[1:-1], sorted(self._func_cache), os.read(0, 100).decode("utf8"))
+        os.write(1, line.encode("utf8"))
+        for arg in argv[1:-1]:
+            self.getFunc("func_" + arg)
+        if "exit" in argv:
+            sys.exit(3)
+        if "fail" in argv:
+            raise Exception("failed")
+        return len(argv) - 2
+
+
+def _serve(socket_path):
+    prefork.PreforkServer(FakeInterpreter(), socket_path, base_argv=["cpython.py"], jobs=2).serve()
+
+
+@pytest.fixture
+def server(tmp_path):
+    socket_path = str(tmp_path / "prefork.sock")
+    proc = multiprocessing.get_context("fork").Process(target=_serve, args=(socket_path,))
+    proc.start()
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.05)
+    yield socket_path
+    prefork.shutdown(socket_path)
+    proc.join(10)
+    assert proc.exitcode == 0
+
+
+def test_run_and_learn(server):
+    res = prefork.submit(server, ["a", "b"], stdin="in", timeout=10)
+    assert res["exit_code"] == 2 and res["error"] is None
+    assert res["stdout"] == "['a', 'b'] ['Py_Main'] in\n"
+    res = prefork.submit(server, ["fresh"], timeout=10)
+    assert res["exit_code"] == 1
+    assert res["stdout"] == "['fresh'] ['Py_Main', 'func_a', 'func_b'] \n"
+
+
+def test_exit_and_error(server):
+    res = prefork.submit(server, ["exit"], timeout=10)
+    assert res["exit_code"] == 3 and res["error"] is None
+    res = prefork.submit(server, ["fail"], timeout=10)
+    assert res["exit_code"] == 1 and "failed" in res["error"]
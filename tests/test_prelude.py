@@ -0,0 +1,61 @@
+import parse_cache
+import prelude
+
+
+class WrapValue:
+    # Like cparser.CWrapValue: part of every fresh state, and not picklable.
+    def __init__(self, value):
+        self.value = value
+
+
+class Decl:
+    def __init__(self, name, callee):
+        self.name = name
+        self.callee = callee
+
+
+class FakeState:
+    parse_units = ["Python.h", "a.c"]
+    num_parsed = 0
+    num_created = 0
+
+    def __init__(self):
+        # Like autoSetupSystemMacros and autoSetupGlobalIncludeWrappers, which new_state() skips.
+        type(self).num_created += 1
+        for key in parse_cache.StateAttribs:
+            setattr(self, key, {})
+        self.contentlist, self._errors, self.input_files = [], [], []
+        self.parsed_units = 0
+        self.funcs["memcpy"] = WrapValue(lambda *args: None)
+        self.funcs["memmove"] = Decl("memmove", self.funcs["memcpy"])
+
+    def parse_unit(self, unit):
+        type(self).num_parsed += 1
+        self.funcs["f"] = Decl("f", self.funcs["memcpy"])
+        self.contentlist.append(self.funcs["f"])
+        self.parsed_units += 1
+
+
+def test_states_do_not_share_objects():
+    s1 = prelude.new_state(FakeState, use_cache=False)
+    s2 = prelude.new_state(FakeState, use_cache=False)
+    assert FakeState.num_parsed == 1
+    assert FakeState.num_created == 1
+    for s in [s1, s2]:
+        assert s.parsed_units == 1
+        assert s.contentlist == [s.funcs["f"]]
+        assert s.funcs["f"].callee is s.funcs["memcpy"]
+        assert s.funcs["memmove"].callee is s.funcs["memcpy"]
+    assert s1.funcs["f"] is not s2.funcs["f"]
+    assert s1.funcs["memcpy"] is not s2.funcs["memcpy"]
+    s1.funcs["memcpy"].value = None  # like native_bindings.install
+    s1.funcs["f"].name = "g"  # like compile_to_py fix_name
+    assert s2.funcs["memcpy"].value is not None and s2.funcs["f"].name == "f"
+
+
+def test_load_into_returns_own_table():
+    state = FakeState()
+    memcpy = state.funcs["memcpy"]
+    table = prelude.load_into(state, use_cache=False)
+    assert state.funcs["memcpy"] is memcpy and state.funcs["f"].callee is memcpy
+    assert table[id(memcpy)] == (("funcs", "memcpy"), memcpy)
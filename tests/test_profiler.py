@@ -0,0 +1,93 @@
+import io
+import pstats
+
+from profiler import Profiler
+
+
+class FakeInterpreter:
+    """Resolves functions by name like cparser.interpreter.Interpreter.getFunc()."""
+
+    def __init__(self, funcs):
+        self.funcs = funcs
+        self._func_cache = {}
+
+    def getFunc(self, funcname):
+        if funcname not in self._func_cache:
+            self._func_cache[funcname] = self.funcs[funcname]
+        return self._func_cache[funcname]
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _make_interpreter(clock):
+    interpreter = None
+
+    def leaf():
+        clock.now += 1.0
+
+    def fib(n):
+        clock.now += 0.5
+        if n > 0:
+            interpreter.getFunc("fib")(n - 1)
+
+    def main():
+        clock.now += 2.0
+        interpreter.getFunc("leaf")()
+        interpreter.getFunc("leaf")()
+        interpreter.getFunc("fib")(2)
+
+    main.C_resType = "int"
+    interpreter = FakeInterpreter({"main": main, "leaf": leaf, "fib": fib})
+    return interpreter
+
+
+def test_profiler_times():
+    clock = FakeClock()
+    interpreter = _make_interpreter(clock)
+    profiler = Profiler(timer=clock)
+    profiler.install(interpreter)
+    interpreter.getFunc("main")()
+    stats = profiler.get_pstats_dict()
+    main_key, leaf_key, fib_key = ("~", 0, "main"), ("~", 0, "leaf"), ("~", 0, "fib")
+    assert stats[main_key][:4] == (1, 1, 2.0, 5.5)
+    assert stats[leaf_key][:4] == (2, 2, 2.0, 2.0)
+    assert stats[leaf_key][4] == {main_key: (2, 2, 2.0, 2.0)}
+    # Recursive: 3 calls, 1 primitive, inclusive time only from the outermost call.
+    assert stats[fib_key][:4] == (1, 3, 1.5, 1.5)
+    assert stats[fib_key][4][main_key] == (1, 1, 0.5, 1.5)
+    assert stats[fib_key][4][fib_key][:2] == (0, 2)
+
+
+def test_profiler_keeps_func_attribs():
+    clock = FakeClock()
+    interpreter = _make_interpreter(clock)
+    profiler = Profiler(timer=clock)
+    profiler.install(interpreter)
+    main = interpreter.getFunc("main")
+    assert main.C_resType == "int"
+    assert interpreter.getFunc("main") is main
+    assert interpreter._func_cache["main"] is main
+
+
+def test_profiler_pstats_file(tmp_path):
+    clock = FakeClock()
+    interpreter = _make_interpreter(clock)
+    profiler = Profiler(timer=clock)
+    profiler.install(interpreter)
+    interpreter.getFunc("main")()
+    fn = str(tmp_path / "out.prof")
+    profiler.write_pstats(fn)
+    s = pstats.Stats(fn)
+    assert s.total_calls == 6
+    out = io.StringIO()
+    profiler.print_summary(top=2, file=out)
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 4
+    assert lines[2].split()[-2] in ("main", "leaf")
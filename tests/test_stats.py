@@ -0,0 +1,65 @@
+import io
+import json
+import tracemalloc
+
+from stats import PhaseStats
+
+
+def test_phases_nested_memory():
+    stats = PhaseStats()
+    stats.enable(trace_memory=True)
+    with stats.phase("outer"):
+        with stats.phase("inner"):
+            data = bytearray(4 * 1024 * 1024)
+            del data
+        kept = [bytearray(1024 * 1024)]
+    outer, inner = stats.records
+    assert (outer.name, outer.depth, inner.depth) == ("outer", 0, 1)
+    assert inner.mem_peak >= 4 * 1024 * 1024
+    assert inner.mem_allocated < 1024 * 1024
+    # The peak of the inner phase also counts for the outer one.
+    assert outer.mem_peak >= inner.mem_peak
+    assert outer.mem_allocated >= 1024 * 1024
+    assert outer.duration >= inner.duration
+    del kept
+    tracemalloc.stop()
+
+
+def test_phase_exception_and_output(tmp_path):
+    stats = PhaseStats()
+    stats.enable(trace_memory=False)
+    try:
+        with stats.phase("run"):
+            raise SystemExit(0)
+    except SystemExit:
+        pass
+    assert stats.records[0].exception == "SystemExit"
+    out = io.StringIO()
+    stats.print_table(file=out)
+    assert "run (SystemExit)" in out.getvalue()
+    fn = str(tmp_path / "stats.json")
+    stats.write_json(fn)
+    with open(fn) as f:
+        assert json.load(f)["phases"][0]["name"] == "run"
+
+
+def test_disabled_records_nothing():
+    stats = PhaseStats()
+    with stats.phase("x"):
+        pass
+    assert stats.records == []
+
+
+def test_objects_only_top_level():
+    stats = PhaseStats()
+    stats.enable(trace_memory=False)
+    with stats.phase("outer"):
+        with stats.phase("inner"):
+            kept = [[] for _ in range(1000)]
+    outer, inner = stats.records
+    assert inner.objects is None
+    assert outer.objects > 500
+    out = io.StringIO()
+    stats.print_table(file=out)
+    assert out.getvalue().splitlines()[2].split()[-1] == "-"
+    del kept
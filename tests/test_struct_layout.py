@@ -0,0 +1,214 @@
+import ast
+import ctypes
+
+import pytest
+
+import struct_layout
+
+
+class WrappedSsize(ctypes.c_ssize_t):
+    pass
+
+
+class TypeObject(ctypes.Structure):
+    _fields_ = [("ob_refcnt", ctypes.c_ssize_t), ("tp_flags", ctypes.c_ulong), ("tp_basicsize", ctypes.c_int)]
+
+
+class Object(ctypes.Structure):
+    _fields_ = [
+        ("ob_refcnt", WrappedSsize), ("ob_type", ctypes.POINTER(TypeObject)), ("data", ctypes.c_byte * 3),
+        ("flag", ctypes.c_uint, 3), ("value", ctypes.c_double)]
+
+
+def test_layout():
+    layout = struct_layout.get_layout(Object)
+    assert layout is struct_layout.get_layout(Object)
+    assert sorted(layout.fields) == ["data", "ob_refcnt", "ob_type", "value"]
+    for name in layout.fields:
+        assert layout.fields[name].offset == getattr(Object, name).offset
+    assert layout.fields["ob_refcnt"].is_scalar and layout.fields["ob_type"].is_scalar
+    assert not layout.fields["data"].is_scalar
+
+
+def test_read_write():
+    tp = TypeObject(1, 0x40000, 32)
+    ob = Object(WrappedSsize(5), ctypes.pointer(tp))
+    ob.value = 1.5
+    ob_addr = struct_layout.get_pointer_address(ctypes.pointer(ob))
+    assert ob_addr == ctypes.addressof(ob)
+    get_refcnt = struct_layout.make_field_getter(Object, "ob_refcnt")
+    set_refcnt = struct_layout.make_field_setter(Object, "ob_refcnt")
+    set_refcnt(ob_addr, get_refcnt(ob_addr) + 1)
+    assert ob.ob_refcnt.value == 6
+    layout = struct_layout.get_layout(Object)
+    assert layout.fields["value"].read(ob_addr) == 1.5
+    tp_addr = layout.fields["ob_type"].read(ob_addr)
+    assert tp_addr == ctypes.addressof(tp)
+    assert struct_layout.make_field_getter(TypeObject, "tp_flags")(tp_addr) == 0x40000
+    layout.fields["value"].write(ob_addr, -2.0)
+    assert ob.value == -2.0
+
+
+def test_write_wraps_around():
+    tp = TypeObject(1, 0x40000, 32)
+    tp_addr = ctypes.addressof(tp)
+    set_flags = struct_layout.make_field_setter(TypeObject, "tp_flags")
+    set_flags(tp_addr, tp.tp_flags & ~0x40000)
+    assert tp.tp_flags == 0
+    set_flags(tp_addr, ~0x40000)  # tp_flags &= ~X, with a negative Python int
+    assert tp.tp_flags == ctypes.c_ulong(~0x40000).value
+    set_basicsize = struct_layout.make_field_setter(TypeObject, "tp_basicsize")
+    set_basicsize(tp_addr, 2 ** 31)
+    assert tp.tp_basicsize == -2 ** 31
+    struct_layout.get_layout(TypeObject).fields["tp_basicsize"].write(tp_addr, -1)
+    assert tp.tp_basicsize == -1
+
+
+class WrappedUbyte(ctypes.c_ubyte):
+    pass
+
+
+class WrappedDouble(ctypes.c_double):
+    pass
+
+
+class Counters(ctypes.Structure):
+    _fields_ = [
+        ("ob_refcnt", WrappedSsize), ("small", WrappedUbyte), ("ratio", WrappedDouble), ("plain", ctypes.c_int),
+        ("ob_type", ctypes.POINTER(TypeObject))]
+
+
+class FakeHelpers:
+    """The inc helpers of the translated code, with the semantics of cparser.interpreter.Helpers."""
+
+    @staticmethod
+    def postInc(a):
+        old = type(a)(a.value)
+        a.value += 1
+        return old
+
+    @staticmethod
+    def prefixInc(a):
+        a.value += 1
+        return a
+
+    @staticmethod
+    def postDec(a):
+        old = type(a)(a.value)
+        a.value -= 1
+        return old
+
+    @staticmethod
+    def prefixDec(a):
+        a.value -= 1
+        return a
+
+
+# Like the translated code of cparser.interpreter, e.g. of Py_INCREF and Py_DECREF.
+Source = """
+def f(op, n):
+    res = []
+    for _ in range(n):
+        helpers.postInc(op.contents.ob_refcnt)
+        helpers.prefixInc(op.contents.small)
+        helpers.postDec(op.contents.ratio)
+        res.append(helpers.prefixDec(op.contents.ob_refcnt).value)
+        res.append(helpers.postInc(op.contents.small).value)
+        res.append(helpers.prefixInc(op.contents.ratio).value)
+    res.append(op.contents.ob_refcnt.value)
+    return res
+
+
+def inc_plain(op):
+    helpers.postInc(op.contents.plain)
+
+
+def inc_pointer(op):
+    helpers.postInc(op.contents.ob_type)
+"""
+
+
+def _compile(module_ast, helpers):
+    ns = {"helpers": helpers}
+    exec(compile(ast.fix_missing_locations(module_ast), "<test>", "exec"), ns)
+    return ns
+
+
+def _new_counters():
+    return Counters(WrappedSsize(3), WrappedUbyte(250), WrappedDouble(0.25))
+
+
+def test_access_pass_same_behavior():
+    module_ast = ast.parse(Source)
+    access_pass = struct_layout.StructAccessPass()
+    assert [access_pass.transform_func(func_ast) for func_ast in module_ast.body] == [6, 1, 1]
+    assert access_pass.num_rewritten_by_func == {"f": 6, "inc_plain": 1, "inc_pointer": 1}
+    source = ast.unparse(module_ast.body[0])
+    assert "Inc(" not in source and "Dec(" not in source
+    assert "op.contents.ob_refcnt.value" in source  # plain reads stay
+
+    class Helpers(FakeHelpers):
+        pass
+    Helpers.struct_field_inc = struct_layout.StructFieldAccess(Helpers).inc
+    orig_ns = _compile(ast.parse(Source), FakeHelpers)
+    ns = _compile(module_ast, Helpers)
+
+    for n in [0, 1, 10]:  # small wraps around at 255
+        orig_ob, ob = _new_counters(), _new_counters()
+        expected = orig_ns["f"](ctypes.pointer(orig_ob), n)
+        assert ns["f"](ctypes.pointer(ob), n) == expected
+        assert [(ob.ob_refcnt.value, ob.small.value, ob.ratio.value)] == [
+            (orig_ob.ob_refcnt.value, orig_ob.small.value, orig_ob.ratio.value)]
+
+    # Through the original helpers: the fundamental types give plain ints, which they don't accept.
+    for name in ["inc_plain", "inc_pointer"]:
+        with pytest.raises(AttributeError):
+            orig_ns[name](ctypes.pointer(_new_counters()))
+        with pytest.raises(AttributeError):
+            ns[name](ctypes.pointer(_new_counters()))
+
+    with pytest.raises(ValueError, match="NULL pointer access"):
+        orig_ns["f"](ctypes.POINTER(Counters)(), 1)
+    with pytest.raises(ValueError, match="NULL pointer access"):
+        ns["f"](ctypes.POINTER(Counters)(), 1)
+
+
+def test_access_pass_keeps_other_accesses():
+    access_pass = struct_layout.StructAccessPass()
+    for source in [
+            "def f(op):\n    return op.contents.ob_refcnt.value",
+            "def f(op):\n    op.contents.ob_refcnt.value = 1",
+            "def f(op, x):\n    helpers.assign(op.contents.ob_refcnt, x)",
+            "def f(x):\n    helpers.postInc(x)",
+            "def f(op):\n    return helpers.postInc(op.contents.ob_refcnt)"]:
+        module_ast = ast.parse(source)
+        dump = ast.dump(module_ast)
+        assert access_pass.transform_func(module_ast.body[0]) == 0, source
+        assert ast.dump(module_ast) == dump
+
+
+
+class WrappedFloat(ctypes.c_float):
+    pass
+
+
+def test_fallback_is_cached():
+    calls = []
+
+    class CountingAccess(struct_layout.StructFieldAccess):
+        def _get_field(self, ptr_type, name):
+            calls.append((ptr_type, name))
+            return super()._get_field(ptr_type, name)
+
+    class Holder(ctypes.Structure):
+        _fields_ = [("ob_refcnt", WrappedSsize), ("scale", WrappedFloat)]
+
+    access = CountingAccess(FakeHelpers)
+    holder = Holder(WrappedSsize(0), WrappedFloat(0.5))
+    p = ctypes.pointer(holder)
+    for _ in range(3):
+        access.inc(p, "ob_refcnt", 1)
+        assert access.inc(p, "scale", 1, post=False) == holder.scale.value  # float: through the helper
+    assert (holder.ob_refcnt.value, holder.scale.value) == (3, 3.5)
+    assert access._fields["scale"][ctypes.POINTER(Holder)] is None
+    assert calls == [(ctypes.POINTER(Holder), "ob_refcnt"), (ctypes.POINTER(Holder), "scale")]
@@ -0,0 +1,221 @@
+import ast
+import ctypes
+import re
+
+import pytest
+
+from switch_dispatch import SwitchLowering
+
+
+class FakeInterpreter:
+    globalsDict = {"ctypes": ctypes, "ctypes_wrapped": ctypes}
+
+
+Source = """
+def f(ops):
+    out = []
+    for op in ops:
+        if op.value == 1:
+            out.append("one")
+        elif op.value == ctypes_wrapped.c_int(2).value:
+            out.append("two")
+            continue
+        elif op.value == 3 or 4 == op.value:
+            out.append("three or four")
+        elif op.value == 10:
+            if op.value == 10:
+                out.append("ten")
+        elif op.value == 20:
+            break
+        elif op.value == 21:
+            pass
+        elif op.value == 1:
+            out.append("unreachable")
+        elif op.value == 30:
+            out.append("thirty")
+        elif op.value == 31:
+            return out + ["return"]
+        else:
+            out.append("default %i" % op.value)
+        out.append("after")
+    return out
+"""
+
+
+def compile_func(module_ast):
+    ns = {"ctypes_wrapped": ctypes}
+    exec(compile(ast.fix_missing_locations(module_ast), "<test>", "exec"), ns)
+    return ns["f"]
+
+
+def test_lowering_same_behavior():
+    module_ast = ast.parse(Source)
+    orig_func = compile_func(ast.parse(Source))
+    lowering = SwitchLowering(FakeInterpreter())
+    lowering.transform_func(module_ast.body[0])
+    assert lowering.num_lowered == 1 and lowering.num_lowered_by_func == {"f": 1}
+    assert not any(isinstance(node, ast.BoolOp) and isinstance(node.op, ast.Or) for node in ast.walk(module_ast))
+    func = compile_func(module_ast)
+    for values in [range(-2, 35), [1, 2, 3, 4, 10, 21, 30, 5], [31, 1], [20, 1], [ctypes.c_uint(2 ** 32 - 1).value]]:
+        ops = [ctypes.c_int(v) for v in values]
+        assert func(ops) == orig_func(ops)
+
+
+def test_short_or_impure_chains_not_lowered():
+    lowering = SwitchLowering(FakeInterpreter())
+    for source in [
+            "if x == 1: pass\nelif x == 2: pass",
+            "\n".join(["if f() == 0: pass"] + ["elif f() == %i: pass" % i for i in range(1, 10)]),
+            "\n".join(["if x == 0: pass"] + ["elif x == %i: pass" % i for i in range(1, 9)] + ["elif y: pass"]),
+            "\n".join(["if x == 0: pass"] + ["elif x == %i: pass" % i for i in range(1, 10)] + ["elif x == -1: pass"])]:
+        module_ast = ast.parse(source)
+        assert lowering.transform_stmts(module_ast.body) == module_ast.body
+    assert lowering.num_lowered == 0
+
+
+def test_non_int_subjects_take_default():
+    source = "\n".join(
+        ["def f(x):", "    if x == 0:", "        return 0"] +
+        ["    elif x == %i:\n        return %i" % (i, i) for i in range(1, 10)] +
+        ["    else:", "        return 'default'"])
+    module_ast = ast.parse(source)
+    orig_func = compile_func(ast.parse(source))
+    lowering = SwitchLowering(FakeInterpreter())
+    lowering.transform_func(module_ast.body[0])
+    assert lowering.num_lowered == 1
+    func = compile_func(module_ast)
+    # char values are bytes, and ctypes objects only compare equal to themselves.
+    for x in [b"\x03", b"a", None, "3", ctypes.c_int(3), 3.0, 3.5, True, float("nan"), 9, 10]:
+        assert func(x) == orig_func(x), x
+
+
+def test_ctypes_case_values_not_lowered():
+    source = "\n".join(["if x == 0: pass"] + ["elif x == ctypes_wrapped.c_int(%i): pass" % i for i in range(1, 10)])
+    module_ast = ast.parse(source)
+    lowering = SwitchLowering(FakeInterpreter())
+    assert lowering.transform_stmts(module_ast.body) == module_ast.body
+
+
+# Like the translation of a C switch by cparser.interpreter, with a nested switch.
+FallthroughSource = """
+def f(ops):
+    out = []
+    for op in ops:
+        while True:
+            _switchvalue = op.value
+            _switchfallthrough = False
+            if _switchfallthrough or _switchvalue == 1:
+                _switchfallthrough = True
+                out.append("one")
+            if _switchfallthrough or _switchvalue == 2 or _switchvalue == 3:
+                _switchfallthrough = True
+                out.append("two or three")
+                break
+            if _switchfallthrough or _switchvalue == 4:
+                _switchfallthrough = True
+                while True:
+                    _switchvalue2 = len(out)
+                    _switchfallthrough2 = False
+                    if _switchfallthrough2 or _switchvalue2 == 0:
+                        _switchfallthrough2 = True
+                        out.append("first")
+                        break
+                    if _switchfallthrough2 or _switchvalue2 == 1:
+                        _switchfallthrough2 = True
+                        out.append("second")
+                    break
+            if _switchfallthrough or _switchvalue == 5:
+                _switchfallthrough = True
+                out.append("five")
+            if _switchfallthrough or _switchvalue == 6:
+                _switchfallthrough = True
+            if _switchfallthrough or _switchvalue == 7:
+                _switchfallthrough = True
+                out.append("seven")
+                break
+            if _switchfallthrough or _switchvalue == 8 or _switchvalue == 1:
+                _switchfallthrough = True
+                out.append("eight")
+            if _switchfallthrough or _switchvalue == %i:
+                _switchfallthrough = True
+                return out + ["big"]
+            if _switchfallthrough or _switchvalue == 9:
+                _switchfallthrough = True
+                out.append("nine")
+                break
+            if _switchfallthrough or not out:
+                _switchfallthrough = True
+                out.append("default")
+            break
+        out.append("after")
+    return out
+"""
+
+
+@pytest.mark.parametrize("big", [40, 100000])  # dense and sparse table
+def test_fallthrough_lowering_same_behavior(big):
+    source = FallthroughSource % big
+    module_ast = ast.parse(source)
+    orig_func = compile_func(ast.parse(source))
+    lowering = SwitchLowering(FakeInterpreter())
+    lowering.transform_func(module_ast.body[0])
+    assert lowering.num_lowered == 1
+    source = ast.unparse(module_ast)
+    assert "_switchfallthrough or not out" in source  # not a case block, stays
+    assert not re.search(r"_switchfallthrough or _switchvalue ==", source)
+    assert "_switchfallthrough2 or _switchvalue2 ==" in source  # too short
+    func = compile_func(module_ast)
+    for values in [range(-2, 45), [8, 1, 6, 5, 4, 4], [big, 1], [100000, 40, 39], [9, 0]]:
+        ops = [ctypes.c_int(v) for v in values]
+        assert func(ops) == orig_func(ops)
+
+
+def test_fallthrough_flag_reset_not_lowered():
+    source = "\n".join(
+        ["if F or V == %i:\n    F = True\n    x()" % i for i in range(9)] +
+        ["if F or V == 9:\n    F = True\n    F = False"])
+    module_ast = ast.parse(source)
+    lowering = SwitchLowering(FakeInterpreter())
+    assert lowering.lower_fallthrough_run(module_ast.body) is None
+    assert lowering.lower_fallthrough_run(module_ast.body[:-1]) is not None
+
+
+CSwitchSource = """
+int classify(int x) {
+    int r = 0;
+    switch (x) {
+    case 0: r += 1;
+    case 1: r += 10; break;
+    case 2:
+    case 3: r += 100;
+    case 4: r += 1000; break;
+    case 5: return -5;
+    case 7: r += 7;
+    case 8: r += 8; break;
+    case 9: r += 9;
+    case 100: r += 100;
+    default: r += 5;
+    }
+    return r;
+}
+"""
+
+
+def test_real_switch_translation(tmp_path):
+    cparser = pytest.importorskip("cparser")
+    import cparser.interpreter
+    import switch_dispatch
+    src = tmp_path / "switch.c"
+    src.write_text(CSwitchSource)
+    state = cparser.State()
+    state.autoSetupSystemMacros()
+    cparser.parse(str(src), state)
+    assert not state._errors
+    plain = cparser.interpreter.Interpreter()
+    plain.register(state)
+    lowered = cparser.interpreter.Interpreter()
+    lowered.register(state)
+    lowering = switch_dispatch.install(lowered)
+    for x in list(range(-2, 12)) + [99, 100, 101]:
+        assert lowered.runFunc("classify", x).value == plain.runFunc("classify", x).value, x
+    assert sum(num for (func_name, num) in lowering.num_lowered_by_func.items() if "classify" in func_name) == 1
@@ -0,0 +1,220 @@
+"""
+Tests for translate_cache, the on-disk cache of the compiled code per C function.
+"""
+
+import ctypes
+import os
+import pickle
+
+from translate_cache import TranslationCache
+
+
+class FakeCFunc:
+
+    def __init__(self, name, def_pos, source, arg_types=(), res_type=ctypes.c_int):
+        self.name = name
+        self.defPos = def_pos
+        self.source = source  # the translation of the fake interpreter
+        self.args = list(arg_types)
+        self.type = res_type
+
+
+class FakeState:
+
+    def __init__(self, funcs, input_files, parse_units, unit_entry_digests):
+        self.funcs = {func.name: func for func in funcs}
+        self.input_files = {fn: None for fn in input_files}
+        self.parse_units = parse_units
+        self.parsed_units = len(parse_units)
+        self.unit_entry_digests = unit_entry_digests
+
+
+class FakeInterpreter:
+    """Translates like cparser.interpreter.Interpreter._translateFuncToPy, from the source of the FakeCFunc."""
+
+    def __init__(self, state):
+        self.state = state
+        self.globalsDict = {"ctypes": ctypes, "values": None}
+        self.translated = []
+
+    def getCType(self, t):
+        return t
+
+    def _translateFuncToPy(self, funcname):
+        self.translated.append(funcname)
+        cfunc = self.state.funcs[funcname]
+        namespace = {}
+        exec(compile(cfunc.source, "<PyCParser_%s>" % funcname, "exec"), self.globalsDict, namespace)
+        func = namespace[funcname]
+        func.C_cFunc = cfunc
+        func.C_pyAst = "ast"
+        func.C_interpreter = self
+        func.C_argTypes = [self.getCType(a) for a in cfunc.args]
+        func.C_resType = self.getCType(cfunc.type)
+        return func
+
+
+def _write(fn, text):
+    with open(fn, "w") as f:
+        f.write(text)
+
+
+def _setup(tmp_path):
+    header_fn, c_fn, other_c_fn = [str(tmp_path / name) for name in ["foo.h", "foo.c", "bar.c"]]
+    _write(header_fn, "int add(int a, int b);\n")
+    _write(c_fn, "int add(int a, int b) { return a + b; }\n")
+    _write(other_c_fn, "int seven(void) { return 7; }\n")
+    funcs = [
+        FakeCFunc(
+            "add", c_fn + ":1:1", "def add(a, b):\n    return ctypes.c_int(a.value + b.value)\n",
+            arg_types=[ctypes.c_int, ctypes.c_int]),
+        FakeCFunc("seven", other_c_fn + ":1:1", "def seven():\n    return ctypes.c_int(7)\n"),
+        FakeCFunc("get_value", other_c_fn + ":2:1", "def get_value():\n    return values.x\n")]
+    parse_units = [("foo.c", [("numfree", "numfree__foo")]), ("bar.c", [])]
+    state = FakeState(
+        funcs, [header_fn, c_fn, other_c_fn], parse_units, {c_fn: "entry-foo", other_c_fn: "entry-bar"})
+    return state, str(tmp_path / "cache.pickle")
+
+
+def _new_interpreter(state, cache_fn, variant=""):
+    interpreter = FakeInterpreter(state)
+    cache = TranslationCache(state, filename=cache_fn, variant=variant, recipe="test-recipe")
+    cache.install(interpreter)
+    return interpreter, cache
+
+
+def test_hit_skips_the_translation(tmp_path):
+    state, cache_fn = _setup(tmp_path)
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    assert interpreter._translateFuncToPy("add")(ctypes.c_int(1), ctypes.c_int(2)).value == 3
+    assert (cache.hits, cache.misses) == (0, 1)
+    cache.save()
+    assert os.path.exists(cache_fn)
+
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    func = interpreter._translateFuncToPy("add")
+    assert interpreter.translated == []
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert func(ctypes.c_int(3), ctypes.c_int(4)).value == 7
+    assert func.__name__ == "add"
+    assert func.__globals__ is interpreter.globalsDict
+    assert func.C_cFunc is state.funcs["add"]
+    assert func.C_interpreter is interpreter
+    assert func.C_argTypes == [ctypes.c_int, ctypes.c_int]
+    assert func.C_resType is ctypes.c_int
+    assert func.C_pyAst is None
+
+
+def test_miss_on_other_function_and_variant(tmp_path):
+    state, cache_fn = _setup(tmp_path)
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("add")
+    cache.save()
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    assert interpreter._translateFuncToPy("seven")().value == 7
+    assert (cache.hits, cache.misses) == (0, 1)
+    interpreter, cache = _new_interpreter(state, cache_fn, variant="constfold")
+    interpreter._translateFuncToPy("add")
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_invalidation(tmp_path):
+    state, cache_fn = _setup(tmp_path)
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("add")
+    interpreter._translateFuncToPy("seven")
+    cache.save()
+
+    # The C file of a function changed: only its functions are translated again.
+    _write(str(tmp_path / "foo.c"), "int add(int a, int b) { return b + a; }\n")
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("add")
+    interpreter._translateFuncToPy("seven")
+    assert interpreter.translated == ["add"]
+    cache.save()
+
+    # A header changed: all of them.
+    _write(str(tmp_path / "foo.h"), "long add(long a, long b);\n")
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("add")
+    interpreter._translateFuncToPy("seven")
+    assert interpreter.translated == ["add", "seven"]
+
+
+def test_miss_on_changed_unit_macros(tmp_path):
+    state, cache_fn = _setup(tmp_path)
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("add")
+    interpreter._translateFuncToPy("seven")
+    cache.save()
+
+    # The macro state when foo.c is entered changed, e.g. a macro leaked by an earlier unit.
+    state.unit_entry_digests[str(tmp_path / "foo.c")] = "entry-foo-2"
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("add")
+    interpreter._translateFuncToPy("seven")
+    assert interpreter.translated == ["add"]
+    cache.save()
+
+    # The macro hacks of a unit changed.
+    state.parse_units[0] = ("foo.c", [("numfree", "numfree__foo2")])
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("add")
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_uncacheable(tmp_path):
+    state, cache_fn = _setup(tmp_path)
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("get_value")  # refers to the wrapped values
+    assert cache.uncacheable == 1
+    state.funcs["seven"].defPos = None
+    interpreter._translateFuncToPy("seven")
+    assert cache.uncacheable == 1  # no key at all
+    assert cache.entries == {}
+    cache.save()
+    assert not os.path.exists(cache_fn)
+
+
+def test_save_merges_with_other_processes(tmp_path):
+    state, cache_fn = _setup(tmp_path)
+    # Both load the empty cache, like two concurrent runs.
+    interpreter1, cache1 = _new_interpreter(state, cache_fn)
+    interpreter2, cache2 = _new_interpreter(state, cache_fn)
+    interpreter1._translateFuncToPy("add")
+    interpreter2._translateFuncToPy("seven")
+    cache1.save()
+    cache2.save()
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("add")
+    interpreter._translateFuncToPy("seven")
+    assert interpreter.translated == []
+    assert (cache.hits, cache.misses) == (2, 0)
+
+
+def _read_cache_file(cache_fn):
+    with open(cache_fn, "rb") as f:
+        return pickle.load(f)[1]
+
+
+def test_save_drops_outdated_entries(tmp_path):
+    state, cache_fn = _setup(tmp_path)
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("add")
+    interpreter._translateFuncToPy("seven")
+    cache.save()
+    assert len(_read_cache_file(cache_fn)) == 2
+
+    # The C file of add changed: its old entry goes away.
+    _write(str(tmp_path / "foo.c"), "int add(int a, int b) { return b + a; }\n")
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("add")
+    cache.save()
+    assert len(_read_cache_file(cache_fn)) == 2
+
+    # A header changed: all the old entries go away.
+    _write(str(tmp_path / "foo.h"), "long add(long a, long b);\n")
+    interpreter, cache = _new_interpreter(state, cache_fn)
+    interpreter._translateFuncToPy("seven")
+    cache.save()
+    assert [entry[3] for entry in _read_cache_file(cache_fn).values()] == [str(tmp_path / "bar.c")]
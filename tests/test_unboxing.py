@@ -0,0 +1,226 @@
+import ast
+import ctypes
+import re
+
+import pytest
+
+from unboxing import UnboxingPass, box, get_int_width, make_unbox_as, unbox, wrap_int
+
+
+@pytest.mark.parametrize("ctype", [
+    ctypes.c_byte, ctypes.c_ubyte, ctypes.c_short, ctypes.c_ushort, ctypes.c_int, ctypes.c_uint,
+    ctypes.c_long, ctypes.c_ulong, ctypes.c_longlong, ctypes.c_ulonglong])
+def test_wrap_int_like_ctypes(ctype):
+    bits, signed = get_int_width(ctype)
+    for value in [0, 1, -1, 127, 128, 255, 256, 2 ** 31, -2 ** 31 - 1, 2 ** 63 + 5, -2 ** 64 - 3]:
+        assert wrap_int(value, bits, signed) == ctype(value).value
+
+
+def test_get_int_width_non_int():
+    for ctype in [ctypes.c_double, ctypes.c_float, ctypes.c_bool, ctypes.c_char, ctypes.c_void_p]:
+        assert get_int_width(ctype) is None
+
+
+def test_box_unbox():
+    assert unbox(ctypes.c_int(-5)) == -5
+    assert unbox(3) == 3
+    boxed = box(7, ctypes.c_ushort)
+    assert isinstance(boxed, ctypes.c_ushort) and boxed.value == 7
+
+
+class FakeHelpers:
+    """The helpers of the translated code, with the semantics of cparser.interpreter.Helpers."""
+
+    @staticmethod
+    def assign(a, b):
+        a.value = b.value if isinstance(b, ctypes._SimpleCData) else b
+        return a
+
+    @staticmethod
+    def postInc(a):
+        old = type(a)(a.value)
+        a.value += 1
+        return old
+
+    @staticmethod
+    def prefixInc(a):
+        a.value += 1
+        return a
+
+    @staticmethod
+    def postDec(a):
+        old = type(a)(a.value)
+        a.value -= 1
+        return old
+
+    @staticmethod
+    def prefixDec(a):
+        a.value -= 1
+        return a
+
+    @staticmethod
+    def clear(a):
+        a.value = 0
+
+    unbox_as = staticmethod(make_unbox_as(assign.__func__))
+
+
+class FakeInterpreter:
+    helpers = FakeHelpers
+    globalsDict = {"ctypes": ctypes, "ctypes_wrapped": ctypes}
+
+
+# Like the translated code of cparser.interpreter.
+Source = """
+def f(n, seed):
+    i = ctypes_wrapped.c_int(0)
+    h = ctypes_wrapped.c_uint(seed.value)
+    b = ctypes_wrapped.c_byte(100)
+    k = ctypes_wrapped.c_long()
+    d = ctypes_wrapped.c_double(0)
+    p = ctypes_wrapped.c_int(1)
+    q = ctypes_wrapped.c_int(2)
+    r = ctypes_wrapped.c_double(3)
+    log = []
+    while i.value < n.value:
+        helpers.assign(h, ctypes_wrapped.c_uint((h.value ^ i.value) * 1000003))
+        helpers.postInc(b)
+        k.value = k.value - 7 * i.value
+        k.value += i.value
+        helpers.assign(d, ctypes_wrapped.c_double(d.value + 0.5))
+        ctypes.pointer(p).contents.value += 1
+        helpers.clear(q)
+        log.append(use(i, r))
+        helpers.prefixInc(i)
+    helpers.assign(r, d)
+    g = lambda: r.value
+    return collect(h, b, k, d, p, q, r, g()) + log
+
+
+def collect(*args):
+    return list(args)
+
+
+def use(x, y):
+    return x.value + y.value
+"""
+
+
+def _compile(module_ast):
+    ns = dict(FakeInterpreter.globalsDict, helpers=FakeHelpers)
+    exec(compile(ast.fix_missing_locations(module_ast), "<test>", "exec"), ns)
+    return ns["f"]
+
+
+def _values(res):
+    return [(type(v), v.value) if isinstance(v, ctypes._SimpleCData) else v for v in res]
+
+
+def test_unboxing_same_behavior():
+    module_ast = ast.parse(Source)
+    unboxing = UnboxingPass(FakeInterpreter())
+    assert unboxing.transform_func(module_ast.body[0]) == ["b", "d", "h", "i", "k"]
+    assert unboxing.num_unboxed_by_func == {"f": 5}
+    source = ast.unparse(module_ast.body[0])
+    for name in ["i", "h", "b", "k", "d"]:
+        assert not re.search(r"\b%s\.value" % name, source)
+    for name in ["p", "q", "r"]:  # address taken, modified by a helper, used in a lambda
+        assert "%s = ctypes_wrapped.c_" % name in source
+    orig_func = _compile(ast.parse(Source))
+    func = _compile(module_ast)
+    for n, seed in [(0, 0), (1, 5), (200, 2 ** 32 - 1), (1000, 12345)]:
+        expected = _values(orig_func(ctypes.c_int(n), ctypes.c_uint(seed)))
+        assert _values(func(ctypes.c_int(n), ctypes.c_uint(seed))) == expected
+
+
+def test_mask_wraps_like_ctypes():
+    unboxing = UnboxingPass(FakeInterpreter())
+    for ctype in [ctypes.c_byte, ctypes.c_ubyte, ctypes.c_short, ctypes.c_int, ctypes.c_uint, ctypes.c_longlong]:
+        source = "def f(v):\n    x = ctypes_wrapped.%s()\n    x.value = v\n    return x\n" % ctype.__name__
+        module_ast = ast.parse(source)
+        assert unboxing.transform_func(module_ast.body[0]) == ["x"]
+        func = _compile(module_ast)
+        for value in [0, 1, -1, 127, 128, 255, 256, 2 ** 31, -2 ** 31 - 1, 2 ** 63 + 5, -2 ** 64 - 3]:
+            res = func(value)
+            assert type(res) is ctype and res.value == ctype(value).value
+
+
+def test_not_unboxed():
+    unboxing = UnboxingPass(FakeInterpreter())
+    for source in [
+            "def f(x):\n    x.value = 1\n    return x",  # args stay boxed
+            "def f():\n    x = ctypes_wrapped.c_float(1)\n    return x",  # less precision than a Python float
+            "def f():\n    x = ctypes_wrapped.c_char(1)\n    return x",
+            "def f():\n    x = ctypes_wrapped.c_int(1)\n    y = helpers.assign(x, 2)\n    return y",
+            "def f():\n    x = ctypes_wrapped.c_int(1)\n    x = ctypes_wrapped.c_long(1)\n    return x",
+            "def f():\n    x = ctypes_wrapped.c_int(1)\n    return ctypes.byref(x)",
+            "def f():\n    x = ctypes_wrapped.c_int(1)\n    for x in []: pass\n    return x",
+            "def f():\n    x = make()\n    return x.value"]:
+        module_ast = ast.parse(source)
+        dump = ast.dump(module_ast)
+        assert unboxing.transform_func(module_ast.body[0]) == [], source
+        assert ast.dump(module_ast) == dump
+    assert unboxing.num_unboxed == 0
+
+
+def test_unbox_as():
+    unbox_as = FakeHelpers.unbox_as
+    assert unbox_as(ctypes.c_long(-3), ctypes.c_int) == -3
+    assert unbox_as(7, ctypes.c_double) == 7.0 and type(unbox_as(7, ctypes.c_double)) is float
+    assert unbox_as(ctypes.c_double(2.75), ctypes.c_double) == 2.75
+    assigned = []
+
+    def assign(a, b):
+        assigned.append(b)
+        a.value = int(b.value)
+
+    unbox_as = make_unbox_as(assign)
+    value = ctypes.c_double(-2.75)
+    assert unbox_as(value, ctypes.c_int) == -2
+    assert assigned == [value]
+
+
+# For the test with the real translation: address-taken locals, locals passed
+# to calls and returned, and wrap-around of narrow types.
+CSource = """
+static int add(int a, int b) { return a + b; }
+static void bump(int *p) { *p += 3; }
+static unsigned char same(unsigned char c) { return c; }
+
+int mix(int n) {
+    int i, acc = 0;
+    int taken = 1;
+    unsigned char small = 250;
+    double d = 0.5;
+    for (i = 0; i < n; i++) {
+        acc = add(acc, i * 7);
+        bump(&taken);
+        small++;
+        d = d * 1.5;
+    }
+    if (n < 0) return acc;
+    return acc + taken + same(small) + (int) d;
+}
+"""
+
+
+def test_real_translation_same_results(tmp_path):
+    cparser = pytest.importorskip("cparser")
+    import cparser.interpreter
+    import unboxing
+    src = tmp_path / "mix.c"
+    src.write_text(CSource)
+    state = cparser.State()
+    state.autoSetupSystemMacros()
+    cparser.parse(str(src), state)
+    assert not state._errors
+    plain = cparser.interpreter.Interpreter()
+    plain.register(state)
+    unboxed = cparser.interpreter.Interpreter()
+    unboxed.register(state)
+    unboxing_pass = unboxing.install(unboxed)
+    for n in [-1, 0, 1, 5, 20]:
+        assert unboxed.runFunc("mix", n).value == plain.runFunc("mix", n).value, n
+    # At most i, acc, small and d. Not taken, as its address goes to bump().
+    num_unboxed = sum(num for (func_name, num) in unboxing_pass.num_unboxed_by_func.items() if "mix" in func_name)
+    assert 0 < num_unboxed <= 4
@@ -0,0 +1,297 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+On-disk cache of the compiled Python code per C function.
+
+The interpreter translates every C function to a Python AST on first use,
+compiles it and binds it to its globals (Interpreter._translateFuncToPy).
+We keep the marshalled code object on disk, so that a hit skips both the
+translation and the compile(), and only binds the code to the globals again.
+
+The parsed state is determined by its recipe (cparser sources, host
+platform, see parse_cache), its parse units and its input files. A function
+also depends on the preprocessor state in which its C file was parsed, i.e.
+the macros which the units before it leave behind. So the key of a function is
+
+* the recipe, the parse units (incl. the macro hacks) and the content of all
+  headers, computed once,
+* the content of the C file which defines the function, and the entry digest
+  of its unit (see parse_incremental.entry_digest, recorded while parsing in
+  state.unit_entry_digests), computed once per file,
+* the function name and the variant (translation options which change the result, e.g. "constfold").
+
+Every entry also keeps the headers digest and the digest of its C file, so
+that save() can drop the entries which cannot hit anymore. save() merges
+with the entries which other processes have saved in the meantime.
+
+Only plain functions are cached: their globals are the ones of the
+interpreter, they have no closure and no defaults, and we know how to
+restore all their attributes (FuncAttribs). Translations which register
+new wrapped values (they refer to "values.<name>") are not cached, because
+replaying them would miss that side effect.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import marshal
+import os
+import pickle
+import types
+
+import parse_cache
+
+# Increase this when the layout of the cache file changes.
+# 2: marshalled code objects instead of pickled ASTs.
+# 3: the headers digest, C file and its digest in every entry.
+TranslateCacheFormatVersion = 3
+
+# The attributes of a translated function which we can restore on a cache hit.
+FuncAttribs = {"C_cFunc", "C_pyAst", "C_interpreter", "C_argTypes", "C_resType"}
+
+
+def get_code_names(code):
+    """
+    :param types.CodeType code:
+    :return: all names which the code (incl. nested code) refers to
+    :rtype: set[str]
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(get_code_names(const))
+    return names
+
+
+def _refers_to_wrapped_values(code):
+    """
+    :param types.CodeType code:
+    :rtype: bool
+    """
+    return "values" in get_code_names(code)
+
+
+class TranslationCache:
+
+    def __init__(self, state, filename=None, variant="", recipe=None):
+        """
+        :param cparser.State state:
+        :param str|None filename: by default in parse_cache.CacheDir, depending on the recipe of the state
+        :param str variant: part of the keys. for translation options which change the result, e.g. "constfold"
+        :param str|None recipe: by default parse_cache.recipe_digest(type(state))
+        """
+        self.state = state
+        self.variant = variant
+        if recipe is None:
+            recipe = parse_cache.recipe_digest(type(state))
+        self.recipe = recipe
+        if filename is None:
+            filename = "%s/translated-%s.pickle" % (parse_cache.CacheDir, recipe[:16])
+        self.filename = filename
+        # key -> marshalled code, func attribs, headers digest, C file, C file digest
+        self.entries = {}  # type: dict[str,(bytes,list[str],str,str,str)]
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self._dirty = False
+        self._headers_digest = None  # type: str|None
+        self._file_digests = {}  # type: dict[str,str|None]
+        self._all_entries_digest = None  # type: str|None
+
+    def _read_entries(self):
+        """
+        :return: the entries in the cache file, or {} if there is none in our format
+        :rtype: dict[str,(bytes,list[str],str,str,str)]
+        """
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename, "rb") as f:
+                version, entries = pickle.load(f)
+        except Exception as exc:
+            print("Translate cache: cannot load %s: %s: %s" % (self.filename, type(exc).__name__, exc))
+            return {}
+        if version != TranslateCacheFormatVersion:
+            return {}
+        return entries
+
+    def load(self):
+        self.entries.update(self._read_entries())
+
+    def _is_current(self, entry):
+        """
+        :param (bytes,list[str],str,str,str) entry:
+        :return: whether the entry can still hit, i.e. the headers and its C file are unchanged
+        :rtype: bool
+        """
+        _, _, headers_digest, source_fn, source_digest = entry
+        return headers_digest == self._get_headers_digest() and self._get_file_digest(source_fn) == source_digest
+
+    def save(self):
+        """
+        Writes our entries, merged with the ones which other processes saved since our load().
+        Outdated entries are dropped.
+        """
+        if not self._dirty:
+            return
+        if not os.path.exists(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        entries = self._read_entries()
+        entries.update(self.entries)
+        entries = {key: entry for (key, entry) in entries.items() if self._is_current(entry)}
+        tmp_fn = "%s.%i.tmp" % (self.filename, os.getpid())
+        try:
+            with open(tmp_fn, "wb") as f:
+                pickle.dump((TranslateCacheFormatVersion, entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as exc:
+            print("Translate cache: cannot save %s: %s: %s" % (self.filename, type(exc).__name__, exc))
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+            return
+        os.rename(tmp_fn, self.filename)
+        self.entries = entries
+        self._dirty = False
+
+    def _get_file_digest(self, filename):
+        if filename not in self._file_digests:
+            self._file_digests[filename] = parse_cache.file_digest(filename)
+        return self._file_digests[filename]
+
+    def _get_headers_digest(self):
+        """
+        :return: digest over the recipe, the parse units and all input files besides the C files
+        :rtype: str
+        """
+        if self._headers_digest is None:
+            h = hashlib.sha1(("%s %r\n" % (self.recipe, getattr(self.state, "parsed_units", None))).encode("utf8"))
+            h.update(("units %r\n" % (getattr(self.state, "parse_units", None),)).encode("utf8"))
+            for fn in sorted(self.state.input_files):
+                if not fn.endswith(".c"):
+                    h.update(("%s %s\n" % (fn, self._get_file_digest(fn))).encode("utf8"))
+            self._headers_digest = h.hexdigest()
+        return self._headers_digest
+
+    def _get_unit_entry_digest(self, source_fn):
+        """
+        :param str source_fn: the file which defines the function
+        :return: parse_incremental.entry_digest() of the unit of this C file.
+          for functions from headers, a digest over the entries of all units
+        :rtype: str
+        """
+        entry_digests = getattr(self.state, "unit_entry_digests", {})
+        if source_fn in entry_digests:
+            return entry_digests[source_fn]
+        if self._all_entries_digest is None:
+            h = hashlib.sha1()
+            for fn, digest in sorted(entry_digests.items()):
+                h.update(("%s %s\n" % (fn, digest)).encode("utf8"))
+            self._all_entries_digest = h.hexdigest()
+        return self._all_entries_digest
+
+    @staticmethod
+    def _get_source_filename(func):
+        """
+        :param cparser.CFunc func:
+        :return: the file which defines the function, or None if we don't know
+        :rtype: str|None
+        """
+        def_pos = getattr(func, "defPos", None)
+        if not def_pos or not getattr(func, "name", None):
+            return None
+        return str(def_pos).split(":")[0]
+
+    def get_key(self, func):
+        """
+        :param cparser.CFunc func:
+        :return: key for its translation, or None if we cannot compute one
+        :rtype: str|None
+        """
+        source_fn = self._get_source_filename(func)
+        if source_fn is None:
+            return None
+        source_digest = self._get_file_digest(source_fn)
+        if source_digest is None:
+            return None
+        h = hashlib.sha1(("%s %s %s %s %s\n" % (
+            self._get_headers_digest(), source_digest, self._get_unit_entry_digest(source_fn),
+            self.variant, func.name)).encode("utf8"))
+        return h.hexdigest()
+
+    @staticmethod
+    def _get_func_attribs(interpreter, cfunc):
+        """
+        :param cparser.interpreter.Interpreter interpreter:
+        :param cparser.CFunc cfunc:
+        :return: the attributes of the translated function, like the interpreter sets them
+        :rtype: dict[str]
+        """
+        return {
+            "C_cFunc": cfunc,
+            "C_pyAst": None,  # not kept
+            "C_interpreter": interpreter,
+            "C_argTypes": [interpreter.getCType(arg) for arg in cfunc.args],
+            "C_resType": interpreter.getCType(cfunc.type)}
+
+    def _is_cacheable(self, interpreter, cfunc, func):
+        """
+        :param cparser.interpreter.Interpreter interpreter:
+        :param cparser.CFunc cfunc:
+        :param types.FunctionType func: the translation
+        :rtype: bool
+        """
+        if not isinstance(func, types.FunctionType):
+            return False
+        if func.__globals__ is not interpreter.globalsDict or func.__closure__ or func.__defaults__ \
+                or func.__kwdefaults__:
+            return False
+        if not set(vars(func)) <= FuncAttribs or _refers_to_wrapped_values(func.__code__):
+            return False
+        # Check that we restore the same attributes.
+        attribs = self._get_func_attribs(interpreter, cfunc)
+        for key, value in vars(func).items():
+            if key == "C_pyAst":
+                continue
+            if key in ("C_cFunc", "C_interpreter"):
+                if value is not attribs[key]:
+                    return False
+            elif value != attribs[key]:
+                return False
+        return True
+
+    def install(self, interpreter):
+        """
+        Loads the cache and wraps the translation of the interpreter.
+        Call this after interpreter.register(state), and after all hooks which change the translation.
+
+        :param cparser.interpreter.Interpreter interpreter:
+        """
+        self.load()
+        orig_translate = interpreter._translateFuncToPy
+
+        def _translateFuncToPy(funcname):
+            cfunc = self.state.funcs.get(funcname)
+            key = self.get_key(cfunc) if cfunc is not None else None
+            entry = self.entries.get(key) if key is not None else None
+            if entry is not None:
+                self.hits += 1
+                code_data, attrib_names = entry[:2]
+                func = types.FunctionType(marshal.loads(code_data), interpreter.globalsDict, funcname)
+                attribs = self._get_func_attribs(interpreter, cfunc)
+                for name in attrib_names:
+                    setattr(func, name, attribs[name])
+                return func
+            self.misses += 1
+            func = orig_translate(funcname)
+            if key is not None:
+                if self._is_cacheable(interpreter, cfunc, func):
+                    source_fn = self._get_source_filename(cfunc)
+                    self.entries[key] = (
+                        marshal.dumps(func.__code__), sorted(vars(func)),
+                        self._get_headers_digest(), source_fn, self._get_file_digest(source_fn))
+                    self._dirty = True
+                else:
+                    self.uncacheable += 1
+            return func
+
+        interpreter._translateFuncToPy = _translateFuncToPy
@@ -0,0 +1,456 @@
+# PyCPython - interpret CPython in Python
+# code under BSD 2-Clause License
+
+"""
+Unboxed locals: scalar C locals as plain Python ints/floats.
+
+The translated code models every C local as a ctypes object, so every i++
+or comparison creates new wrapper objects, e.g. for "int i = 0; i++;"::
+
+    i = ctypes_wrapped.c_int(0)
+    helpers.postInc(i)
+    if i.value < n.value: ...
+
+A scalar local (integer type or double) whose address is never taken
+cannot be observed through memory. After the translation of a function,
+we rewrite such locals to plain Python values::
+
+    i = 0
+    i = ((i + 1) + 2147483648 & 4294967295) - 2147483648
+    if i < n.value: ...
+
+Every assignment masks the value to the C width inline (like wrap_int()).
+Where the translated code needs the ctypes object, i.e. as a call argument
+or as the return value, we box it again: ctypes_wrapped.c_int(i).
+
+We only rewrite a local when we understand all its uses: initialized by
+the construction of its type, read via .value, assigned via .value = e or
+helpers.assign(x, e), helpers.postInc() etc. as statements, and passed to
+calls or returned. Any other use, e.g. ctypes.pointer(x) for &x, passing
+it as the first argument of another helper (which might modify it), or
+a use in a nested function, keeps the local as it is.
+"""
+
+from __future__ import print_function
+
+import ast
+import copy
+import ctypes
+
+import constfold
+
+_FloatCtypes = (ctypes.c_float, ctypes.c_double, ctypes.c_longdouble)
+
+# helpers.<name>(x) as a statement -> the value which is added to x.
+IncHelpers = {"postInc": 1, "prefixInc": 1, "postDec": -1, "prefixDec": -1}
+
+# Calls which take the address of their argument, or reinterpret it.
+AddressFuncNames = {"pointer", "byref", "addressof", "cast"}
+
+
+def get_int_width(ctype):
+    """
+    :param type ctype: ctypes type of a scalar local
+    :return: (bits, signed) for integer types, None otherwise (floats, bool, char)
+    :rtype: (int,bool)|None
+    """
+    if not issubclass(ctype, ctypes._SimpleCData) or issubclass(ctype, _FloatCtypes + (ctypes.c_bool,)):
+        return None
+    if type(ctype(0).value) is not int:
+        return None  # c_char, pointers
+    return ctypes.sizeof(ctype) * 8, ctype(-1).value == -1
+
+
+def is_unboxable_type(ctype):
+    """
+    :param object ctype:
+    :return: whether a local of this type can be a plain Python value.
+      Not c_float, because a Python float has more precision
+    :rtype: bool
+    """
+    if not isinstance(ctype, type):
+        return False
+    if issubclass(ctype, ctypes.c_double):
+        return True
+    return get_int_width(ctype) is not None
+
+
+def wrap_int(value, bits, signed):
+    """
+    Wrap-around like the C assignment to an integer of this width.
+
+    :param int value:
+    :param int bits:
+    :param bool signed:
+    :rtype: int
+    """
+    value &= (1 << bits) - 1
+    if signed and value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
+
+def unbox(value):
+    """
+    :param ctypes._SimpleCData|int|float value:
+    :return: plain Python value
+    :rtype: int|float
+    """
+    if isinstance(value, ctypes._SimpleCData):
+        return value.value
+    return value
+
+
+def box(value, ctype):
+    """
+    :param int|float value: unboxed local
+    :param type ctype: its ctypes type
+    :return: the ctypes object, for calls and stores
+    :rtype: ctypes._SimpleCData
+    """
+    return ctype(value)
+
+
+def make_unbox_as(assign):
+    """
+    :param (ctypes._CData,object)->object assign: helpers.assign of the interpreter
+    :return: function (value, ctype) -> the plain value which a local of this type gets by the assignment
+    :rtype: (object,type)->int|float
+    """
+    def unbox_as(value, ctype):
+        plain = value.value if isinstance(value, ctypes._SimpleCData) else value
+        if type(plain) is int or type(plain) is bool:
+            return float(plain) if issubclass(ctype, ctypes.c_double) else plain
+        if type(plain) is float and issubclass(ctype, ctypes.c_double):
+            return plain
+        # E.g. a double to an int, or a pointer. Like the boxed local.
+        boxed = ctype()
+        assign(boxed, value)
+        return boxed.value
+
+    return unbox_as
+
+
+def _helpers_attr(name):
+    return ast.Attribute(value=ast.Name(id="helpers", ctx=ast.Load()), attr=name, ctx=ast.Load())
+
+
+def _get_helper_name(func):
+    """
+    :param ast.expr func: of a call
+    :return: for helpers.<name>, the name, otherwise None
+    :rtype: str|None
+    """
+    if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == "helpers":
+        return func.attr
+    return None
+
+
+def _is_address_func(func):
+    name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+    return name in AddressFuncNames
+
+
+class _Local:
+
+    def __init__(self, name):
+        self.name = name
+        self.ctor = None  # type: ast.expr|None  # e.g. ctypes_wrapped.c_int
+        self.ctype = None  # type: type|None
+        self.ok = True
+
+
+class UnboxingPass:
+
+    def __init__(self, interpreter):
+        """
+        :param cparser.interpreter.Interpreter interpreter: to evaluate the type constructors
+        """
+        self.folder = constfold.ConstFolder(interpreter)
+        self.num_unboxed = 0
+        self.num_unboxed_by_func = {}  # type: dict[str,int]  # translated function name -> unboxed locals
+        self._ctor_types = {}  # type: dict[str,type|None]  # ast.dump(ctor) -> ctype
+
+    def _get_ctor_type(self, ctor):
+        """
+        :param ast.expr ctor:
+        :return: the ctypes type, if it is one of a local which we can unbox
+        :rtype: type|None
+        """
+        key = ast.dump(ctor)
+        if key not in self._ctor_types:
+            ctype = None
+            if constfold.is_const_expr(ctor):
+                try:
+                    ctype = self.folder.evaluate(ctor)
+                except Exception:
+                    ctype = None
+            self._ctor_types[key] = ctype if is_unboxable_type(ctype) else None
+        return self._ctor_types[key]
+
+    # Analysis.
+
+    def _check_init(self, local, assign):
+        """
+        :param _Local local:
+        :param ast.Assign assign: local = <value>
+        """
+        value = assign.value
+        if len(assign.targets) != 1 or not isinstance(value, ast.Call) or value.keywords or len(value.args) > 1:
+            local.ok = False
+            return
+        ctype = self._get_ctor_type(value.func)
+        if ctype is None or (local.ctype is not None and ctype is not local.ctype):
+            local.ok = False
+            return
+        local.ctor, local.ctype = value.func, ctype
+
+    def _check_use(self, local, node, parents):
+        """
+        :param _Local local:
+        :param ast.Name node: a use of the local
+        :param list[ast.AST] parents: from the function down to the parent of node
+        """
+        parent = parents[-1]
+        if isinstance(node.ctx, ast.Store):
+            if isinstance(parent, ast.Assign) and parent.targets == [node]:
+                self._check_init(local, parent)
+            else:
+                local.ok = False
+            return
+        if not isinstance(node.ctx, ast.Load):
+            local.ok = False
+            return
+        if isinstance(parent, ast.Attribute):
+            if parent.attr != "value":
+                local.ok = False
+            elif isinstance(parent.ctx, ast.Store):
+                grandparent = parents[-2]
+                if not (isinstance(grandparent, ast.Assign) and grandparent.targets == [parent]) \
+                        and not isinstance(grandparent, ast.AugAssign):
+                    local.ok = False
+            elif not isinstance(parent.ctx, ast.Load):
+                local.ok = False
+            return
+        if isinstance(parent, ast.Return):
+            return  # boxed
+        if isinstance(parent, ast.Call) and node in parent.args:
+            helper_name = _get_helper_name(parent.func)
+            if _is_address_func(parent.func):
+                local.ok = False
+            elif helper_name is not None and parent.args[0] is node:
+                # Only the statements which we rewrite. Other helpers might modify their first argument.
+                if not isinstance(parents[-2], ast.Expr) or parent.keywords:
+                    local.ok = False
+                elif helper_name == "assign":
+                    local.ok = local.ok and len(parent.args) == 2
+                elif helper_name in IncHelpers:
+                    local.ok = local.ok and len(parent.args) == 1
+                else:
+                    local.ok = False
+            return  # otherwise boxed
+        local.ok = False
+
+    def find_unboxable(self, func_ast):
+        """
+        :param ast.FunctionDef func_ast: translated function
+        :return: name -> local, for the locals which we can unbox
+        :rtype: dict[str,_Local]
+        """
+        locals_ = {}  # type: dict[str,_Local]
+        excluded = {arg.arg for arg in func_ast.args.args + func_ast.args.kwonlyargs}
+        for arg in (func_ast.args.vararg, func_ast.args.kwarg):
+            if arg is not None:
+                excluded.add(arg.arg)
+
+        def visit(node, parents, nested):
+            if isinstance(node, (ast.Global, ast.Nonlocal)):
+                excluded.update(node.names)
+            if isinstance(node, ast.Name):
+                if nested:
+                    excluded.add(node.id)
+                    return
+                local = locals_.get(node.id)
+                if local is None:
+                    local = locals_[node.id] = _Local(node.id)
+                self._check_use(local, node, parents)
+                return
+            child_nested = nested or (len(parents) > 0 and isinstance(node, (
+                ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef,
+                ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)))
+            parents.append(node)
+            for child in ast.iter_child_nodes(node):
+                visit(child, parents, child_nested)
+            parents.pop()
+
+        visit(func_ast, [], False)
+        return {
+            name: local for (name, local) in locals_.items()
+            if local.ok and local.ctype is not None and name not in excluded}
+
+    # Rewriting.
+
+    def transform_func(self, func_ast):
+        """
+        :param ast.FunctionDef func_ast: translated function, transformed in-place
+        :return: names of the unboxed locals
+        :rtype: list[str]
+        """
+        locals_ = self.find_unboxable(func_ast)
+        if not locals_:
+            return []
+        _Rewriter(locals_, self._get_ctor_type).visit(func_ast)
+        ast.fix_missing_locations(func_ast)
+        self.num_unboxed += len(locals_)
+        self.num_unboxed_by_func[func_ast.name] = len(locals_)
+        return sorted(locals_)
+
+    def install(self, interpreter):
+        """
+        :param cparser.interpreter.Interpreter interpreter:
+        """
+        interpreter.helpers.unbox_as = make_unbox_as(interpreter.helpers.assign)
+        orig_translate = interpreter._translateFuncToPyAst
+
+        def _translateFuncToPyAst(func, *args, **kwargs):
+            funcEnv = orig_translate(func, *args, **kwargs)
+            self.transform_func(funcEnv.astNode)
+            return funcEnv
+
+        interpreter._translateFuncToPyAst = _translateFuncToPyAst
+
+
+class _Rewriter(ast.NodeTransformer):
+
+    def __init__(self, locals_, get_ctor_type):
+        """
+        :param dict[str,_Local] locals_: the ones which we unbox
+        :param (ast.expr)->(type|None) get_ctor_type: UnboxingPass._get_ctor_type
+        """
+        self.locals = locals_
+        self.get_ctor_type = get_ctor_type
+
+    def _get_local(self, node):
+        """
+        :param ast.AST node:
+        :return: for a Name of an unboxed local, the local, otherwise None
+        :rtype: _Local|None
+        """
+        if isinstance(node, ast.Name):
+            return self.locals.get(node.id)
+        return None
+
+    def _get_value_local(self, node):
+        """
+        :return: for <local>.value, the local, otherwise None
+        :rtype: _Local|None
+        """
+        if isinstance(node, ast.Attribute) and node.attr == "value":
+            return self._get_local(node.value)
+        return None
+
+    @staticmethod
+    def _mask(local, expr):
+        """
+        :param _Local local:
+        :param ast.expr expr: plain Python value
+        :return: expr converted like the C assignment to the local
+        :rtype: ast.expr
+        """
+        width = get_int_width(local.ctype)
+        if width is None:
+            return ast.Call(func=ast.Name(id="float", ctx=ast.Load()), args=[expr], keywords=[])
+        bits, signed = width
+        mask = ast.Constant(value=(1 << bits) - 1)
+        if not signed:
+            return ast.BinOp(left=expr, op=ast.BitAnd(), right=mask)
+        half = ast.Constant(value=1 << (bits - 1))
+        return ast.BinOp(
+            left=ast.BinOp(left=ast.BinOp(left=expr, op=ast.Add(), right=half), op=ast.BitAnd(), right=mask),
+            op=ast.Sub(), right=copy.copy(half))
+
+    def _get_assigned_value(self, local, expr):
+        """
+        :param _Local local:
+        :param ast.expr expr: what the translated code assigns to the boxed local, already visited
+        :return: the plain value which the local gets
+        :rtype: ast.expr
+        """
+        if isinstance(expr, ast.Call) and len(expr.args) == 1 and not expr.keywords \
+                and self.get_ctor_type(expr.func) is local.ctype:
+            # A new object of our type from a Python value. The mask does the same conversion.
+            expr = expr.args[0]
+            if isinstance(expr, ast.Constant) and type(expr.value) in (int, float):
+                return ast.Constant(value=local.ctype(expr.value).value)
+            return self._mask(local, expr)
+        if isinstance(expr, ast.Constant) and type(expr.value) is int:
+            return ast.Constant(value=local.ctype(expr.value).value)
+        return self._mask(local, ast.Call(
+            func=_helpers_attr("unbox_as"), args=[expr, copy.deepcopy(local.ctor)], keywords=[]))
+
+    @staticmethod
+    def _assign(local, value, ref):
+        return ast.copy_location(
+            ast.Assign(targets=[ast.Name(id=local.name, ctx=ast.Store())], value=value), ref)
+
+    def visit_Assign(self, node):
+        if len(node.targets) == 1:
+            local = self._get_local(node.targets[0])
+            if local is not None:  # initialization by the type constructor
+                if not node.value.args:
+                    value = ast.Constant(value=local.ctype().value)
+                else:
+                    value = self._get_assigned_value(local, self.visit(node.value))
+                return self._assign(local, value, node)
+            local = self._get_value_local(node.targets[0])
+            if local is not None:
+                return self._assign(local, self._mask(local, self.visit(node.value)), node)
+        return self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        local = self._get_value_local(node.target)
+        if local is not None:
+            value = ast.BinOp(left=ast.Name(id=local.name, ctx=ast.Load()), op=node.op, right=self.visit(node.value))
+            return self._assign(local, self._mask(local, value), node)
+        return self.generic_visit(node)
+
+    def visit_Expr(self, node):
+        call = node.value
+        if isinstance(call, ast.Call) and call.args:
+            local = self._get_local(call.args[0])
+            helper_name = _get_helper_name(call.func)
+            if local is not None and helper_name == "assign":
+                return self._assign(local, self._get_assigned_value(local, self.visit(call.args[1])), node)
+            if local is not None and helper_name in IncHelpers:
+                value = ast.BinOp(
+                    left=ast.Name(id=local.name, ctx=ast.Load()), op=ast.Add(),
+                    right=ast.Constant(value=IncHelpers[helper_name]))
+                return self._assign(local, self._mask(local, value), node)
+        return self.generic_visit(node)
+
+    def visit_Attribute(self, node):
+        local = self._get_value_local(node)
+        if local is not None and isinstance(node.ctx, ast.Load):
+            return ast.copy_location(ast.Name(id=local.name, ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        local = self._get_local(node)
+        if local is not None and isinstance(node.ctx, ast.Load):
+            # Call argument or return value: box it.
+            return ast.copy_location(
+                ast.Call(func=copy.deepcopy(local.ctor), args=[node], keywords=[]), node)
+        return node
+
+
+def install(interpreter):
+    """
+    Call this after interpreter.register(state), and before the translate cache.
+
+    :param cparser.interpreter.Interpreter interpreter:
+    :return: the pass, for its statistics
+    :rtype: UnboxingPass
+    """
+    unboxing = UnboxingPass(interpreter)
+    unboxing.install(interpreter)
+    return unboxing